@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Measure compression ratio and write/read speed of compressed exposures (e.g. coaddTempExp)
+
+Each selected exposure is compressed with each combination of algorithm and quantization level;
+the results are summed over all exposures and reported for each combination, along with
+the same measurements for the uncompressed files, to help choose FitsCompressionConfig settings.
+"""
+import os
+import shutil
+import tempfile
+import time
+
+import numpy
+
+import lsst.pex.config as pexConfig
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.pipe.base as pipeBase
+from lsst.pipe.tasks.fitsCompression import FitsCompressionConfig, compressFitsFile
+
+__all__ = ["BenchmarkCompressionTask"]
+
+class BenchmarkCompressionConfig(pexConfig.Config):
+    """Config for BenchmarkCompressionTask
+    """
+    algorithmList = pexConfig.ListField(
+        doc = "compression algorithms for the image and variance planes",
+        dtype = str,
+        default = ("GZIP_1", "GZIP_2", "RICE_1", "HCOMPRESS_1"),
+    )
+    maskAlgorithm = pexConfig.Field(
+        doc = "compression algorithm for the mask plane",
+        dtype = str,
+        default = "RICE_1",
+    )
+    quantizeLevelList = pexConfig.ListField(
+        doc = "quantization levels for the image and variance planes; 0 means lossless " \
+            "(only tried with GZIP algorithms)",
+        dtype = float,
+        default = (0, 4, 16, 64),
+    )
+    tileSize = pexConfig.ListField(
+        doc = "Width, height of compression tiles (pixels)",
+        dtype = int,
+        length = 2,
+        default = (256, 256),
+    )
+    subregionSize = pexConfig.ListField(
+        doc = "Width, height of the subregion read from the center of each exposure (pixels), " \
+            "e.g. the subregionSize used by assembleCoadd",
+        dtype = int,
+        length = 2,
+        default = (2000, 2000),
+    )
+    tempDir = pexConfig.Field(
+        doc = "directory for compressed files; if None then use the system default temporary directory",
+        dtype = str,
+        optional = True,
+    )
+
+
+class CompressionResult(object):
+    """Summed measurements for one compression setting
+    """
+    def __init__(self, name):
+        self.name = name
+        self.numFiles = 0
+        self.rawBytes = 0     # bytes of uncompressed files
+        self.fileBytes = 0    # bytes of files with this setting
+        self.writeTime = 0.0
+        self.readTime = 0.0
+        self.subReadTime = 0.0
+        self.sumSqErr = 0.0   # sum of (error / sigma)^2 of the image plane
+        self.numPix = 0
+
+    def add(self, rawBytes, fileBytes, writeTime, readTime, subReadTime, errArr):
+        self.numFiles += 1
+        self.rawBytes += rawBytes
+        self.fileBytes += fileBytes
+        self.writeTime += writeTime
+        self.readTime += readTime
+        self.subReadTime += subReadTime
+        if errArr is not None:
+            self.sumSqErr += float(numpy.sum(errArr**2))
+            self.numPix += errArr.size
+
+    def report(self, log):
+        mbRaw = self.rawBytes / 1.0e6
+        log.info("%-20s ratio=%6.2f; write=%7.1f MB/s; read=%7.1f MB/s; subregion read=%7.3f s/file; " \
+            "rms error/sigma=%0.4f" % (
+                self.name,
+                self.rawBytes / float(max(1, self.fileBytes)),
+                mbRaw / self.writeTime if self.writeTime > 0 else numpy.nan,
+                mbRaw / self.readTime if self.readTime > 0 else numpy.nan,
+                self.subReadTime / max(1, self.numFiles),
+                numpy.sqrt(self.sumSqErr / self.numPix) if self.numPix > 0 else 0.0,
+        ))
+
+
+class RunDataRefListRunner(pipeBase.TaskRunner):
+    @staticmethod
+    def getTargetList(parsedCmd):
+        """Return a list of targets (arguments for __call__); one entry per invocation
+        """
+        return [parsedCmd.dataRefList] # one argument consisting of a list of dataRefs
+
+    def __call__(self, dataRefList):
+        """Run BenchmarkCompressionTask.run on a single target
+
+        @param dataRefList: list of data references
+        """
+        task = self.TaskClass(config=self.config, log=self.log)
+        result = task.run(dataRefList)
+
+        if self.doReturnResults:
+            return pipeBase.Struct(
+                dataRefList = dataRefList,
+                metadata = task.metadata,
+                result = result,
+            )
+
+
+class BenchmarkCompressionTask(pipeBase.CmdLineTask):
+    """Measure compression ratio and write/read speed of compressed exposures
+    """
+    ConfigClass = BenchmarkCompressionConfig
+    RunnerClass = RunDataRefListRunner
+    _DefaultName = "benchmarkCompression"
+
+    def makeCompressionConfigList(self):
+        """Return a list of (name, FitsCompressionConfig) for each valid setting to try
+        """
+        compressionConfigList = []
+        for algorithm in self.config.algorithmList:
+            for quantizeLevel in self.config.quantizeLevelList:
+                if quantizeLevel <= 0 and not algorithm.startswith("GZIP"):
+                    continue
+                compressionConfig = FitsCompressionConfig()
+                compressionConfig.doCompress = True
+                compressionConfig.imageAlgorithm = algorithm
+                compressionConfig.varianceAlgorithm = algorithm
+                compressionConfig.maskAlgorithm = self.config.maskAlgorithm
+                compressionConfig.quantizeLevel = quantizeLevel if quantizeLevel > 0 else None
+                compressionConfig.tileSize = self.config.tileSize
+                compressionConfig.validate()
+                name = "%s/%s" % (algorithm, "lossless" if quantizeLevel <= 0 else "q=%g" % (quantizeLevel,))
+                compressionConfigList.append((name, compressionConfig))
+        return compressionConfigList
+
+    @pipeBase.timeMethod
+    def run(self, dataRefList):
+        """Measure compression of a collection of exposures
+
+        @param dataRefList: a list of data references for exposures
+        @return: a pipeBase.Struct with fields:
+        - resultList: a list of CompressionResult, the first for the uncompressed files
+        """
+        compressionConfigList = self.makeCompressionConfigList()
+        rawResult = CompressionResult("uncompressed")
+        resultList = [rawResult] + [CompressionResult(name) for name, config in compressionConfigList]
+
+        tempDir = tempfile.mkdtemp(dir=self.config.tempDir)
+        try:
+            for dataRef in dataRefList:
+                datasetType = dataRef.butlerSubset.datasetType
+                fileName = dataRef.get(datasetType + "_filename")[0]
+                self.log.info("Benchmarking %s" % (fileName,))
+                rawBytes = os.path.getsize(fileName)
+
+                # copy the file first, so all reads are from the same device
+                rawFileName = os.path.join(tempDir, "raw.fits")
+                startTime = time.time()
+                shutil.copyfile(fileName, rawFileName)
+                writeTime = time.time() - startTime
+                rawExposure, readTime, subReadTime = self.readExposure(rawFileName)
+                rawResult.add(rawBytes, rawBytes, writeTime, readTime, subReadTime, None)
+                rawMI = rawExposure.getMaskedImage()
+                sigmaArr = numpy.sqrt(rawMI.getVariance().getArray())
+                goodArr = numpy.isfinite(rawMI.getImage().getArray()) & numpy.isfinite(sigmaArr) \
+                    & (sigmaArr > 0)
+
+                for (name, compressionConfig), result in zip(compressionConfigList, resultList[1:]):
+                    compFileName = os.path.join(tempDir, "compressed.fits")
+                    startTime = time.time()
+                    compressFitsFile(rawFileName, compressionConfig, outFileName=compFileName)
+                    writeTime = time.time() - startTime
+                    exposure, readTime, subReadTime = self.readExposure(compFileName)
+                    diffArr = exposure.getMaskedImage().getImage().getArray() - rawMI.getImage().getArray()
+                    errArr = diffArr[goodArr] / sigmaArr[goodArr]
+                    result.add(rawBytes, os.path.getsize(compFileName), writeTime, readTime, subReadTime,
+                        errArr)
+                    os.remove(compFileName)
+                os.remove(rawFileName)
+        finally:
+            shutil.rmtree(tempDir, ignore_errors=True)
+
+        for result in resultList:
+            result.report(self.log)
+        return pipeBase.Struct(
+            resultList = resultList,
+        )
+
+    def readExposure(self, fileName):
+        """Read an exposure and a subregion of it, timing both
+
+        @return (exposure, time to read exposure, time to read subregion)
+        """
+        startTime = time.time()
+        exposure = afwImage.ExposureF(fileName)
+        readTime = time.time() - startTime
+
+        bbox = exposure.getMaskedImage().getBBox(afwImage.LOCAL)
+        subDim = afwGeom.Extent2I(min(self.config.subregionSize[0], bbox.getWidth()),
+            min(self.config.subregionSize[1], bbox.getHeight()))
+        subMin = afwGeom.Point2I((bbox.getWidth() - subDim[0]) // 2, (bbox.getHeight() - subDim[1]) // 2)
+        startTime = time.time()
+        afwImage.ExposureF(fileName, 0, afwGeom.Box2I(subMin, subDim), afwImage.LOCAL)
+        subReadTime = time.time() - startTime
+        return exposure, readTime, subReadTime
+
+    @classmethod
+    def _makeArgumentParser(cls):
+        """Create an argument parser
+        """
+        return pipeBase.ArgumentParser(name=cls._DefaultName,
+            datasetType=pipeBase.DatasetArgument(help="dataset type of exposures, e.g. deepCoadd_tempExp"))
+
+
+if __name__ == "__main__":
+    BenchmarkCompressionTask.parseAndRun()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Time direct (afwMath.convolve) and FFT convolution of a masked image for a range of kernel sizes
+and report the crossover: the smallest kernel size for which FFT convolution is faster,
+a suitable value for ConvolveConfig.fftMinKernelSize on this machine
+"""
+import argparse
+import time
+
+import numpy
+
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+from lsst.pipe.tasks.fftConvolve import fftConvolveMaskedImage
+
+def makeMaskedImage(width, height):
+    """Make a masked image of gaussian noise, with a few masked pixels
+    """
+    maskedImage = afwImage.MaskedImageF(width, height)
+    numpy.random.seed(1)
+    maskedImage.getImage().getArray()[:] = numpy.random.normal(100.0, 10.0, (height, width))
+    maskedImage.getVariance().getArray()[:] = 100.0
+    maskArr = maskedImage.getMask().getArray()
+    maskArr[numpy.random.uniform(size=(height, width)) < 0.001] = afwImage.MaskU.getPlaneBitMask("SAT")
+    return maskedImage
+
+def timeConvolution(func, numRepeats):
+    """Return the shortest time (sec) of numRepeats calls to func()
+    """
+    timeList = []
+    for i in range(numRepeats):
+        startTime = time.time()
+        func()
+        timeList.append(time.time() - startTime)
+    return min(timeList)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, nargs=2, default=(2048, 4096), metavar=("WIDTH", "HEIGHT"),
+        help="dimensions of the image (pixels)")
+    parser.add_argument("--kernelSizes", type=int, nargs="+", default=range(5, 82, 8),
+        help="kernel widths (and heights) to try (pixels)")
+    parser.add_argument("--tileSize", type=int, default=512, help="tile size for FFT convolution (pixels)")
+    parser.add_argument("--repeats", type=int, default=3, help="number of times to time each convolution")
+    args = parser.parse_args()
+
+    srcMI = makeMaskedImage(*args.size)
+    destMI = srcMI.Factory(srcMI.getDimensions())
+    print "Image size = %d x %d; FFT tile size = %d" % (args.size[0], args.size[1], args.tileSize)
+    print "kernel size  direct (sec)  FFT (sec)  direct/FFT"
+    crossover = None
+    for kernelSize in sorted(args.kernelSizes):
+        kernel = afwMath.AnalyticKernel(kernelSize, kernelSize,
+            afwMath.GaussianFunction2D(kernelSize / 6.0, kernelSize / 6.0))
+        directTime = timeConvolution(lambda: afwMath.convolve(destMI, srcMI, kernel, True), args.repeats)
+        fftTime = timeConvolution(
+            lambda: fftConvolveMaskedImage(destMI, srcMI, kernel, doNormalize=True, tileSize=args.tileSize),
+            args.repeats)
+        print "%11d  %11.3f  %9.3f  %10.2f" % (kernelSize, directTime, fftTime, directTime / fftTime)
+        if crossover is None and fftTime < directTime:
+            crossover = kernelSize
+    if crossover is None:
+        print "FFT convolution was not faster for any kernel size tried"
+    else:
+        print "FFT convolution was first faster at kernel size %d; set fftMinKernelSize accordingly" % \
+            (crossover,)
+
+if __name__ == "__main__":
+    main()
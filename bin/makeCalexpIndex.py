@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Make or update a SQLite calexp index for SqliteSelectImagesTask
+
+The corners of each calexp are computed from the WCS and size in its metadata (calexp_md),
+so the pixels are not read; the FWHM is measured from the calexp's PSF (psf dataset), and the zero point
+(FLUXMAG0) and sky level are read from the metadata. Use doUpdate=True to fill in the zero point and
+sky level of calexps in an index made before those were recorded.
+All data references are handled in one process, because SQLite allows only one writer at a time.
+"""
+import math
+
+import lsst.pex.config as pexConfig
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.pipe.base as pipeBase
+from lsst.meas.algorithms import PsfAttributes
+from lsst.pipe.tasks.sqliteSelectImages import CalexpIndex
+
+__all__ = ["MakeCalexpIndexTask"]
+
+FwhmPerSigma = 2 * math.sqrt(2 * math.log(2))
+
+class MakeCalexpIndexConfig(pexConfig.Config):
+    """Config for MakeCalexpIndexTask
+    """
+    indexPath = pexConfig.Field(
+        doc = "Path of the SQLite calexp index; it is created if it does not exist",
+        dtype = str,
+    )
+    filterKey = pexConfig.Field(
+        doc = "Name of the filter key in data IDs, e.g. \"filter\" or \"band\"; " \
+            "if absent from a data ID then the filter is read from the calexp metadata",
+        dtype = str,
+        default = "filter",
+    )
+    visitKey = pexConfig.Field(
+        doc = "Name of the visit key in data IDs; " \
+            "if absent from a data ID then the visit is recorded as NULL",
+        dtype = str,
+        default = "visit",
+    )
+    skyLevelKey = pexConfig.Field(
+        doc = "Name of the calexp metadata key holding the mean sky level (counts/pixel), as recorded " \
+            "by the background statistics of CalibrateTask; if absent then the sky level is recorded as NULL",
+        dtype = str,
+        default = "BGMEAN2",
+    )
+    doReadPsf = pexConfig.Field(
+        doc = "Read the PSF of each calexp to measure its FWHM? If False then the FWHM is recorded as NULL",
+        dtype = bool,
+        default = True,
+    )
+    doUpdate = pexConfig.Field(
+        doc = "Replace the entries of calexps that are already in the index? " \
+            "If False then those calexps are skipped, so new calexps are added quickly",
+        dtype = bool,
+        default = False,
+    )
+
+
+class RunDataRefListRunner(pipeBase.TaskRunner):
+    @staticmethod
+    def getTargetList(parsedCmd):
+        """Return a list of targets (arguments for __call__); one entry per invocation
+        """
+        return [parsedCmd.dataRefList] # one argument consisting of a list of dataRefs
+
+    def __call__(self, dataRefList):
+        """Run MakeCalexpIndexTask.run on a single target
+
+        @param dataRefList: list of data references
+        """
+        task = self.TaskClass(config=self.config, log=self.log)
+        result = task.run(dataRefList)
+
+        if self.doReturnResults:
+            return pipeBase.Struct(
+                dataRefList = dataRefList,
+                metadata = task.metadata,
+                result = result,
+            )
+
+
+class MakeCalexpIndexTask(pipeBase.CmdLineTask):
+    """Make or update a SQLite calexp index for SqliteSelectImagesTask
+    """
+    ConfigClass = MakeCalexpIndexConfig
+    RunnerClass = RunDataRefListRunner
+    _DefaultName = "makeCalexpIndex"
+
+    @pipeBase.timeMethod
+    def run(self, dataRefList):
+        """Add calexps to the index
+
+        @param dataRefList: a list of data references for calexps
+        @return: a pipeBase.Struct with fields:
+        - numAdded: number of calexps added or replaced
+        - numSkipped: number of calexps skipped because they were already in the index
+        - numMissing: number of calexps skipped because they do not exist
+        - numFailed: number of calexps skipped because they could not be indexed (e.g. unreadable
+            metadata or PSF); the error is logged and the other calexps are still indexed
+        """
+        numAdded = numSkipped = numMissing = numFailed = 0
+        index = CalexpIndex(self.config.indexPath, create=True)
+        try:
+            for dataRef in dataRefList:
+                if not self.config.doUpdate and index.hasExposure(dataRef.dataId):
+                    numSkipped += 1
+                    continue
+                if not dataRef.datasetExists("calexp"):
+                    self.log.warn("Calexp %s not found; skipping it" % (dataRef.dataId,))
+                    numMissing += 1
+                    continue
+                try:
+                    self.addCalexp(index, dataRef)
+                except Exception, e:
+                    self.log.warn("Error indexing calexp %s; skipping it: %s" % (dataRef.dataId, e))
+                    numFailed += 1
+                    continue
+                numAdded += 1
+                if numAdded % 100 == 0:
+                    index.commit()
+        finally:
+            index.close()
+        self.log.info("Added %d calexps to %s; skipped %d already indexed, %d missing and %d failed" % \
+            (numAdded, self.config.indexPath, numSkipped, numMissing, numFailed))
+        return pipeBase.Struct(
+            numAdded = numAdded,
+            numSkipped = numSkipped,
+            numMissing = numMissing,
+            numFailed = numFailed,
+        )
+
+    def addCalexp(self, index, dataRef):
+        """Add one calexp to the index
+
+        @param[in,out] index: calexp index (a CalexpIndex)
+        @param[in] dataRef: data reference for calexp
+        """
+        md = dataRef.get("calexp_md", immediate=True)
+        wcs = afwImage.makeWcs(md)
+        bbox = afwGeom.Box2D(afwGeom.Box2I(afwGeom.Point2I(0, 0),
+            afwGeom.Extent2I(md.get("NAXIS1"), md.get("NAXIS2"))))
+        coordList = [wcs.pixelToSky(pos).toIcrs() for pos in bbox.getCorners()]
+
+        filterName = dataRef.dataId.get(self.config.filterKey)
+        if filterName is None:
+            filterName = afwImage.Filter(md).getName()
+        visit = dataRef.dataId.get(self.config.visitKey)
+
+        fwhm = None
+        if self.config.doReadPsf:
+            psf = dataRef.get("psf", immediate=True)
+            kWidth, kHeight = psf.getKernel().getDimensions()
+            psfAttr = PsfAttributes(psf, kWidth//2, kHeight//2)
+            sigmaPix = psfAttr.computeGaussianWidth(psfAttr.ADAPTIVE_MOMENT)
+            fwhm = sigmaPix * FwhmPerSigma * wcs.pixelScale().asArcseconds()
+
+        fluxMag0 = md.get("FLUXMAG0") if md.exists("FLUXMAG0") else None
+        skyLevel = md.get(self.config.skyLevelKey) if md.exists(self.config.skyLevelKey) else None
+
+        index.addExposure(dataRef.dataId, filterName, visit, fwhm, coordList,
+            fluxMag0=fluxMag0, skyLevel=skyLevel)
+
+    @classmethod
+    def _makeArgumentParser(cls):
+        """Create an argument parser
+        """
+        return pipeBase.ArgumentParser(name=cls._DefaultName, datasetType="calexp")
+
+    def _getConfigName(self):
+        """Don't persist config, so return None
+        """
+        return None
+
+    def _getMetadataName(self):
+        """Don't persist metadata, so return None
+        """
+        return None
+
+
+if __name__ == "__main__":
+    MakeCalexpIndexTask.parseAndRun()
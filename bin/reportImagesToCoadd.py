@@ -29,6 +29,7 @@ import lsst.afw.coord as afwCoord
 import lsst.afw.geom as afwGeom
 import lsst.pipe.base as pipeBase
 from lsst.pipe.tasks.makeSkyMap import MakeSkyMapTask
+from lsst.pipe.tasks.patchOverlapIndex import PatchOverlapIndex, computePatchOverlaps, getCoaddId
 from lsst.pipe.tasks.selectImages import BadSelectImagesTask
 
 __all__ = ["ReportImagesToCoaddTask", "ReportImagesToCoaddArgumentParser"]
@@ -46,7 +47,8 @@ class ReportImagesToCoaddConfig(pexConfig.Config):
         target = BadSelectImagesTask, # must be retargeted
     )
     raDecRange = pexConfig.ListField(
-        doc = "min RA, min Dec, max RA, max Dec (ICRS, deg); if omitted then search whole sky",
+        doc = "min RA, min Dec, max RA, max Dec (ICRS, deg); if omitted then search whole sky; " \
+            "if select.doExactOverlap is True then the region is the great-circle polygon of these corners",
         dtype = float,
         length = 4,
         optional = True,
@@ -56,6 +58,12 @@ class ReportImagesToCoaddConfig(pexConfig.Config):
         dtype = bool,
         default = False,
     )
+    overlapIndexPath = pexConfig.Field(
+        doc = "path of a patch overlap index (see lsst.pipe.tasks.patchOverlapIndex) to create or update " \
+            "with the selected images; images already in the index are not recomputed; if None, no index",
+        dtype = str,
+        optional = True,
+    )
 
 
 class ReportImagesToCoaddTask(pipeBase.CmdLineTask):
@@ -124,6 +132,9 @@ class ReportImagesToCoaddTask(pipeBase.CmdLineTask):
                     else:
                         ccdInfoSet.add(exposureInfo)
         
+        if self.config.overlapIndexPath is not None:
+            self.updateOverlapIndex(skyMap, getCoaddId(dataRef.dataId), exposureInfoList)
+
         fwhmList = numpy.array(fwhmList, dtype=float)
         print "FWHM Q1=%0.2f Q2=%0.2f Q3=%0.2f" % (
             numpy.percentile(fwhmList, 25.0),
@@ -154,6 +165,29 @@ class ReportImagesToCoaddTask(pipeBase.CmdLineTask):
             ccdInfoSetDict = ccdInfoSetDict,
         )
 
+    def updateOverlapIndex(self, skyMap, coaddId, exposureInfoList):
+        """Add images that are not already in the patch overlap index to the index
+
+        @param skyMap: sky map
+        @param coaddId: coadd ID of the images (coadd data ID items other than tract and patch)
+        @param exposureInfoList: list of exposure information for the selected images
+        @return the number of images added
+        """
+        numAdded = 0
+        index = PatchOverlapIndex(self.config.overlapIndexPath, create=True)
+        try:
+            for exposureInfo in exposureInfoList:
+                if index.hasExposure(exposureInfo.dataId):
+                    continue
+                overlapList = computePatchOverlaps(skyMap, exposureInfo.coordList)
+                index.addExposure(exposureInfo.dataId, coaddId, overlapList)
+                numAdded += 1
+        finally:
+            index.close()
+        self.log.info("Added %d of %d images to patch overlap index %s" % \
+            (numAdded, len(exposureInfoList), self.config.overlapIndexPath))
+        return numAdded
+
     @classmethod
     def _makeArgumentParser(cls):
         """Create an argument parser
@@ -27,9 +27,10 @@ import lsst.afw.image as afwImage
 import lsst.afw.math as afwMath
 import lsst.coadd.utils as coaddUtils
 import lsst.pipe.base as pipeBase
-from .coaddBase import CoaddBaseTask
+from .coaddBase import CoaddBaseTask, makeConfigHash, getDatasetSignature
 from .interpImage import InterpImageTask
-from .matchBackgrounds import MatchBackgroundsTask
+from .matchBackgrounds import MatchBackgroundsTask, BackgroundInfoCache
+from .tempExpUtils import getTempExpCropBBox, readTempExp
 
 __all__ = ["AssembleCoaddTask"]
 
@@ -103,6 +104,42 @@ class AssembleCoaddConfig(CoaddBaseTask.ConfigClass):
         dtype = bool,
         default = True,
     )
+    doUseMappedTempExp = pexConfig.Field(
+        doc = "Read subregions of coaddTempExp from their memory-mappable copies, where they exist " \
+              "and are up to date, instead of from FITS? The pixels are still copied into afw images, " \
+              "so this only saves FITS decoding (and decompression). " \
+              "See MakeCoaddTempExpConfig.doWriteMappedTempExp",
+        dtype = bool,
+        default = False,
+    )
+    doReadCroppedTempExp = pexConfig.Field(
+        doc = "Read the metadata of each coaddTempExp (once) to find out whether it was persisted cropped? " \
+              "Must be True if any coaddTempExp was made with MakeCoaddTempExpConfig.doCropTempExp; " \
+              "if False then subregions are read without reading the metadata",
+        dtype = bool,
+        default = False,
+    )
+    doWriteBackgroundInfo = pexConfig.Field(
+        doc = "Persist the results of background matching as <coaddName>Coadd_bgInfo, " \
+              "so they can be reused by later runs? Ignored if doMatchBackgrounds false.",
+        dtype = bool,
+        default = False,
+    )
+    doReuseBackgroundInfo = pexConfig.Field(
+        doc = "Use persisted <coaddName>Coadd_bgInfo instead of matching backgrounds, " \
+              "if it exists and was made from the same, unchanged coadd temp exposures " \
+              "with the same configuration? Ignored if doMatchBackgrounds false.",
+        dtype = bool,
+        default = False,
+    )
+    backgroundInfoBinSize = pexConfig.Field(
+        doc = "Size of bins (pixels) of the background models persisted in <coaddName>Coadd_bgInfo; " \
+              "the models are rendered by bilinear interpolation between bin centers. " \
+              "Should be a few times smaller than matchBackgrounds.binSize",
+        dtype = int,
+        default = 32,
+        check = lambda x: x > 0,
+    )
 
 
 class AssembleCoaddTask(CoaddBaseTask):
@@ -139,6 +176,7 @@ class AssembleCoaddTask(CoaddBaseTask):
             plus the camera-specific filter key (e.g. "filter")
         Used to access the following data products (depending on the config):
         - [in] self.config.coaddName + "Coadd_tempExp"
+        - [in/out] self.config.coaddName + "Coadd_bgInfo"
         - [out] self.config.coaddName + "Coadd"
 
         @return: a pipeBase.Struct with fields:
@@ -160,7 +198,6 @@ class AssembleCoaddTask(CoaddBaseTask):
         self.log.info("Selected %s calexp" % (numExp,))
 
         tempExpName = self.config.coaddName + "Coadd_tempExp"
-        tempExpSubName = tempExpName + "_sub"
 
         # compute tempKeyList: a tuple of ID key names in a calExpId that identify a coaddTempExp.
         # You must also specify tract and patch to make a complete coaddTempExp ID.
@@ -184,7 +221,7 @@ class AssembleCoaddTask(CoaddBaseTask):
                 raise pipeBase.TaskError("Could not find reference exposure %s %s." % \
                     (tempExpName, refExpDataRef.dataId))
 
-            refExposure = refExpDataRef.get(tempExpName, immediate=True)
+            refExposure = readTempExp(refExpDataRef, tempExpName)
             refImageScaler = self.scaleZeroPoint.computeImageScaler(
                 exposure = refExposure,
                 exposureId = refExpDataRef.dataId,
@@ -227,7 +264,7 @@ class AssembleCoaddTask(CoaddBaseTask):
                 self.log.warn("Could not find %s %s; skipping it" % (tempExpName, tempExpRef.dataId))
                 continue
 
-            tempExp = tempExpRef.get(tempExpName, immediate=True)
+            tempExp = readTempExp(tempExpRef, tempExpName)
             maskedImage = tempExp.getMaskedImage()
             imageScaler = self.scaleZeroPoint.computeImageScaler(
                 exposure = tempExp, 
@@ -258,17 +295,48 @@ class AssembleCoaddTask(CoaddBaseTask):
         self.log.info("Found %s %s" % (len(tempExpRefList), tempExpName))
 
         if self.config.doMatchBackgrounds:
-            try:
-                backgroundInfoList = self.matchBackgrounds.run(
-                    expRefList = tempExpRefList,
-                    imageScalerList = imageScalerList,
-                    refExpDataRef = refExpDataRef,
-                    refImageScaler = refImageScaler,
-                    expDatasetType = tempExpName,
-                ).backgroundInfoList
-            except Exception, e:
-                self.log.fatal("Cannot match backgrounds: %s" % (e))
-                raise pipeBase.TaskError("Background matching failed.")
+            bgInfoName = self.config.coaddName + "Coadd_bgInfo"
+            tempExpIdList = [tempExpRef.dataId for tempExpRef in tempExpRefList]
+            tempExpSignatureList = [getDatasetSignature(tempExpRef, [tempExpName])
+                for tempExpRef in tempExpRefList]
+            bgConfigHash = makeConfigHash(
+                self.matchBackgrounds.config,
+                self.scaleZeroPoint.config,
+                None if refExpDataRef is None else sorted(refExpDataRef.dataId.items()),
+            )
+            backgroundInfoList = None
+            if self.config.doReuseBackgroundInfo:
+                backgroundInfoList = self.readBackgroundInfoList(
+                    butler = butler,
+                    patchId = patchIdDict,
+                    expIdList = tempExpIdList,
+                    expSignatureList = tempExpSignatureList,
+                    configHash = bgConfigHash,
+                )
+
+            if backgroundInfoList is None:
+                try:
+                    backgroundInfoList = self.matchBackgrounds.run(
+                        expRefList = tempExpRefList,
+                        imageScalerList = imageScalerList,
+                        refExpDataRef = refExpDataRef,
+                        refImageScaler = refImageScaler,
+                        expDatasetType = tempExpName,
+                    ).backgroundInfoList
+                except Exception, e:
+                    self.log.fatal("Cannot match backgrounds: %s" % (e))
+                    raise pipeBase.TaskError("Background matching failed.")
+
+                if self.config.doWriteBackgroundInfo:
+                    self.log.info("Persisting %s" % (bgInfoName,))
+                    bgInfoCache = BackgroundInfoCache(
+                        expIdList = tempExpIdList,
+                        expSignatureList = tempExpSignatureList,
+                        configHash = bgConfigHash,
+                        backgroundInfoList = backgroundInfoList,
+                        binSize = self.config.backgroundInfoBinSize,
+                    )
+                    butler.put(bgInfoCache, bgInfoName, dataId=patchIdDict)
 
             newWeightList = []
             newTempExpRefList = []
@@ -330,6 +398,11 @@ class AssembleCoaddTask(CoaddBaseTask):
         coaddMaskedImage = coaddExposure.getMaskedImage()
         subregionSizeArr = self.config.subregionSize
         subregionSize = afwGeom.Extent2I(subregionSizeArr[0], subregionSizeArr[1])
+        # read the crop bbox of each coaddTempExp once, rather than once per subregion
+        if self.config.doReadCroppedTempExp:
+            cropBBoxList = [getTempExpCropBBox(tempExpRef, tempExpName) for tempExpRef in tempExpRefList]
+        else:
+            cropBBoxList = [None] * len(tempExpRefList)
         didSetMetadata = False
         for subBBox in _subBBoxIter(bbox, subregionSize):
             try:
@@ -338,7 +411,9 @@ class AssembleCoaddTask(CoaddBaseTask):
                 maskedImageList = afwImage.vectorMaskedImageF() # [] is rejected by afwMath.statisticsStack
                 for idx, (tempExpRef, imageScaler) in enumerate(zip(tempExpRefList,imageScalerList)):
 
-                    exposure = tempExpRef.get(tempExpSubName, bbox=subBBox, imageOrigin="PARENT")
+                    exposure = readTempExp(tempExpRef, tempExpName, bbox=subBBox,
+                        useMapped=self.config.doUseMappedTempExp, cropBBox=cropBBoxList[idx],
+                        checkCrop=False)
                     maskedImage = exposure.getMaskedImage()
                     imageScaler.scaleMaskedImage(maskedImage)
                         
@@ -401,6 +476,36 @@ class AssembleCoaddTask(CoaddBaseTask):
         )
 
 
+    def readBackgroundInfoList(self, butler, patchId, expIdList, expSignatureList, configHash):
+        """Read persisted background matching results, if they exist and are valid
+
+        @param[in] butler: data butler
+        @param[in] patchId: data ID of the coadd patch
+        @param[in] expIdList: list of data IDs of the coadd temp exposures to be matched, in order
+        @param[in] expSignatureList: list of signatures of the files of the coadd temp exposures,
+            in order, as returned by getDatasetSignature
+        @param[in] configHash: hash of the configuration that affects background matching
+        @return backgroundInfoList, in the format returned by MatchBackgroundsTask.run,
+            or None if the persisted results do not exist, cannot be read (e.g. because
+            the mapper does not define the dataset type) or are not valid
+        """
+        bgInfoName = self.config.coaddName + "Coadd_bgInfo"
+        try:
+            if not butler.datasetExists(bgInfoName, patchId):
+                self.log.info("No %s found; matching backgrounds" % (bgInfoName,))
+                return None
+            bgInfoCache = butler.get(bgInfoName, dataId=patchId, immediate=True)
+        except Exception, e:
+            self.log.warn("Could not read %s (%s); matching backgrounds" % (bgInfoName, e))
+            return None
+        if not bgInfoCache.isValid(expIdList=expIdList, expSignatureList=expSignatureList,
+            configHash=configHash):
+            self.log.info("%s was made from different inputs or config; matching backgrounds" % \
+                (bgInfoName,))
+            return None
+        self.log.info("Using background matching results from %s" % (bgInfoName,))
+        return bgInfoCache.getBackgroundInfoList()
+
     @classmethod
     def _makeArgumentParser(cls):
         """Create an argument parser
@@ -20,10 +20,33 @@
 # the GNU General Public License along with this program.  If not,
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
+import lsst.pex.config as pexConfig
+import lsst.pipe.base as pipeBase
 import lsst.coadd.chisquared as coaddChiSq
 from .coadd import CoaddTask
+from .mergeableCoadd import MergeableCoaddMixin
+
+class MergeableChiSquaredCoadd(MergeableCoaddMixin, coaddChiSq.Coadd):
+    """A chi squared coadd whose partial coadds can be merged
+    """
+    pass
 
 class ChiSquaredCoaddConfig(CoaddTask.ConfigClass):
+    filterList = pexConfig.ListField(
+        doc = "Filters to coadd in a single run, which also makes a coadd of all of them combined, " \
+            "persisted as <coaddName>Coadd_multiBand (see ChiSquaredCoaddTask.runMultiBand); " \
+            "the filter of the patch data reference is then ignored. " \
+            "If empty then only the filter of the patch data reference is coadded",
+        dtype = str,
+        default = [],
+    )
+    filterKey = pexConfig.Field(
+        doc = "name of the filter key in data IDs, e.g. \"filter\" or \"band\"; " \
+            "only used if filterList is set",
+        dtype = str,
+        default = "filter",
+    )
+
     def setDefaults(self):
         self.coaddName = "chiSquared"
 
@@ -33,7 +56,88 @@ class ChiSquaredCoaddTask(CoaddTask):
     ConfigClass = ChiSquaredCoaddConfig
     _DefaultName = "chiSquaredCoadd"
 
+    def run(self, patchRef):
+        """Coadd images of one filter or, if config.filterList is set, of several filters
+
+        @param patchRef: data reference for sky map patch. Must include keys "tract", "patch",
+            plus the camera-specific filter key (e.g. "filter" or "band")
+        @return: a pipeBase.Struct; see CoaddTask.run or, if config.filterList is set, runMultiBand
+        """
+        if self.config.filterList:
+            return self.runMultiBand(patchRef)
+        return CoaddTask.run(self, patchRef)
+
+    @pipeBase.timeMethod
+    def runMultiBand(self, patchRef):
+        """Make a chi squared coadd of each filter in config.filterList and of all filters combined
+
+        The sky map patch and its geometry are computed once, and each calexp is read and warped once.
+        The combined coadd is the sum of the per-filter chi squared sums (it is merged from them,
+        see MergeableCoaddMixin), for use as a multi-band detection image.
+        The per-filter coadds are persisted as <coaddName>Coadd for each filter
+        and the combined coadd as <coaddName>Coadd_multiBand, whose data ID has no filter
+        (see getMultiBandDatasetName); the camera's mapper must define that dataset type.
+
+        @param patchRef: data reference for sky map patch. Must include keys "tract" and "patch";
+            its filter (if any) is replaced by each filter of config.filterList in turn
+        @return: a pipeBase.Struct with fields:
+        - coadd: the combined coadd object
+        - coaddExposure: the combined coadd exposure, as returned by coadd.getCoadd()
+        - bandCoaddExposureDict: a dict of filter name: coadd exposure for that filter;
+            filters with no exposures to coadd are omitted
+        """
+        skyInfo = self.getSkyInfo(patchRef)
+        tractWcs = skyInfo.wcs
+        patchBBox = skyInfo.bbox
+
+        doPsfMatch = self.config.warpAndPsfMatch.desiredFwhm is not None
+        if not doPsfMatch:
+            self.log.info("No PSF matching will be done (desiredFwhm is None)")
+
+        butler = patchRef.butlerSubset.butler
+        coadd = self.makeCoadd(patchBBox, tractWcs)
+        bandCoaddExposureDict = dict()
+        for filterName in self.config.filterList:
+            bandDataId = dict(patchRef.dataId)
+            bandDataId[self.config.filterKey] = filterName
+            bandPatchRef = butler.dataRef(datasetType=self.config.coaddName + "Coadd", dataId=bandDataId)
+            calExpRefList = self.selectExposures(patchRef=bandPatchRef, wcs=tractWcs, bbox=patchBBox)
+            if not calExpRefList:
+                self.log.warn("No exposures to coadd in filter %s" % (filterName,))
+                continue
+            self.log.info("Coadd %s calexp in filter %s" % (len(calExpRefList), filterName))
+
+            bandCoadd = self.makeCoadd(patchBBox, tractWcs)
+            self.accumulateCoadd(bandCoadd, calExpRefList, tractWcs=tractWcs, patchBBox=patchBBox,
+                doPsfMatch=doPsfMatch)
+            coadd.mergePartialData(bandCoadd.getPartialData())
+            bandCoaddExposureDict[filterName] = self.finishCoadd(bandPatchRef, bandCoadd, tractWcs=tractWcs)
+            del bandCoadd
+
+        if not bandCoaddExposureDict:
+            raise pipeBase.TaskError("No exposures to coadd in any of filters %s" % (self.config.filterList,))
+        multiBandDatasetName = self.getMultiBandDatasetName()
+        multiBandDataId = dict((key, value) for key, value in patchRef.dataId.iteritems()
+            if key != self.config.filterKey)
+        multiBandPatchRef = butler.dataRef(datasetType=multiBandDatasetName, dataId=multiBandDataId)
+        coaddExposure = self.finishCoadd(multiBandPatchRef, coadd, tractWcs=tractWcs,
+            datasetName=multiBandDatasetName, doWritePsf=False)
+
+        return pipeBase.Struct(
+            coadd = coadd,
+            coaddExposure = coaddExposure,
+            bandCoaddExposureDict = bandCoaddExposureDict,
+        )
+
+    def getMultiBandDatasetName(self):
+        """Return the dataset type of the combined coadd of all filters: <coaddName>Coadd_multiBand
+
+        Its data ID is that of the patch without the filter key; its weight map is persisted
+        as <coaddName>Coadd_multiBand_depth.
+        """
+        return self.config.coaddName + "Coadd_multiBand"
+
     def makeCoadd(self, bbox, wcs):
-        """Make a coadd object; in this case an instance of coaddChiSq.Coadd
+        """Make a coadd object; in this case an instance of coaddChiSq.Coadd that can be merged
         """
-        return coaddChiSq.Coadd.fromConfig(bbox=bbox, wcs=wcs, config=self.config.coadd)
+        return MergeableChiSquaredCoadd(bbox=bbox, wcs=wcs, badMaskPlanes=self.config.badMaskPlanes)
@@ -20,6 +20,8 @@
 # the GNU General Public License along with this program.  If not,
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
+import multiprocessing
+
 import lsst.pex.config as pexConfig
 import lsst.afw.detection as afwDetection
 import lsst.afw.geom as afwGeom
@@ -31,6 +33,7 @@ import lsst.ip.isr as ipIsr
 from lsst.ip.diffim import ModelPsfMatchTask
 from .coaddBase import CoaddBaseTask, CoaddArgumentParser
 from .interpImage import InterpImageTask
+from .mergeableCoadd import MergeableCoadd
 from .warpAndPsfMatch import WarpAndPsfMatchTask
 
 # export CoaddArgumentParser for backward compatibility; new code should get it from coaddBase
@@ -67,6 +70,17 @@ class CoaddConfig(CoaddBaseTask.ConfigClass):
         dtype = bool,
         default = True,
     )
+    numProcesses = pexConfig.Field(
+        doc = "Number of worker processes among which to divide the calexps; each worker reads, " \
+            "PSF-matches, warps and adds its calexps to a partial coadd, " \
+            "and the partial coadds are merged; " \
+            "if 1 then all calexps are processed serially in this process. " \
+            "A daemonic process (e.g. a TaskRunner worker when run with -j > 1) cannot start workers, " \
+            "so there this is ignored (with a warning) and calexps are processed serially",
+        dtype = int,
+        default = 1,
+        check = lambda x: x >= 1,
+    )
 
 
 class CoaddTask(CoaddBaseTask):
@@ -100,6 +114,8 @@ class CoaddTask(CoaddBaseTask):
         associated with the calibrated science exposures (without having to warp those models).
         
         Coaddition is performed as a weighted sum. See lsst.coadd.utils.Coadd for details.
+        If config.numProcesses > 1 the calexps are divided among worker processes, each of which
+        makes a partial coadd, and the partial coadds are merged (see MergeableCoaddMixin).
     
         @param patchRef: data reference for sky map patch. Must include keys "tract", "patch",
             plus the camera-specific filter key (e.g. "filter" or "band")
@@ -124,25 +140,58 @@ class CoaddTask(CoaddBaseTask):
             self.log.info("No PSF matching will be done (desiredFwhm is None)")
     
         coadd = self.makeCoadd(patchBBox, tractWcs)
-        for ind, calExpRef in enumerate(imageRefList):
-            if not calExpRef.datasetExists("calexp"):
-                self.log.warn("Could not find calexp %s; skipping it" % (calExpRef.dataId,))
-                continue
-
-            self.log.info("Processing exposure %d of %d: id=%s" % (ind+1, numExp, calExpRef.dataId))
-            exposure = self.warpAndPsfMatch.getCalExp(calExpRef, getPsf=doPsfMatch)
-            try:
-                exposure = self.warpAndPsfMatch.run(exposure, wcs=tractWcs, maxBBox=patchBBox).exposure
-                scale = self.scaleZeroPoint.computeScale(exposure.getCalib())
-                maskedImage = exposure.getMaskedImage()
-                maskedImage *= scale
-                coadd.addExposure(exposure)
-            except Exception, e:
-                self.log.warn("Error processing exposure %s; skipping it: %s" % (calExpRef.dataId, e))
-                continue
+        self.accumulateCoadd(coadd, imageRefList, tractWcs=tractWcs, patchBBox=patchBBox,
+            doPsfMatch=doPsfMatch)
+        coaddExposure = self.finishCoadd(patchRef, coadd, tractWcs=tractWcs)
         
+        return pipeBase.Struct(
+            coaddExposure = coaddExposure,
+            coadd = coadd,
+        )
+
+    def accumulateCoadd(self, coadd, calExpRefList, tractWcs, patchBBox, doPsfMatch):
+        """Add calexps to a coadd, dividing them among config.numProcesses processes
+
+        @param[in,out] coadd: coadd object, as returned by makeCoadd; if config.numProcesses > 1
+            it must support getPartialData and mergePartialData (see MergeableCoaddMixin)
+        @param[in] calExpRefList: list of data references for calexps
+        @param[in] tractWcs: WCS of tract
+        @param[in] patchBBox: outer bbox of patch
+        @param[in] doPsfMatch: PSF-match the calexps?
+        """
+        numExp = len(calExpRefList)
+        numProcesses = min(self.config.numProcesses, numExp)
+        if numProcesses > 1:
+            numProcesses = self.getUsableNumProcesses(numProcesses, "numProcesses")
+        if numProcesses <= 1:
+            self.addCalExpList(coadd, calExpRefList, tractWcs=tractWcs, patchBBox=patchBBox,
+                doPsfMatch=doPsfMatch)
+            return
+
+        self.log.info("Coadd %d calexps with %d processes" % (numExp, numProcesses))
+        pool = multiprocessing.Pool(numProcesses, initializer=_initCoaddWorker,
+            initargs=(self, calExpRefList, tractWcs, patchBBox, doPsfMatch, numProcesses))
+        try:
+            # merge the partial coadds in a fixed order, so the floating-point result is reproducible
+            for partialData in pool.imap(_makePartialCoaddInWorker, range(numProcesses)):
+                coadd.mergePartialData(partialData)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def finishCoadd(self, patchRef, coadd, tractWcs, datasetName=None, doWritePsf=True):
+        """Compute the coadd exposure from a coadd object, interpolate (optional) and persist (optional)
+
+        @param[in] patchRef: data reference for sky map patch
+        @param[in] coadd: coadd object, to which all calexps have been added
+        @param[in] tractWcs: WCS of tract
+        @param[in] datasetName: dataset type of the coadd exposure; if None then <coaddName>Coadd.
+            The weight map is persisted as datasetName + "_depth"
+        @param[in] doWritePsf: persist <coaddName>Coadd_initPsf (if desiredFwhm is not None)?
+        @return coadd exposure, as returned by coadd.getCoadd()
+        """
         coaddExposure = coadd.getCoadd()
-        coaddExposure.setConfig(self.scaleZeroPoint.getCalib())
+        coaddExposure.setCalib(self.scaleZeroPoint.getCalib())
         if self.config.doInterp:
             fwhmArcSec = self.config.warpAndPsfMatch.desiredFwhm or 1.5
             fwhmPixels = fwhmArcSec / tractWcs.pixelScale().asArcseconds()
@@ -153,16 +202,16 @@ class CoaddTask(CoaddBaseTask):
             )
 
         if self.config.doWrite:
-            coaddName = self.config.coaddName + "Coadd"
+            coaddName = datasetName if datasetName is not None else self.config.coaddName + "Coadd"
             self.log.info("Persisting %s" % (coaddName,))
             patchRef.put(coaddExposure, coaddName)
 
             weightMap = coadd.getWeightMap()                
-            weightMapName = self.config.coaddName + "Coadd_depth"
+            weightMapName = coaddName + "_depth"
             self.log.info("Persisting %s" % (weightMapName,))
             patchRef.put(weightMap, weightMapName)
 
-            if self.config.warpAndPsfMatch.desiredFwhm is not None:
+            if doWritePsf and self.config.warpAndPsfMatch.desiredFwhm is not None:
                 psfName = self.config.coaddName + "Coadd_initPsf"
                 self.log.info("Persisting %s" % (psfName,))
                 wcs = coaddExposure.getWcs()
@@ -171,18 +220,69 @@ class CoaddTask(CoaddBaseTask):
                 kernelDim = afwGeom.Point2I(kernelSize, kernelSize)
                 coaddPsf = self.makeModelPsf(fwhmPixels=fwhmPixels, kernelDim=kernelDim)
                 patchRef.put(coaddPsf, psfName)
-        
-        return pipeBase.Struct(
-            coaddExposure = coaddExposure,
-            coadd = coadd,
-        )
+        return coaddExposure
     
+    def addCalExpList(self, coadd, calExpRefList, tractWcs, patchBBox, doPsfMatch):
+        """Read, PSF-match (optional), warp, zero-point scale and add calexps to a coadd
+
+        Calexps that cannot be found or processed are skipped, with a warning.
+
+        @param[in,out] coadd: coadd object, as returned by makeCoadd
+        @param[in] calExpRefList: list of data references for calexps
+        @param[in] tractWcs: WCS of tract
+        @param[in] patchBBox: outer bbox of patch
+        @param[in] doPsfMatch: PSF-match the calexps?
+        """
+        numExp = len(calExpRefList)
+        for ind, calExpRef in enumerate(calExpRefList):
+            if not calExpRef.datasetExists("calexp"):
+                self.log.warn("Could not find calexp %s; skipping it" % (calExpRef.dataId,))
+                continue
+
+            self.log.info("Processing exposure %d of %d: id=%s" % (ind+1, numExp, calExpRef.dataId))
+            exposure = self.warpAndPsfMatch.getCalExp(calExpRef, getPsf=doPsfMatch)
+            try:
+                exposure = self.warpAndPsfMatch.run(exposure, wcs=tractWcs, maxBBox=patchBBox).exposure
+                scale = self.scaleZeroPoint.computeScale(exposure.getCalib())
+                maskedImage = exposure.getMaskedImage()
+                maskedImage *= scale
+                coadd.addExposure(exposure)
+            except Exception, e:
+                self.log.warn("Error processing exposure %s; skipping it: %s" % (calExpRef.dataId, e))
+                continue
+
     def makeCoadd(self, bbox, wcs):
         """Make a coadd object, e.g. lsst.coadd.utils.Coadd
         
         @param[in] bbox: bounding box for coadd
         @param[in] wcs: WCS for coadd
         
-        This exists to allow subclasses to return a different kind of coadd
+        This exists to allow subclasses to return a different kind of coadd.
+        If config.numProcesses > 1 the coadd must support getPartialData and mergePartialData
+        (see MergeableCoaddMixin).
         """
-        return coaddUtils.Coadd(bbox=bbox, wcs=wcs, badMaskPlanes=self.config.badMaskPlanes)
+        return MergeableCoadd(bbox=bbox, wcs=wcs, badMaskPlanes=self.config.badMaskPlanes)
+
+
+# state of a worker process of CoaddTask.accumulateCoadd:
+# (task, calExpRefList, tractWcs, patchBBox, doPsfMatch, numWorkers);
+# set by _initCoaddWorker and only used in the worker processes
+_CoaddWorkerState = None
+
+def _initCoaddWorker(task, calExpRefList, tractWcs, patchBBox, doPsfMatch, numWorkers):
+    """Initialize a worker process of CoaddTask.accumulateCoadd
+    """
+    global _CoaddWorkerState
+    _CoaddWorkerState = (task, calExpRefList, tractWcs, patchBBox, doPsfMatch, numWorkers)
+
+def _makePartialCoaddInWorker(workerInd):
+    """Make a partial coadd of every numWorkers'th calexp, in a worker process of CoaddTask.run
+
+    @param[in] workerInd: index of worker; the worker processes calExpRefList[workerInd::numWorkers]
+    @return partial coadd data (see MergeableCoaddMixin.getPartialData)
+    """
+    task, calExpRefList, tractWcs, patchBBox, doPsfMatch, numWorkers = _CoaddWorkerState
+    coadd = task.makeCoadd(patchBBox, tractWcs)
+    task.addCalExpList(coadd, calExpRefList[workerInd::numWorkers], tractWcs=tractWcs, patchBBox=patchBBox,
+        doPsfMatch=doPsfMatch)
+    return coadd.getPartialData()
@@ -20,19 +20,29 @@
 # the GNU General Public License along with this program.  If not,
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
+import hashlib
 import math
+import multiprocessing
+import os
 
 import lsst.pex.config as pexConfig
 import lsst.afw.detection as afwDetection
 import lsst.afw.geom as afwGeom
 import lsst.afw.image as afwImage
 import lsst.pipe.base as pipeBase
+from .lruCache import LruCache
+from .patchOverlapIndex import PatchOverlapIndex, getCoaddId
 from .selectImages import BadSelectImagesTask
+from .skyMapCache import getSkyMap
 
-__all__ = ["CoaddBaseTask"]
+__all__ = ["CoaddBaseTask", "makeConfigHash", "getDatasetSignature"]
 
 FwhmPerSigma = 2 * math.sqrt(2 * math.log(2))
 
+# cache of (select config hash, coadd name, tract ID, other data ID items): patchDataRefListDict,
+# as returned by CoaddBaseTask.selectTractExposures; used if config.doSelectPerTract is True
+_TractSelectionCache = LruCache(maxSize=2)
+
 class CoaddBaseConfig(pexConfig.Config):
     """Config for CoaddBaseTask
     """
@@ -50,6 +60,23 @@ class CoaddBaseConfig(pexConfig.Config):
         doc = "Mask planes that, if set, the associated pixel should not be included in the coaddTempExp.",
         default = ("EDGE",),
     )
+    doSelectPerTract = pexConfig.Field(
+        doc = "Select exposures for all patches of a tract with one selection query, " \
+            "and reuse the result for other patches of the same tract handled by this process?",
+        dtype = bool,
+        default = False,
+    )
+    overlapIndexPath = pexConfig.Field(
+        doc = "Path of a patch overlap index, as made by bin/reportImagesToCoadd.py; if specified then " \
+            "the exposures that overlap each patch are looked up in the index instead of being found by " \
+            "the selection subtask. Its cuts still apply: unless it is BadSelectImagesTask, its run method " \
+            "is called once for the region of the requested patches (for quality cuts, maxExposures etc.) " \
+            "and indexed exposures that it does not return are rejected; then select.minOverlapArea " \
+            "(if select.doExactOverlap) and select.maxExposuresPerPatch are applied using the overlaps " \
+            "recorded in the index, which are always exact footprint overlaps",
+        dtype = str,
+        optional = True,
+    )
 
 
 class CoaddBaseTask(pipeBase.CmdLineTask):
@@ -69,6 +96,22 @@ class CoaddBaseTask(pipeBase.CmdLineTask):
         """
         return self._badPixelMask
 
+    def getUsableNumProcesses(self, numProcesses, fieldName):
+        """Get the number of worker processes this task may start
+
+        A daemonic process (e.g. a TaskRunner pool worker, as used when run with -j > 1)
+        is not allowed to have children, so in one the work must be done serially.
+
+        @param[in] numProcesses: number of worker processes requested
+        @param[in] fieldName: name of the config field that requested them (for the log message)
+        @return numProcesses, or 1 if this process is daemonic
+        """
+        if numProcesses > 1 and multiprocessing.current_process().daemon:
+            self.log.warn("Ignoring %s=%d: a daemonic process (e.g. when run with -j > 1) cannot "
+                "start worker processes; working serially" % (fieldName, numProcesses))
+            return 1
+        return numProcesses
+
     def selectExposures(self, patchRef, wcs, bbox):
         """Select exposures to coadd
         
@@ -77,10 +120,94 @@ class CoaddBaseTask(pipeBase.CmdLineTask):
         @param[in] wcs: WCS of coadd patch
         @param[in] bbox: bbox of coadd patch
         @return a list of science exposures to coadd, as butler data references
+
+        If config.overlapIndexPath is specified or config.doSelectPerTract is True then wcs and bbox
+        are ignored; the exposures are those that overlap the outer bbox of the patch.
         """
+        if self.config.overlapIndexPath is not None:
+            skyInfo = self.getSkyInfo(patchRef)
+            patchIndex = tuple(skyInfo.patchInfo.getIndex())
+            return self._selectIndexedExposures(patchRef, skyInfo.tractInfo, [patchIndex])[patchIndex]
+        if self.config.doSelectPerTract:
+            return self._selectExposuresPerTract(patchRef)
         cornerPosList = afwGeom.Box2D(bbox).getCorners()
         coordList = [wcs.pixelToSky(pos) for pos in cornerPosList]
         return self.select.runDataRef(patchRef, coordList).dataRefList
+
+    def selectTractExposures(self, patchRef, tractInfo, patchIndexList=None):
+        """Select exposures to coadd for many patches of one tract with a single selection query
+
+        @param patchRef: data reference for any sky map patch of the tract. Must include keys
+            "tract", "patch", plus the camera-specific filter key (e.g. "filter" or "band")
+        @param[in] tractInfo: tract information for the tract
+        @param[in] patchIndexList: list of patch indices (x, y); if None then all patches of the tract
+        @return a dict of patch index (x, y): list of science exposures to coadd, as butler data references
+        """
+        if self.config.overlapIndexPath is not None:
+            if patchIndexList is None:
+                numPatches = tractInfo.getNumPatches()
+                patchIndexList = [(x, y) for y in range(numPatches[1]) for x in range(numPatches[0])]
+            return self._selectIndexedExposures(patchRef, tractInfo, patchIndexList)
+        return self.select.runTractDataRef(patchRef, tractInfo, patchIndexList).patchDataRefListDict
+
+    def _selectIndexedExposures(self, patchRef, tractInfo, patchIndexList):
+        """Select exposures for patches of one tract from the patch overlap index (config.overlapIndexPath)
+
+        The cuts of the selection subtask are applied to the exposures found in the index;
+        see BaseSelectImagesTask.selectIndexed.
+
+        @param patchRef: data reference for any sky map patch of the tract
+        @param[in] tractInfo: tract information for the tract
+        @param[in] patchIndexList: list of patch indices (x, y)
+        @return a dict of patch index (x, y): list of science exposures to coadd, as butler data references;
+            an exposure that overlaps several patches has the same data reference in each list
+        """
+        coaddId = getCoaddId(patchRef.dataId)
+        patchCandidateListDict = dict()
+        index = PatchOverlapIndex(self.config.overlapIndexPath)
+        try:
+            for patchIndex in patchIndexList:
+                patchIndex = tuple(patchIndex)
+                patchCandidateListDict[patchIndex] = [(dataId, patchFraction)
+                    for dataId, patchFraction, exposureFraction
+                    in index.getPatchExposures(tractInfo.getId(), patchIndex, coaddId)]
+        finally:
+            index.close()
+        patchDataIdListDict = self.select.selectIndexed(patchRef, tractInfo, patchCandidateListDict)
+
+        butler = patchRef.butlerSubset.butler
+        dataRefDict = dict() # data ID key: data reference
+        patchDataRefListDict = dict()
+        for patchIndex, dataIdList in patchDataIdListDict.iteritems():
+            dataRefList = []
+            for dataId in dataIdList:
+                dataIdKey = PatchOverlapIndex.getDataIdKey(dataId)
+                if dataIdKey not in dataRefDict:
+                    dataRefDict[dataIdKey] = butler.dataRef(datasetType="calexp", dataId=dataId)
+                dataRefList.append(dataRefDict[dataIdKey])
+            patchDataRefListDict[patchIndex] = dataRefList
+        return patchDataRefListDict
+
+    def _selectExposuresPerTract(self, patchRef):
+        """Select exposures for a patch using a selection for its whole tract, cached process-wide
+
+        Patches handled by one process are usually in the same tract (and for the same filter),
+        so only the first patch of each tract queries the selection subtask.
+
+        @param patchRef: data reference for sky map patch
+        @return a list of science exposures to coadd, as butler data references
+        """
+        skyInfo = self.getSkyInfo(patchRef)
+        otherItems = tuple(sorted((key, val) for key, val in patchRef.dataId.iteritems()
+            if key not in ("tract", "patch")))
+        cacheKey = (makeConfigHash(self.select.config), self.config.coaddName, skyInfo.tractInfo.getId(),
+            otherItems)
+        patchDataRefListDict = _TractSelectionCache.get(cacheKey)
+        if patchDataRefListDict is None:
+            patchDataRefListDict = self.selectTractExposures(patchRef, skyInfo.tractInfo)
+            _TractSelectionCache.put(cacheKey, patchDataRefListDict)
+            self.log.info("Selected exposures for all patches of tract %s" % (skyInfo.tractInfo.getId(),))
+        return list(patchDataRefListDict[tuple(skyInfo.patchInfo.getIndex())])
     
     def getSkyInfo(self, patchRef):
         """Return SkyMap, tract and patch
@@ -88,13 +215,13 @@ class CoaddBaseTask(pipeBase.CmdLineTask):
         @param patchRef: data reference for sky map. Must include keys "tract" and "patch"
         
         @return pipe_base Struct containing:
-        - skyMap: sky map
+        - skyMap: sky map (shared with other tasks in this process, so do not modify it)
         - tractInfo: information for chosen tract of sky map
         - patchInfo: information about chosen patch of tract
         - wcs: WCS of tract
         - bbox: outer bbox of patch, as an afwGeom Box2I
         """
-        skyMap = patchRef.get(self.config.coaddName + "Coadd_skyMap")
+        skyMap = getSkyMap(patchRef, self.config.coaddName + "Coadd_skyMap")
         tractId = patchRef.dataId["tract"]
         tractInfo = skyMap[tractId]
 
@@ -142,6 +269,51 @@ class CoaddBaseTask(pipeBase.CmdLineTask):
         """
         return "%s_%s_metadata" % (self.config.coaddName, self._DefaultName)
 
+def makeConfigHash(*configList):
+    """Return a hash string that identifies the values of one or more configs
+
+    The hash is intended for deciding whether persisted intermediate products
+    were made with the same configuration as the current run.
+
+    @param[in] configList: configs (pex_config Config) or other simple values to hash
+    @return hex digest (str)
+    """
+    md5 = hashlib.md5()
+    for config in configList:
+        if isinstance(config, pexConfig.Config):
+            config = config.toDict()
+        md5.update(repr(_makeSortedValue(config)))
+    return md5.hexdigest()
+
+def getDatasetSignature(dataRef, datasetTypeList):
+    """Return a signature of the files of one or more datasets, based on file modification time and size
+
+    The signature is intended for deciding whether persisted intermediate products were made
+    from the files that exist now.
+
+    @param[in] dataRef: data reference
+    @param[in] datasetTypeList: list of dataset types whose files are included
+    @return signature (a hex string), or "unknown" if any file could not be found
+    """
+    md5 = hashlib.md5()
+    for datasetType in datasetTypeList:
+        try:
+            fileName = dataRef.get(datasetType + "_filename")[0]
+            fileStat = os.stat(fileName)
+        except Exception:
+            return "unknown"
+        md5.update("%s %r %d" % (datasetType, fileStat.st_mtime, fileStat.st_size))
+    return md5.hexdigest()
+
+def _makeSortedValue(value):
+    """Return a version of value with all dicts replaced by sorted tuples of items, recursively
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((key, _makeSortedValue(val)) for key, val in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_makeSortedValue(val) for val in value)
+    return value
+
 class CoaddArgumentParser(pipeBase.ArgumentParser):
     """A version of lsst.pipe.base.ArgumentParser specialized for coaddition.
     
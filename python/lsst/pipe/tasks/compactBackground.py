@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import numpy
+
+__all__ = ["CompactBackground"]
+
+class CompactBackground(object):
+    """A compact representation of a smooth background image, which can be evaluated at any position
+
+    The background is stored as the mean of each binSize x binSize bin of the full-resolution image
+    and is evaluated by bilinear interpolation between bin centers (and extrapolation by the nearest
+    value beyond the outermost bin centers). It holds only numpy arrays and ints, so it may be pickled.
+    """
+    def __init__(self, image, binSize, signature=None):
+        """Construct a CompactBackground from a full-resolution background image
+
+        @param[in] image: full-resolution background (an afwImage.ImageF or similar)
+        @param[in] binSize: size of bins (pixels)
+        @param[in] signature: signature of the file the image was read from (used to detect changes),
+            or None if unknown
+        """
+        if binSize < 1:
+            raise RuntimeError("binSize=%s must be >= 1" % (binSize,))
+        self.binSize = int(binSize)
+        self.signature = signature
+        self.xy0 = (image.getX0(), image.getY0())
+        array = image.getArray()
+        height, width = array.shape
+        self.dimensions = (width, height)
+        numX = (width + self.binSize - 1) // self.binSize
+        numY = (height + self.binSize - 1) // self.binSize
+        self.binArr = numpy.zeros((numY, numX), dtype=numpy.float32)
+        self.xCenterArr = numpy.zeros(numX, dtype=float)
+        self.yCenterArr = numpy.zeros(numY, dtype=float)
+        for i in range(numX):
+            xStart = i * self.binSize
+            xEnd = min(xStart + self.binSize, width)
+            self.xCenterArr[i] = self.xy0[0] + 0.5 * (xStart + xEnd - 1)
+        for j in range(numY):
+            yStart = j * self.binSize
+            yEnd = min(yStart + self.binSize, height)
+            self.yCenterArr[j] = self.xy0[1] + 0.5 * (yStart + yEnd - 1)
+            for i in range(numX):
+                xStart = i * self.binSize
+                xEnd = min(xStart + self.binSize, width)
+                self.binArr[j, i] = array[yStart:yEnd, xStart:xEnd].mean()
+
+    def getNBytes(self):
+        """Return the number of bytes of data
+        """
+        return self.binArr.nbytes + self.xCenterArr.nbytes + self.yCenterArr.nbytes
+
+    def evaluate(self, xArr, yArr):
+        """Evaluate the background at the specified parent pixel positions
+
+        @param[in] xArr: x parent pixel positions (a numpy array of any shape)
+        @param[in] yArr: y parent pixel positions (a numpy array of the same shape as xArr)
+        @return background values, as a numpy array of the same shape as xArr
+        """
+        iArr, xFrac = self._getIndexAndFrac(numpy.asarray(xArr, dtype=float), self.xCenterArr)
+        jArr, yFrac = self._getIndexAndFrac(numpy.asarray(yArr, dtype=float), self.yCenterArr)
+        i1Arr = numpy.minimum(iArr + 1, len(self.xCenterArr) - 1)
+        j1Arr = numpy.minimum(jArr + 1, len(self.yCenterArr) - 1)
+        return self.binArr[jArr,  iArr ] * (1 - xFrac) * (1 - yFrac) \
+             + self.binArr[jArr,  i1Arr] * xFrac       * (1 - yFrac) \
+             + self.binArr[j1Arr, iArr ] * (1 - xFrac) * yFrac \
+             + self.binArr[j1Arr, i1Arr] * xFrac       * yFrac
+
+    @staticmethod
+    def _getIndexAndFrac(posArr, centerArr):
+        """Return the index of the bin center at or below each position, and the fractional
+        distance to the next bin center, clamped to [0, 1]
+        """
+        if len(centerArr) < 2:
+            return numpy.zeros(posArr.shape, dtype=int), numpy.zeros(posArr.shape, dtype=float)
+        indArr = numpy.clip(numpy.searchsorted(centerArr, posArr, side="right") - 1, 0, len(centerArr) - 2)
+        fracArr = (posArr - centerArr[indArr]) / (centerArr[indArr + 1] - centerArr[indArr])
+        return indArr, numpy.clip(fracArr, 0.0, 1.0)
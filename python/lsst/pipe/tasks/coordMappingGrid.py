@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import cPickle
+import hashlib
+import os
+
+import numpy
+
+import lsst.afw.geom as afwGeom
+from .lruCache import LruCache
+
+__all__ = ["CoordMappingGrid", "CoordMappingCache"]
+
+class CoordMappingGrid(object):
+    """An interpolated mapping from destination pixel position to source pixel position
+
+    The mapping is evaluated exactly (using the two WCSs) at the nodes of a regular grid
+    covering the footprint of the source image on the destination, and is bilinearly interpolated
+    between nodes. The grid holds only numpy arrays and ints, so it may be pickled.
+    """
+    def __init__(self, srcWcs, srcBBox, destWcs, spacing):
+        """Construct a CoordMappingGrid
+
+        @param[in] srcWcs: WCS of source image (e.g. calexp)
+        @param[in] srcBBox: parent bbox of source image (an afwGeom.Box2I)
+        @param[in] destWcs: WCS of destination image (e.g. tract)
+        @param[in] spacing: spacing of grid nodes (destination pixels)
+        """
+        if spacing < 1:
+            raise RuntimeError("spacing=%s must be >= 1" % (spacing,))
+        self.spacing = int(spacing)
+
+        # find the footprint of the source image on the destination by sampling its boundary,
+        # since the mapping is not linear
+        srcBox = afwGeom.Box2D(srcBBox)
+        numPerSide = 8
+        destBox = afwGeom.Box2D()
+        for i in range(numPerSide + 1):
+            frac = i / float(numPerSide)
+            xPos = srcBox.getMinX() + frac * srcBox.getWidth()
+            yPos = srcBox.getMinY() + frac * srcBox.getHeight()
+            for srcPos in (
+                afwGeom.Point2D(xPos, srcBox.getMinY()),
+                afwGeom.Point2D(xPos, srcBox.getMaxY()),
+                afwGeom.Point2D(srcBox.getMinX(), yPos),
+                afwGeom.Point2D(srcBox.getMaxX(), yPos),
+            ):
+                destBox.include(destWcs.skyToPixel(srcWcs.pixelToSky(srcPos)))
+        destBBox = afwGeom.Box2I(destBox, afwGeom.Box2I.EXPAND)
+        self.destMin = (destBBox.getMinX(), destBBox.getMinY())
+        self.destMax = (destBBox.getMaxX(), destBBox.getMaxY())
+
+        # grid nodes span the destination bbox; the last node may lie beyond it
+        numX = (destBBox.getWidth() + self.spacing - 1) // self.spacing + 1
+        numY = (destBBox.getHeight() + self.spacing - 1) // self.spacing + 1
+        self.srcXArr = numpy.zeros((numY, numX), dtype=float)
+        self.srcYArr = numpy.zeros((numY, numX), dtype=float)
+        for j in range(numY):
+            yPos = self.destMin[1] + j * self.spacing
+            for i in range(numX):
+                xPos = self.destMin[0] + i * self.spacing
+                srcPos = srcWcs.skyToPixel(destWcs.pixelToSky(afwGeom.Point2D(xPos, yPos)))
+                self.srcXArr[j, i] = srcPos[0]
+                self.srcYArr[j, i] = srcPos[1]
+
+    def getDestBBox(self):
+        """Return the parent bbox of the footprint of the source image on the destination (an afwGeom.Box2I)
+        """
+        return afwGeom.Box2I(afwGeom.Point2I(*self.destMin), afwGeom.Point2I(*self.destMax))
+
+    def mapToSource(self, xArr, yArr):
+        """Map destination pixel positions to source pixel positions
+
+        Positions should lie within getDestBBox(); positions outside are extrapolated
+        from the nearest grid cell, and so are less accurate.
+
+        @param[in] xArr: x destination pixel positions (a numpy array or sequence)
+        @param[in] yArr: y destination pixel positions (a numpy array or sequence)
+        @return (srcXArr, srcYArr): source pixel positions, as numpy arrays
+        """
+        xGrid = (numpy.asarray(xArr, dtype=float) - self.destMin[0]) / self.spacing
+        yGrid = (numpy.asarray(yArr, dtype=float) - self.destMin[1]) / self.spacing
+        numY, numX = self.srcXArr.shape
+        iArr = numpy.clip(numpy.floor(xGrid).astype(int), 0, numX - 2)
+        jArr = numpy.clip(numpy.floor(yGrid).astype(int), 0, numY - 2)
+        xFrac = xGrid - iArr
+        yFrac = yGrid - jArr
+        result = []
+        for nodeArr in (self.srcXArr, self.srcYArr):
+            result.append(
+                  nodeArr[jArr,     iArr    ] * (1 - xFrac) * (1 - yFrac) \
+                + nodeArr[jArr,     iArr + 1] * xFrac       * (1 - yFrac) \
+                + nodeArr[jArr + 1, iArr    ] * (1 - xFrac) * yFrac \
+                + nodeArr[jArr + 1, iArr + 1] * xFrac       * yFrac
+            )
+        return tuple(result)
+
+
+class CoordMappingCache(object):
+    """A cache of CoordMappingGrid, in memory (least recently used are discarded) and optionally on disk
+
+    Grids are keyed by the FITS representation of both WCSs, the source bbox and the grid spacing,
+    so a grid is found again whenever the same geometry is processed, e.g. for each patch
+    a calexp overlaps, or when the calexp is reprocessed.
+    """
+    def __init__(self, maxSize, cacheDir=None):
+        """Construct a CoordMappingCache
+
+        @param[in] maxSize: maximum number of grids to hold in memory
+        @param[in] cacheDir: directory in which to persist grids; None for no persistence
+        """
+        self._lruCache = LruCache(maxSize)
+        self._cacheDir = cacheDir
+
+    def getGrid(self, srcWcs, srcBBox, destWcs, spacing):
+        """Return a CoordMappingGrid, from the cache if possible, else computing and caching it
+
+        Arguments are as for the CoordMappingGrid constructor.
+        """
+        key = self._makeKey(srcWcs, srcBBox, destWcs, spacing)
+        grid = self._lruCache.get(key)
+        if grid is not None:
+            return grid
+        grid = self._readGrid(key)
+        if grid is None:
+            grid = CoordMappingGrid(srcWcs=srcWcs, srcBBox=srcBBox, destWcs=destWcs, spacing=spacing)
+            self._writeGrid(key, grid)
+        self._lruCache.put(key, grid)
+        return grid
+
+    @staticmethod
+    def _makeKey(srcWcs, srcBBox, destWcs, spacing):
+        """Return a key (a hex string) identifying a coordinate mapping
+        """
+        md5 = hashlib.md5()
+        for wcs in (srcWcs, destWcs):
+            md = wcs.getFitsMetadata()
+            for name in md.names():
+                md5.update("%s=%r\n" % (name, md.get(name)))
+        md5.update("%s %s %s %s %s" % (srcBBox.getMinX(), srcBBox.getMinY(), srcBBox.getMaxX(),
+            srcBBox.getMaxY(), spacing))
+        return md5.hexdigest()
+
+    def _getPath(self, key):
+        return os.path.join(self._cacheDir, "coordMappingGrid-%s.pickle" % (key,))
+
+    def _readGrid(self, key):
+        """Return the grid persisted for key, or None if none (or if persistence is disabled)
+        """
+        if self._cacheDir is None:
+            return None
+        path = self._getPath(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, "rb") as inFile:
+                return cPickle.load(inFile)
+        except Exception:
+            # a corrupt or incompatible file; it will be recomputed and rewritten
+            return None
+
+    def _writeGrid(self, key, grid):
+        """Persist grid for key, if persistence is enabled
+
+        The file is written under a temporary name and renamed, so that concurrent
+        processes never read a partial file.
+        """
+        if self._cacheDir is None:
+            return
+        if not os.path.isdir(self._cacheDir):
+            try:
+                os.makedirs(self._cacheDir)
+            except OSError:
+                # another process may have just made it
+                if not os.path.isdir(self._cacheDir):
+                    raise
+        path = self._getPath(key)
+        tempPath = "%s.%d.tmp" % (path, os.getpid())
+        with open(tempPath, "wb") as outFile:
+            cPickle.dump(grid, outFile, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tempPath, path)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""A columnar container of exposure information, for large image selections
+
+A list of BaseExposureInfo objects holds a data ID dict and four afwCoord.IcrsCoord per exposure,
+which is slow to make and to use for whole-sky selections. ExposureInfoTable holds the same
+information as numpy arrays and supports vectorized overlap tests; it is also a sequence of
+ExposureInfoRow objects, which have the fields of an exposure information object
+(dataId, coordList and any other columns), so code written for lists keeps working.
+"""
+import numpy
+
+import lsst.afw.coord as afwCoord
+import lsst.afw.geom as afwGeom
+
+__all__ = ["ExposureInfoTable", "ExposureInfoRow"]
+
+class ExposureInfoTable(object):
+    """A columnar container of exposure information
+
+    Columns are:
+    - one column per data ID key, e.g. visit and ccd
+    - ra, dec: corner coordinates of each exposure (ICRS, deg), as float arrays of shape (N, 4)
+    - any number of other columns, e.g. fwhm or filterName, as arrays of shape (N,)
+    """
+    def __init__(self, dataIdColumnDict, ra, dec, **columnDict):
+        """Construct an ExposureInfoTable
+
+        @param[in] dataIdColumnDict: dict of data ID key: array of values
+        @param[in] ra: RA of the corners of each exposure (deg); array-like of shape (N, 4)
+        @param[in] dec: Dec of the corners of each exposure (deg); array-like of shape (N, 4)
+        @param[in] columnDict: other columns, each an array-like of length N
+        """
+        self.ra = numpy.array(ra, dtype=float).reshape(-1, 4)
+        self.dec = numpy.array(dec, dtype=float).reshape(-1, 4)
+        numRows = len(self.ra)
+        if self.dec.shape != self.ra.shape:
+            raise RuntimeError("ra shape %s != dec shape %s" % (self.ra.shape, self.dec.shape))
+        self._dataIdColumnDict = dict()
+        for key, values in dataIdColumnDict.iteritems():
+            self._dataIdColumnDict[key] = numpy.array(values)
+        self._columnDict = dict()
+        for name, values in columnDict.iteritems():
+            if name in ("ra", "dec", "dataId", "coordList"):
+                raise RuntimeError("Column name %r is reserved" % (name,))
+            self._columnDict[name] = numpy.array(values)
+        for name, values in self._dataIdColumnDict.items() + self._columnDict.items():
+            if len(values) != numRows:
+                raise RuntimeError("Column %r has %d values; expected %d" % (name, len(values), numRows))
+        self._vertexNormalArrays = None # see _getVertexNormalArrays
+
+    @classmethod
+    def fromExposureInfoList(cls, exposureInfoList, columnNameList=()):
+        """Make an ExposureInfoTable from a list of exposure information objects
+
+        @param[in] exposureInfoList: list of objects with fields dataId (all with the same keys)
+            and coordList (four corners), e.g. BaseExposureInfo subclasses
+        @param[in] columnNameList: names of other fields to copy, e.g. ("fwhm",)
+        """
+        dataIdKeyList = sorted(exposureInfoList[0].dataId.keys()) if exposureInfoList else []
+        dataIdColumnDict = dict((key, [expInfo.dataId[key] for expInfo in exposureInfoList])
+            for key in dataIdKeyList)
+        ra = []
+        dec = []
+        for expInfo in exposureInfoList:
+            icrsCoordList = [coord.toIcrs() for coord in expInfo.coordList]
+            ra.append([coord.getRa().asDegrees() for coord in icrsCoordList])
+            dec.append([coord.getDec().asDegrees() for coord in icrsCoordList])
+        columnDict = dict((name, [getattr(expInfo, name) for expInfo in exposureInfoList])
+            for name in columnNameList)
+        return cls(dataIdColumnDict, ra, dec, **columnDict)
+
+    def __len__(self):
+        return len(self.ra)
+
+    def __iter__(self):
+        for ind in range(len(self)):
+            yield ExposureInfoRow(self, ind)
+
+    def __getitem__(self, ind):
+        """Return a row (for an integer index) or a new ExposureInfoTable (for a slice, index array
+        or boolean mask)
+        """
+        if isinstance(ind, (int, long, numpy.integer)):
+            if ind < 0:
+                ind += len(self)
+            if not 0 <= ind < len(self):
+                raise IndexError("Index %s out of range" % (ind,))
+            return ExposureInfoRow(self, ind)
+        dataIdColumnDict = dict((key, values[ind]) for key, values in self._dataIdColumnDict.iteritems())
+        columnDict = dict((name, values[ind]) for name, values in self._columnDict.iteritems())
+        return ExposureInfoTable(dataIdColumnDict, self.ra[ind], self.dec[ind], **columnDict)
+
+    def getDataIdKeys(self):
+        """Return the data ID keys, sorted
+        """
+        return sorted(self._dataIdColumnDict.keys())
+
+    def getDataIdColumn(self, key):
+        """Return the array of values for a data ID key
+        """
+        return self._dataIdColumnDict[key]
+
+    def getColumnNames(self):
+        """Return the names of the columns other than the data ID keys, ra and dec, sorted
+        """
+        return sorted(self._columnDict.keys())
+
+    def getColumn(self, name):
+        """Return the array of values of a column other than a data ID key, ra or dec
+        """
+        return self._columnDict[name]
+
+    def hasColumn(self, name):
+        """Return True if there is a column (other than a data ID key, ra or dec) with this name
+        """
+        return name in self._columnDict
+
+    def getDataId(self, ind):
+        """Return the data ID of one exposure as a dict
+        """
+        return dict((key, _toScalar(values[ind])) for key, values in self._dataIdColumnDict.iteritems())
+
+    def getCoordList(self, ind):
+        """Return the corner coordinates of one exposure as a list of afwCoord.IcrsCoord
+        """
+        return [afwCoord.IcrsCoord(afwGeom.Angle(ra, afwGeom.degrees), afwGeom.Angle(dec, afwGeom.degrees))
+            for ra, dec in zip(self.ra[ind], self.dec[ind])]
+
+    def getOverlapMask(self, raDecList, indices=None):
+        """Return a boolean array that is True for each exposure whose footprint overlaps a region
+
+        Footprints and the region are treated as convex spherical polygons with great-circle edges.
+        Two such polygons are disjoint if and only if all vertices of one lie outside
+        an edge of the other; this is tested for all exposures at once.
+        The vertices and edge normals of the footprints are computed once per table.
+
+        @param[in] raDecList: vertices of a convex region, as (RA, Dec) pairs (deg), in any order
+        @param[in] indices: indices of the exposures to test, as an integer array; if None then all
+        @return a boolean array with one element per tested exposure
+        """
+        if len(self) == 0 or (indices is not None and len(indices) == 0):
+            return numpy.zeros(0, dtype=bool)
+        regionRaDec = numpy.array(raDecList, dtype=float)
+        regionVec = _orderVertices(_vectorsFromRaDec(regionRaDec[:, 0], regionRaDec[:, 1])[numpy.newaxis])[0]
+        expVec, expNormals = self._getVertexNormalArrays()
+        if indices is not None:
+            expVec = expVec[indices]
+            expNormals = expNormals[indices]
+
+        regionNormals = _getInwardNormals(regionVec[numpy.newaxis])[0] # shape (M, 3)
+
+        # exposure vertex dot region edge normal, shape (N, 4, M)
+        expDotRegion = numpy.einsum("nkj,mj->nkm", expVec, regionNormals)
+        isSeparated = numpy.all(expDotRegion < 0, axis=1).any(axis=1)
+        # exposure edge normal dot region vertex, shape (N, 4, M)
+        regionDotExp = numpy.einsum("nkj,mj->nkm", expNormals, regionVec)
+        isSeparated |= numpy.all(regionDotExp < 0, axis=2).any(axis=1)
+        return ~isSeparated
+
+    def _getVertexNormalArrays(self):
+        """Return the unit vectors of the vertices of each footprint, in order, and the inward normals
+        of its edges, each of shape (N, 4, 3); computed on first use
+        """
+        if self._vertexNormalArrays is None:
+            expVec = _orderVertices(_vectorsFromRaDec(self.ra, self.dec))
+            self._vertexNormalArrays = (expVec, _getInwardNormals(expVec))
+        return self._vertexNormalArrays
+
+
+class ExposureInfoRow(object):
+    """One exposure of an ExposureInfoTable, with the fields of an exposure information object
+
+    Fields are dataId (a dict), coordList (a list of afwCoord.IcrsCoord) and one attribute
+    for each other column of the table. Rows are made on demand and refer to their table.
+    """
+    def __init__(self, table, ind):
+        self._table = table
+        self._ind = ind
+
+    @property
+    def dataId(self):
+        return self._table.getDataId(self._ind)
+
+    @property
+    def coordList(self):
+        return self._table.getCoordList(self._ind)
+
+    def __getattr__(self, name):
+        if name.startswith("_") or not self._table.hasColumn(name):
+            raise AttributeError("%s has no attribute %r" % (type(self).__name__, name))
+        return _toScalar(self._table.getColumn(name)[self._ind])
+
+    def __eq__(self, other):
+        return isinstance(other, ExposureInfoRow) and self._table is other._table and self._ind == other._ind
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self._table), self._ind))
+
+    def __repr__(self):
+        return "ExposureInfoRow(dataId=%s)" % (self.dataId,)
+
+
+def _toScalar(value):
+    """Convert a numpy scalar to the equivalent Python scalar
+    """
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+def _vectorsFromRaDec(ra, dec):
+    """Return unit vectors for arrays of RA, Dec (deg), with shape ra.shape + (3,)
+    """
+    raRad = numpy.radians(ra)
+    decRad = numpy.radians(dec)
+    cosDec = numpy.cos(decRad)
+    return numpy.concatenate([
+        (cosDec * numpy.cos(raRad))[..., numpy.newaxis],
+        (cosDec * numpy.sin(raRad))[..., numpy.newaxis],
+        numpy.sin(decRad)[..., numpy.newaxis],
+    ], axis=-1)
+
+def _normalize(vec):
+    """Normalize an array of vectors along the last axis
+    """
+    return vec / numpy.sqrt(numpy.sum(vec**2, axis=-1))[..., numpy.newaxis]
+
+def _orderVertices(vec):
+    """Sort the vertices of convex spherical polygons by position angle around their centers
+
+    @param[in] vec: unit vectors of vertices, shape (N, K, 3)
+    @return sorted unit vectors, shape (N, K, 3)
+    """
+    center = _normalize(numpy.sum(vec, axis=1)) # shape (N, 3)
+    refAxis = numpy.zeros(center.shape)
+    useX = numpy.abs(center[:, 0]) < 0.9
+    refAxis[useX, 0] = 1.0
+    refAxis[~useX, 1] = 1.0
+    axis1 = _normalize(numpy.cross(center, refAxis))
+    axis2 = numpy.cross(center, axis1)
+    angle = numpy.arctan2(numpy.einsum("nkj,nj->nk", vec, axis2), numpy.einsum("nkj,nj->nk", vec, axis1))
+    order = numpy.argsort(angle, axis=1)
+    return vec[numpy.arange(len(vec))[:, numpy.newaxis], order]
+
+def _getInwardNormals(vec):
+    """Return the normals of the edges of convex spherical polygons, pointing inward
+
+    @param[in] vec: unit vectors of vertices, in order, shape (N, K, 3)
+    @return normal of the edge from each vertex to the next, shape (N, K, 3)
+    """
+    normals = numpy.cross(vec, numpy.roll(vec, -1, axis=1))
+    center = numpy.sum(vec, axis=1)
+    sign = numpy.where(numpy.einsum("nkj,nj->nk", normals, center) < 0, -1.0, 1.0)
+    return normals * sign[..., numpy.newaxis]
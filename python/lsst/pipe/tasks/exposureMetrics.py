@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import contextlib
+import resource
+import time
+
+__all__ = ["ExposureMetrics", "getMaskedImageNBytes"]
+
+class ExposureMetrics(object):
+    """Measure the cost of processing one exposure and record it in task metadata
+
+    Each metric is added to the task metadata as "<prefix><Name>" (e.g. "matchReadTime"),
+    once per exposure, so each metadata item is an array with one entry per exposure
+    and entries with the same index refer to the same exposure.
+    Metrics that were not measured for an exposure are recorded as NaN, to keep the arrays aligned.
+
+    The following are always recorded (memory units are those of resource.getrusage:
+    kB on Linux, bytes on Mac OS X):
+    - <prefix>ExpId: data ID of the exposure, as a string
+    - <prefix>MaxResidentSetSize: peak resident set size of the process so far,
+        measured when the exposure has been processed
+    - <prefix>MaxRssDelta: increase in peak resident set size while processing the exposure.
+        The peak is a high-water mark for the whole process, so this is 0 for an exposure
+        that needed no more memory than an earlier one; use it to find the exposures that raised
+        the peak, and MaxResidentSetSize for the memory in use
+    """
+    def __init__(self, task, prefix, dataId, nameList):
+        """Construct an ExposureMetrics and start measuring peak memory
+
+        @param[in] task: task whose metadata receives the metrics
+        @param[in] prefix: prefix for metadata item names
+        @param[in] dataId: data ID of the exposure
+        @param[in] nameList: names of all metrics that may be measured; each name must start
+            with an uppercase letter, e.g. "ReadTime"
+        """
+        self._task = task
+        self._prefix = prefix
+        self._dataIdStr = " ".join("%s=%s" % (key, dataId[key]) for key in sorted(dataId.keys()))
+        self._nameList = tuple(nameList)
+        self._valueDict = dict()
+        self._startMaxRss = self._getMaxRss()
+
+    @staticmethod
+    def _getMaxRss():
+        """Return the peak resident set size of this process
+        """
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    @contextlib.contextmanager
+    def timeStage(self, name):
+        """Context manager that adds the elapsed wall-clock time (sec) of its block to metric name
+
+        Time is added, rather than set, so a stage may be timed in several pieces.
+        """
+        startTime = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - startTime)
+
+    def set(self, name, value):
+        """Set the value of a metric
+
+        @raise RuntimeError if name is not in nameList
+        """
+        if name not in self._nameList:
+            raise RuntimeError("Unknown metric %r; must be one of %s" % (name, self._nameList))
+        self._valueDict[name] = value
+
+    def add(self, name, value):
+        """Add value to a metric, which starts at 0
+
+        @raise RuntimeError if name is not in nameList
+        """
+        self.set(name, self._valueDict.get(name, 0) + value)
+
+    def get(self, name):
+        """Return the value of a metric, or None if it has not been set
+        """
+        return self._valueDict.get(name)
+
+    def getValueDict(self):
+        """Return a dict of metric name: value for the metrics that have been set
+
+        The dict may be pickled, e.g. to return metrics measured in another process,
+        which can then be restored by calling set for each item.
+        """
+        return dict(self._valueDict)
+
+    def record(self):
+        """Add the metrics to the task metadata
+
+        Call once, when the exposure has been processed.
+        """
+        metadata = self._task.metadata
+        metadata.add(self._prefix + "ExpId", self._dataIdStr)
+        for name in self._nameList:
+            metadata.add(self._prefix + name, float(self._valueDict.get(name, float("nan"))))
+        maxRss = self._getMaxRss()
+        metadata.add(self._prefix + "MaxResidentSetSize", maxRss)
+        metadata.add(self._prefix + "MaxRssDelta", maxRss - self._startMaxRss)
+
+
+def getMaskedImageNBytes(maskedImage):
+    """Return the number of bytes of pixel data in a MaskedImage (image, mask and variance planes)
+    """
+    return sum(plane.getArray().nbytes for plane in
+        (maskedImage.getImage(), maskedImage.getMask(), maskedImage.getVariance()))
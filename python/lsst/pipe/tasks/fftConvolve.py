@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Convolution of masked images using FFTs
+
+afwMath.convolve computes each output pixel directly, so its cost per pixel grows as the kernel area.
+For a spatially invariant kernel an FFT-based convolution costs per pixel only the log of the FFT size,
+so is much faster for large kernels (e.g. PSF matching of exposures with bad seeing).
+The image is convolved in tiles that are added together (overlap-add), which bounds the FFT size
+and so the memory used.
+
+fftConvolveMaskedImage reproduces afwMath.convolve (with doCopyEdge false) to within rounding error:
+- the kernel is applied in the same orientation and with the same center
+- the variance is convolved with the square of the kernel
+- each mask bit is OR-ed over the pixels where the kernel is nonzero
+- a pixel whose kernel footprint includes a non-finite pixel is non-finite
+- edge pixels (whose kernel footprint extends beyond the image) are set to (NaN, EDGE, inf)
+"""
+import numpy
+
+import lsst.pex.config as pexConfig
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+
+__all__ = ["ConvolveConfig", "useFftConvolve", "convolveMaskedImage", "fftConvolveMaskedImage"]
+
+class ConvolveConfig(pexConfig.Config):
+    """Config for convolveMaskedImage
+    """
+    fftMinKernelSize = pexConfig.Field(
+        doc = "convolve using FFTs if the kernel is spatially invariant and its width or height " \
+            "is at least this (pixels); None to always use afwMath.convolve. " \
+            "Use bin/benchmarkConvolution.py to find the crossover for your machine",
+        dtype = int,
+        optional = True,
+        check = lambda x: x > 0,
+    )
+    fftTileSize = pexConfig.Field(
+        doc = "width and height of image tiles convolved by each FFT (pixels); the FFT size is this " \
+            "plus the kernel size - 1, rounded up to a product of 2, 3 and 5",
+        dtype = int,
+        default = 512,
+        check = lambda x: x > 0,
+    )
+
+def useFftConvolve(kernel, config):
+    """Return True if convolveMaskedImage will convolve using FFTs
+
+    @param[in] kernel: convolution kernel (an afwMath.Kernel)
+    @param[in] config: convolution configuration (a ConvolveConfig)
+    """
+    if config.fftMinKernelSize is None or kernel.isSpatiallyVarying():
+        return False
+    return max(kernel.getWidth(), kernel.getHeight()) >= config.fftMinKernelSize
+
+def convolveMaskedImage(destMI, srcMI, kernel, config, doNormalize=True):
+    """Convolve a masked image, using FFTs if the kernel is large and spatially invariant
+    (see useFftConvolve), else afwMath.convolve
+
+    @param[out] destMI: convolved masked image; must have the same dimensions as srcMI
+    @param[in] srcMI: masked image to convolve
+    @param[in] kernel: convolution kernel (an afwMath.Kernel)
+    @param[in] config: convolution configuration (a ConvolveConfig)
+    @param[in] doNormalize: normalize the kernel to sum to 1?
+    """
+    if useFftConvolve(kernel, config):
+        fftConvolveMaskedImage(destMI, srcMI, kernel, doNormalize=doNormalize, tileSize=config.fftTileSize)
+    else:
+        afwMath.convolve(destMI, srcMI, kernel, doNormalize)
+
+def fftConvolveMaskedImage(destMI, srcMI, kernel, doNormalize=True, tileSize=512):
+    """Convolve a masked image with a spatially invariant kernel using FFTs
+
+    @param[out] destMI: convolved masked image; must have the same dimensions as srcMI
+    @param[in] srcMI: masked image to convolve
+    @param[in] kernel: convolution kernel (an afwMath.Kernel); must be spatially invariant
+    @param[in] doNormalize: normalize the kernel to sum to 1?
+    @param[in] tileSize: width and height of image tiles convolved by each FFT (pixels)
+
+    @raise RuntimeError if the kernel is spatially varying or the images have different dimensions
+    """
+    if kernel.isSpatiallyVarying():
+        raise RuntimeError("FFT convolution requires a spatially invariant kernel")
+    if destMI.getDimensions() != srcMI.getDimensions():
+        raise RuntimeError("destMI dimensions %s != srcMI dimensions %s" % \
+            (destMI.getDimensions(), srcMI.getDimensions()))
+    kImage = afwImage.ImageD(kernel.getDimensions())
+    kernel.computeImage(kImage, doNormalize)
+    kArr = kImage.getArray()
+    ctrX, ctrY = kernel.getCtrX(), kernel.getCtrY()
+    shape = srcMI.getImage().getArray().shape
+    correlator = _FftCorrelator(kArr, ctrX=ctrX, ctrY=ctrY, shape=shape, tileSize=tileSize)
+    footprintCorrelator = _FftCorrelator((kArr != 0).astype(float), ctrX=ctrX, ctrY=ctrY, shape=shape,
+        tileSize=tileSize)
+    squareCorrelator = _FftCorrelator(kArr**2, ctrX=ctrX, ctrY=ctrY, shape=shape, tileSize=tileSize)
+
+    def reaches(boolArr):
+        """Return a bool array that is True where the kernel footprint includes a True pixel of boolArr
+        """
+        return footprintCorrelator.correlate(boolArr.astype(float)) > 0.5
+
+    # a non-finite pixel would spread through the whole tile, so convolve it as 0 and then
+    # set the pixels whose kernel footprint includes it
+    for srcPlane, destPlane, planeCorrelator in (
+        (srcMI.getImage(), destMI.getImage(), correlator),
+        (srcMI.getVariance(), destMI.getVariance(), squareCorrelator),
+    ):
+        srcArr = srcPlane.getArray()
+        destArr = destPlane.getArray()
+        nanArr = numpy.isnan(srcArr)
+        infArr = numpy.isinf(srcArr)
+        destArr[:] = planeCorrelator.correlate(numpy.where(nanArr | infArr, 0.0, srcArr))
+        if infArr.any():
+            destArr[reaches(infArr)] = numpy.nan if destPlane is destMI.getImage() else numpy.inf
+        if nanArr.any():
+            destArr[reaches(nanArr)] = numpy.nan
+
+    srcMaskArr = srcMI.getMask().getArray()
+    destMaskArr = destMI.getMask().getArray()
+    destMaskArr[:] = 0
+    orMask = int(numpy.bitwise_or.reduce(srcMaskArr.ravel())) if srcMaskArr.size > 0 else 0
+    bit = 0
+    while orMask >> bit:
+        bitMask = 1 << bit
+        if orMask & bitMask:
+            destMaskArr[reaches((srcMaskArr & bitMask) != 0)] |= bitMask
+        bit += 1
+
+    # edge pixels, as set by afwMath.convolve
+    edgeArr = numpy.ones(shape, dtype=bool)
+    height, width = shape
+    kHeight, kWidth = kArr.shape
+    edgeArr[ctrY:height - kHeight + ctrY + 1, ctrX:width - kWidth + ctrX + 1] = False
+    destMI.getImage().getArray()[edgeArr] = numpy.nan
+    destMaskArr[edgeArr] = afwImage.MaskU.getPlaneBitMask("EDGE")
+    destMI.getVariance().getArray()[edgeArr] = numpy.inf
+
+
+class _FftCorrelator(object):
+    """Apply a kernel to 2-d arrays of a fixed shape, as afwMath.convolve does, using FFTs
+
+    The result is out[y, x] = sum over j, i of arr[y - ctrY + j, x - ctrX + i] * kArr[j, i],
+    where arr is taken to be 0 outside its bounds.
+    """
+    def __init__(self, kArr, ctrX, ctrY, shape, tileSize):
+        """Construct a _FftCorrelator
+
+        @param[in] kArr: kernel image array
+        @param[in] ctrX, ctrY: center of kernel (pixels)
+        @param[in] shape: shape of arrays to be correlated
+        @param[in] tileSize: width and height of image tiles convolved by each FFT (pixels)
+        """
+        self.kShape = kArr.shape
+        self.ctrX = ctrX
+        self.ctrY = ctrY
+        self.shape = tuple(shape)
+        self.tileShape = (max(1, min(tileSize, self.shape[0])), max(1, min(tileSize, self.shape[1])))
+        self.fftShape = tuple(_getFftSize(tileLen + kLen - 1)
+            for tileLen, kLen in zip(self.tileShape, self.kShape))
+        # correlation is convolution with the flipped kernel
+        self.kFftArr = numpy.fft.rfft2(kArr[::-1, ::-1], self.fftShape)
+
+    def correlate(self, arr):
+        """Return arr correlated with the kernel, as a new float64 array of the same shape
+        """
+        if arr.shape != self.shape:
+            raise RuntimeError("arr shape %s != %s" % (arr.shape, self.shape))
+        height, width = self.shape
+        kHeight, kWidth = self.kShape
+        tileHeight, tileWidth = self.tileShape
+        fullArr = numpy.zeros((height + kHeight - 1, width + kWidth - 1), dtype=float)
+        for yStart in range(0, height, tileHeight):
+            yEnd = min(yStart + tileHeight, height)
+            for xStart in range(0, width, tileWidth):
+                xEnd = min(xStart + tileWidth, width)
+                tileFftArr = numpy.fft.rfft2(arr[yStart:yEnd, xStart:xEnd], self.fftShape)
+                convArr = numpy.fft.irfft2(tileFftArr * self.kFftArr, self.fftShape)
+                outHeight = yEnd - yStart + kHeight - 1
+                outWidth = xEnd - xStart + kWidth - 1
+                fullArr[yStart:yStart + outHeight, xStart:xStart + outWidth] += convArr[:outHeight, :outWidth]
+        yOffset = kHeight - 1 - self.ctrY
+        xOffset = kWidth - 1 - self.ctrX
+        return fullArr[yOffset:yOffset + height, xOffset:xOffset + width]
+
+def _getFftSize(minSize):
+    """Return the smallest integer >= minSize whose only prime factors are 2, 3 and 5
+    (for which FFTs are fast)
+    """
+    size = max(1, minSize)
+    while True:
+        remainder = size
+        for factor in (2, 3, 5):
+            while remainder % factor == 0:
+                remainder //= factor
+        if remainder == 1:
+            return size
+        size += 1
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Tile compression of persisted exposures
+
+afw writes exposures uncompressed, so compression is applied to the FITS file after it is written:
+each image extension is rewritten as a tile-compressed image (a FITS binary table that cfitsio,
+and hence afw, reads transparently as an image). The HDU order is unchanged, so readers need
+no changes, and reading a subregion only decompresses the tiles it overlaps.
+Data in the primary HDU cannot be tile-compressed and is left as it is.
+"""
+import os
+
+import lsst.pex.config as pexConfig
+
+__all__ = ["FitsCompressionConfig", "compressFitsFile", "compressDataset"]
+
+_AlgorithmDict = {
+    "GZIP_1": "gzip",
+    "GZIP_2": "gzip with byte shuffling; usually best for floating-point data",
+    "RICE_1": "Rice; fast, and good for integer data",
+    "HCOMPRESS_1": "H-compress; 2-dimensional wavelet compression",
+    "PLIO_1": "IRAF PLIO; only for non-negative integers < 2^24, e.g. masks",
+}
+
+class FitsCompressionConfig(pexConfig.Config):
+    """Config for compressing a persisted exposure (image, mask and variance planes)
+    """
+    doCompress = pexConfig.Field(
+        doc = "Compress the file?",
+        dtype = bool,
+        default = False,
+    )
+    imageAlgorithm = pexConfig.ChoiceField(
+        doc = "compression algorithm for the image plane",
+        dtype = str,
+        default = "GZIP_2",
+        allowed = _AlgorithmDict,
+    )
+    maskAlgorithm = pexConfig.ChoiceField(
+        doc = "compression algorithm for the mask plane (always lossless)",
+        dtype = str,
+        default = "RICE_1",
+        allowed = _AlgorithmDict,
+    )
+    varianceAlgorithm = pexConfig.ChoiceField(
+        doc = "compression algorithm for the variance plane",
+        dtype = str,
+        default = "GZIP_2",
+        allowed = _AlgorithmDict,
+    )
+    quantizeLevel = pexConfig.Field(
+        doc = "If None then the image and variance planes are compressed losslessly " \
+            "(which requires a GZIP algorithm); otherwise they are quantized to " \
+            "(noise sigma / quantizeLevel) before compression (lossy, but much smaller)",
+        dtype = float,
+        optional = True,
+        check = lambda x: x > 0,
+    )
+    tileSize = pexConfig.ListField(
+        doc = "Width, height of compression tiles (pixels); " \
+            "reading a subregion decompresses every tile it overlaps",
+        dtype = int,
+        length = 2,
+        default = (256, 256),
+    )
+
+    def validate(self):
+        pexConfig.Config.validate(self)
+        if self.quantizeLevel is None:
+            for name in ("imageAlgorithm", "varianceAlgorithm"):
+                if not getattr(self, name).startswith("GZIP"):
+                    raise ValueError("%s=%s cannot compress floating-point data losslessly; " \
+                        "use a GZIP algorithm or set quantizeLevel" % (name, getattr(self, name)))
+        if self.doCompress:
+            # fail now, rather than after the uncompressed file has been written
+            try:
+                _importPyfits()
+            except ImportError:
+                raise ValueError("doCompress is True but neither pyfits nor astropy.io.fits can be imported")
+
+def _importPyfits():
+    """Import and return pyfits (or astropy.io.fits)
+
+    @throw ImportError if neither can be imported
+    """
+    try:
+        import pyfits
+    except ImportError:
+        import astropy.io.fits as pyfits
+    return pyfits
+
+def compressFitsFile(inFileName, config, outFileName=None):
+    """Tile-compress the image extensions of a FITS file containing an exposure or masked image
+
+    The first three image extensions are taken to be the image, mask and variance planes,
+    in that order (unless EXTTYPE identifies them); any others are compressed like the mask
+    if they have integer pixels, else like the image.
+    Other extensions (e.g. tables) and already-compressed extensions are copied unchanged.
+
+    @param[in] inFileName: path of file to compress
+    @param[in] config: compression configuration (a FitsCompressionConfig); doCompress is ignored
+    @param[in] outFileName: path of compressed file; if None then inFileName is replaced
+        (the compressed file is written under a temporary name and then renamed)
+    """
+    pyfits = _importPyfits()
+    if outFileName is None:
+        outFileName = inFileName
+    tempFileName = "%s.%d.tmp" % (outFileName, os.getpid())
+    # the FITS tile size is (width, height), but pyfits expects numpy axis order (height, width)
+    tileSize = (config.tileSize[1], config.tileSize[0])
+
+    inHduList = pyfits.open(inFileName, memmap=False, uint=True)
+    try:
+        outHduList = pyfits.HDUList([inHduList[0]])
+        planeNameList = ["IMAGE", "MASK", "VARIANCE"]
+        for hdu in inHduList[1:]:
+            if not isinstance(hdu, pyfits.ImageHDU) or hdu.data is None:
+                outHduList.append(hdu)
+                continue
+            planeName = hdu.header.get("EXTTYPE", "").strip().upper()
+            if planeName in planeNameList:
+                planeNameList.remove(planeName)
+            elif planeNameList:
+                planeName = planeNameList.pop(0)
+            isInteger = hdu.data.dtype.kind in ("i", "u")
+            if planeName == "MASK" or (planeName not in ("IMAGE", "VARIANCE") and isInteger):
+                algorithm = config.maskAlgorithm
+                quantizeLevel = 16 # not used for integer data
+            else:
+                algorithm = config.varianceAlgorithm if planeName == "VARIANCE" else config.imageAlgorithm
+                quantizeLevel = 0.0 if config.quantizeLevel is None else config.quantizeLevel
+            outHduList.append(pyfits.CompImageHDU(
+                data = hdu.data,
+                header = hdu.header,
+                compression_type = algorithm,
+                tile_size = tileSize,
+                quantize_level = quantizeLevel,
+            ))
+        outHduList.writeto(tempFileName, clobber=True)
+    finally:
+        inHduList.close()
+    os.rename(tempFileName, outFileName)
+
+def compressDataset(dataRef, datasetType, config, log=None):
+    """Compress the file of a persisted dataset in place, if config.doCompress is True
+
+    @param[in] dataRef: data reference for the dataset
+    @param[in] datasetType: dataset type; datasetType + "_filename" must be supported by the butler
+    @param[in] config: compression configuration (a FitsCompressionConfig)
+    @param[in] log: log for a message about compression, or None for no message
+    """
+    if not config.doCompress:
+        return
+    fileName = dataRef.get(datasetType + "_filename")[0]
+    origSize = os.path.getsize(fileName)
+    compressFitsFile(fileName, config)
+    if log is not None:
+        log.info("Compressed %s %s by a factor of %0.2f" % \
+            (datasetType, dataRef.dataId, origSize / float(max(1, os.path.getsize(fileName)))))
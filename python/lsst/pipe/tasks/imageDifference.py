@@ -36,6 +36,10 @@ import lsst.meas.astrom as measAstrom
 from lsst.meas.algorithms import SourceDetectionTask, SourceMeasurementTask, SourceDeblendTask, \
     starSelectorRegistry, AlgorithmRegistry, PsfAttributes
 from lsst.ip.diffim import ImagePsfMatchTask, DipoleMeasurementTask, DipoleAnalysis, SourceFlagChecker
+from .fftConvolve import ConvolveConfig, convolveMaskedImage
+from .fitsCompression import FitsCompressionConfig, compressDataset
+from .patchOverlapIndex import PatchOverlapIndex
+from .skyMapCache import getSkyMap
              
 FwhmPerSigma = 2 * math.sqrt(2 * math.log(2))
 
@@ -53,6 +57,8 @@ class ImageDifferenceConfig(pexConfig.Config):
         doc = "Use a simple gaussian PSF model for pre-convolution (else use fit PSF)? "
             "Ignored if doPreConvolve false.",
     )
+    preConvolve = pexConfig.ConfigField(dtype=ConvolveConfig,
+        doc = "convolution of the science exposure for pre-convolution (direct or FFT-based)")
     doDetection = pexConfig.Field(dtype=bool, default=True, doc = "Detect sources?")
     doMerge = pexConfig.Field(dtype=bool, default=True,
         doc = "Merge positive and negative diaSources with grow radius set by growFootprint")
@@ -62,6 +68,8 @@ class ImageDifferenceConfig(pexConfig.Config):
     doWriteSubtractedExp = pexConfig.Field(dtype=bool, default=True, doc = "Write difference exposure?")
     doWriteMatchedExp = pexConfig.Field(dtype=bool, default=False,
         doc = "Write warped and PSF-matched template coadd exposure?")
+    diffExpCompression = pexConfig.ConfigField(dtype=FitsCompressionConfig,
+        doc = "Compression of persisted difference exposure and warped and PSF-matched template exposure")
     doWriteSources = pexConfig.Field(dtype=bool, default=True, doc = "Write sources?")
     doWriteHeavyFootprintsInSources = pexConfig.Field(dtype=bool, default=False,
         doc = "Include HeavyFootprint data in source table?")
@@ -71,6 +79,12 @@ class ImageDifferenceConfig(pexConfig.Config):
         dtype = str,
         default = "deep",
     )
+    overlapIndexPath = pexConfig.Field(
+        doc = "Path of a patch overlap index, as made by bin/reportImagesToCoadd.py; if specified " \
+            "and the exposure is in the index then the template patches are looked up in it",
+        dtype = str,
+        optional = True,
+    )
     convolveTemplate = pexConfig.Field(
         doc = "Which image gets convolved (default = template)",
         dtype = bool,
@@ -249,7 +263,6 @@ class ImageDifferenceTask(pipeBase.CmdLineTask):
             # compute scienceSigmaPost: sigma of science exposure with pre-convolution, if done,
             # else sigma of original science exposure
             if self.config.doPreConvolve:
-                convControl = afwMath.ConvolutionControl()
                 # cannot convolve in place, so make a new MI to receive convolved image
                 srcMI = exposure.getMaskedImage()
                 destMI = srcMI.Factory(srcMI.getDimensions())
@@ -261,7 +274,8 @@ class ImageDifferenceTask(pipeBase.CmdLineTask):
                 else:
                     # convolve with science exposure's PSF model
                     preConvPsf = psf
-                afwMath.convolve(destMI, srcMI, preConvPsf.getKernel(), convControl)
+                convolveMaskedImage(destMI, srcMI, preConvPsf.getKernel(), self.config.preConvolve,
+                    doNormalize=True)
                 exposure.setMaskedImage(destMI)
                 scienceSigmaPost = scienceSigmaOrig * math.sqrt(2)
             else:
@@ -308,7 +322,9 @@ class ImageDifferenceTask(pipeBase.CmdLineTask):
             subtractedExposure = subtractRes.subtractedExposure
 
             if self.config.doWriteMatchedExp:
-                sensorRef.put(subtractRes.matchedExposure, self.config.coaddName + "Diff_matchedExp")
+                matchedExposureName = self.config.coaddName + "Diff_matchedExp"
+                sensorRef.put(subtractRes.matchedExposure, matchedExposureName)
+                compressDataset(sensorRef, matchedExposureName, self.config.diffExpCompression, log=self.log)
 
         if self.config.doDetection:
             if subtractedExposure is None:
@@ -394,6 +410,7 @@ class ImageDifferenceTask(pipeBase.CmdLineTask):
 
         if self.config.doWriteSubtractedExp:
             sensorRef.put(subtractedExposure, subtractedExposureName)
+            compressDataset(sensorRef, subtractedExposureName, self.config.diffExpCompression, log=self.log)
  
         self.runDebug(exposure, subtractRes, selectSources, kernelSources, diaSources)
         return pipeBase.Struct(
@@ -485,14 +502,16 @@ class ImageDifferenceTask(pipeBase.CmdLineTask):
         
         @note: the coadd consists of whole patches stitched together, so it may be larger than necessary
         """
-        skyMap = sensorRef.get(datasetType=self.config.coaddName + "Coadd_skyMap")
-        expWcs = exposure.getWcs()
-        expBoxD = afwGeom.Box2D(exposure.getBBox(afwImage.PARENT))
-        ctrSkyPos = expWcs.pixelToSky(expBoxD.getCenter())
-        tractInfo = skyMap.findTract(ctrSkyPos)
+        skyMap = getSkyMap(sensorRef, self.config.coaddName + "Coadd_skyMap")
+        tractInfo, patchList = self.findIndexedPatches(skyMap, sensorRef.dataId)
+        if tractInfo is None:
+            expWcs = exposure.getWcs()
+            expBoxD = afwGeom.Box2D(exposure.getBBox(afwImage.PARENT))
+            ctrSkyPos = expWcs.pixelToSky(expBoxD.getCenter())
+            tractInfo = skyMap.findTract(ctrSkyPos)
+            skyCorners = [expWcs.pixelToSky(pixPos) for pixPos in expBoxD.getCorners()]
+            patchList = tractInfo.findPatchList(skyCorners)
         self.log.info("Using skyMap tract %s" % (tractInfo.getId(),))
-        skyCorners = [expWcs.pixelToSky(pixPos) for pixPos in expBoxD.getCorners()]
-        patchList = tractInfo.findPatchList(skyCorners)
         if not patchList:
             raise RuntimeError("No suitable tract found")
         self.log.info("Assembling %s coadd patches" % (len(patchList),))
@@ -567,6 +586,35 @@ class ImageDifferenceTask(pipeBase.CmdLineTask):
         coaddExposure.setPsf(coaddPsf)
         return coaddExposure, coaddApCorr
 
+    def findIndexedPatches(self, skyMap, dataId):
+        """Find the template patches for an exposure in the patch overlap index (config.overlapIndexPath)
+
+        @param[in] skyMap: sky map
+        @param[in] dataId: data ID of exposure
+        @return (tractInfo, patchList): the tract containing the largest fraction of the exposure
+            and the patches of that tract that the exposure overlaps; (None, None) if there is no index
+            or the exposure is not in it
+        """
+        if self.config.overlapIndexPath is None:
+            return None, None
+        index = PatchOverlapIndex(self.config.overlapIndexPath)
+        try:
+            overlapList = index.getExposurePatches(dataId)
+        finally:
+            index.close()
+        if not overlapList:
+            self.log.info("Exposure %s not in patch overlap index; using sky map geometry" % (dataId,))
+            return None, None
+        fractionDict = dict() # tract ID: fraction of exposure in tract
+        for tractId, patchIndex, patchFraction, exposureFraction in overlapList:
+            fractionDict[tractId] = fractionDict.get(tractId, 0.0) + exposureFraction
+        tractId = max(sorted(fractionDict.keys()), key=lambda tractId: fractionDict[tractId])
+        tractInfo = skyMap[tractId]
+        patchList = [tractInfo.getPatchInfo(patchIndex)
+            for overlapTractId, patchIndex, patchFraction, exposureFraction in overlapList
+            if overlapTractId == tractId]
+        return tractInfo, patchList
+
     def _getConfigName(self):
         """Return the name of the config dataset
         """
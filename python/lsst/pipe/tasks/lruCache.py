@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import collections
+
+__all__ = ["LruCache"]
+
+class LruCache(object):
+    """A least-recently-used cache with a limit on total size
+
+    By default each item has size 1, so maxSize is the maximum number of items;
+    specify sizeFunc to limit something else, such as the number of bytes.
+    The most recently stored or retrieved item is always kept, even if it exceeds maxSize.
+    """
+    def __init__(self, maxSize, sizeFunc=None):
+        """Construct an LruCache
+
+        @param[in] maxSize: maximum total size of cached items; if <= 0 then nothing is cached
+        @param[in] sizeFunc: function that returns the size of an item; if None then each item has size 1
+        """
+        self.maxSize = maxSize
+        self._sizeFunc = sizeFunc if sizeFunc is not None else lambda value: 1
+        self._itemDict = collections.OrderedDict() # key: (value, size), oldest first
+        self._totSize = 0
+        self.numHits = 0
+        self.numMisses = 0
+
+    def __len__(self):
+        return len(self._itemDict)
+
+    def __contains__(self, key):
+        return key in self._itemDict
+
+    def getTotalSize(self):
+        """Return the total size of the cached items
+        """
+        return self._totSize
+
+    def get(self, key, default=None):
+        """Return the value for key and mark it as most recently used, or default if not cached
+        """
+        item = self._itemDict.pop(key, None)
+        if item is None:
+            self.numMisses += 1
+            return default
+        self.numHits += 1
+        self._itemDict[key] = item
+        return item[0]
+
+    def put(self, key, value):
+        """Cache value for key, discarding least recently used items as needed to respect maxSize
+        """
+        if self.maxSize <= 0:
+            return
+        self.pop(key)
+        size = self._sizeFunc(value)
+        self._itemDict[key] = (value, size)
+        self._totSize += size
+        while self._totSize > self.maxSize and len(self._itemDict) > 1:
+            oldKey, (oldValue, oldSize) = self._itemDict.popitem(last=False)
+            self._totSize -= oldSize
+
+    def pop(self, key, default=None):
+        """Remove key from the cache and return its value, or default if not cached
+        """
+        item = self._itemDict.pop(key, None)
+        if item is None:
+            return default
+        self._totSize -= item[1]
+        return item[0]
+
+    def clear(self):
+        """Remove all items from the cache
+        """
+        self._itemDict.clear()
+        self._totSize = 0
@@ -20,16 +20,25 @@
 # the GNU General Public License along with this program.  If not,
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
+import collections
 import math
+import multiprocessing
+import sys
+import traceback
 
 import numpy
 
 import lsst.pex.config as pexConfig
 import lsst.afw.geom as afwGeom
 import lsst.afw.image as afwImage
+import lsst.daf.base as dafBase
 import lsst.coadd.utils as coaddUtils
 import lsst.pipe.base as pipeBase
-from .coaddBase import CoaddBaseTask
+from .coaddBase import CoaddBaseTask, makeConfigHash, getDatasetSignature
+from .fitsCompression import FitsCompressionConfig, compressDataset
+from .mappedExposure import writeMappedExposure, getMappedPath
+from .overlap import polygonBoxOverlapArea
+from .tempExpUtils import cropTempExp
 from .warpAndPsfMatch import WarpAndPsfMatchTask
 
 __all__ = ["MakeCoaddTempExpTask"]
@@ -56,22 +65,209 @@ class MakeCoaddTempExpConfig(CoaddBaseTask.ConfigClass):
         dtype = bool,
         default = True,
     )
+    doIncremental = pexConfig.Field(
+        doc = "Rebuild an existing <coaddName>Coadd_tempExp only if its recorded provenance " \
+            "(input calexp IDs, the modification times and sizes of their files, and the config items " \
+            "that affect pixels; see MakeCoaddTempExpTask.ExecutionOnlyConfigNames) has changed? " \
+            "If True then doOverwrite is ignored for coaddTempExp that have provenance",
+        dtype = bool,
+        default = False,
+    )
+    doCropTempExp = pexConfig.Field(
+        doc = "Persist each <coaddName>Coadd_tempExp cropped to the bbox of its pixels with data, " \
+            "recording the patch bbox in its metadata? Readers must use tempExpUtils.readTempExp, " \
+            "which restores the missing pixels as EDGE; assembleCoadd needs doReadCroppedTempExp=True",
+        dtype = bool,
+        default = False,
+    )
+    tempExpCompression = pexConfig.ConfigField(
+        dtype = FitsCompressionConfig,
+        doc = "Compression of persisted <coaddName>Coadd_tempExp",
+    )
+    doWriteMappedTempExp = pexConfig.Field(
+        doc = "Also write each <coaddName>Coadd_tempExp in an uncompressed memory-mappable layout, " \
+            "next to its FITS file, so that readers of subregions can copy pixels from the mapped file " \
+            "instead of decoding FITS (see AssembleCoaddConfig.doUseMappedTempExp)?",
+        dtype = bool,
+        default = False,
+    )
     bgSubtracted = pexConfig.Field(
         doc = "Work with a background subtracted calexp?",
         dtype = bool,
         default = False,
     )
+    numWarpProcesses = pexConfig.Field(
+        doc = "Number of worker processes used to read, PSF-match and warp calexps; " \
+            "if 1 then calexps are processed serially in this process. " \
+            "A daemonic process (e.g. a TaskRunner worker when run with -j > 1) cannot start workers, " \
+            "so there this is ignored (with a warning) and calexps are processed serially",
+        dtype = int,
+        default = 1,
+        check = lambda x: x >= 1,
+    )
+    maxPendingWarps = pexConfig.Field(
+        doc = "Maximum number of calexps being warped or waiting to be added to the coaddTempExp " \
+            "(limits memory use); if None then use 2 * numWarpProcesses; ignored if numWarpProcesses = 1",
+        dtype = int,
+        optional = True,
+        check = lambda x: x >= 1,
+    )
+    doPreFilterOverlap = pexConfig.Field(
+        doc = "Before reading pixels, compute each calexp's footprint on the tract from its header " \
+            "and skip calexps whose overlap with the patch is not more than minOverlapArea?",
+        dtype = bool,
+        default = False,
+    )
+    minOverlapArea = pexConfig.Field(
+        doc = "Minimum area of overlap (tract pixels) between a calexp and a patch; " \
+            "ignored if doPreFilterOverlap false",
+        dtype = float,
+        default = 0.0,
+        check = lambda x: x >= 0,
+    )
+    doReadSubregion = pexConfig.Field(
+        doc = "Read only the region of each calexp (and its background) that maps into the patch, " \
+            "grown by the sizes of the warping and PSF-matching kernels? If False, read whole calexps",
+        dtype = bool,
+        default = False,
+    )
+    doOrderPatches = pexConfig.Field(
+        doc = "Process patches in an order that puts neighboring patches next to each other " \
+            "(a serpentine scan of each tract), so calexps shared by neighbors are likely still " \
+            "in the read cache? If False, process patches in the order specified; ignored if doWarpPerTract",
+        dtype = bool,
+        default = False,
+    )
+    doWarpPerTract = pexConfig.Field(
+        doc = "Process all requested patches of a tract together, warping each calexp once onto the tract " \
+            "and copying the warped pixels into every patch it overlaps? If False, process each patch separately",
+        dtype = bool,
+        default = False,
+    )
+
+
+def _getPatchOrderKey(patchRef):
+    """Return a sort key for a patch data reference that puts neighboring patches next to each other
+
+    Patches are grouped by data ID without patch (tract, filter, etc.); within a group they are
+    ordered by row (y index) and then by x index, in alternating directions (a serpentine scan),
+    so consecutive patches are always adjacent and share many calexps.
+    """
+    otherKey = tuple(sorted((key, val) for key, val in patchRef.dataId.iteritems() if key != "patch"))
+    xInd, yInd = [int(i) for i in patchRef.dataId["patch"].split(",")]
+    return otherKey, yInd, (-xInd if yInd % 2 else xInd)
+
+
+def _mergeSelectionOrder(keyListList):
+    """Merge several lists of keys, each in selection order, into one list that preserves the order
+    of every input list where possible
+
+    If the input lists are not consistent with any single order, keys that would close a cycle
+    are placed in the order in which they first appear.
+
+    @param[in] keyListList: list of lists of keys; a key may appear in several lists
+    @return a list of all keys, each once
+    """
+    firstIndDict = dict() # key: index of first appearance
+    successorSetDict = dict() # key: set of keys that must follow it
+    numPredecessorsDict = dict() # key: number of distinct keys that must precede it
+    for keyList in keyListList:
+        for key in keyList:
+            if key not in firstIndDict:
+                firstIndDict[key] = len(firstIndDict)
+                successorSetDict[key] = set()
+                numPredecessorsDict[key] = 0
+        for prevKey, key in zip(keyList[:-1], keyList[1:]):
+            if key not in successorSetDict[prevKey]:
+                successorSetDict[prevKey].add(key)
+                numPredecessorsDict[key] += 1
+
+    mergedList = []
+    remainingSet = set(firstIndDict.keys())
+    while remainingSet:
+        readyList = [key for key in remainingSet if numPredecessorsDict[key] == 0]
+        key = min(readyList or remainingSet, key=lambda k: firstIndDict[k])
+        remainingSet.remove(key)
+        mergedList.append(key)
+        for nextKey in successorSetDict[key]:
+            numPredecessorsDict[nextKey] -= 1
+    return mergedList
+
+
+class MakeCoaddTempExpRunner(pipeBase.TaskRunner):
+    """Task runner for MakeCoaddTempExpTask
+
+    If config.doWarpPerTract is True then all patches of a tract (with the same filter, etc.)
+    are passed to MakeCoaddTempExpTask.run as one list of data references.
+    Otherwise, if config.doOrderPatches is True, patches are processed in an order that puts
+    neighboring patches next to each other, to make good use of the shared read cache
+    (see WarpAndPsfMatchConfig.readCacheSizeMB).
+    """
+    @staticmethod
+    def getTargetList(parsedCmd, **kwargs):
+        if not parsedCmd.config.doWarpPerTract:
+            if not parsedCmd.config.doOrderPatches:
+                return pipeBase.TaskRunner.getTargetList(parsedCmd, **kwargs)
+            patchRefList = sorted(parsedCmd.dataRefList, key=_getPatchOrderKey)
+            return [(patchRef, kwargs) for patchRef in patchRefList]
+
+        # patchRefListDict: a dict of data ID without patch (as a sorted tuple of items): list of patchRef
+        patchRefListDict = dict()
+        for patchRef in parsedCmd.dataRefList:
+            tractKey = tuple(sorted((key, val) for key, val in patchRef.dataId.iteritems() if key != "patch"))
+            patchRefListDict.setdefault(tractKey, []).append(patchRef)
+        return [(patchRefListDict[tractKey], kwargs) for tractKey in sorted(patchRefListDict.keys())]
+
+    def __call__(self, args):
+        """Run MakeCoaddTempExpTask.run on a single target, then shut down its warp worker pool
+
+        @param args: (patchRef, kwargs), as returned by getTargetList; patchRef may be a list
+            of patch data references (if config.doWarpPerTract), in which case the task metadata
+            is written for each patch
+        """
+        patchRef, kwargs = args
+        patchRefList = patchRef if isinstance(patchRef, (list, tuple)) else [patchRef]
+        task = self.TaskClass(config=self.config, log=self.log)
+        result = None
+        try:
+            if self.doRaise:
+                result = task.run(patchRef, **kwargs)
+            else:
+                try:
+                    result = task.run(patchRef, **kwargs)
+                except Exception, e:
+                    task.log.fatal("Failed on dataId=%s: %s" % \
+                        (", ".join(str(ref.dataId) for ref in patchRefList), e))
+                    if not isinstance(e, pipeBase.TaskError):
+                        traceback.print_exc(file=sys.stderr)
+        finally:
+            task.closeWarpPool()
+        for ref in patchRefList:
+            task.writeMetadata(ref)
+
+        if self.doReturnResults:
+            return pipeBase.Struct(
+                dataRef = patchRef,
+                metadata = task.metadata,
+                result = result,
+            )
 
 
 class MakeCoaddTempExpTask(CoaddBaseTask):
     """Task to produce <coaddName>Coadd_tempExp images and (optional) <coaddName>Coadd_initPsf
     """
     ConfigClass = MakeCoaddTempExpConfig
+    RunnerClass = MakeCoaddTempExpRunner
     _DefaultName = "makeCoaddTempExp"
+    # config fields that only control how or whether coaddTempExps are made, not their pixels
+    ExecutionOnlyConfigNames = ("doWrite", "doOverwrite", "doIncremental", "doWriteMappedTempExp",
+        "numWarpProcesses", "maxPendingWarps", "doOrderPatches", "doSelectPerTract")
     
     def __init__(self, *args, **kwargs):
         CoaddBaseTask.__init__(self, *args, **kwargs)
         self.makeSubtask("warpAndPsfMatch")
+        self._warpPool = None
+        self._warpPoolKey = None
 
     @pipeBase.timeMethod
     def run(self, patchRef):
@@ -87,9 +283,13 @@ class MakeCoaddTempExpTask(CoaddBaseTask):
         associated with the calibrated science exposures (without having to warp those models).
         
         @param[in] patchRef: data reference for sky map patch. Must include keys "tract", "patch",
-            plus the camera-specific filter key (e.g. "filter" or "band")
+            plus the camera-specific filter key (e.g. "filter" or "band").
+            If config.doWarpPerTract is True this may also be a list of patch data references
+            for one tract, which are passed to runTract.
         @return: a pipeBase.Struct with fields:
         - dataRefList: a list of data references for the new <coaddName>Coadd_tempExp
+        - skippedDataRefList: a list of data references for existing <coaddName>Coadd_tempExp
+            that were not rebuilt (see config.doOverwrite and config.doIncremental)
 
         @warning: this task assumes that all exposures in a coaddTempExp have the same filter.
         
@@ -97,6 +297,10 @@ class MakeCoaddTempExpTask(CoaddBaseTask):
         with any good pixels in the patch. For a mosaic camera the resulting Calib should be ignored
         (assembleCoadd should determine zeropoint scaling without referring to it).
         """
+        if self.config.doWarpPerTract:
+            patchRefList = patchRef if isinstance(patchRef, (list, tuple)) else [patchRef]
+            return self.runTract(patchRefList)
+
         skyInfo = self.getSkyInfo(patchRef)
         
         tractWcs = skyInfo.wcs
@@ -106,6 +310,7 @@ class MakeCoaddTempExpTask(CoaddBaseTask):
         
         # initialize outputs
         dataRefList = []
+        skippedDataRefList = []
         
         numExp = len(calExpRefList)
         if numExp < 1:
@@ -134,6 +339,10 @@ class MakeCoaddTempExpTask(CoaddBaseTask):
             if not calExpRef.datasetExists("calexp"):
                 self.log.warn("Could not find calexp %s; skipping it" % (calExpId,))
                 continue
+            if self.config.doPreFilterOverlap:
+                footprint = self.getCalExpFootprint(calExpRef, tractWcs)
+                if not self.checkCalExpOverlap(calExpRef, footprint, patchBBox):
+                    continue
             
             tempExpIdTuple = tuple(calExpId[key] for key in tempExpKeyList)
             calExpSubsetRefList = tempExpIdDict.get(tempExpIdTuple)
@@ -152,8 +361,9 @@ class MakeCoaddTempExpTask(CoaddBaseTask):
                 datasetType = tempExpName,
                 dataId = tempExpId,
             )
-            if not self.config.doOverwrite and tempExpRef.datasetExists(datasetType=tempExpName):
-                self.log.info("tempCoaddExp exists %s; skipping it"%(tempExpId))
+            provenance = self.makeProvenance(calExpSubsetRefList, doPsfMatch=doPsfMatch)
+            if not self.needTempExp(tempExpRef, provenance):
+                skippedDataRefList.append(tempExpRef)
                 continue
             self.log.info("Computing coaddTempExp %d of %d: id=%s" % (tempExpInd+1, numTempExp, tempExpId))
 
@@ -162,14 +372,21 @@ class MakeCoaddTempExpTask(CoaddBaseTask):
             edgeMask = afwImage.MaskU.getPlaneBitMask("EDGE")
             coaddTempExp.getMaskedImage().set(numpy.nan, edgeMask, numpy.inf)
             didSetMetadata = False
-            for calExpInd, calExpRef in enumerate(calExpSubsetRefList):
+            warpedExpIter = self.iterWarpedCalExp(
+                calExpRefList = calExpSubsetRefList,
+                tractWcs = tractWcs,
+                patchBBox = patchBBox,
+                doPsfMatch = doPsfMatch,
+            )
+            for calExpInd, (calExpRef, exposure, expMetrics, warpError) in enumerate(warpedExpIter):
                 self.log.info("Processing calexp %d of %d for this tempExp: id=%s" % \
                     (calExpInd+1, len(calExpSubsetRefList), calExpRef.dataId))
                 try:
-                    exposure = self.warpAndPsfMatch.getCalExp(calExpRef, getPsf=doPsfMatch, bgSubtracted=self.config.bgSubtracted) 
-                    exposure = self.warpAndPsfMatch.run(exposure, wcs=tractWcs, maxBBox=patchBBox).exposure
-                    numGoodPix = coaddUtils.copyGoodPixels(
-                        coaddTempExp.getMaskedImage(), exposure.getMaskedImage(), self._badPixelMask)
+                    if warpError is not None:
+                        raise RuntimeError(warpError)
+                    with expMetrics.timeStage("CopyTime"):
+                        numGoodPix = coaddUtils.copyGoodPixels(
+                            coaddTempExp.getMaskedImage(), exposure.getMaskedImage(), self._badPixelMask)
                     totGoodPix += numGoodPix
                     if numGoodPix == 0:
                         self.log.warn("Calexp %s has no good pixels in this patch" % (calExpRef.dataId,))
@@ -184,7 +401,8 @@ class MakeCoaddTempExpTask(CoaddBaseTask):
                 except Exception, e:
                     self.log.warn("Error processing calexp %s; skipping it: %s" % \
                         (calExpRef.dataId, e))
-                    continue
+                finally:
+                    expMetrics.record()
 
             if (totGoodPix == 0) or not didSetMetadata: # testing didSetMetadata is not needed but safer
                 self.log.warn("Could not compute coaddTempExp %s: no good pixels" % (tempExpRef.dataId,))
@@ -192,23 +410,592 @@ class MakeCoaddTempExpTask(CoaddBaseTask):
             self.log.info("coaddTempExp %s has %s good pixels" % (tempExpRef.dataId, totGoodPix))
                 
             if self.config.doWrite and coaddTempExp is not None:
-                self.log.info("Persisting %s %s" % (tempExpName, tempExpRef.dataId))
-                tempExpRef.put(coaddTempExp, tempExpName)
-                if self.config.warpAndPsfMatch.desiredFwhm is not None:
-                    psfName = self.config.coaddName + "Coadd_initPsf"
-                    self.log.info("Persisting %s %s" % (psfName, tempExpRef.dataId))
-                    wcs = coaddTempExp.getWcs()
-                    fwhmPixels = self.config.warpAndPsfMatch.desiredFwhm / wcs.pixelScale().asArcseconds()
-                    kernelSize = int(round(fwhmPixels * self.config.coaddKernelSizeFactor))
-                    kernelDim = afwGeom.Point2I(kernelSize, kernelSize)
-                    coaddPsf = self.makeModelPsf(fwhmPixels=fwhmPixels, kernelDim=kernelDim)
-                    patchRef.put(coaddPsf, psfName)
+                self.writeTempExp(patchRef=patchRef, tempExpRef=tempExpRef, coaddTempExp=coaddTempExp,
+                    provenance=provenance)
 
             if coaddTempExp:
                 dataRefList.append(tempExpRef)
             else:
                 self.log.warn("This %s temp coadd exposure could not be created"%(tempExpRef.dataId,))
         
+        self.reportSkipped(skippedDataRefList)
+        return pipeBase.Struct(
+            dataRefList = dataRefList,
+            skippedDataRefList = skippedDataRefList,
+        )
+
+    @pipeBase.timeMethod
+    def runTract(self, patchRefList):
+        """Produce <coaddName>Coadd_tempExp images and (optional) <coaddName>Coadd_initPsf
+        for several patches of one tract, warping each calexp only once
+
+        Each calexp is read, PSF-matched (optional) and warped onto the tract pixel grid,
+        covering just the calexp's footprint, then its good pixels are copied into the
+        coaddTempExp of every patch it overlaps, so a calexp that overlaps several patches is processed once.
+        Calexps are copied into each coaddTempExp in selection order (merging the selection order
+        of each patch), so if the selection returns calexps in a consistent order for all patches
+        then the results are the same as calling run for each patch.
+
+        @param[in] patchRefList: list of data references for sky map patches, all in the same tract
+            and with the same filter. Each must include keys "tract", "patch",
+            plus the camera-specific filter key (e.g. "filter" or "band")
+        @return: a pipeBase.Struct with fields:
+        - dataRefList: a list of data references for the new <coaddName>Coadd_tempExp
+        - skippedDataRefList: a list of data references for existing <coaddName>Coadd_tempExp
+            that were not rebuilt (see config.doOverwrite and config.doIncremental)
+        """
+        if not patchRefList:
+            raise pipeBase.TaskError("No patches to process")
+        skyInfoList = [self.getSkyInfo(patchRef) for patchRef in patchRefList]
+        tractIdSet = set(skyInfo.tractInfo.getId() for skyInfo in skyInfoList)
+        if len(tractIdSet) != 1:
+            raise pipeBase.TaskError("All patches must be in one tract; found tracts %s" % (sorted(tractIdSet),))
+        tractWcs = skyInfoList[0].wcs
+        self.log.info("Process %d patches of tract %s" % (len(patchRefList), tractIdSet.pop()))
+
+        # select calexps for all patches with one query, keeping one data reference per calexp, and compute:
+        # - calExpRefDict: a dict of calexp ID (as a sorted tuple of items): calExpRef
+        # - selectedKeyList: a list of calexp IDs, in selection order
+        # - patchIndListDict: a dict of calexp ID: list of indices of the patches it overlaps
+        calExpRefDict = dict()
+        patchIndListDict = dict()
+        patchKeyListList = [] # list of calexp IDs for each patch, in selection order
+        footprintDict = dict() # calexp ID: footprint on tract; only used if config.doPreFilterOverlap
+        patchDataRefListDict = self.selectTractExposures(patchRef=patchRefList[0],
+            tractInfo=skyInfoList[0].tractInfo,
+            patchIndexList=[skyInfo.patchInfo.getIndex() for skyInfo in skyInfoList])
+        for patchInd, skyInfo in enumerate(skyInfoList):
+            patchKeyList = []
+            for calExpRef in patchDataRefListDict[tuple(skyInfo.patchInfo.getIndex())]:
+                calExpKey = tuple(sorted(calExpRef.dataId.items()))
+                if self.config.doPreFilterOverlap:
+                    if calExpKey not in footprintDict:
+                        footprintDict[calExpKey] = self.getCalExpFootprint(calExpRef, tractWcs)
+                    if not self.checkCalExpOverlap(calExpRef, footprintDict[calExpKey], skyInfo.bbox):
+                        continue
+                calExpRefDict.setdefault(calExpKey, calExpRef)
+                patchIndListDict.setdefault(calExpKey, []).append(patchInd)
+                patchKeyList.append(calExpKey)
+            patchKeyListList.append(patchKeyList)
+        selectedKeyList = _mergeSelectionOrder(patchKeyListList)
+        del footprintDict
+
+        numExp = len(calExpRefDict)
+        if numExp < 1:
+            raise pipeBase.TaskError("No exposures to coadd")
+        self.log.info("Process %s calexp" % (numExp,))
+
+        doPsfMatch = self.config.warpAndPsfMatch.desiredFwhm is not None
+        if not doPsfMatch:
+            self.log.info("No PSF matching will be done (desiredFwhm is None)")
+
+        tempExpName = self.config.coaddName + "Coadd_tempExp"
+        butler = patchRefList[0].butlerSubset.butler
+        tempExpKeySet = set(butler.getKeys(datasetType=tempExpName, level="Ccd")) - set(("patch", "tract"))
+        tempExpKeyList = tuple(sorted(tempExpKeySet))
+
+        # compute tempExpIdDict, a dict whose:
+        # - keys are tuples of coaddTempExp ID values in tempKeyList order
+        # - values are a list of calexp IDs (keys of calExpRefDict) for calexps in this coaddTempExp,
+        #   in selection order
+        tempExpIdDict = dict()
+        for calExpKey in selectedKeyList:
+            calExpRef = calExpRefDict[calExpKey]
+            if not calExpRef.datasetExists("calexp"):
+                self.log.warn("Could not find calexp %s; skipping it" % (calExpRef.dataId,))
+                continue
+            tempExpIdTuple = tuple(calExpRef.dataId[key] for key in tempExpKeyList)
+            tempExpIdDict.setdefault(tempExpIdTuple, []).append(calExpKey)
+
+        dataRefList = []
+        skippedDataRefList = []
+        numTempExp = len(tempExpIdDict)
+        edgeMask = afwImage.MaskU.getPlaneBitMask("EDGE")
+        for tempExpInd, tempExpIdTuple in enumerate(sorted(tempExpIdDict.keys())):
+            calExpKeyList = tempExpIdDict[tempExpIdTuple]
+            self.log.info("Computing coaddTempExp %d of %d for %d patches: %s" % \
+                (tempExpInd+1, numTempExp, len(patchRefList), dict(zip(tempExpKeyList, tempExpIdTuple))))
+
+            # make a coaddTempExp for each patch overlapped by these calexps, unless it already exists
+            # (and we are not overwriting); patchDataDict is a dict of patch index: pipeBase.Struct
+            patchDataDict = dict()
+            for calExpKey in calExpKeyList:
+                for patchInd in patchIndListDict[calExpKey]:
+                    if patchInd in patchDataDict:
+                        continue
+                    patchRef = patchRefList[patchInd]
+                    tempExpId = dict(zip(tempExpKeyList, tempExpIdTuple))
+                    tempExpId.update(patchRef.dataId)
+                    tempExpRef = butler.dataRef(datasetType=tempExpName, dataId=tempExpId)
+                    patchCalExpRefList = [calExpRefDict[key] for key in calExpKeyList
+                        if patchInd in patchIndListDict[key]]
+                    provenance = self.makeProvenance(patchCalExpRefList, doPsfMatch=doPsfMatch)
+                    if not self.needTempExp(tempExpRef, provenance):
+                        skippedDataRefList.append(tempExpRef)
+                        patchDataDict[patchInd] = None
+                        continue
+                    coaddTempExp = afwImage.ExposureF(skyInfoList[patchInd].bbox, tractWcs)
+                    coaddTempExp.getMaskedImage().set(numpy.nan, edgeMask, numpy.inf)
+                    patchDataDict[patchInd] = pipeBase.Struct(
+                        patchRef = patchRef,
+                        tempExpRef = tempExpRef,
+                        coaddTempExp = coaddTempExp,
+                        provenance = provenance,
+                        totGoodPix = 0,
+                        didSetMetadata = False,
+                    )
+            activePatchIndList = sorted(ind for ind, data in patchDataDict.iteritems() if data is not None)
+            if not activePatchIndList:
+                continue
+
+            # warp each calexp once, onto a bbox no larger than needed for all the patches that need it
+            calExpRefList = []
+            for calExpKey in calExpKeyList:
+                if any(patchInd in activePatchIndList for patchInd in patchIndListDict[calExpKey]):
+                    calExpRefList.append(calExpRefDict[calExpKey])
+            maxBBox = afwGeom.Box2I()
+            for patchInd in activePatchIndList:
+                for corner in skyInfoList[patchInd].bbox.getCorners():
+                    maxBBox.include(corner)
+
+            warpedExpIter = self.iterWarpedCalExp(
+                calExpRefList = calExpRefList,
+                tractWcs = tractWcs,
+                patchBBox = maxBBox,
+                doPsfMatch = doPsfMatch,
+            )
+            for calExpInd, (calExpRef, exposure, expMetrics, warpError) in enumerate(warpedExpIter):
+                self.log.info("Processing calexp %d of %d for this tempExp: id=%s" % \
+                    (calExpInd+1, len(calExpRefList), calExpRef.dataId))
+                if warpError is not None:
+                    self.log.warn("Error processing calexp %s; skipping it: %s" % \
+                        (calExpRef.dataId, warpError))
+                    expMetrics.record()
+                    continue
+                calExpKey = tuple(sorted(calExpRef.dataId.items()))
+                for patchInd in patchIndListDict[calExpKey]:
+                    patchData = patchDataDict[patchInd]
+                    if patchData is None:
+                        continue
+                    try:
+                        with expMetrics.timeStage("CopyTime"):
+                            numGoodPix = coaddUtils.copyGoodPixels(patchData.coaddTempExp.getMaskedImage(),
+                                exposure.getMaskedImage(), self._badPixelMask)
+                    except Exception, e:
+                        self.log.warn("Error processing calexp %s for patch %s; skipping it: %s" % \
+                            (calExpRef.dataId, patchData.patchRef.dataId["patch"], e))
+                        continue
+                    if numGoodPix == 0:
+                        self.log.warn("Calexp %s has no good pixels in patch %s" % \
+                            (calExpRef.dataId, patchData.patchRef.dataId["patch"]))
+                        continue
+                    self.log.info("Calexp %s has %s good pixels in patch %s" % \
+                        (calExpRef.dataId, numGoodPix, patchData.patchRef.dataId["patch"]))
+                    patchData.totGoodPix += numGoodPix
+                    if not patchData.didSetMetadata:
+                        patchData.coaddTempExp.setCalib(exposure.getCalib())
+                        patchData.coaddTempExp.setFilter(exposure.getFilter())
+                        patchData.didSetMetadata = True
+                expMetrics.record()
+                del exposure
+
+            for patchInd in activePatchIndList:
+                patchData = patchDataDict[patchInd]
+                if (patchData.totGoodPix == 0) or not patchData.didSetMetadata:
+                    self.log.warn("Could not compute coaddTempExp %s: no good pixels" % \
+                        (patchData.tempExpRef.dataId,))
+                    continue
+                self.log.info("coaddTempExp %s has %s good pixels" % \
+                    (patchData.tempExpRef.dataId, patchData.totGoodPix))
+                if self.config.doWrite:
+                    self.writeTempExp(patchRef=patchData.patchRef, tempExpRef=patchData.tempExpRef,
+                        coaddTempExp=patchData.coaddTempExp, provenance=patchData.provenance)
+                dataRefList.append(patchData.tempExpRef)
+            del patchDataDict
+
+        self.reportSkipped(skippedDataRefList)
         return pipeBase.Struct(
             dataRefList = dataRefList,
+            skippedDataRefList = skippedDataRefList,
         )
+
+    def getCalExpFootprint(self, calExpRef, tractWcs):
+        """Compute the footprint of a calexp on the tract pixel grid, reading only the calexp's header
+
+        @param[in] calExpRef: data reference for calexp
+        @param[in] tractWcs: WCS of tract
+        @return the four corners of the calexp in tract pixel coordinates, as a list of (x, y),
+            or None if the header could not be used
+        """
+        try:
+            md = calExpRef.get("calexp_md", immediate=True)
+            if not md.exists("NAXIS1") or not md.exists("NAXIS2"):
+                raise RuntimeError("header has no NAXIS1, NAXIS2")
+            calExpDim = afwGeom.Extent2D(md.get("NAXIS1"), md.get("NAXIS2"))
+            calExpWcs = afwImage.makeWcs(md)
+        except Exception, e:
+            self.log.warn("Could not compute footprint of calexp %s from its header: %s" % \
+                (calExpRef.dataId, e))
+            return None
+
+        # the WCS in the header is relative to the image origin, not the parent
+        calExpBox = afwGeom.Box2D(afwGeom.Point2D(-0.5, -0.5), calExpDim)
+        footprint = []
+        for calExpPos in calExpBox.getCorners():
+            tractPos = tractWcs.skyToPixel(calExpWcs.pixelToSky(calExpPos))
+            footprint.append((tractPos[0], tractPos[1]))
+        return footprint
+
+    def checkCalExpOverlap(self, calExpRef, footprint, patchBBox):
+        """Return True if a calexp footprint overlaps a patch by more than config.minOverlapArea
+
+        @param[in] calExpRef: data reference for calexp (for log messages)
+        @param[in] footprint: footprint of calexp in tract pixels, as returned by getCalExpFootprint;
+            if None then the calexp is assumed to overlap
+        @param[in] patchBBox: outer bbox of patch
+        """
+        if footprint is None:
+            return True
+        patchBox = afwGeom.Box2D(patchBBox)
+        overlapArea = polygonBoxOverlapArea(footprint,
+            (patchBox.getMinX(), patchBox.getMinY(), patchBox.getMaxX(), patchBox.getMaxY()))
+        if overlapArea <= self.config.minOverlapArea:
+            self.log.info("Calexp %s overlaps patch by %0.1f <= %0.1f pixels; skipping it without reading" % \
+                (calExpRef.dataId, overlapArea, self.config.minOverlapArea))
+            return False
+        return True
+
+    def makeProvenance(self, calExpRefList, doPsfMatch):
+        """Make the provenance of a coaddTempExp
+
+        @param[in] calExpRefList: list of data references for the calexps that go into the coaddTempExp
+        @param[in] doPsfMatch: PSF-match the calexps?
+        @return provenance as a dict of metadata item name: value, with these items:
+        - PROVCFG: hash of the task config, as returned by makeProvenanceConfigHash
+        - PROVNIN: number of input calexps
+        - PROVID<n>: data ID of input calexp n, as a string
+        - PROVSIG<n>: signature of the files of input calexp n; "unknown" if they could not be found
+        """
+        configHash = self.makeProvenanceConfigHash()
+        datasetTypeList = ["calexp"]
+        if not self.config.bgSubtracted:
+            datasetTypeList.append("calexpBackground")
+        if doPsfMatch:
+            datasetTypeList.append("psf")
+
+        inputList = []
+        for calExpRef in calExpRefList:
+            idStr = " ".join("%s=%s" % (key, calExpRef.dataId[key]) for key in sorted(calExpRef.dataId.keys()))
+            inputList.append((idStr, self._getInputSignature(calExpRef, datasetTypeList)))
+        inputList.sort()
+
+        provenance = dict(PROVCFG = configHash, PROVNIN = len(inputList))
+        for ind, (idStr, signature) in enumerate(inputList):
+            provenance["PROVID%d" % (ind,)] = idStr
+            provenance["PROVSIG%d" % (ind,)] = signature
+        return provenance
+
+    def makeProvenanceConfigHash(self):
+        """Return a hash of the task config for the provenance of a coaddTempExp
+
+        The fields listed in ExecutionOnlyConfigNames are hashed at their default values,
+        so changing them does not make existing coaddTempExps out of date.
+        """
+        configDict = self.config.toDict()
+        defaultDict = type(self.config)().toDict()
+        for name in self.ExecutionOnlyConfigNames:
+            configDict[name] = defaultDict[name]
+        return makeConfigHash(configDict)
+
+    def _getInputSignature(self, calExpRef, datasetTypeList):
+        """Return a signature of the files of one input calexp, based on file modification time and size
+
+        @return signature (a hex string), or "unknown" if any file could not be found
+        """
+        return getDatasetSignature(calExpRef, datasetTypeList)
+
+    def needTempExp(self, tempExpRef, provenance):
+        """Return True if a coaddTempExp should be (re)built, logging the reason if not
+
+        An existing coaddTempExp is rebuilt if config.doIncremental is True and its recorded
+        provenance differs from provenance (or is missing and config.doOverwrite is True),
+        or if config.doIncremental is False and config.doOverwrite is True.
+
+        @param[in] tempExpRef: data reference for coaddTempExp
+        @param[in] provenance: provenance of the coaddTempExp to be built, as returned by makeProvenance
+        """
+        tempExpName = self.config.coaddName + "Coadd_tempExp"
+        if not tempExpRef.datasetExists(datasetType=tempExpName):
+            return True
+        if self.config.doIncremental:
+            try:
+                md = tempExpRef.get(tempExpName + "_md", immediate=True)
+            except Exception, e:
+                self.log.warn("Could not read metadata of %s %s: %s" % (tempExpName, tempExpRef.dataId, e))
+                md = None
+            if md is not None and md.exists("PROVCFG"):
+                oldProvenance = dict((name, md.get(name)) for name in md.names() if name.startswith("PROV"))
+                if oldProvenance == provenance and "unknown" not in provenance.values():
+                    self.log.info("tempCoaddExp %s is up to date; skipping it" % (tempExpRef.dataId,))
+                    return False
+                self.log.info("tempCoaddExp %s inputs or config changed; rebuilding it" % (tempExpRef.dataId,))
+                return True
+        if not self.config.doOverwrite:
+            self.log.info("tempCoaddExp exists %s; skipping it" % (tempExpRef.dataId,))
+            return False
+        return True
+
+    def reportSkipped(self, skippedDataRefList):
+        """Report the coaddTempExp that were not rebuilt
+        """
+        if skippedDataRefList:
+            self.log.info("Skipped %d existing coaddTempExp: %s" % \
+                (len(skippedDataRefList), ", ".join(str(ref.dataId) for ref in skippedDataRefList)))
+
+    def writeTempExp(self, patchRef, tempExpRef, coaddTempExp, provenance=None):
+        """Persist a <coaddName>Coadd_tempExp and (if desiredFwhm not None) <coaddName>Coadd_initPsf
+
+        @param[in] patchRef: data reference for sky map patch
+        @param[in] tempExpRef: data reference for coaddTempExp
+        @param[in,out] coaddTempExp: coaddTempExp to persist; it is cropped before being persisted
+            if config.doCropTempExp is True
+        @param[in] provenance: provenance of coaddTempExp, as returned by makeProvenance,
+            which is added to its metadata; ignored if None
+        """
+        tempExpName = self.config.coaddName + "Coadd_tempExp"
+        if provenance is not None:
+            metadata = coaddTempExp.getMetadata()
+            for name, value in provenance.iteritems():
+                metadata.set(name, value)
+        if self.config.doCropTempExp:
+            patchBBox = coaddTempExp.getMaskedImage().getBBox(afwImage.PARENT)
+            coaddTempExp = cropTempExp(coaddTempExp)
+            cropBBox = coaddTempExp.getMaskedImage().getBBox(afwImage.PARENT)
+            if cropBBox != patchBBox:
+                self.log.info("Cropped %s %s to %s" % (tempExpName, tempExpRef.dataId, cropBBox))
+        self.log.info("Persisting %s %s" % (tempExpName, tempExpRef.dataId))
+        tempExpRef.put(coaddTempExp, tempExpName)
+        compressDataset(tempExpRef, tempExpName, self.config.tempExpCompression, log=self.log)
+        if self.config.doWriteMappedTempExp:
+            # write this after the FITS file is complete, so the mapped file is newer
+            mappedPath = getMappedPath(tempExpRef.get(tempExpName + "_filename")[0])
+            self.log.info("Writing mapped %s %s" % (tempExpName, tempExpRef.dataId))
+            writeMappedExposure(coaddTempExp, mappedPath)
+        if self.config.warpAndPsfMatch.desiredFwhm is not None:
+            psfName = self.config.coaddName + "Coadd_initPsf"
+            self.log.info("Persisting %s %s" % (psfName, tempExpRef.dataId))
+            wcs = coaddTempExp.getWcs()
+            fwhmPixels = self.config.warpAndPsfMatch.desiredFwhm / wcs.pixelScale().asArcseconds()
+            kernelSize = int(round(fwhmPixels * self.config.coaddKernelSizeFactor))
+            kernelDim = afwGeom.Point2I(kernelSize, kernelSize)
+            coaddPsf = self.makeModelPsf(fwhmPixels=fwhmPixels, kernelDim=kernelDim)
+            patchRef.put(coaddPsf, psfName)
+
+    def warpCalExp(self, calExpRef, tractWcs, patchBBox, doPsfMatch, expMetrics=None):
+        """Read one calexp, PSF-match it (if doPsfMatch) and warp it onto the patch
+
+        @param[in] calExpRef: data reference for calexp
+        @param[in] tractWcs: WCS of tract
+        @param[in] patchBBox: outer bbox of patch; the maximum bbox of the warped exposure
+        @param[in] doPsfMatch: PSF-match the calexp? (if True the PSF is read)
+        @param[in,out] expMetrics: an ExposureMetrics for the calexp, as returned by
+            self.warpAndPsfMatch.makeExposureMetrics, to which to add the cost of each stage;
+            None if not wanted
+        @return warped exposure
+        """
+        if expMetrics is None:
+            expMetrics = self.warpAndPsfMatch.makeExposureMetrics(calExpRef.dataId)
+        calExpBBox = None
+        if self.config.doReadSubregion:
+            calExpBBox = self.warpAndPsfMatch.getCalExpSubBBox(calExpRef, wcs=tractWcs, destBBox=patchBBox,
+                doPsfMatch=doPsfMatch)
+            if calExpBBox is not None:
+                self.log.info("Reading subregion %s of calexp %s" % (calExpBBox, calExpRef.dataId))
+        background = None
+        bgSubtracted = self.config.bgSubtracted
+        if not bgSubtracted and self.warpAndPsfMatch.config.compactBackgroundBinSize > 0:
+            # add the background after warping, and only to the warped pixels
+            with expMetrics.timeStage("ReadTime"):
+                background = self.warpAndPsfMatch.getCompactBackground(calExpRef)
+            bgSubtracted = True
+        exposure = self.warpAndPsfMatch.getCalExp(calExpRef, getPsf=doPsfMatch,
+            bgSubtracted=bgSubtracted, bbox=calExpBBox, expMetrics=expMetrics)
+        return self.warpAndPsfMatch.run(exposure, wcs=tractWcs, maxBBox=patchBBox,
+            dataId=calExpRef.dataId, background=background, expMetrics=expMetrics).exposure
+
+    def iterWarpedCalExp(self, calExpRefList, tractWcs, patchBBox, doPsfMatch):
+        """Iterate over warped calexps, in the order of calExpRefList
+
+        If config.numWarpProcesses > 1 the calexps are read, PSF-matched and warped
+        by a pool of worker processes (see getWarpPool), with at most config.maxPendingWarps calexps
+        in progress or waiting to be returned at any time. Metadata added by the warpAndPsfMatch task
+        and its subtasks in the worker processes is merged into the metadata of those tasks in this process.
+
+        @param[in] calExpRefList: list of data references for calexps
+        @param[in] tractWcs: WCS of tract
+        @param[in] patchBBox: maximum bbox of the warped exposures (normally the outer bbox of the patch)
+        @param[in] doPsfMatch: PSF-match the calexps?
+        @return an iterator over tuples of (calExpRef, warped exposure, expMetrics, error), where:
+            - warped exposure is None and error is a message string if processing failed,
+                else error is None
+            - expMetrics is an ExposureMetrics holding the cost of each stage of processing the calexp
+                (see WarpAndPsfMatchTask.makeExposureMetrics); the caller should add "CopyTime"
+                and then call expMetrics.record(). If the calexp was warped by a worker process
+                then the memory metrics recorded are those of this process, not the worker.
+        """
+        numProcesses = self.config.numWarpProcesses
+        if numProcesses > 1 and calExpRefList:
+            numProcesses = self.getUsableNumProcesses(numProcesses, "numWarpProcesses")
+        if numProcesses <= 1 or not calExpRefList:
+            for calExpRef in calExpRefList:
+                expMetrics = self.warpAndPsfMatch.makeExposureMetrics(calExpRef.dataId)
+                try:
+                    exposure = self.warpCalExp(calExpRef, tractWcs=tractWcs, patchBBox=patchBBox,
+                        doPsfMatch=doPsfMatch, expMetrics=expMetrics)
+                except Exception, e:
+                    yield calExpRef, None, expMetrics, str(e)
+                    continue
+                yield calExpRef, exposure, expMetrics, None
+            return
+
+        maxPending = self.config.maxPendingWarps
+        if maxPending is None:
+            maxPending = 2 * numProcesses
+        self.log.info("Warping %d calexps with %d processes" % (len(calExpRefList), numProcesses))
+
+        pool = self.getWarpPool(butler=calExpRefList[0].butlerSubset.butler, tractWcs=tractWcs,
+            doPsfMatch=doPsfMatch)
+        bboxArgs = (patchBBox.getMinX(), patchBBox.getMinY(), patchBBox.getMaxX(), patchBBox.getMaxY())
+        taskDict = self.warpAndPsfMatch.getTaskDict()
+        pendingResultList = collections.deque()
+        nextInd = 0
+        for calExpRef in calExpRefList:
+            while nextInd < len(calExpRefList) and len(pendingResultList) < maxPending:
+                jobArgs = (calExpRefList[nextInd].dataId, bboxArgs)
+                pendingResultList.append(pool.apply_async(_warpCalExpInWorker, jobArgs))
+                nextInd += 1
+            exposureData, metricValueDict, metadataDict, warpError = pendingResultList.popleft().get()
+            expMetrics = self.warpAndPsfMatch.makeExposureMetrics(calExpRef.dataId)
+            for name, value in metricValueDict.iteritems():
+                expMetrics.set(name, value)
+            for fullName, itemDict in metadataDict.iteritems():
+                metadata = taskDict[fullName].metadata
+                for name, valueList in itemDict.iteritems():
+                    for value in valueList:
+                        metadata.add(name, value)
+            if warpError is not None:
+                yield calExpRef, None, expMetrics, warpError
+            else:
+                yield calExpRef, _makeExposureFromData(exposureData, tractWcs), expMetrics, None
+
+    def getWarpPool(self, butler, tractWcs, doPsfMatch):
+        """Return the pool of worker processes used by iterWarpedCalExp, creating it if necessary
+
+        The pool is kept and reused for later coaddTempExps (and patches) with the same butler,
+        tract WCS and doPsfMatch, so the read caches of the worker processes persist between them.
+        Call closeWarpPool when done (MakeCoaddTempExpRunner does so after each target).
+
+        @param[in] butler: data butler from which the workers read calexps
+        @param[in] tractWcs: WCS of tract
+        @param[in] doPsfMatch: PSF-match the calexps?
+        @return a multiprocessing.Pool of config.numWarpProcesses processes
+        """
+        if self._warpPool is not None:
+            oldButler, oldTractWcs, oldDoPsfMatch = self._warpPoolKey
+            if oldButler is butler and oldTractWcs is tractWcs and oldDoPsfMatch == doPsfMatch:
+                return self._warpPool
+            self.closeWarpPool()
+        self._warpPool = multiprocessing.Pool(self.config.numWarpProcesses, initializer=_initWarpWorker,
+            initargs=(self, butler, tractWcs, doPsfMatch))
+        self._warpPoolKey = (butler, tractWcs, doPsfMatch)
+        return self._warpPool
+
+    def closeWarpPool(self):
+        """Shut down the pool of worker processes used by iterWarpedCalExp, if any
+        """
+        if self._warpPool is None:
+            return
+        try:
+            self._warpPool.terminate()
+            self._warpPool.join()
+        finally:
+            self._warpPool = None
+            self._warpPoolKey = None
+
+
+# state of a worker process of MakeCoaddTempExpTask.iterWarpedCalExp: (task, butler, tractWcs, doPsfMatch);
+# set by _initWarpWorker and only used in the worker processes
+_WarpWorkerState = None
+
+def _initWarpWorker(task, butler, tractWcs, doPsfMatch):
+    """Initialize a worker process of MakeCoaddTempExpTask.iterWarpedCalExp
+    """
+    global _WarpWorkerState
+    _WarpWorkerState = (task, butler, tractWcs, doPsfMatch)
+
+def _warpCalExpInWorker(dataId, bboxArgs):
+    """Warp one calexp in a worker process of MakeCoaddTempExpTask.iterWarpedCalExp
+
+    @param[in] dataId: data ID of calexp
+    @param[in] bboxArgs: maximum bbox of the warped exposure, as (min x, min y, max x, max y)
+    @return (exposureData, metricValueDict, metadataDict, error): data for the warped exposure
+        (see _makeExposureData) or None if processing failed; a dict of metric name: value measured
+        for the calexp (see WarpAndPsfMatchTask.makeExposureMetrics); a dict of task full name:
+        dict of metadata name: list of values added by the warpAndPsfMatch task and its subtasks;
+        and None or an error message if processing failed
+    """
+    task, butler, tractWcs, doPsfMatch = _WarpWorkerState
+    calExpRef = butler.dataRef(datasetType="calexp", dataId=dataId)
+    patchBBox = afwGeom.Box2I(afwGeom.Point2I(bboxArgs[0], bboxArgs[1]),
+        afwGeom.Point2I(bboxArgs[2], bboxArgs[3]))
+    taskDict = task.warpAndPsfMatch.getTaskDict()
+    for subtask in taskDict.itervalues():
+        subtask.metadata = dafBase.PropertyList()
+    expMetrics = task.warpAndPsfMatch.makeExposureMetrics(calExpRef.dataId)
+    exposureData = None
+    warpError = None
+    try:
+        exposure = task.warpCalExp(calExpRef, tractWcs=tractWcs, patchBBox=patchBBox,
+            doPsfMatch=doPsfMatch, expMetrics=expMetrics)
+        exposureData = _makeExposureData(exposure)
+    except Exception, e:
+        warpError = str(e)
+    metadataDict = dict()
+    for fullName, subtask in taskDict.iteritems():
+        metadata = subtask.metadata
+        metadataDict[fullName] = dict((name, list(metadata.getArray(name))) for name in metadata.names())
+    return exposureData, expMetrics.getValueDict(), metadataDict, warpError
+
+def _makeExposureData(exposure):
+    """Return the parts of a warped exposure needed by MakeCoaddTempExpTask, as picklable data
+
+    @return a tuple: (xy0, image array, mask array, variance array, (fluxMag0, fluxMag0Sigma), filter name)
+    """
+    maskedImage = exposure.getMaskedImage()
+    return (
+        (maskedImage.getX0(), maskedImage.getY0()),
+        maskedImage.getImage().getArray(),
+        maskedImage.getMask().getArray(),
+        maskedImage.getVariance().getArray(),
+        exposure.getCalib().getFluxMag0(),
+        exposure.getFilter().getName(),
+    )
+
+def _makeExposureFromData(exposureData, wcs):
+    """Make an exposure from the data returned by _makeExposureData
+
+    @param[in] exposureData: data returned by _makeExposureData
+    @param[in] wcs: WCS of exposure
+    @return exposure (an afwImage.ExposureF)
+    """
+    xy0, imageArr, maskArr, varianceArr, fluxMag0, filterName = exposureData
+    height, width = imageArr.shape
+    bbox = afwGeom.Box2I(afwGeom.Point2I(xy0[0], xy0[1]), afwGeom.Extent2I(width, height))
+    exposure = afwImage.ExposureF(bbox, wcs)
+    maskedImage = exposure.getMaskedImage()
+    maskedImage.getImage().getArray()[:,:] = imageArr
+    maskedImage.getMask().getArray()[:,:] = maskArr
+    maskedImage.getVariance().getArray()[:,:] = varianceArr
+    exposure.getCalib().setFluxMag0(fluxMag0[0], fluxMag0[1])
+    exposure.setFilter(afwImage.Filter(filterName))
+    return exposure
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""A memory-mappable file layout for exposures
+
+The file contains a fixed-size prefix (magic string and header length), a JSON header
+(bbox, plane layout, WCS, calib, filter, mask plane dict and metadata) and the image, mask
+and variance planes as raw native-endian arrays, each starting on a page boundary.
+Pixel data are accessed through numpy.memmap, so a subregion is a numpy view onto the mapped
+file: nothing is read until it is used, and the OS page cache is shared between processes.
+
+MappedExposure.getArrays returns those views, but MappedExposure.getExposure (and hence
+tempExpUtils.readTempExp) copies them into new afw images, because afw images cannot share
+numpy memory. For those readers the gain over FITS is only that no FITS decoding
+(or decompression) is done and only the pages of the subregion are touched; the pixels are
+still copied once.
+"""
+import json
+import os
+import struct
+
+import numpy
+
+import lsst.daf.base as dafBase
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+
+__all__ = ["MappedExposure", "writeMappedExposure", "getMappedPath"]
+
+_Magic = "LSSTMAPPEDEXP001"
+_PrefixFormat = "<16sQ" # magic, header length
+_Alignment = 4096
+_PlaneNameList = ("image", "mask", "variance")
+
+def getMappedPath(fitsPath):
+    """Return the path of the mapped copy of a FITS file
+    """
+    return fitsPath + ".mmap"
+
+def _roundUp(value, alignment=_Alignment):
+    return ((value + alignment - 1) // alignment) * alignment
+
+def _propertyListToDict(propertyList):
+    """Convert a PropertyList (with scalar items) to a list of (name, list of values), preserving order
+    """
+    return [(name, list(propertyList.getArray(name))) for name in propertyList.names()]
+
+def _dictToPropertyList(itemList):
+    """Convert the output of _propertyListToDict back to a PropertyList
+    """
+    propertyList = dafBase.PropertyList()
+    for name, valueList in itemList:
+        propertyList.set(str(name), _fromJson(valueList[0]))
+        for value in valueList[1:]:
+            propertyList.add(str(name), _fromJson(value))
+    return propertyList
+
+def _fromJson(value):
+    """Convert JSON unicode strings to str, so they are accepted by PropertyList
+    """
+    if isinstance(value, unicode):
+        return str(value)
+    return value
+
+def writeMappedExposure(exposure, path):
+    """Write an exposure in the memory-mappable layout
+
+    The file is written under a temporary name and then renamed, so readers never see a partial file.
+
+    @param[in] exposure: exposure to write (e.g. an afwImage.ExposureF)
+    @param[in] path: path of file
+    """
+    maskedImage = exposure.getMaskedImage()
+    bbox = maskedImage.getBBox(afwImage.PARENT)
+    arrayList = [numpy.ascontiguousarray(plane.getArray()) for plane in
+        (maskedImage.getImage(), maskedImage.getMask(), maskedImage.getVariance())]
+    calib = exposure.getCalib()
+    header = dict(
+        bbox = (bbox.getMinX(), bbox.getMinY(), bbox.getWidth(), bbox.getHeight()),
+        planes = [dict(name=name, dtype=arr.dtype.str, offset=0)
+            for name, arr in zip(_PlaneNameList, arrayList)],
+        wcs = _propertyListToDict(exposure.getWcs().getFitsMetadata()) if exposure.hasWcs() else None,
+        fluxMag0 = calib.getFluxMag0(),
+        filter = exposure.getFilter().getName(),
+        maskPlaneDict = dict(maskedImage.getMask().getMaskPlaneDict()),
+        metadata = _propertyListToDict(exposure.getMetadata()),
+    )
+
+    # the plane offsets do not change the header length much; leave room for them
+    headerLen = len(json.dumps(header)) + 100
+    offset = _roundUp(struct.calcsize(_PrefixFormat) + headerLen)
+    for planeDict, arr in zip(header["planes"], arrayList):
+        planeDict["offset"] = offset
+        offset = _roundUp(offset + arr.nbytes)
+    headerStr = json.dumps(header)
+    if len(headerStr) > headerLen:
+        raise RuntimeError("Bug: header length %d > %d" % (len(headerStr), headerLen))
+
+    tempPath = "%s.%d.tmp" % (path, os.getpid())
+    with open(tempPath, "wb") as outFile:
+        outFile.write(struct.pack(_PrefixFormat, _Magic, len(headerStr)))
+        outFile.write(headerStr)
+        for planeDict, arr in zip(header["planes"], arrayList):
+            outFile.seek(planeDict["offset"])
+            arr.tofile(outFile)
+        outFile.truncate(offset)
+    os.rename(tempPath, path)
+
+
+class MappedExposure(object):
+    """An exposure in a file written by writeMappedExposure, with its pixels memory-mapped
+    """
+    def __init__(self, path):
+        """Open a mapped exposure file and read its header
+
+        @raise RuntimeError if the file is not a mapped exposure file
+        """
+        self.path = path
+        prefixLen = struct.calcsize(_PrefixFormat)
+        with open(path, "rb") as inFile:
+            magic, headerLen = struct.unpack(_PrefixFormat, inFile.read(prefixLen))
+            if magic != _Magic:
+                raise RuntimeError("%s is not a mapped exposure file" % (path,))
+            self._header = json.loads(inFile.read(headerLen))
+        x0, y0, width, height = self._header["bbox"]
+        self._bbox = afwGeom.Box2I(afwGeom.Point2I(x0, y0), afwGeom.Extent2I(width, height))
+        self._arrayList = [
+            numpy.memmap(path, dtype=numpy.dtype(str(planeDict["dtype"])), mode="r",
+                offset=planeDict["offset"], shape=(height, width))
+            for planeDict in self._header["planes"]
+        ]
+
+    def getBBox(self):
+        """Return the parent bbox of the exposure
+        """
+        return afwGeom.Box2I(self._bbox)
+
+    def getArrays(self, bbox=None):
+        """Return (image, mask, variance) arrays for a region, as read-only views onto the mapped file
+
+        @param[in] bbox: parent bbox of region; if None then the whole exposure
+        @raise RuntimeError if bbox is not contained in the exposure's bbox
+        """
+        if bbox is None:
+            return tuple(self._arrayList)
+        if not self._bbox.contains(bbox):
+            raise RuntimeError("bbox %s not contained in %s bbox %s" % (bbox, self.path, self._bbox))
+        xStart = bbox.getMinX() - self._bbox.getMinX()
+        yStart = bbox.getMinY() - self._bbox.getMinY()
+        return tuple(arr[yStart:yStart + bbox.getHeight(), xStart:xStart + bbox.getWidth()]
+            for arr in self._arrayList)
+
+    def getWcs(self):
+        """Return the WCS, or None if the exposure has none
+        """
+        if self._header["wcs"] is None:
+            return None
+        return afwImage.makeWcs(_dictToPropertyList(self._header["wcs"]))
+
+    def getMetadata(self):
+        """Return the metadata (a PropertyList)
+        """
+        return _dictToPropertyList(self._header["metadata"])
+
+    def getExposure(self, bbox=None):
+        """Return the exposure, or a region of it, as an afwImage.ExposureF
+
+        The pixels of the region are copied from the mapped file (afw images cannot share numpy memory).
+
+        @param[in] bbox: parent bbox of region; if None then the whole exposure
+        @raise RuntimeError if bbox is not contained in the exposure's bbox,
+            or if the mask planes are incompatible with those of this process
+        """
+        if bbox is None:
+            bbox = self.getBBox()
+        arrayList = self.getArrays(bbox)
+        exposure = afwImage.ExposureF(bbox, self.getWcs())
+        maskedImage = exposure.getMaskedImage()
+        self._conformMaskPlanes(maskedImage.getMask())
+        for plane, arr in zip((maskedImage.getImage(), maskedImage.getMask(), maskedImage.getVariance()),
+            arrayList):
+            plane.getArray()[:] = arr
+        calib = exposure.getCalib()
+        calib.setFluxMag0(*self._header["fluxMag0"])
+        exposure.setFilter(afwImage.Filter(str(self._header["filter"])))
+        exposure.setMetadata(self.getMetadata())
+        return exposure
+
+    def _conformMaskPlanes(self, mask):
+        """Add mask planes that are in the file but not in this process; check bits of the others
+
+        @raise RuntimeError if a mask plane has a different bit in the file than in this process
+        """
+        currDict = mask.getMaskPlaneDict()
+        for name, bit in self._header["maskPlaneDict"].iteritems():
+            name = str(name)
+            if name not in currDict:
+                mask.addMaskPlane(name)
+                currDict = mask.getMaskPlaneDict()
+            if currDict[name] != bit:
+                raise RuntimeError("Mask plane %s has bit %d in %s but bit %d in this process" % \
+                    (name, bit, self.path, currDict[name]))
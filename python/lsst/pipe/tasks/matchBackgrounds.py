@@ -26,6 +26,13 @@ import lsst.afw.geom as afwGeom
 import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipeBase
 import lsstDebug
+from .compactBackground import CompactBackground
+from .exposureMetrics import ExposureMetrics, getMaskedImageNBytes
+from .tempExpUtils import readTempExp
+
+# names of per-exposure metrics recorded by MatchBackgroundsTask; see ExposureMetrics
+_MatchMetricNameList = ("ReadTime", "ScaleTime", "FitTime", "RenderTime", "BytesRead")
+_SelectRefMetricNameList = ("ReadTime", "ScaleTime", "StatsTime", "BytesRead")
 
 class MatchBackgroundsConfig(pexConfig.Config):
 
@@ -159,6 +166,9 @@ class MatchBackgroundsTask(pipeBase.Task):
             - diffImVar: the mean variance of the difference image.
             All fields except isReference will be None if isReference True or the fit failed.
         
+        Per-exposure costs are recorded in the task metadata with prefix "match";
+        see lsst.pipe.tasks.exposureMetrics.ExposureMetrics for details.
+
         @warning: all exposures must exist on disk
         """
         
@@ -198,7 +208,7 @@ class MatchBackgroundsTask(pipeBase.Task):
         if refInd is not None and refInd not in refIndSet:
             raise RuntimeError("Internal error: selected reference %s not found in expRefList")
         
-        refExposure = refExpDataRef.get(expDatasetType, immediate=True)
+        refExposure = readTempExp(refExpDataRef, expDatasetType)
         if refImageScaler is not None:
             refMI = refExposure.getMaskedImage()
             refImageScaler.scaleMaskedImage(refMI)
@@ -209,6 +219,7 @@ class MatchBackgroundsTask(pipeBase.Task):
 
         backgroundInfoList = []
         for ind, (toMatchRef, imageScaler) in enumerate(zip(expRefList, imageScalerList)):
+            expMetrics = ExposureMetrics(self, "match", toMatchRef.dataId, _MatchMetricNameList)
             if ind in refIndSet:
                 backgroundInfoStruct = pipeBase.Struct(
                     isReference = True,
@@ -220,15 +231,19 @@ class MatchBackgroundsTask(pipeBase.Task):
             else:
                 self.log.info("Matching background of %s to %s" % (toMatchRef.dataId, refExpDataRef.dataId))
                 try:
-                    toMatchExposure = toMatchRef.get(expDatasetType, immediate=True)
+                    with expMetrics.timeStage("ReadTime"):
+                        toMatchExposure = readTempExp(toMatchRef, expDatasetType)
+                    expMetrics.set("BytesRead", getMaskedImageNBytes(toMatchExposure.getMaskedImage()))
                     if imageScaler is not None:
-                        toMatchMI = toMatchExposure.getMaskedImage()
-                        imageScaler.scaleMaskedImage(toMatchMI)
+                        with expMetrics.timeStage("ScaleTime"):
+                            toMatchMI = toMatchExposure.getMaskedImage()
+                            imageScaler.scaleMaskedImage(toMatchMI)
                     #store a string specifying the visit to label debug plot
                     self.debugDataIdString = ''.join([str(toMatchRef.dataId[vk]) for vk in debugIdKeyList])
                     backgroundInfoStruct = self.matchBackgrounds(
                         refExposure = refExposure,
                         sciExposure = toMatchExposure,
+                        expMetrics = expMetrics,
                     )
                     backgroundInfoStruct.isReference = False
                 except Exception, e:
@@ -241,6 +256,7 @@ class MatchBackgroundsTask(pipeBase.Task):
                         diffImVar = None,
                     )
     
+            expMetrics.record()
             backgroundInfoList.append(backgroundInfoStruct)
             
         return pipeBase.Struct(
@@ -256,6 +272,9 @@ class MatchBackgroundsTask(pipeBase.Task):
         - bestRefWeightVariance
         - bestRefWeightLevel
 
+        Per-exposure costs are recorded in the task metadata with prefix "selectRef";
+        see lsst.pipe.tasks.exposureMetrics.ExposureMetrics for details.
+
         @param[in] expRefList: list of data references to exposures.
             Retrieves dataset type specified by expDatasetType.
             If an exposure is not found, it is skipped with a warning.
@@ -277,19 +296,26 @@ class MatchBackgroundsTask(pipeBase.Task):
                 (len(expRefList), len(imageScalerList)))
 
         for expRef, imageScaler  in zip(expRefList, imageScalerList):
-            exposure = expRef.get(expDatasetType, immediate=True)
+            expMetrics = ExposureMetrics(self, "selectRef", expRef.dataId, _SelectRefMetricNameList)
+            with expMetrics.timeStage("ReadTime"):
+                exposure = readTempExp(expRef, expDatasetType)
             maskedImage = exposure.getMaskedImage()
+            expMetrics.set("BytesRead", getMaskedImageNBytes(maskedImage))
             if imageScaler is not None:
                 try:
-                    imageScaler.scaleMaskedImage(maskedImage)
+                    with expMetrics.timeStage("ScaleTime"):
+                        imageScaler.scaleMaskedImage(maskedImage)
                 except:
                     #need to put a place holder in Arr
                     varList.append(numpy.nan)
                     meanBkgdLevelList.append(numpy.nan)
                     coverageList.append(numpy.nan)
+                    expMetrics.record()
                     continue  
-            statObjIm = afwMath.makeStatistics(maskedImage.getImage(), maskedImage.getMask(),
-                afwMath.MEAN | afwMath.NPOINT | afwMath.VARIANCE, self.sctrl)
+            with expMetrics.timeStage("StatsTime"):
+                statObjIm = afwMath.makeStatistics(maskedImage.getImage(), maskedImage.getMask(),
+                    afwMath.MEAN | afwMath.NPOINT | afwMath.VARIANCE, self.sctrl)
+            expMetrics.record()
             meanVar, meanVarErr = statObjIm.getResult(afwMath.VARIANCE)
             meanBkgdLevel, meanBkgdLevelErr = statObjIm.getResult(afwMath.MEAN)
             npoints, npointsErr = statObjIm.getResult(afwMath.NPOINT)
@@ -312,7 +338,7 @@ class MatchBackgroundsTask(pipeBase.Task):
 
     
     @pipeBase.timeMethod
-    def matchBackgrounds(self, refExposure, sciExposure):
+    def matchBackgrounds(self, refExposure, sciExposure, expMetrics=None):
         """
         Match science exposure's background level to that of reference exposure.
 
@@ -328,6 +354,8 @@ class MatchBackgroundsTask(pipeBase.Task):
         @param[in] refExposure: reference exposure
         @param[in,out] sciExposure: science exposure; modified by changing the background level
             to match that of the reference exposure
+        @param[in,out] expMetrics: an ExposureMetrics for sciExposure that accepts "FitTime" and "RenderTime";
+            if None then the times are measured but not recorded
         @returns a pipBase.Struct with fields:
             - backgroundModel: an afw.math.Approximate or an afw.math.Background.
             - fitRMS: rms of the fit. This is the sqrt(mean(residuals**2)).
@@ -336,6 +364,9 @@ class MatchBackgroundsTask(pipeBase.Task):
             - diffImVar: the mean variance of the difference image.
         """
 
+        if expMetrics is None:
+            expMetrics = ExposureMetrics(self, "match", {}, _MatchMetricNameList)
+
         if lsstDebug.Info(__name__).savefits:
             refExposure.writeFits(lsstDebug.Info(__name__).figpath + 'refExposure.fits')
             sciExposure.writeFits(lsstDebug.Info(__name__).figpath + 'sciExposure.fits')
@@ -366,75 +397,80 @@ class MatchBackgroundsTask(pipeBase.Task):
         self.sctrl.setNumSigmaClip(self.config.numSigmaClip)
         self.sctrl.setNumIter(self.config.numIter)
 
-        im  = refExposure.getMaskedImage()
-        diffMI = im.Factory(im,True)
-        diffMI -= sciExposure.getMaskedImage()
-
-        width = diffMI.getWidth()
-        height = diffMI.getHeight()
-        nx = width // self.config.binSize
-        if width % self.config.binSize != 0:
-            nx += 1
-        ny = height // self.config.binSize
-        if height % self.config.binSize != 0:
-            ny += 1
-
-        bctrl = afwMath.BackgroundControl(nx, ny, self.sctrl, statsFlag)
-        bctrl.setUndersampleStyle(self.config.undersampleStyle)
-        bctrl.setInterpStyle(self.config.interpStyle)
-
-        bkgd = afwMath.makeBackground(diffMI, bctrl)
-
-        # Some config and input checks if config.usePolynomial:
-        # 1) Check that order/bin size make sense:
-        # 2) Change binsize or order if underconstrained.
-        # 3) Add some tiny Gaussian noise if the image is completely uniform
-        #        (change after ticket 2411)
-        if self.config.usePolynomial:
-            order = self.config.order
-            bgX, bgY, bgZ, bgdZ = self._gridImage(diffMI, self.config.binSize, statsFlag)
-            minNumberGridPoints = min(len(set(bgX)),len(set(bgY)))
-            if len(bgZ) == 0:
-                raise ValueError("No overlap with reference. Nothing to match")
-            elif minNumberGridPoints <= self.config.order:
-                #must either lower order or raise number of bins or throw exception
-                if self.config.undersampleStyle == "THROW_EXCEPTION":
-                    raise ValueError("Image does not cover enough of ref image for order and binsize")
-                elif self.config.undersampleStyle == "REDUCE_INTERP_ORDER":
-                    self.log.warn("Reducing order to %d"%(minNumberGridPoints - 1))
-                    order = minNumberGridPoints - 1
-                elif self.config.undersampleStyle == "INCREASE_NXNYSAMPLE":
-                    newBinSize = (minNumberGridPoints*self.config.binSize)// (self.config.order +1)
-                    bctrl.setNxSample(newBinSize)
-                    bctrl.setNySample(newBinSize)
-                    bkgd = afwMath.makeBackground(diffMI, bctrl) #do over
-                    self.log.warn("Decreasing binsize to %d"%(newBinSize))
-
-            if not any(dZ > 1e-8 for dZ in bgdZ) and not any(bgZ): #uniform image
-                gaussianNoiseIm = afwImage.ImageF(diffMI.getImage(), True)
-                afwMath.randomGaussianImage(gaussianNoiseIm, afwMath.Random(1))
-                gaussianNoiseIm *= 1e-8
-                diffMI += gaussianNoiseIm
-                bkgd = afwMath.makeBackground(diffMI, bctrl)
+        with expMetrics.timeStage("FitTime"):
+            im  = refExposure.getMaskedImage()
+            diffMI = im.Factory(im,True)
+            diffMI -= sciExposure.getMaskedImage()
+
+            width = diffMI.getWidth()
+            height = diffMI.getHeight()
+            nx = width // self.config.binSize
+            if width % self.config.binSize != 0:
+                nx += 1
+            ny = height // self.config.binSize
+            if height % self.config.binSize != 0:
+                ny += 1
+
+            bctrl = afwMath.BackgroundControl(nx, ny, self.sctrl, statsFlag)
+            bctrl.setUndersampleStyle(self.config.undersampleStyle)
+            bctrl.setInterpStyle(self.config.interpStyle)
+
+            bkgd = afwMath.makeBackground(diffMI, bctrl)
+
+            # Some config and input checks if config.usePolynomial:
+            # 1) Check that order/bin size make sense:
+            # 2) Change binsize or order if underconstrained.
+            # 3) Add some tiny Gaussian noise if the image is completely uniform
+            #        (change after ticket 2411)
+            if self.config.usePolynomial:
+                order = self.config.order
+                bgX, bgY, bgZ, bgdZ = self._gridImage(diffMI, self.config.binSize, statsFlag)
+                minNumberGridPoints = min(len(set(bgX)),len(set(bgY)))
+                if len(bgZ) == 0:
+                    raise ValueError("No overlap with reference. Nothing to match")
+                elif minNumberGridPoints <= self.config.order:
+                    #must either lower order or raise number of bins or throw exception
+                    if self.config.undersampleStyle == "THROW_EXCEPTION":
+                        raise ValueError("Image does not cover enough of ref image for order and binsize")
+                    elif self.config.undersampleStyle == "REDUCE_INTERP_ORDER":
+                        self.log.warn("Reducing order to %d"%(minNumberGridPoints - 1))
+                        order = minNumberGridPoints - 1
+                    elif self.config.undersampleStyle == "INCREASE_NXNYSAMPLE":
+                        newBinSize = (minNumberGridPoints*self.config.binSize)// (self.config.order +1)
+                        bctrl.setNxSample(newBinSize)
+                        bctrl.setNySample(newBinSize)
+                        bkgd = afwMath.makeBackground(diffMI, bctrl) #do over
+                        self.log.warn("Decreasing binsize to %d"%(newBinSize))
+
+                if not any(dZ > 1e-8 for dZ in bgdZ) and not any(bgZ): #uniform image
+                    gaussianNoiseIm = afwImage.ImageF(diffMI.getImage(), True)
+                    afwMath.randomGaussianImage(gaussianNoiseIm, afwMath.Random(1))
+                    gaussianNoiseIm *= 1e-8
+                    diffMI += gaussianNoiseIm
+                    bkgd = afwMath.makeBackground(diffMI, bctrl)
 
         #Add offset to sciExposure
         try:
             if self.config.usePolynomial:
-                actrl = afwMath.ApproximateControl(afwMath.ApproximateControl.CHEBYSHEV,
-                                                   order,
-                                                   order)
-                undersampleStyle = getattr(afwMath, self.config.undersampleStyle)
-                approx = bkgd.getApproximate(actrl,undersampleStyle)
-                bkgdImage = approx.getImage()
+                with expMetrics.timeStage("FitTime"):
+                    actrl = afwMath.ApproximateControl(afwMath.ApproximateControl.CHEBYSHEV,
+                                                       order,
+                                                       order)
+                    undersampleStyle = getattr(afwMath, self.config.undersampleStyle)
+                    approx = bkgd.getApproximate(actrl,undersampleStyle)
+                with expMetrics.timeStage("RenderTime"):
+                    bkgdImage = approx.getImage()
             else:
-                bkgdImage = bkgd.getImageF()
+                with expMetrics.timeStage("RenderTime"):
+                    bkgdImage = bkgd.getImageF()
         except Exception, e:
             raise RuntimeError("Background/Approximation failed to interp image %s: %s" % (
                 self.debugDataIdString, e))
 
-        sciMI  = sciExposure.getMaskedImage()
-        sciMI += bkgdImage
-        del sciMI
+        with expMetrics.timeStage("RenderTime"):
+            sciMI  = sciExposure.getMaskedImage()
+            sciMI += bkgdImage
+            del sciMI
 
         if lsstDebug.Info(__name__).savefits:
             sciExposure.writeFits(lsstDebug.Info(__name__).figpath + 'sciMatchedExposure.fits')
@@ -566,6 +602,124 @@ class MatchBackgroundsTask(pipeBase.Task):
         return numpy.array(bgX), numpy.array(bgY), numpy.array(bgZ), numpy.array(bgdZ)
 
 
+class MatchedBackgroundModel(object):
+    """A compact background-matching model that can be pickled
+
+    The fitted afw.math.Background and afw.math.Approximate objects cannot be persisted,
+    so the image they render is saved as a CompactBackground: the mean of each binSize x binSize bin,
+    which is interpolated bilinearly when the model is rendered. Matching models are smooth
+    on the scale of MatchBackgroundsConfig.binSize, so a few times smaller bins lose little accuracy.
+    Both getImage and getImageF are provided, so this may be used in place of either kind of model.
+    """
+    def __init__(self, image, binSize):
+        """Construct a MatchedBackgroundModel
+
+        @param[in] image: rendered model (an afwImage.ImageF or ImageD)
+        @param[in] binSize: size of bins (pixels)
+        """
+        self._compactBackground = CompactBackground(image, binSize)
+        self._image = None
+
+    def __getstate__(self):
+        """Do not pickle the rendered image
+        """
+        return dict(_compactBackground = self._compactBackground, _image = None)
+
+    def getNBytes(self):
+        """Return the number of bytes of data that are persisted
+        """
+        return self._compactBackground.getNBytes()
+
+    def getImageF(self):
+        """Return the model as an afwImage.ImageF
+
+        The image is rendered once and then reused, so do not modify it.
+        """
+        if self._image is None:
+            width, height = self._compactBackground.dimensions
+            x0, y0 = self._compactBackground.xy0
+            yArr, xArr = numpy.mgrid[y0:y0 + height, x0:x0 + width]
+            self._image = afwImage.ImageF(width, height)
+            self._image.setXY0(afwGeom.Point2I(x0, y0))
+            self._image.getArray()[:,:] = self._compactBackground.evaluate(xArr, yArr)
+        return self._image
+
+    getImage = getImageF
+
+
+class BackgroundInfoCache(object):
+    """Persistable record of the results of MatchBackgroundsTask.run for one patch
+
+    Saving this allows the background matching of a patch to be reused when the coadd is
+    assembled again with different settings (e.g. different clipping or interpolation),
+    as long as the same exposures, unchanged, are being matched with the same configuration.
+    """
+    def __init__(self, expIdList, expSignatureList, configHash, backgroundInfoList, binSize):
+        """Construct a BackgroundInfoCache
+
+        @param[in] expIdList: list of data IDs (dicts) of the matched exposures,
+            in the order used for backgroundInfoList
+        @param[in] expSignatureList: list of signatures of the files of the matched exposures,
+            in the same order; see lsst.pipe.tasks.coaddBase.getDatasetSignature
+        @param[in] configHash: a string that identifies the configuration used for matching;
+            see lsst.pipe.tasks.coaddBase.makeConfigHash
+        @param[in] backgroundInfoList: backgroundInfoList returned by MatchBackgroundsTask.run
+        @param[in] binSize: size of bins of the persisted background models (pixels);
+            see MatchedBackgroundModel
+        """
+        if not len(expIdList) == len(expSignatureList) == len(backgroundInfoList):
+            raise RuntimeError("len(expIdList) = %s, len(expSignatureList) = %s and " \
+                "len(backgroundInfoList) = %s must be equal" % \
+                (len(expIdList), len(expSignatureList), len(backgroundInfoList)))
+        self.expIdList = [self._makeIdKey(expId) for expId in expIdList]
+        self.expSignatureList = list(expSignatureList)
+        self.configHash = configHash
+        self.infoDictList = []
+        for backgroundInfo in backgroundInfoList:
+            if backgroundInfo.backgroundModel is None:
+                model = None
+            elif isinstance(backgroundInfo.backgroundModel, MatchedBackgroundModel):
+                model = backgroundInfo.backgroundModel
+            elif hasattr(backgroundInfo.backgroundModel, "getImageF"):
+                model = MatchedBackgroundModel(backgroundInfo.backgroundModel.getImageF(), binSize)
+            else:
+                model = MatchedBackgroundModel(backgroundInfo.backgroundModel.getImage(), binSize)
+            self.infoDictList.append(dict(
+                isReference = backgroundInfo.isReference,
+                backgroundModel = model,
+                fitRMS = backgroundInfo.fitRMS,
+                matchedMSE = backgroundInfo.matchedMSE,
+                diffImVar = backgroundInfo.diffImVar,
+            ))
+
+    @staticmethod
+    def _makeIdKey(dataId):
+        """Return a hashable, order-independent version of a data ID
+        """
+        return tuple(sorted(dataId.items()))
+
+    def isValid(self, expIdList, expSignatureList, configHash):
+        """Return True if this cache was made from the specified exposures and configuration
+
+        A cache is never valid if any signature is "unknown".
+
+        @param[in] expIdList: list of data IDs (dicts) of the exposures to match, in order
+        @param[in] expSignatureList: list of signatures of the files of the exposures to match, in order
+        @param[in] configHash: a string that identifies the current configuration
+        """
+        return configHash == self.configHash \
+            and [self._makeIdKey(expId) for expId in expIdList] == self.expIdList \
+            and list(expSignatureList) == self.expSignatureList \
+            and "unknown" not in self.expSignatureList
+
+    def getBackgroundInfoList(self):
+        """Return a backgroundInfoList in the format returned by MatchBackgroundsTask.run
+
+        The background models are MatchedBackgroundModel objects.
+        """
+        return [pipeBase.Struct(**infoDict) for infoDict in self.infoDictList]
+
+
 class DataRefMatcher(object):
     """Match data references for a specified dataset type
         
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import numpy
+
+import lsst.afw.image as afwImage
+import lsst.coadd.utils as coaddUtils
+
+__all__ = ["MergeableCoaddMixin", "MergeableCoadd"]
+
+class MergeableCoaddMixin(object):
+    """Mixin for lsst.coadd.utils.Coadd and its subclasses, so that partial coadds
+    (each built from a subset of the exposures, e.g. in a separate process) can be merged
+
+    A Coadd accumulates sums over exposures (in its _coadd exposure and _weightMap image)
+    that are only normalized by getCoadd; the sums of the partial coadds are added
+    (and the masks OR-ed) to give the sums of a coadd of all the exposures.
+    This works for any subclass that accumulates in this way, e.g. the chi-squared coadd.
+    """
+    def getPartialData(self):
+        """Return the partial sums and filter names of this coadd, as picklable data for mergePartialData
+        """
+        maskedImage = self._coadd.getMaskedImage()
+        bbox = maskedImage.getBBox(afwImage.PARENT)
+        return dict(
+            bbox = (bbox.getMinX(), bbox.getMinY(), bbox.getWidth(), bbox.getHeight()),
+            image = maskedImage.getImage().getArray(),
+            mask = maskedImage.getMask().getArray(),
+            variance = maskedImage.getVariance().getArray(),
+            weight = self._weightMap.getArray(),
+            filterNameList = sorted(self._filterDict.keys()),
+        )
+
+    def mergePartialData(self, partialData):
+        """Add the partial sums of another coadd (of other exposures) to this coadd
+
+        @param[in] partialData: data returned by getPartialData for a coadd with the same bbox
+        @raise RuntimeError if the bbox of the partial coadd differs from that of this coadd
+        """
+        maskedImage = self._coadd.getMaskedImage()
+        bbox = maskedImage.getBBox(afwImage.PARENT)
+        bboxTuple = (bbox.getMinX(), bbox.getMinY(), bbox.getWidth(), bbox.getHeight())
+        if tuple(partialData["bbox"]) != bboxTuple:
+            raise RuntimeError("Partial coadd bbox %s != coadd bbox %s" % (partialData["bbox"], bboxTuple))
+        maskedImage.getImage().getArray()[:] += partialData["image"]
+        maskArr = maskedImage.getMask().getArray()
+        maskArr[:] = numpy.bitwise_or(maskArr, partialData["mask"])
+        maskedImage.getVariance().getArray()[:] += partialData["variance"]
+        self._weightMap.getArray()[:] += partialData["weight"]
+        for filterName in partialData["filterNameList"]:
+            if filterName not in self._filterDict:
+                self._filterDict[filterName] = afwImage.Filter(filterName)
+
+
+class MergeableCoadd(MergeableCoaddMixin, coaddUtils.Coadd):
+    """A lsst.coadd.utils.Coadd whose partial coadds can be merged
+    """
+    pass
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Simple polygon utilities for computing how much of an exposure lands in a patch
+
+Planar polygons are sequences of (x, y) vertices in order (either sense);
+boxes are (minX, minY, maxX, maxY).
+
+Spherical polygons have great-circle edges and are specified as sequences of (RA, Dec) vertices (deg);
+they must be smaller than a hemisphere. Their vertices may be given in any order, as long as the polygon
+is convex (e.g. the four corners of an exposure or patch), because they are sorted around their center.
+"""
+import math
+
+__all__ = ["clipPolygonToBox", "polygonArea", "polygonBoxOverlapArea",
+    "sphericalPolygonArea", "sphericalPolygonOverlapArea"]
+
+SqArcsecPerSr = (180.0 * 3600.0 / math.pi)**2
+
+def clipPolygonToBox(pointList, box):
+    """Clip a convex or concave polygon to an axis-aligned box (Sutherland-Hodgman)
+
+    @param[in] pointList: vertices of polygon, as (x, y) pairs
+    @param[in] box: (minX, minY, maxX, maxY)
+    @return vertices of the clipped polygon, as a list of (x, y) tuples; empty if there is no overlap
+    """
+    minX, minY, maxX, maxY = box
+    # each edge is (is inside function, intersection function)
+    edgeList = (
+        (lambda p: p[0] >= minX, lambda p, q: _intersectX(p, q, minX)),
+        (lambda p: p[0] <= maxX, lambda p, q: _intersectX(p, q, maxX)),
+        (lambda p: p[1] >= minY, lambda p, q: _intersectY(p, q, minY)),
+        (lambda p: p[1] <= maxY, lambda p, q: _intersectY(p, q, maxY)),
+    )
+    outList = [(float(x), float(y)) for x, y in pointList]
+    for isInside, intersect in edgeList:
+        inList = outList
+        outList = []
+        if not inList:
+            break
+        prevPoint = inList[-1]
+        for point in inList:
+            if isInside(point):
+                if not isInside(prevPoint):
+                    outList.append(intersect(prevPoint, point))
+                outList.append(point)
+            elif isInside(prevPoint):
+                outList.append(intersect(prevPoint, point))
+            prevPoint = point
+    return outList
+
+def _intersectX(p, q, x):
+    """Return the point on segment p-q with the specified x
+    """
+    frac = (x - p[0]) / (q[0] - p[0])
+    return (x, p[1] + frac * (q[1] - p[1]))
+
+def _intersectY(p, q, y):
+    """Return the point on segment p-q with the specified y
+    """
+    frac = (y - p[1]) / (q[1] - p[1])
+    return (p[0] + frac * (q[0] - p[0]), y)
+
+def polygonArea(pointList):
+    """Return the area of a simple polygon (shoelace formula)
+
+    @param[in] pointList: vertices of polygon, as (x, y) pairs
+    @return area (always >= 0)
+    """
+    area = 0.0
+    numPoints = len(pointList)
+    for i in range(numPoints):
+        x0, y0 = pointList[i]
+        x1, y1 = pointList[(i + 1) % numPoints]
+        area += x0 * y1 - x1 * y0
+    return abs(area) / 2.0
+
+def polygonBoxOverlapArea(pointList, box):
+    """Return the area of overlap of a polygon and an axis-aligned box
+
+    @param[in] pointList: vertices of polygon, as (x, y) pairs
+    @param[in] box: (minX, minY, maxX, maxY)
+    """
+    return polygonArea(clipPolygonToBox(pointList, box))
+
+def sphericalPolygonArea(raDecList):
+    """Return the area of a convex spherical polygon
+
+    @param[in] raDecList: vertices of polygon, as (RA, Dec) pairs (deg)
+    @return area (arcsec^2)
+    """
+    return _vectorPolygonArea(_orderVectors([_vectorFromRaDec(ra, dec) for ra, dec in raDecList])) \
+        * SqArcsecPerSr
+
+def sphericalPolygonOverlapArea(raDecList, clipRaDecList):
+    """Return the area of overlap of two convex spherical polygons
+
+    The overlap is computed exactly (to rounding error) by clipping the first polygon
+    to each great-circle edge of the second (Sutherland-Hodgman on the sphere).
+
+    @param[in] raDecList: vertices of first polygon, as (RA, Dec) pairs (deg)
+    @param[in] clipRaDecList: vertices of second polygon, as (RA, Dec) pairs (deg)
+    @return area of overlap (arcsec^2)
+    """
+    vecList = _orderVectors([_vectorFromRaDec(ra, dec) for ra, dec in raDecList])
+    clipVecList = _orderVectors([_vectorFromRaDec(ra, dec) for ra, dec in clipRaDecList])
+    clipCenter = _normalize(_sum(clipVecList))
+    numClip = len(clipVecList)
+    for i in range(numClip):
+        # normal of the plane of the edge, pointing into the clip polygon
+        normal = _cross(clipVecList[i], clipVecList[(i + 1) % numClip])
+        if _dot(normal, clipCenter) < 0:
+            normal = _scale(normal, -1.0)
+        inList = vecList
+        vecList = []
+        if not inList:
+            break
+        prevVec = inList[-1]
+        prevDist = _dot(prevVec, normal)
+        for vec in inList:
+            dist = _dot(vec, normal)
+            if dist >= 0:
+                if prevDist < 0:
+                    vecList.append(_intersectEdge(prevVec, prevDist, vec, dist))
+                vecList.append(vec)
+            elif prevDist >= 0:
+                vecList.append(_intersectEdge(prevVec, prevDist, vec, dist))
+            prevVec, prevDist = vec, dist
+    if len(vecList) < 3:
+        return 0.0
+    return _vectorPolygonArea(vecList) * SqArcsecPerSr
+
+def _vectorFromRaDec(ra, dec):
+    """Return the unit vector for an RA, Dec (deg)
+    """
+    raRad = math.radians(ra)
+    decRad = math.radians(dec)
+    return (math.cos(decRad) * math.cos(raRad), math.cos(decRad) * math.sin(raRad), math.sin(decRad))
+
+def _dot(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+def _cross(a, b):
+    return (a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0])
+
+def _scale(a, factor):
+    return (a[0] * factor, a[1] * factor, a[2] * factor)
+
+def _sum(vecList):
+    return tuple(sum(vec[i] for vec in vecList) for i in range(3))
+
+def _normalize(a):
+    norm = math.sqrt(_dot(a, a))
+    return _scale(a, 1.0 / norm)
+
+def _intersectEdge(p, pDist, q, qDist):
+    """Return the point where great-circle arc p-q crosses a plane, given the signed distances of p and q
+    from the plane (which must have opposite signs); the result lies on the minor arc between p and q
+    """
+    pWeight = abs(qDist)
+    qWeight = abs(pDist)
+    return _normalize((
+        pWeight * p[0] + qWeight * q[0],
+        pWeight * p[1] + qWeight * q[1],
+        pWeight * p[2] + qWeight * q[2],
+    ))
+
+def _orderVectors(vecList):
+    """Return vertices of a convex spherical polygon sorted by position angle around their center
+    """
+    center = _normalize(_sum(vecList))
+    # make an orthonormal basis for the plane tangent at the center
+    refAxis = (1.0, 0.0, 0.0) if abs(center[0]) < 0.9 else (0.0, 1.0, 0.0)
+    axis1 = _normalize(_cross(center, refAxis))
+    axis2 = _cross(center, axis1)
+    return sorted(vecList, key=lambda vec: math.atan2(_dot(vec, axis2), _dot(vec, axis1)))
+
+def _vectorPolygonArea(vecList):
+    """Return the area of a spherical polygon whose vertices are unit vectors in order (sr)
+
+    The polygon is divided into a fan of triangles about its first vertex, and the signed area
+    of each triangle is computed with the formula of Van Oosterom and Strackee.
+    """
+    area = 0.0
+    a = vecList[0]
+    for b, c in zip(vecList[1:-1], vecList[2:]):
+        area += 2.0 * math.atan2(_dot(a, _cross(b, c)), 1.0 + _dot(a, b) + _dot(b, c) + _dot(c, a))
+    return abs(area)
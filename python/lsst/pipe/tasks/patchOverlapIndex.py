@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""A persisted index of which calexps overlap which sky map patches
+
+The index is a SQLite file that maps (tract, patch) to the calexps that overlap the outer bbox
+of the patch, with the fraction of the patch covered by each calexp and the fraction of the calexp
+that lands in the patch. It is built incrementally by bin/reportImagesToCoadd.py (calexps already
+in the index are skipped), and used by the coadd tasks and imageDifference instead of
+selection queries and sky map geometry. An index is only valid for the sky map it was built with.
+
+Calexps are grouped by "coadd ID": the items of the coadd data ID other than tract and patch,
+e.g. {"filter": "r"}.
+"""
+import json
+import sqlite3
+
+import lsst.afw.geom as afwGeom
+from .overlap import polygonArea, polygonBoxOverlapArea
+
+__all__ = ["PatchOverlapIndex", "computePatchOverlaps", "getCoaddId"]
+
+class PatchOverlapIndex(object):
+    """A SQLite index of (tract, patch): calexps that overlap the patch, with overlap fractions
+    """
+    _SchemaVersion = 1
+
+    def __init__(self, path, create=False):
+        """Open an index
+
+        @param[in] path: path of SQLite file
+        @param[in] create: create the index if it does not exist? If False and the index
+            does not exist then RuntimeError is raised
+        """
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0:
+            if not create:
+                self._conn.close()
+                raise RuntimeError("%s is not a patch overlap index" % (path,))
+            self._createTables()
+        elif version != self._SchemaVersion:
+            self._conn.close()
+            raise RuntimeError("%s has schema version %s; this code requires %s" % \
+                (path, version, self._SchemaVersion))
+
+    def _createTables(self):
+        self._conn.executescript("""
+            CREATE TABLE calexp (
+                id INTEGER PRIMARY KEY,
+                dataId TEXT UNIQUE NOT NULL,
+                coaddId TEXT NOT NULL
+            );
+            CREATE TABLE overlap (
+                calexpId INTEGER NOT NULL,
+                tract INTEGER NOT NULL,
+                patchX INTEGER NOT NULL,
+                patchY INTEGER NOT NULL,
+                patchFraction REAL NOT NULL,
+                exposureFraction REAL NOT NULL,
+                PRIMARY KEY (tract, patchX, patchY, calexpId)
+            );
+            CREATE INDEX overlap_calexp ON overlap (calexpId);
+            PRAGMA user_version = %d;
+        """ % (self._SchemaVersion,))
+        self._conn.commit()
+
+    def close(self):
+        """Commit changes and close the index
+        """
+        self._conn.commit()
+        self._conn.close()
+
+    def commit(self):
+        """Commit changes
+        """
+        self._conn.commit()
+
+    @staticmethod
+    def getDataIdKey(dataId):
+        """Return the string stored in the index for a data ID or coadd ID
+        """
+        return json.dumps(dataId, sort_keys=True)
+
+    def hasExposure(self, dataId):
+        """Return True if the calexp with the given data ID is in the index
+
+        A calexp that overlaps no patches is still recorded, so it is not processed again.
+        """
+        cursor = self._conn.execute("SELECT COUNT(*) FROM calexp WHERE dataId = ?",
+            (self.getDataIdKey(dataId),))
+        return cursor.fetchone()[0] > 0
+
+    def addExposure(self, dataId, coaddId, overlapList):
+        """Add a calexp to the index, replacing any existing entry for the same data ID
+
+        @param[in] dataId: data ID of calexp (a dict)
+        @param[in] coaddId: coadd ID of the coadds the calexp goes into, as returned by getCoaddId
+        @param[in] overlapList: list of (tract ID, patch index (x, y), patch fraction, exposure fraction),
+            as returned by computePatchOverlaps
+        """
+        dataIdKey = self.getDataIdKey(dataId)
+        cursor = self._conn.execute("SELECT id FROM calexp WHERE dataId = ?", (dataIdKey,))
+        row = cursor.fetchone()
+        if row is not None:
+            self._conn.execute("DELETE FROM calexp WHERE id = ?", (row[0],))
+            self._conn.execute("DELETE FROM overlap WHERE calexpId = ?", (row[0],))
+        cursor = self._conn.execute("INSERT INTO calexp VALUES (NULL, ?, ?)",
+            (dataIdKey, self.getDataIdKey(coaddId)))
+        calexpId = cursor.lastrowid
+        self._conn.executemany("INSERT INTO overlap VALUES (?, ?, ?, ?, ?, ?)",
+            [(calexpId, tractId, patchIndex[0], patchIndex[1], patchFraction, exposureFraction)
+                for tractId, patchIndex, patchFraction, exposureFraction in overlapList])
+
+    def getPatchExposures(self, tractId, patchIndex, coaddId, minPatchFraction=0.0):
+        """Return the calexps that overlap a patch, ordered by data ID
+
+        @param[in] tractId: tract ID
+        @param[in] patchIndex: patch index (x, y)
+        @param[in] coaddId: coadd ID, as returned by getCoaddId
+        @param[in] minPatchFraction: minimum fraction of the patch covered by a calexp
+        @return a list of (data ID, patch fraction, exposure fraction)
+        """
+        cursor = self._conn.execute("SELECT calexp.dataId, patchFraction, exposureFraction " \
+            "FROM overlap JOIN calexp ON overlap.calexpId = calexp.id " \
+            "WHERE tract = ? AND patchX = ? AND patchY = ? AND coaddId = ? AND patchFraction > ? " \
+            "ORDER BY calexp.dataId",
+            (tractId, patchIndex[0], patchIndex[1], self.getDataIdKey(coaddId), minPatchFraction))
+        return [(_dataIdFromKey(dataIdKey), patchFraction, exposureFraction)
+            for dataIdKey, patchFraction, exposureFraction in cursor]
+
+    def getExposurePatches(self, dataId):
+        """Return the patches that a calexp overlaps
+
+        @param[in] dataId: data ID of calexp
+        @return a list of (tract ID, patch index (x, y), patch fraction, exposure fraction),
+            ordered by tract ID and patch index; empty if the calexp is not in the index
+        """
+        cursor = self._conn.execute("SELECT tract, patchX, patchY, patchFraction, exposureFraction " \
+            "FROM overlap JOIN calexp ON overlap.calexpId = calexp.id " \
+            "WHERE calexp.dataId = ? ORDER BY tract, patchX, patchY",
+            (self.getDataIdKey(dataId),))
+        return [(tractId, (patchX, patchY), patchFraction, exposureFraction)
+            for tractId, patchX, patchY, patchFraction, exposureFraction in cursor]
+
+
+def _dataIdFromKey(dataIdKey):
+    """Return a data ID from the string stored in the index, with unicode strings converted to str
+    """
+    def fromJson(value):
+        if isinstance(value, unicode):
+            return str(value)
+        return value
+    return dict((str(key), fromJson(value)) for key, value in json.loads(dataIdKey).iteritems())
+
+def getCoaddId(dataId):
+    """Return the coadd ID of a coadd data ID: the items other than tract and patch, as a dict
+    """
+    return dict((key, value) for key, value in dataId.iteritems() if key not in ("tract", "patch"))
+
+def computePatchOverlaps(skyMap, coordList):
+    """Compute the overlap of a calexp with the outer bboxes of sky map patches
+
+    Overlaps are computed on the pixel grid of each tract, treating the calexp as the polygon
+    formed by its corners. The patches found by the sky map and their neighbors are checked,
+    because the sky map finds patches by their inner bboxes.
+
+    @param[in] skyMap: sky map
+    @param[in] coordList: coordinates of the corners of the calexp, in order around its edge
+    @return a list of (tract ID, patch index (x, y), patch fraction, exposure fraction) for each patch
+        with nonzero overlap, where patch fraction is the fraction of the area of the patch's outer bbox
+        covered by the calexp and exposure fraction is the fraction of the calexp that lands in that bbox
+    """
+    overlapList = []
+    for tractInfo, patchInfoList in skyMap.findTractPatchList(coordList):
+        tractWcs = tractInfo.getWcs()
+        polygon = []
+        for coord in coordList:
+            pixPos = tractWcs.skyToPixel(coord)
+            polygon.append((pixPos.getX(), pixPos.getY()))
+        exposureArea = polygonArea(polygon)
+        if exposureArea <= 0:
+            continue
+
+        numPatches = tractInfo.getNumPatches()
+        patchIndexSet = set()
+        for patchInfo in patchInfoList:
+            xInd, yInd = patchInfo.getIndex()
+            for yNbr in range(max(0, yInd - 1), min(numPatches[1], yInd + 2)):
+                for xNbr in range(max(0, xInd - 1), min(numPatches[0], xInd + 2)):
+                    patchIndexSet.add((xNbr, yNbr))
+
+        for patchIndex in sorted(patchIndexSet):
+            patchBox = afwGeom.Box2D(tractInfo.getPatchInfo(patchIndex).getOuterBBox())
+            overlapArea = polygonBoxOverlapArea(polygon,
+                (patchBox.getMinX(), patchBox.getMinY(), patchBox.getMaxX(), patchBox.getMaxY()))
+            if overlapArea <= 0:
+                continue
+            overlapList.append((tractInfo.getId(), patchIndex, overlapArea / patchBox.getArea(),
+                overlapArea / exposureArea))
+    return overlapList
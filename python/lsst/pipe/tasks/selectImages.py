@@ -20,13 +20,52 @@
 # the GNU General Public License along with this program.  If not,
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
+import math
+
+import numpy
+
 import lsst.pex.config as pexConfig
+import lsst.afw.geom as afwGeom
 import lsst.pipe.base as pipeBase
+from .exposureInfoTable import ExposureInfoTable
+from .overlap import sphericalPolygonOverlapArea
 
 __all__ = ["BaseSelectImagesTask", "BaseExposureInfo", "BadSelectImagesTask"]
 
-class SelectImagesConfig(pexConfig.Config):
-    """Config for BaseSelectImagesTask
+class BaseSelectImagesConfig(pexConfig.Config):
+    """Config for BaseSelectImagesTask that does not depend on how images are found
+    """
+    maxExposures = pexConfig.Field(
+        doc = "maximum exposures to select; intended for debugging; ignored if None",
+        dtype = int,
+        optional = True,
+    )
+    doExactOverlap = pexConfig.Field(
+        doc = "In runDataRef and runTractDataRef, reject exposures whose footprint (the spherical polygon " \
+            "of their corners) overlaps the region of interest by no more than minOverlapArea? " \
+            "The region of interest must be convex, e.g. the corners of a patch.",
+        dtype = bool,
+        default = False,
+    )
+    minOverlapArea = pexConfig.Field(
+        doc = "Minimum area of overlap between an exposure and the region of interest (arcsec^2); " \
+            "ignored unless doExactOverlap is True",
+        dtype = float,
+        default = 0.0,
+        check = lambda x: x >= 0,
+    )
+    maxExposuresPerPatch = pexConfig.Field(
+        doc = "In runDataRef and runTractDataRef, keep at most this many exposures per region of interest " \
+            "(e.g. per patch): those with the largest expectedWeight field, which the task must provide; " \
+            "exposures with unknown expected weight are kept last. Ignored if None",
+        dtype = int,
+        optional = True,
+        check = lambda x: x is None or x > 0,
+    )
+
+
+class SelectImagesConfig(BaseSelectImagesConfig):
+    """Config for BaseSelectImagesTask subclasses that query a database server
     """
     host = pexConfig.Field(
         doc = "Database server host name",
@@ -40,11 +79,6 @@ class SelectImagesConfig(pexConfig.Config):
         doc = "Name of database",
         dtype = str,
     )
-    maxExposures = pexConfig.Field(
-        doc = "maximum exposures to select; intended for debugging; ignored if None",
-        dtype = int,
-        optional = True,
-    )
 
 
 class BaseExposureInfo(object):
@@ -56,7 +90,9 @@ class BaseExposureInfo(object):
         The object has the following fields:
         - dataId: data ID of exposure (a dict)
         - coordList: a list of corner coordinates of the exposure (list of afwCoord.IcrsCoord)
-        plus any others items that are desired
+        plus any others items that are desired, such as:
+        - expectedWeight: expected weight of the exposure in a coadd (None if unknown);
+            required if config.maxExposuresPerPatch is set
         
         Subclasses must provide __init__ (which calls this one) and override getColumnNames.
         """
@@ -91,8 +127,9 @@ class BaseSelectImagesTask(pipeBase.Task):
         subclasses may add additional keyword arguments, as required
         
         @return a pipeBase Struct containing:
-        - exposureInfoList: a list of exposure information objects (subclasses of BaseExposureInfo),
-            which have at least the following fields:
+        - exposureInfoList: an ExposureInfoTable (preferred for large selections) or a list of
+            exposure information objects (subclasses of BaseExposureInfo); either way,
+            iterating over it gives objects that have at least the following fields:
             - dataId: data ID dictionary
             - coordList: coordinates of the corner of the exposure (list of afwCoord.IcrsCoord)
         """
@@ -112,11 +149,20 @@ class BaseSelectImagesTask(pipeBase.Task):
         @param[in] coordList: list of coordinates defining region of interest; if None, search the whole sky
         @param[in] makeDataRefList: if True, return dataRefList
         @return a pipeBase Struct containing:
-        - exposureInfoList: a list of ccdInfo objects
+        - exposureInfoList: a list of ccdInfo objects or an ExposureInfoTable, as returned by run
         - dataRefList: a list of data references (None if makeDataRefList False)
+
+        If config.doExactOverlap is True then exposures that do not overlap the region by more than
+        config.minOverlapArea are rejected, and then if config.maxExposuresPerPatch is set
+        only that many exposures with the largest expected weight are kept,
+        before any data references are made.
         """
         runArgDict = self._runArgDictFromDataId(dataRef.dataId)
         exposureInfoList = self.run(coordList, **runArgDict).exposureInfoList
+        if self.config.doExactOverlap and coordList is not None:
+            exposureInfoList = self.selectOverlapping(exposureInfoList, coordList)
+        if self.config.maxExposuresPerPatch is not None:
+            exposureInfoList = self.selectHighestWeight(exposureInfoList)
 
         if makeDataRefList:        
             butler = dataRef.butlerSubset.butler
@@ -132,6 +178,304 @@ class BaseSelectImagesTask(pipeBase.Task):
             exposureInfoList = exposureInfoList,
         )
 
+    def runTractDataRef(self, dataRef, tractInfo, patchIndexList=None, makeDataRefList=True):
+        """Select images for many patches of one tract with a single call to run
+
+        The region searched is the union of the outer bboxes of the patches. Each selected exposure
+        is then assigned to every patch whose outer bbox overlaps the bounding box of the exposure's
+        corners on the tract pixel grid and, if config.doExactOverlap is True, whose outer bbox
+        overlaps the exposure's footprint on the sky by more than config.minOverlapArea.
+        If config.maxExposuresPerPatch is set then only that many exposures with the largest
+        expected weight are kept for each patch. This replaces one runDataRef call per patch.
+
+        @param[in] dataRef: data reference; must contain any extra keys needed by the subclass
+            (e.g. a data reference for any one of the patches)
+        @param[in] tractInfo: tract information (lsst.skymap TractInfo)
+        @param[in] patchIndexList: list of patch indices (x, y); if None then all patches of the tract
+        @param[in] makeDataRefList: if True, return patchDataRefListDict
+        @return a pipeBase Struct containing:
+        - exposureInfoList: a list of ccdInfo objects or an ExposureInfoTable for all the patches,
+            as returned by run
+        - patchExposureInfoListDict: a dict of patch index (x, y): list of ccdInfo objects
+            for exposures that overlap the patch; every patch in patchIndexList has an entry
+        - patchDataRefListDict: a dict of patch index (x, y): list of data references
+            (None if makeDataRefList False); an exposure that overlaps several patches
+            has the same data reference in each list
+        """
+        tractWcs = tractInfo.getWcs()
+        if patchIndexList is None:
+            numPatches = tractInfo.getNumPatches()
+            patchIndexList = [(x, y) for y in range(numPatches[1]) for x in range(numPatches[0])]
+        patchBoxDict = dict()
+        patchRaDecListDict = dict() # patch index: list of (RA, Dec) of outer bbox corners
+        regionBox = afwGeom.Box2D()
+        for patchIndex in patchIndexList:
+            patchIndex = tuple(patchIndex)
+            patchBox = afwGeom.Box2D(tractInfo.getPatchInfo(patchIndex).getOuterBBox())
+            patchBoxDict[patchIndex] = patchBox
+            patchRaDecListDict[patchIndex] = _getRaDecList(
+                [tractWcs.pixelToSky(pos) for pos in patchBox.getCorners()])
+            regionBox.include(patchBox)
+        coordList = [tractWcs.pixelToSky(pos) for pos in regionBox.getCorners()]
+
+        runArgDict = self._runArgDictFromDataId(dataRef.dataId)
+        exposureInfoList = self.run(coordList, **runArgDict).exposureInfoList
+        # rows of an ExposureInfoTable are made on demand, so make them once
+        exposureInfoRowList = list(exposureInfoList)
+
+        # compute patchExpIndListDict: a dict of patch index: list of indices into exposureInfoRowList;
+        # find candidate patches from the patch grid, then check their outer bboxes
+        tractMin = afwGeom.Box2D(tractInfo.getBBox()).getMin()
+        innerDim = tractInfo.getPatchInnerDimensions()
+        border = tractInfo.getPatchBorder()
+        patchExpIndListDict = dict((patchIndex, []) for patchIndex in patchBoxDict)
+        for expInd, exposureInfo in enumerate(exposureInfoRowList):
+            expBox = afwGeom.Box2D()
+            for coord in exposureInfo.coordList:
+                expBox.include(tractWcs.skyToPixel(coord))
+            indRangeList = []
+            for i, (minPos, maxPos) in enumerate(((expBox.getMinX(), expBox.getMaxX()),
+                (expBox.getMinY(), expBox.getMaxY()))):
+                indRangeList.append(range(
+                    int(math.floor((minPos - tractMin[i] - border) / innerDim[i])),
+                    int(math.floor((maxPos - tractMin[i] + border) / innerDim[i])) + 1,
+                ))
+            for yInd in indRangeList[1]:
+                for xInd in indRangeList[0]:
+                    patchBox = patchBoxDict.get((xInd, yInd))
+                    if patchBox is not None and patchBox.overlaps(expBox):
+                        patchExpIndListDict[(xInd, yInd)].append(expInd)
+
+        if self.config.doExactOverlap:
+            # compute the corners of the exposures (and, for a table, their edge normals) once,
+            # then test each patch against its candidate exposures only
+            overlapTable = _makeOverlapTable(exposureInfoList)
+            if overlapTable is None:
+                overlapTable = exposureInfoList
+            for patchIndex, expIndList in patchExpIndListDict.items():
+                patchExpIndListDict[patchIndex] = self._getOverlapIndices(overlapTable,
+                    patchRaDecListDict[patchIndex], expIndList)
+
+        if self.config.maxExposuresPerPatch is not None:
+            weightArr = _getExpectedWeightArray(exposureInfoList)
+            for patchIndex, expIndList in patchExpIndListDict.items():
+                patchExpIndListDict[patchIndex] = self._getHighestWeightIndices(weightArr, expIndList)
+
+        patchExposureInfoListDict = dict(
+            (patchIndex, [exposureInfoRowList[expInd] for expInd in expIndList])
+            for patchIndex, expIndList in patchExpIndListDict.iteritems())
+
+        if makeDataRefList:
+            butler = dataRef.butlerSubset.butler
+            dataRefDict = dict() # index into exposureInfoRowList: data reference
+            patchDataRefListDict = dict()
+            for patchIndex, expIndList in patchExpIndListDict.iteritems():
+                for expInd in expIndList:
+                    if expInd not in dataRefDict:
+                        dataRefDict[expInd] = butler.dataRef(
+                            datasetType = "calexp",
+                            dataId = exposureInfoRowList[expInd].dataId,
+                        )
+                patchDataRefListDict[patchIndex] = [dataRefDict[expInd] for expInd in expIndList]
+        else:
+            patchDataRefListDict = None
+
+        return pipeBase.Struct(
+            exposureInfoList = exposureInfoList,
+            patchExposureInfoListDict = patchExposureInfoListDict,
+            patchDataRefListDict = patchDataRefListDict,
+        )
+
+    def selectIndexed(self, dataRef, tractInfo, patchCandidateListDict):
+        """Apply the cuts of this task to exposures found in a patch overlap index
+
+        The patch overlap index (see lsst.pipe.tasks.patchOverlapIndex) replaces the overlap tests
+        of runTractDataRef, but not the cuts made by run (e.g. quality cuts and config.maxExposures):
+        run is called once for the union of the outer bboxes of the patches, and candidates it
+        does not return are rejected. Then if config.doExactOverlap is True, candidates that overlap
+        a patch by no more than config.minOverlapArea are rejected, and if config.maxExposuresPerPatch
+        is set only that many exposures with the largest expected weight are kept for each patch.
+
+        @param[in] dataRef: data reference; must contain any extra keys needed by the subclass
+        @param[in] tractInfo: tract information (lsst.skymap TractInfo)
+        @param[in] patchCandidateListDict: a dict of patch index (x, y): list of (data ID, patch fraction)
+            for the exposures that overlap the patch according to the index, where patch fraction
+            is the fraction of the area of the outer bbox of the patch covered by the exposure
+        @return a dict of patch index (x, y): list of data IDs of the selected exposures,
+            in the order of patchCandidateListDict
+        """
+        exposureInfoDict = self._runIndexed(dataRef, tractInfo, patchCandidateListDict.keys())
+        pixelArea = tractInfo.getWcs().pixelScale().asArcseconds()**2
+        patchDataIdListDict = dict()
+        for patchIndex, candidateList in patchCandidateListDict.iteritems():
+            patchIndex = tuple(patchIndex)
+            if self.config.doExactOverlap:
+                patchArea = afwGeom.Box2D(tractInfo.getPatchInfo(patchIndex).getOuterBBox()).getArea() \
+                    * pixelArea
+                candidateList = [(dataId, patchFraction) for dataId, patchFraction in candidateList
+                    if patchFraction * patchArea > self.config.minOverlapArea]
+            dataIdList = [dataId for dataId, patchFraction in candidateList]
+            if exposureInfoDict is not None:
+                dataIdList = [dataId for dataId in dataIdList if _getDataIdKey(dataId) in exposureInfoDict]
+            if self.config.maxExposuresPerPatch is not None:
+                if exposureInfoDict is None:
+                    raise RuntimeError("Exposures have no expectedWeight field; " \
+                        "cannot apply maxExposuresPerPatch")
+                weightArr = _getExpectedWeightArray(
+                    [exposureInfoDict[_getDataIdKey(dataId)] for dataId in dataIdList])
+                dataIdList = [dataIdList[ind] for ind in
+                    self._getHighestWeightIndices(weightArr, range(len(dataIdList)))]
+            patchDataIdListDict[patchIndex] = dataIdList
+        return patchDataIdListDict
+
+    def _runIndexed(self, dataRef, tractInfo, patchIndexList):
+        """Call run for the union of the outer bboxes of some patches, for selectIndexed
+
+        @param[in] dataRef: data reference; must contain any extra keys needed by the subclass
+        @param[in] tractInfo: tract information (lsst.skymap TractInfo)
+        @param[in] patchIndexList: list of patch indices (x, y)
+        @return a dict of data ID key (see _getDataIdKey): exposure information, for the exposures
+            returned by run; None if this task makes no cuts of its own
+        """
+        tractWcs = tractInfo.getWcs()
+        regionBox = afwGeom.Box2D()
+        for patchIndex in patchIndexList:
+            regionBox.include(afwGeom.Box2D(tractInfo.getPatchInfo(tuple(patchIndex)).getOuterBBox()))
+        if regionBox.isEmpty():
+            return dict()
+        coordList = [tractWcs.pixelToSky(pos) for pos in regionBox.getCorners()]
+        runArgDict = self._runArgDictFromDataId(dataRef.dataId)
+        exposureInfoList = self.run(coordList, **runArgDict).exposureInfoList
+        return dict((_getDataIdKey(exposureInfo.dataId), exposureInfo) for exposureInfo in exposureInfoList)
+
+    def selectOverlapping(self, exposureInfoList, coordList):
+        """Return the exposures whose footprint overlaps a region by more than config.minOverlapArea
+
+        Footprints and the region are treated as spherical polygons with great-circle edges.
+
+        @param[in] exposureInfoList: list of ccdInfo objects or an ExposureInfoTable
+        @param[in] coordList: coordinates of the corners of a convex region of interest
+        @return the ccdInfo objects that overlap the region, in the original order,
+            as the same type as exposureInfoList
+        """
+        expIndList = self._getOverlapIndices(exposureInfoList, _getRaDecList(coordList))
+        numRejected = len(exposureInfoList) - len(expIndList)
+        if numRejected > 0:
+            self.log.info("Rejected %d of %d exposures that overlap the region by <= %s arcsec^2" % \
+                (numRejected, len(exposureInfoList), self.config.minOverlapArea))
+        if isinstance(exposureInfoList, ExposureInfoTable):
+            return exposureInfoList[numpy.array(expIndList, dtype=int)]
+        return [exposureInfoList[expInd] for expInd in expIndList]
+
+    def selectHighestWeight(self, exposureInfoList):
+        """Return the config.maxExposuresPerPatch exposures with the largest expected weight
+
+        @param[in] exposureInfoList: list of ccdInfo objects or an ExposureInfoTable;
+            each exposure must have an expectedWeight field
+        @return the selected ccdInfo objects, in the original order, as the same type as exposureInfoList
+        """
+        expIndList = self._getHighestWeightIndices(_getExpectedWeightArray(exposureInfoList),
+            range(len(exposureInfoList)))
+        if isinstance(exposureInfoList, ExposureInfoTable):
+            return exposureInfoList[numpy.array(expIndList, dtype=int)]
+        return [exposureInfoList[expInd] for expInd in expIndList]
+
+    def _getHighestWeightIndices(self, weightArr, expIndList):
+        """Return the indices of the config.maxExposuresPerPatch exposures with the largest expected weight
+
+        Exposures with unknown (NaN) expected weight are kept last; ties keep the original order.
+
+        @param[in] weightArr: expected weight of each exposure, as returned by _getExpectedWeightArray
+        @param[in] expIndList: indices of the exposures to choose from, in increasing order
+        @return a list of indices, in increasing order
+        """
+        maxExposures = self.config.maxExposuresPerPatch
+        if maxExposures is None or len(expIndList) <= maxExposures:
+            return list(expIndList)
+        weights = weightArr[numpy.array(expIndList, dtype=int)]
+        sortKey = numpy.where(numpy.isnan(weights), numpy.inf, -weights)
+        keepIndArr = numpy.argsort(sortKey, kind="mergesort")[0:maxExposures]
+        self.log.info("Kept %d of %d exposures with the largest expected weight" % \
+            (maxExposures, len(expIndList)))
+        return sorted(expIndList[ind] for ind in keepIndArr)
+
+    def _getOverlapIndices(self, exposureInfoList, regionRaDecList, expIndList=None):
+        """Return the indices of the exposures that overlap a region by more than config.minOverlapArea
+
+        The overlap is first tested for all exposures at once (see ExposureInfoTable.getOverlapMask),
+        and the area of overlap is only computed for exposures that overlap (and only if
+        config.minOverlapArea > 0). A list of ccdInfo objects is tested this way if every exposure
+        has four corners; otherwise the area of overlap is computed for every exposure.
+
+        @param[in] exposureInfoList: list of ccdInfo objects or an ExposureInfoTable
+        @param[in] regionRaDecList: corners of a convex region of interest, as (RA, Dec) pairs (deg)
+        @param[in] expIndList: indices of the exposures to test, in increasing order; if None then all
+        @return a list of indices into exposureInfoList, in increasing order
+        """
+        if expIndList is None:
+            expIndList = range(len(exposureInfoList))
+        overlapTable = _makeOverlapTable(exposureInfoList)
+        if overlapTable is not None:
+            expIndArr = numpy.array(expIndList, dtype=int)
+            expIndList = [int(expInd) for expInd in
+                expIndArr[overlapTable.getOverlapMask(regionRaDecList, expIndArr)]]
+            if self.config.minOverlapArea <= 0:
+                return expIndList
+            getRaDecList = lambda expInd: zip(overlapTable.ra[expInd], overlapTable.dec[expInd])
+        else:
+            getRaDecList = lambda expInd: _getRaDecList(exposureInfoList[expInd].coordList)
+        minOverlapArea = self.config.minOverlapArea
+        return [expInd for expInd in expIndList
+            if sphericalPolygonOverlapArea(getRaDecList(expInd), regionRaDecList) > minOverlapArea]
+
+def _getRaDecList(coordList):
+    """Return a list of ICRS (RA, Dec) (deg) for a list of afwCoord.Coord
+    """
+    raDecList = []
+    for coord in coordList:
+        icrsCoord = coord.toIcrs()
+        raDecList.append((icrsCoord.getRa().asDegrees(), icrsCoord.getDec().asDegrees()))
+    return raDecList
+
+def _makeOverlapTable(exposureInfoList):
+    """Return an ExposureInfoTable of exposures, for testing their overlap with a region all at once
+
+    @param[in] exposureInfoList: list of ccdInfo objects or an ExposureInfoTable
+    @return exposureInfoList if it is an ExposureInfoTable, else a new ExposureInfoTable with only
+        the corners of the exposures, or None if some exposure does not have four corners
+    """
+    if isinstance(exposureInfoList, ExposureInfoTable):
+        return exposureInfoList
+    raDecListList = [_getRaDecList(ccdInfo.coordList) for ccdInfo in exposureInfoList]
+    if not all(len(raDecList) == 4 for raDecList in raDecListList):
+        return None
+    return ExposureInfoTable(dict(),
+        ra = [[ra for ra, dec in raDecList] for raDecList in raDecListList],
+        dec = [[dec for ra, dec in raDecList] for raDecList in raDecListList],
+    )
+
+def _getDataIdKey(dataId):
+    """Return a hashable key for a data ID
+    """
+    return tuple(sorted(dataId.iteritems()))
+
+def _getExpectedWeightArray(exposureInfoList):
+    """Return the expectedWeight field of each exposure as a float array, with NaN for unknown
+
+    @param[in] exposureInfoList: list of ccdInfo objects or an ExposureInfoTable
+    @throw RuntimeError if the exposures have no expectedWeight field
+    """
+    if isinstance(exposureInfoList, ExposureInfoTable):
+        if not exposureInfoList.hasColumn("expectedWeight"):
+            raise RuntimeError("Exposures have no expectedWeight field; cannot apply maxExposuresPerPatch")
+        return numpy.array(exposureInfoList.getColumn("expectedWeight"), dtype=float)
+    weightList = []
+    for ccdInfo in exposureInfoList:
+        if not hasattr(ccdInfo, "expectedWeight"):
+            raise RuntimeError("Exposures have no expectedWeight field; cannot apply maxExposuresPerPatch")
+        weightList.append(ccdInfo.expectedWeight if ccdInfo.expectedWeight is not None else numpy.nan)
+    return numpy.array(weightList, dtype=float)
+
 class BadSelectImagesTask(BaseSelectImagesTask):
     """Non-functional selection task intended as a placeholder subtask
     """
@@ -140,3 +484,8 @@ class BadSelectImagesTask(BaseSelectImagesTask):
 
     def _runArgDictFromDataId(self, dataId):        
         raise RuntimeError("No select task specified")
+
+    def _runIndexed(self, dataRef, tractInfo, patchIndexList):
+        """The placeholder makes no cuts of its own, so selectIndexed only applies the overlap cuts
+        """
+        return None
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""A process-wide cache of sky maps
+
+Reading a sky map unpickles the whole map, which is wasteful when one process handles many patches
+or exposures (each with a new task, made by the TaskRunner). getSkyMap keeps each sky map read,
+keyed by the path of its file (which identifies both the repository and the dataset type),
+and rereads it if the file's modification time or size has changed.
+"""
+import os
+
+from .lruCache import LruCache
+
+__all__ = ["getSkyMap", "clearSkyMapCache"]
+
+# maximum number of sky maps to cache; a process rarely uses more than one or two
+_MaxNumSkyMaps = 4
+
+# cache of path of sky map file: (file signature, sky map)
+_SkyMapCache = LruCache(maxSize=_MaxNumSkyMaps)
+
+def getSkyMap(dataRef, datasetType):
+    """Return a sky map, from the process-wide cache if it is there and its file is unchanged
+
+    The sky map may be shared with other callers, so it must not be modified.
+    If the path of the sky map cannot be determined the sky map is read and not cached.
+
+    @param[in] dataRef: data reference that can be used to get the sky map
+    @param[in] datasetType: dataset type of the sky map, e.g. "deepCoadd_skyMap";
+        datasetType + "_filename" should be supported by the butler
+    @return sky map
+    """
+    try:
+        path = os.path.realpath(dataRef.get(datasetType + "_filename")[0])
+        fileStat = os.stat(path)
+    except Exception:
+        return dataRef.get(datasetType, immediate=True)
+    signature = (fileStat.st_mtime, fileStat.st_size)
+
+    item = _SkyMapCache.get(path)
+    if item is not None and item[0] == signature:
+        return item[1]
+    skyMap = dataRef.get(datasetType, immediate=True)
+    _SkyMapCache.put(path, (signature, skyMap))
+    return skyMap
+
+def clearSkyMapCache():
+    """Remove all sky maps from the process-wide cache
+    """
+    _SkyMapCache.clear()
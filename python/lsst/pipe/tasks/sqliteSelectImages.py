@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Image selection using a local SQLite index of calexps
+
+The index is a single SQLite file holding, for each calexp, its data ID, filter, visit,
+PSF FWHM, photometric zero point (FLUXMAG0), sky level and the RA, Dec of its four corners,
+plus an R-tree of the RA, Dec bounding box of each calexp, so selecting the calexps that overlap
+a patch is a fast local query that needs no database server. Quality cuts are evaluated
+in the same query, so rejected calexps are never read. Make or update the index
+with bin/makeCalexpIndex.py.
+
+RA bounding boxes are stored with minRa in [0, 360) and maxRa >= minRa, so maxRa > 360
+for a calexp that straddles RA = 0; a calexp that contains a pole has RA range [0, 360].
+"""
+import json
+import math
+import sqlite3
+
+import lsst.pex.config as pexConfig
+import lsst.afw.coord as afwCoord
+import lsst.afw.geom as afwGeom
+import lsst.pipe.base as pipeBase
+from .exposureInfoTable import ExposureInfoTable
+from .selectImages import BaseSelectImagesConfig, BaseSelectImagesTask, BaseExposureInfo
+
+__all__ = ["CalexpIndex", "getRaDecBox", "SqliteExposureInfo", "computeExpectedWeight",
+    "makeSqliteExposureInfoTable", "SqliteSelectImagesTask"]
+
+class CalexpIndex(object):
+    """A SQLite index of calexps, with an R-tree of their RA, Dec bounding boxes
+    """
+    _SchemaVersion = 2
+
+    def __init__(self, path, create=False):
+        """Open an index
+
+        @param[in] path: path of SQLite file
+        @param[in] create: create the index if it does not exist, or upgrade it if it has an older schema?
+            If False and the index does not exist or has an older schema then RuntimeError is raised
+        """
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0:
+            if not create:
+                self._conn.close()
+                raise RuntimeError("%s is not a calexp index" % (path,))
+            self._createTables()
+        elif version == 1 and create:
+            self._upgradeTables()
+        elif version != self._SchemaVersion:
+            self._conn.close()
+            raise RuntimeError("%s has schema version %s; this code requires %s" % \
+                (path, version, self._SchemaVersion))
+
+    def _createTables(self):
+        self._conn.executescript("""
+            CREATE TABLE calexp (
+                id INTEGER PRIMARY KEY,
+                dataId TEXT UNIQUE NOT NULL,
+                filter TEXT,
+                visit INTEGER,
+                fwhm REAL,
+                ra1 REAL, dec1 REAL, ra2 REAL, dec2 REAL, ra3 REAL, dec3 REAL, ra4 REAL, dec4 REAL,
+                fluxMag0 REAL,
+                skyLevel REAL
+            );
+            CREATE INDEX calexp_filter ON calexp (filter);
+            CREATE VIRTUAL TABLE calexp_rtree USING rtree (id, minRa, maxRa, minDec, maxDec);
+            PRAGMA user_version = %d;
+        """ % (self._SchemaVersion,))
+        self._conn.commit()
+
+    def _upgradeTables(self):
+        """Upgrade an index from schema version 1, which lacks fluxMag0 and skyLevel
+
+        Existing calexps get NULL for the new columns; update them with makeCalexpIndex.py doUpdate=True
+        """
+        self._conn.executescript("""
+            ALTER TABLE calexp ADD COLUMN fluxMag0 REAL;
+            ALTER TABLE calexp ADD COLUMN skyLevel REAL;
+            PRAGMA user_version = %d;
+        """ % (self._SchemaVersion,))
+        self._conn.commit()
+
+    def close(self):
+        """Commit changes and close the index
+        """
+        self._conn.commit()
+        self._conn.close()
+
+    def commit(self):
+        """Commit changes
+        """
+        self._conn.commit()
+
+    @staticmethod
+    def getDataIdKey(dataId):
+        """Return the string stored in the dataId column for a data ID
+        """
+        return json.dumps(dataId, sort_keys=True)
+
+    def hasExposure(self, dataId):
+        """Return True if the calexp with the given data ID is in the index
+        """
+        cursor = self._conn.execute("SELECT COUNT(*) FROM calexp WHERE dataId = ?",
+            (self.getDataIdKey(dataId),))
+        return cursor.fetchone()[0] > 0
+
+    def addExposure(self, dataId, filterName, visit, fwhm, coordList, fluxMag0=None, skyLevel=None):
+        """Add a calexp to the index, replacing any existing entry for the same data ID
+
+        @param[in] dataId: data ID of calexp (a dict)
+        @param[in] filterName: name of filter
+        @param[in] visit: visit ID (an int), or None if unknown
+        @param[in] fwhm: FWHM of PSF (arcsec), or None if unknown
+        @param[in] coordList: ICRS coordinates of the four corners of the calexp, in order around its edge
+            (a list of afwCoord.IcrsCoord)
+        @param[in] fluxMag0: flux of a zero-magnitude object (counts), or None if unknown
+        @param[in] skyLevel: mean sky level (counts/pixel), or None if unknown
+        """
+        if len(coordList) != 4:
+            raise RuntimeError("coordList has %d coordinates; must have 4" % (len(coordList),))
+        raDecList = [(coord.getRa().asDegrees(), coord.getDec().asDegrees()) for coord in coordList]
+        dataIdKey = self.getDataIdKey(dataId)
+        cursor = self._conn.execute("SELECT id FROM calexp WHERE dataId = ?", (dataIdKey,))
+        row = cursor.fetchone()
+        if row is not None:
+            self._conn.execute("DELETE FROM calexp WHERE id = ?", (row[0],))
+            self._conn.execute("DELETE FROM calexp_rtree WHERE id = ?", (row[0],))
+        values = [dataIdKey, filterName, visit, fwhm, fluxMag0, skyLevel]
+        for ra, dec in raDecList:
+            values += [ra, dec]
+        # name the columns, because an upgraded index has fluxMag0 and skyLevel in a different position
+        cursor = self._conn.execute("INSERT INTO calexp (dataId, filter, visit, fwhm, fluxMag0, skyLevel, " \
+            "ra1, dec1, ra2, dec2, ra3, dec3, ra4, dec4) VALUES (?%s)" % (", ?" * (len(values) - 1),), values)
+        self._conn.execute("INSERT INTO calexp_rtree VALUES (?, ?, ?, ?, ?)",
+            [cursor.lastrowid] + list(getRaDecBox(raDecList)))
+
+    def query(self, columnNames, coordList=None, filterName=None, padding=0.0,
+        minFwhm=None, maxFwhm=None, minFluxMag0=None, maxSkyLevel=None):
+        """Return rows for calexps whose bounding box overlaps a region and that pass quality cuts,
+        ordered by id
+
+        A calexp whose value is unknown (NULL) for a quantity that is cut on is rejected.
+
+        @param[in] columnNames: names of columns to return, as a comma-separated string
+        @param[in] coordList: coordinates of the corners of the region (a list of afwCoord.Coord),
+            or None to select the whole sky
+        @param[in] filterName: filter name, or None for all filters
+        @param[in] padding: padding of the region (deg)
+        @param[in] minFwhm: minimum FWHM of PSF (arcsec), or None for no limit
+        @param[in] maxFwhm: maximum FWHM of PSF (arcsec), or None for no limit
+        @param[in] minFluxMag0: minimum flux of a zero-magnitude object (counts), or None for no limit
+        @param[in] maxSkyLevel: maximum sky level (counts/pixel), or None for no limit
+        @return a list of rows, each a tuple of values in the order of columnNames
+        """
+        whereList = []
+        values = []
+        if coordList is not None:
+            raDecList = [(coord.toIcrs().getRa().asDegrees(), coord.toIcrs().getDec().asDegrees())
+                for coord in coordList]
+            minRa, maxRa, minDec, maxDec = getRaDecBox(raDecList, padding=padding)
+            # compare to the calexp boxes with the region shifted by -360, 0 and 360 degrees in RA
+            subqueryList = []
+            for raShift in (-360.0, 0.0, 360.0):
+                subqueryList.append("SELECT id FROM calexp_rtree " \
+                    "WHERE minRa <= ? AND maxRa >= ? AND minDec <= ? AND maxDec >= ?")
+                values += [maxRa + raShift, minRa + raShift, maxDec, minDec]
+            whereList.append("id IN (%s)" % (" UNION ".join(subqueryList),))
+        if filterName is not None:
+            whereList.append("filter = ?")
+            values.append(filterName)
+        for columnName, op, limit in (("fwhm", ">=", minFwhm), ("fwhm", "<=", maxFwhm),
+            ("fluxMag0", ">=", minFluxMag0), ("skyLevel", "<=", maxSkyLevel)):
+            if limit is not None:
+                whereList.append("%s %s ?" % (columnName, op))
+                values.append(limit)
+        sql = "SELECT %s FROM calexp" % (columnNames,)
+        if whereList:
+            sql += " WHERE " + " AND ".join(whereList)
+        sql += " ORDER BY id"
+        return self._conn.execute(sql, values).fetchall()
+
+
+def getRaDecBox(raDecList, padding=0.0):
+    """Compute the RA, Dec bounding box of a polygon on the sky
+
+    @param[in] raDecList: list of (RA, Dec) of the vertices of the polygon, in order (deg)
+    @param[in] padding: amount by which to grow the box (deg); RA is grown by padding / cos(Dec)
+    @return (minRa, maxRa, minDec, maxDec) (deg), where minRa is in [0, 360) and maxRa >= minRa
+        (maxRa > 360 if the box straddles RA = 0); if the polygon contains a pole then
+        the RA range is [0, 360] and the Dec range extends to that pole
+    """
+    # unwrap RA along the polygon; if the RA winds through 360 degrees then the polygon contains a pole
+    raList = [raDecList[0][0]]
+    winding = 0.0
+    for (ra0, dec0), (ra1, dec1) in zip(raDecList, raDecList[1:] + raDecList[:1]):
+        delta = (ra1 - ra0 + 180.0) % 360.0 - 180.0
+        winding += delta
+        raList.append(raList[-1] + delta)
+    raList = raList[:-1]
+    decList = [dec for ra, dec in raDecList]
+    minDec = max(-90.0, min(decList) - padding)
+    maxDec = min(90.0, max(decList) + padding)
+    if abs(winding) > 180.0:
+        if sum(decList) > 0:
+            return (0.0, 360.0, minDec, 90.0)
+        return (0.0, 360.0, -90.0, maxDec)
+
+    maxAbsDec = max(abs(minDec), abs(maxDec))
+    if maxAbsDec >= 90.0:
+        return (0.0, 360.0, minDec, maxDec)
+    raPadding = padding / math.cos(math.radians(maxAbsDec))
+    minRa = min(raList) - raPadding
+    maxRa = max(raList) + raPadding
+    if maxRa - minRa >= 360.0:
+        return (0.0, 360.0, minDec, maxDec)
+    raOffset = (minRa % 360.0) - minRa
+    return (minRa + raOffset, maxRa + raOffset, minDec, maxDec)
+
+
+class SqliteExposureInfo(BaseExposureInfo):
+    """Data about a calexp selected from a CalexpIndex
+    """
+    def __init__(self, result):
+        """Set exposure information based on a query result from CalexpIndex.query
+
+        @param[in] result: row of values for the columns returned by getColumnNames
+        """
+        BaseExposureInfo.__init__(self)
+        self.dataId = dict((str(key), _fromJson(value))
+            for key, value in json.loads(result[self._nextInd]).iteritems())
+        self.filterName = _fromJson(result[self._nextInd])
+        self.visit = result[self._nextInd]
+        self.fwhm = result[self._nextInd] # FWHM of PSF (arcsec), or None if unknown
+        self.fluxMag0 = result[self._nextInd] # flux of a zero-magnitude object (counts), or None if unknown
+        self.skyLevel = result[self._nextInd] # mean sky level (counts/pixel), or None if unknown
+        self.expectedWeight = computeExpectedWeight(self.fluxMag0, self.skyLevel)
+        self.coordList = []
+        for i in range(4):
+            ra = result[self._nextInd]
+            dec = result[self._nextInd]
+            self.coordList.append(
+                afwCoord.IcrsCoord(afwGeom.Angle(ra, afwGeom.degrees), afwGeom.Angle(dec, afwGeom.degrees)))
+
+    @staticmethod
+    def getColumnNames():
+        """Get database columns to retrieve, in a format useful to the database interface
+
+        @return database column names as string of comma-separated values
+        """
+        return "dataId, filter, visit, fwhm, fluxMag0, skyLevel, ra1, dec1, ra2, dec2, ra3, dec3, ra4, dec4"
+
+def computeExpectedWeight(fluxMag0, skyLevel):
+    """Compute the expected coadd weight of a calexp, or None if unknown
+
+    AssembleCoaddTask weights a coadd temp exposure by 1/(mean variance) after scaling it to
+    a common zero point; for sky-limited calexps from one camera that is proportional to fluxMag0^2/skyLevel.
+
+    @param[in] fluxMag0: flux of a zero-magnitude object (counts), or None if unknown
+    @param[in] skyLevel: mean sky level (counts/pixel), or None if unknown
+    """
+    if fluxMag0 is None or skyLevel is None or fluxMag0 <= 0 or skyLevel <= 0:
+        return None
+    return fluxMag0**2 / float(skyLevel)
+
+def makeSqliteExposureInfoTable(resultList):
+    """Make an ExposureInfoTable from query results from CalexpIndex.query
+
+    The table has the same fields as SqliteExposureInfo; fwhm, fluxMag0, skyLevel and expectedWeight
+    are NaN if unknown.
+
+    @throw RuntimeError if the data IDs do not all have the same keys
+
+    @param[in] resultList: list of rows of values for the columns returned by
+        SqliteExposureInfo.getColumnNames
+    """
+    dataIdList = [dict((str(key), _fromJson(value)) for key, value in json.loads(result[0]).iteritems())
+        for result in resultList]
+    dataIdKeyList = sorted(dataIdList[0].keys()) if dataIdList else []
+    for dataId in dataIdList:
+        if sorted(dataId.keys()) != dataIdKeyList:
+            raise RuntimeError("Data IDs have different keys: %s and %s; cannot make an ExposureInfoTable" % \
+                (dataIdKeyList, sorted(dataId.keys())))
+    dataIdColumnDict = dict((key, [dataId[key] for dataId in dataIdList]) for key in dataIdKeyList)
+    return ExposureInfoTable(
+        dataIdColumnDict,
+        ra = [result[6::2] for result in resultList],
+        dec = [result[7::2] for result in resultList],
+        filterName = [_fromJson(result[1]) for result in resultList],
+        visit = [result[2] for result in resultList],
+        fwhm = [_nanIfNone(result[3]) for result in resultList],
+        fluxMag0 = [_nanIfNone(result[4]) for result in resultList],
+        skyLevel = [_nanIfNone(result[5]) for result in resultList],
+        expectedWeight = [_nanIfNone(computeExpectedWeight(result[4], result[5])) for result in resultList],
+    )
+
+def _nanIfNone(value):
+    """Return value as a float, or NaN if None
+    """
+    if value is None:
+        return float("nan")
+    return float(value)
+
+def _fromJson(value):
+    """Convert unicode strings (as returned by json and sqlite3) to str
+    """
+    if isinstance(value, unicode):
+        return str(value)
+    return value
+
+
+class SqliteSelectImagesConfig(BaseSelectImagesConfig):
+    """Config for SqliteSelectImagesTask
+    """
+    indexPath = pexConfig.Field(
+        doc = "Path of the SQLite calexp index, as made by bin/makeCalexpIndex.py",
+        dtype = str,
+    )
+    filterKey = pexConfig.Field(
+        doc = "Name of the filter key in data IDs, e.g. \"filter\" or \"band\"",
+        dtype = str,
+        default = "filter",
+    )
+    padding = pexConfig.Field(
+        doc = "Padding of the search region (arcsec), to allow for the curvature of calexp " \
+            "and patch edges in RA, Dec",
+        dtype = float,
+        default = 10.0,
+        check = lambda x: x >= 0,
+    )
+    minFwhm = pexConfig.Field(
+        doc = "Minimum FWHM of PSF (arcsec); calexps with unknown FWHM are rejected; ignored if None",
+        dtype = float,
+        optional = True,
+    )
+    maxFwhm = pexConfig.Field(
+        doc = "Maximum FWHM of PSF (arcsec); calexps with unknown FWHM are rejected; ignored if None",
+        dtype = float,
+        optional = True,
+    )
+    minFluxMag0 = pexConfig.Field(
+        doc = "Minimum flux of a zero-magnitude object (counts), i.e. a floor on zero point " \
+            "and transparency; calexps with unknown FLUXMAG0 are rejected; ignored if None",
+        dtype = float,
+        optional = True,
+    )
+    maxSkyLevel = pexConfig.Field(
+        doc = "Maximum sky level (counts/pixel); calexps with unknown sky level are rejected; " \
+            "ignored if None",
+        dtype = float,
+        optional = True,
+    )
+
+
+class SqliteSelectImagesTask(BaseSelectImagesTask):
+    """Select calexps suitable for coaddition using a local SQLite calexp index
+    """
+    ConfigClass = SqliteSelectImagesConfig
+
+    @pipeBase.timeMethod
+    def run(self, coordList, filter=None):
+        """Select calexps whose bounding box overlaps a region and that pass the quality cuts in the config
+
+        @param[in] coordList: list of coordinates defining region of interest; if None then select all images
+        @param[in] filter: filter name, or None for all filters
+
+        @return a pipeBase Struct containing:
+        - exposureInfoList: an ExposureInfoTable with the fields of SqliteExposureInfo
+        """
+        index = CalexpIndex(self.config.indexPath)
+        try:
+            resultList = index.query(SqliteExposureInfo.getColumnNames(), coordList=coordList,
+                filterName=filter, padding=self.config.padding / 3600.0,
+                minFwhm=self.config.minFwhm, maxFwhm=self.config.maxFwhm,
+                minFluxMag0=self.config.minFluxMag0, maxSkyLevel=self.config.maxSkyLevel)
+        finally:
+            index.close()
+        exposureInfoList = makeSqliteExposureInfoTable(resultList)
+        if self.config.maxExposures is not None:
+            exposureInfoList = exposureInfoList[0:self.config.maxExposures]
+        self.log.info("Selected %d calexps" % (len(exposureInfoList),))
+        return pipeBase.Struct(
+            exposureInfoList = exposureInfoList,
+        )
+
+    def _runArgDictFromDataId(self, dataId):
+        """Extract keyword arguments for run (other than coordList) from a data ID
+
+        @return keyword arguments for run (other than coordList), as a dict
+        """
+        return dict(filter = dataId[self.config.filterKey])
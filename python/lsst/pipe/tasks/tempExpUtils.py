@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Utilities for persisting and reading coaddTempExp
+
+A coaddTempExp covers a whole patch, but pixels with no data are set to (NaN, EDGE, inf).
+To save space a coaddTempExp may be persisted cropped to the bbox of its pixels with data,
+in which case the patch bbox and the stored bbox are recorded in its metadata.
+readTempExp restores the missing pixels, so readers see a coaddTempExp covering the whole patch
+(or the requested region of it).
+
+A coaddTempExp may also have a memory-mappable copy (see mappedExposure), which readTempExp
+can read instead of the FITS file.
+"""
+import os
+
+import numpy
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+from .mappedExposure import MappedExposure, getMappedPath
+
+__all__ = ["cropTempExp", "expandTempExp", "getTempExpCropBBox", "readTempExp"]
+
+# metadata keys for the bbox of the patch and of the stored pixels of a cropped coaddTempExp
+_PatchBBoxKeys = ("PATCHX0", "PATCHY0", "PATCHW", "PATCHH")
+_CropBBoxKeys = ("CROPX0", "CROPY0", "CROPW", "CROPH")
+
+def _getBBox(metadata, keys):
+    """Return a bbox recorded in metadata, or None if not recorded
+    """
+    if not metadata.exists(keys[0]):
+        return None
+    x0, y0, width, height = [metadata.get(key) for key in keys]
+    return afwGeom.Box2I(afwGeom.Point2I(x0, y0), afwGeom.Extent2I(width, height))
+
+def _setBBox(metadata, keys, bbox):
+    """Record a bbox in metadata
+    """
+    for key, value in zip(keys, (bbox.getMinX(), bbox.getMinY(), bbox.getWidth(), bbox.getHeight())):
+        metadata.set(key, value)
+
+def _setNoData(maskedImage):
+    """Set all pixels of a MaskedImage to (NaN, EDGE, inf), the value of pixels with no data
+    """
+    maskedImage.set(numpy.nan, afwImage.MaskU.getPlaneBitMask("EDGE"), numpy.inf)
+
+def cropTempExp(exposure):
+    """Crop a coaddTempExp to the bbox of its pixels with data
+
+    Pixels with no data are those equal to (NaN, EDGE, inf) in the image, mask and variance planes.
+
+    @param[in] exposure: coaddTempExp covering a whole patch
+    @return cropped coaddTempExp, with the patch bbox and cropped bbox recorded in its metadata,
+        or exposure itself if no cropping is possible or it has no pixels with data
+    """
+    maskedImage = exposure.getMaskedImage()
+    noDataArr = numpy.isnan(maskedImage.getImage().getArray()) \
+        & (maskedImage.getMask().getArray() == afwImage.MaskU.getPlaneBitMask("EDGE")) \
+        & numpy.isinf(maskedImage.getVariance().getArray())
+    hasDataArr = numpy.logical_not(noDataArr)
+    rowIndArr = numpy.nonzero(hasDataArr.any(axis=1))[0]
+    colIndArr = numpy.nonzero(hasDataArr.any(axis=0))[0]
+    if len(rowIndArr) == 0:
+        return exposure
+
+    patchBBox = maskedImage.getBBox(afwImage.PARENT)
+    cropBBox = afwGeom.Box2I(
+        afwGeom.Point2I(patchBBox.getMinX() + int(colIndArr[0]), patchBBox.getMinY() + int(rowIndArr[0])),
+        afwGeom.Point2I(patchBBox.getMinX() + int(colIndArr[-1]), patchBBox.getMinY() + int(rowIndArr[-1])),
+    )
+    if cropBBox == patchBBox:
+        return exposure
+    croppedExposure = exposure.Factory(exposure, cropBBox, afwImage.PARENT, True)
+    metadata = croppedExposure.getMetadata()
+    _setBBox(metadata, _PatchBBoxKeys, patchBBox)
+    _setBBox(metadata, _CropBBoxKeys, cropBBox)
+    return croppedExposure
+
+def expandTempExp(exposure, bbox=None):
+    """Expand a cropped coaddTempExp to cover bbox, filling the missing pixels with (NaN, EDGE, inf)
+
+    @param[in] exposure: coaddTempExp, cropped or not
+    @param[in] bbox: parent bbox of the result; if None, the patch bbox recorded in the metadata
+    @return expanded coaddTempExp, or exposure itself if it already covers bbox
+        (or if bbox is None and exposure was not cropped)
+    """
+    if bbox is None:
+        bbox = _getBBox(exposure.getMetadata(), _PatchBBoxKeys)
+        if bbox is None:
+            return exposure
+    dataBBox = exposure.getMaskedImage().getBBox(afwImage.PARENT)
+    if dataBBox == bbox:
+        return exposure
+
+    expandedExposure = exposure.Factory(bbox, exposure.getWcs())
+    expandedMI = expandedExposure.getMaskedImage()
+    _setNoData(expandedMI)
+    dataBBox.clip(bbox)
+    if not dataBBox.isEmpty():
+        expandedView = expandedMI.Factory(expandedMI, dataBBox, afwImage.PARENT, False)
+        expandedView <<= exposure.getMaskedImage().Factory(exposure.getMaskedImage(), dataBBox,
+            afwImage.PARENT, False)
+        del expandedView
+    expandedExposure.setCalib(exposure.getCalib())
+    expandedExposure.setFilter(exposure.getFilter())
+    expandedExposure.setMetadata(exposure.getMetadata())
+    if exposure.hasPsf():
+        expandedExposure.setPsf(exposure.getPsf())
+    return expandedExposure
+
+def getTempExpCropBBox(dataRef, datasetType):
+    """Return the bbox of the stored pixels of a cropped coaddTempExp, or None if it is not cropped
+
+    This reads the metadata of the coaddTempExp; call it once per coaddTempExp and pass the result
+    to readTempExp when reading many regions of one coaddTempExp.
+
+    @param[in] dataRef: data reference for the coaddTempExp
+    @param[in] datasetType: dataset type of the coaddTempExp, e.g. "deepCoadd_tempExp";
+        datasetType + "_md" must also exist
+    """
+    return _getBBox(dataRef.get(datasetType + "_md", immediate=True), _CropBBoxKeys)
+
+def readTempExp(dataRef, datasetType, bbox=None, useMapped=False, cropBBox=None, checkCrop=True):
+    """Read a coaddTempExp, or a region of one, restoring pixels omitted by cropTempExp
+
+    @param[in] dataRef: data reference for the coaddTempExp
+    @param[in] datasetType: dataset type of the coaddTempExp, e.g. "deepCoadd_tempExp";
+        datasetType + "_md" and datasetType + "_sub" must also exist if bbox is not None
+    @param[in] bbox: parent bbox of the region to read; if None then read the whole patch
+    @param[in] useMapped: read the memory-mappable copy of the coaddTempExp, if there is one
+        that is at least as new as the FITS file? This avoids decoding FITS,
+        but the pixels are still copied (see MappedExposure.getExposure)
+    @param[in] cropBBox: bbox of the stored pixels of the coaddTempExp, as returned by
+        getTempExpCropBBox; only used if bbox is not None. If None and checkCrop is True
+        then it is read from the metadata of the coaddTempExp
+    @param[in] checkCrop: if cropBBox is None, read it from the metadata? If False then the
+        coaddTempExp must not be cropped; this saves reading its metadata
+    @return coaddTempExp
+    """
+    if useMapped:
+        mappedExposure = _openMappedTempExp(dataRef, datasetType)
+        if mappedExposure is not None:
+            if bbox is None:
+                return expandTempExp(mappedExposure.getExposure())
+            readBBox = _getReadBBox(bbox, mappedExposure.getBBox())
+            return expandTempExp(mappedExposure.getExposure(readBBox), bbox=bbox)
+
+    if bbox is None:
+        return expandTempExp(dataRef.get(datasetType, immediate=True))
+
+    subName = datasetType + "_sub"
+    if cropBBox is None and checkCrop:
+        cropBBox = getTempExpCropBBox(dataRef, datasetType)
+    if cropBBox is None:
+        return dataRef.get(subName, bbox=bbox, imageOrigin="PARENT", immediate=True)
+    readBBox = _getReadBBox(bbox, cropBBox)
+    exposure = dataRef.get(subName, bbox=readBBox, imageOrigin="PARENT", immediate=True)
+    return expandTempExp(exposure, bbox=bbox)
+
+def _getReadBBox(bbox, dataBBox):
+    """Return the part of bbox that lies within dataBBox, or if none, one pixel of dataBBox
+    (which is enough to obtain the WCS, calib, etc.)
+    """
+    readBBox = afwGeom.Box2I(bbox)
+    readBBox.clip(dataBBox)
+    if readBBox.isEmpty():
+        readBBox = afwGeom.Box2I(dataBBox.getMin(), afwGeom.Extent2I(1, 1))
+    return readBBox
+
+def _openMappedTempExp(dataRef, datasetType):
+    """Return the memory-mappable copy of a coaddTempExp as a MappedExposure,
+    or None if there is none or it is older than the FITS file
+    """
+    fitsPath = dataRef.get(datasetType + "_filename")[0]
+    mappedPath = getMappedPath(fitsPath)
+    try:
+        if os.path.getmtime(mappedPath) < os.path.getmtime(fitsPath):
+            return None
+        return MappedExposure(mappedPath)
+    except (OSError, IOError, RuntimeError):
+        return None
@@ -20,19 +20,52 @@
 # the GNU General Public License along with this program.  If not,
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
+import hashlib
 import math
+import os
+
+import numpy
 
 import lsst.pex.config as pexConfig
 import lsst.afw.detection as afwDetection
 import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
 import lsst.afw.math as afwMath
 import lsst.pipe.base as pipeBase
 from lsst.ip.diffim import ModelPsfMatchTask
+from .compactBackground import CompactBackground
+from .fftConvolve import ConvolveConfig, convolveMaskedImage
+from .exposureMetrics import ExposureMetrics, getMaskedImageNBytes
+from .coordMappingGrid import CoordMappingCache, CoordMappingGrid
+from .lruCache import LruCache
 
 __all__ = ["WarpAndPsfMatchTask"]
 
 FwhmPerSigma = 2 * math.sqrt(2 * math.log(2))
 
+# names of per-calexp metrics measured while making a warped exposure; see ExposureMetrics.
+# WarpAndPsfMatchTask measures all but CopyTime (time spent copying warped pixels into coaddTempExps),
+# which is measured by MakeCoaddTempExpTask
+WarpMetricNameList = ("ReadTime", "BgAddTime", "PsfMatchTime", "WarpTime", "CopyTime",
+    "NumPixWarped", "PixWarpedPerSec", "BytesRead")
+
+# caches shared by all WarpAndPsfMatchTasks in this process (the TaskRunner makes a new task
+# for each patch, so per-task caches would not be reused between patches); see _getSharedCache
+_SharedCacheDict = dict()
+
+def _getSharedCache(key, makeCache):
+    """Return the process-wide cache identified by key, making it with makeCache() if it does not exist
+
+    @param key: a hashable identifier of the cache, including everything that affects
+        its construction (e.g. its size limit)
+    @param makeCache: a function that takes no arguments and returns a new cache
+    """
+    cache = _SharedCacheDict.get(key)
+    if cache is None:
+        cache = makeCache()
+        _SharedCacheDict[key] = cache
+    return cache
+
 class WarpAndPsfMatchConfig(pexConfig.Config):
     """Config for WarpAndPsfMatchTask
     """
@@ -49,6 +82,59 @@ class WarpAndPsfMatchConfig(pexConfig.Config):
         dtype = afwMath.Warper.ConfigClass,
         doc = "warper configuration",
     )
+    convolve = pexConfig.ConfigField(
+        dtype = ConvolveConfig,
+        doc = "convolution by cached PSF-matching kernels (direct or FFT-based)",
+    )
+    kernelCacheSize = pexConfig.Field(
+        doc = "maximum number of fitted PSF-matching kernels to cache in memory, so that a calexp " \
+            "warped for several patches is PSF-matched using a single fit; a cached kernel is only used " \
+            "for the same calexp region with identical PSF models (including their spatial variation) " \
+            "and model PSF; 0 to disable",
+        dtype = int,
+        default = 0,
+    )
+    compactBackgroundBinSize = pexConfig.Field(
+        doc = "if > 0 then, when the calexp background is wanted, use a compact (binned) background model " \
+            "with bins of this size (pixels), which is added after warping, only to the warped pixels; " \
+            "if 0 then the full-resolution calexpBackground is added to the calexp before warping",
+        dtype = int,
+        default = 0,
+    )
+    doWriteCompactBackground = pexConfig.Field(
+        doc = "persist the compact background model as calexpBackgroundCompact, so later reads " \
+            "need not read the full-resolution calexpBackground? Requires a calexpBackgroundCompact " \
+            "(pickled) entry in the camera's mapper. Ignored if compactBackgroundBinSize = 0",
+        dtype = bool,
+        default = False,
+    )
+    readCacheSizeMB = pexConfig.Field(
+        doc = "maximum size (MB) of a cache of calexp, calexpBackground and psf, shared by all patches " \
+            "processed in this process, so that a calexp that overlaps several patches is read once; " \
+            "0 to disable",
+        dtype = int,
+        default = 0,
+        check = lambda x: x >= 0,
+    )
+    coordCacheSize = pexConfig.Field(
+        doc = "maximum number of coordinate mapping grids (one per calexp and tract) to cache in memory; " \
+            "the grids are used to find the region of a calexp to read (getCalExpSubBBox) and to add " \
+            "a compact background to the warped exposure; the warper always maps pixels itself; " \
+            "0 to disable the cache",
+        dtype = int,
+        default = 0,
+    )
+    coordCacheDir = pexConfig.Field(
+        doc = "directory in which to persist coordinate mapping grids, so they can be reused " \
+            "when reprocessing; None for no persistence; ignored if coordCacheSize = 0",
+        dtype = str,
+        optional = True,
+    )
+    coordGridSpacing = pexConfig.Field(
+        doc = "spacing of coordinate mapping grid nodes (pixels)",
+        dtype = int,
+        default = 100,
+    )
 
 
 class WarpAndPsfMatchTask(pipeBase.Task):
@@ -60,28 +146,365 @@ class WarpAndPsfMatchTask(pipeBase.Task):
         pipeBase.Task.__init__(self, *args, **kwargs)
         self.makeSubtask("psfMatch")
         self.warper = afwMath.Warper.fromConfig(self.config.warp)
+        self.coordCache = _getSharedCache(
+            ("coord", self.config.coordCacheSize, self.config.coordCacheDir),
+            lambda: CoordMappingCache(maxSize=self.config.coordCacheSize, cacheDir=self.config.coordCacheDir),
+        )
+        self._modelPsfDict = dict() # (fwhmPixels, kernel width, kernel height): model PSF
+        self.kernelCache = _getSharedCache(
+            ("kernel", self.config.kernelCacheSize),
+            lambda: LruCache(maxSize=self.config.kernelCacheSize),
+        )
+        # values are (dataset, size in bytes)
+        self.readCache = _getSharedCache(
+            ("read", self.config.readCacheSizeMB),
+            lambda: LruCache(maxSize=self.config.readCacheSizeMB * 1024 * 1024,
+                sizeFunc=lambda item: item[1]),
+        )
+
+    def getModelPsf(self, fwhmPixels, kernelDim):
+        """Return a double Gaussian model PSF, reusing a prior model with the same parameters
+
+        The model PSF has core FWHM = fwhmPixels and wings of amplitude 1/10 of core
+        and FWHM = 2.5 * core.
 
-    def getCalExp(self, dataRef, getPsf=True, bgSubtracted=False):
+        @param fwhmPixels: FWHM of core Gaussian, in pixels
+        @param kernelDim: dimensions of PSF kernel, in pixels
+        @return model PSF
+        """
+        key = (fwhmPixels, kernelDim[0], kernelDim[1])
+        modelPsf = self._modelPsfDict.get(key)
+        if modelPsf is None:
+            coreSigma = fwhmPixels / FwhmPerSigma
+            modelPsf = afwDetection.createPsf("DoubleGaussian", kernelDim[0], kernelDim[1],
+                coreSigma, coreSigma * 2.5, 0.1)
+            self._modelPsfDict[key] = modelPsf
+        return modelPsf
+
+    def psfMatchExposure(self, exposure, modelPsf, dataId=None):
+        """PSF-match an exposure to a model PSF, reusing a cached PSF-matching kernel if possible
+
+        Kernels are cached (if config.kernelCacheSize > 0 and dataId is not None) by data ID,
+        parent bbox and PSF of the exposure and by the model PSF.
+
+        @param exposure: exposure to PSF-match; must have a PSF
+        @param modelPsf: model PSF, as returned by getModelPsf
+        @param dataId: data ID of exposure, or None if unknown (in which case the kernel is not cached)
+        @return PSF-matched exposure
+        """
+        if self.config.kernelCacheSize <= 0 or dataId is None:
+            return self.psfMatch.run(exposure, modelPsf).psfMatchedExposure
+
+        key = self._makeKernelKey(exposure, modelPsf, dataId)
+        kernel = self.kernelCache.get(key)
+        if kernel is None:
+            result = self.psfMatch.run(exposure, modelPsf)
+            self.kernelCache.put(key, result.psfMatchingKernel)
+            return result.psfMatchedExposure
+
+        self.log.info("Reuse cached PSF-matching kernel")
+        bbox = exposure.getMaskedImage().getBBox(afwImage.PARENT)
+        psfMatchedExposure = afwImage.ExposureF(bbox, exposure.getWcs())
+        psfMatchedExposure.setFilter(exposure.getFilter())
+        psfMatchedExposure.setCalib(exposure.getCalib())
+        psfMatchedExposure.setPsf(modelPsf)
+        # the kernel is normalized, as by the psfMatch task, since its sum is meaningless
+        # when matching one PSF model to another
+        convolveMaskedImage(psfMatchedExposure.getMaskedImage(), exposure.getMaskedImage(), kernel,
+            self.config.convolve, doNormalize=True)
+        return psfMatchedExposure
+
+    def _makeKernelKey(self, exposure, modelPsf, dataId):
+        """Return a key identifying a PSF-matching problem, for the kernel cache
+
+        The PSFs are identified by a hash of their full models (see _updatePsfHash),
+        so a spatially varying PSF only matches an identical model.
+        """
+        bbox = exposure.getMaskedImage().getBBox(afwImage.PARENT)
+        md5 = hashlib.md5()
+        for psf in (exposure.getPsf(), modelPsf):
+            self._updatePsfHash(md5, psf, bbox)
+        dataIdStr = " ".join("%s=%s" % (key, dataId[key]) for key in sorted(dataId.keys()))
+        return (dataIdStr, bbox.getMinX(), bbox.getMinY(), bbox.getMaxX(), bbox.getMaxY(), md5.hexdigest())
+
+    @staticmethod
+    def _updatePsfHash(md5, psf, bbox):
+        """Add a PSF model to a hash
+
+        The hash covers the type and spatial parameters of the PSF's kernel, the images of its
+        basis kernels (if it is a linear combination of basis kernels), and images of the PSF
+        at a 3x3 grid of positions spanning bbox.
+
+        @param[in,out] md5: hash object (e.g. a hashlib.md5)
+        @param[in] psf: PSF model
+        @param[in] bbox: parent bbox of the exposure the PSF belongs to
+        """
+        kernel = psf.getKernel()
+        md5.update("%s %s" % (type(psf).__name__, type(kernel).__name__))
+        if kernel.isSpatiallyVarying():
+            md5.update(repr([tuple(params) for params in kernel.getSpatialParameters()]))
+            if isinstance(kernel, afwMath.LinearCombinationKernel):
+                for basisKernel in kernel.getKernelList():
+                    basisImage = afwImage.ImageD(basisKernel.getDimensions())
+                    basisKernel.computeImage(basisImage, False)
+                    md5.update(basisImage.getArray().tostring())
+        box = afwGeom.Box2D(bbox)
+        for yPos in (box.getMinY(), box.getCenterY(), box.getMaxY()):
+            for xPos in (box.getMinX(), box.getCenterX(), box.getMaxX()):
+                md5.update(psf.computeImage(afwGeom.Point2D(xPos, yPos)).getArray().tostring())
+
+    def getCoordMappingGrid(self, srcWcs, srcBBox, destWcs):
+        """Return the coordinate mapping grid from destination to source pixels, or None if disabled
+
+        @param srcWcs: WCS of source image (e.g. calexp)
+        @param srcBBox: parent bbox of source image (an afwGeom.Box2I)
+        @param destWcs: WCS of destination image (e.g. tract)
+        @return a CoordMappingGrid, or None if config.coordCacheSize <= 0
+        """
+        if self.config.coordCacheSize <= 0:
+            return None
+        return self.coordCache.getGrid(srcWcs=srcWcs, srcBBox=srcBBox, destWcs=destWcs,
+            spacing=self.config.coordGridSpacing)
+
+    def makeExposureMetrics(self, dataId):
+        """Return an ExposureMetrics for measuring the cost of warping one calexp
+
+        The metrics are recorded in the metadata of this task with prefix "warp"
+        (e.g. "warpReadTime") when record() is called.
+
+        @param dataId: data ID of the calexp
+        """
+        return ExposureMetrics(self, "warp", dataId, WarpMetricNameList)
+
+    def getCalExp(self, dataRef, getPsf=True, bgSubtracted=False, bbox=None, expMetrics=None):
         """Return one "calexp" calibrated exposure, optionally with psf
         
         @param dataRef: a sensor-level data reference
         @param getPsf: include the PSF?
         @param bgSubtracted: return calexp with background subtracted? If False then
             get the calexp's background background model and add it to the calexp.
+        @param bbox: parent bbox of the region of the calexp to read (an afwGeom.Box2I);
+            if None then read the whole calexp
+        @param[in,out] expMetrics: an ExposureMetrics (see makeExposureMetrics) to which to add
+            "ReadTime", "BgAddTime" and "BytesRead"; None if not wanted
         @return calibrated exposure with psf
+
+        The data are read using readDataset, so they may come from the shared read cache.
         """
-        exposure = dataRef.get("calexp", immediate=True)
+        if expMetrics is None:
+            expMetrics = self.makeExposureMetrics(dataRef.dataId)
+        with expMetrics.timeStage("ReadTime"):
+            if bbox is None:
+                exposure = self.readDataset(dataRef, "calexp", expMetrics=expMetrics)
+            else:
+                exposure = self.readDataset(dataRef, "calexp_sub", expMetrics=expMetrics,
+                    bbox=bbox, imageOrigin="PARENT")
+            if self.config.readCacheSizeMB > 0:
+                # the cached exposure must not be modified
+                exposure = exposure.Factory(exposure, True)
         if not bgSubtracted:
-            background = dataRef.get("calexpBackground", immediate=True)
-            mi = exposure.getMaskedImage()
-            mi += background
-            del mi
+            with expMetrics.timeStage("ReadTime"):
+                if bbox is None:
+                    background = self.readDataset(dataRef, "calexpBackground", expMetrics=expMetrics)
+                else:
+                    background = self.readDataset(dataRef, "calexpBackground_sub", expMetrics=expMetrics,
+                        bbox=bbox, imageOrigin="PARENT")
+            with expMetrics.timeStage("BgAddTime"):
+                mi = exposure.getMaskedImage()
+                mi += background
+                del mi
         if getPsf:
-            psf = dataRef.get("psf", immediate=True)
+            with expMetrics.timeStage("ReadTime"):
+                psf = self.readDataset(dataRef, "psf", expMetrics=expMetrics)
             exposure.setPsf(psf)
         return exposure
+
+    def readDataset(self, dataRef, datasetType, expMetrics=None, **kwargs):
+        """Read a calexp, calexpBackground or psf (or a subregion of one), using the shared read cache
+
+        If config.readCacheSizeMB > 0 the dataset is cached (and may be returned from the cache),
+        so the caller must not modify it.
+
+        @param dataRef: a sensor-level data reference
+        @param datasetType: dataset type, e.g. "calexp" or "calexpBackground_sub"
+        @param[in,out] expMetrics: an ExposureMetrics to which to add "BytesRead" (the pixel data read
+            by the butler; nothing is added if the dataset comes from the cache), or None
+        @param **kwargs: additional arguments for dataRef.get, e.g. bbox
+        @return the dataset
+        """
+        if self.config.readCacheSizeMB > 0:
+            key = (datasetType, tuple(sorted(dataRef.dataId.items())),
+                tuple(sorted((name, str(value)) for name, value in kwargs.iteritems())))
+            item = self.readCache.get(key)
+            if item is not None:
+                return item[0]
+        dataset = dataRef.get(datasetType, immediate=True, **kwargs)
+        nBytes = self._getNBytes(dataset)
+        if expMetrics is not None:
+            expMetrics.add("BytesRead", nBytes)
+        if self.config.readCacheSizeMB > 0:
+            self.readCache.put(key, (dataset, nBytes))
+        return dataset
+
+    @staticmethod
+    def _getNBytes(dataset):
+        """Return the number of bytes of pixel data in a calexp, calexpBackground or psf
+        """
+        if hasattr(dataset, "getMaskedImage"):
+            return getMaskedImageNBytes(dataset.getMaskedImage())
+        elif hasattr(dataset, "getArray"):
+            return dataset.getArray().nbytes
+        # a psf; small compared to the images
+        return 0
     
-    def run(self, exposure, wcs, maxBBox=None, destBBox=None):
+    def getCompactBackground(self, dataRef):
+        """Return the compact background model of a calexp
+
+        The persisted calexpBackgroundCompact is used if it exists, has the right bin size
+        and was made from the current calexpBackground; otherwise the model is computed
+        from calexpBackground and (if config.doWriteCompactBackground) persisted.
+        If the mapper does not define calexpBackgroundCompact then the model is always computed
+        from calexpBackground.
+
+        @param dataRef: a sensor-level data reference
+        @return compact background model (a CompactBackground)
+        """
+        binSize = self.config.compactBackgroundBinSize
+        signature = self._getFileSignature(dataRef, "calexpBackground")
+        compactName = "calexpBackgroundCompact"
+        if signature is not None:
+            try:
+                # raises if the mapper does not define the dataset type
+                compactExists = dataRef.datasetExists(compactName)
+            except Exception, e:
+                self.log.logdebug("Cannot look up %s %s: %s" % (compactName, dataRef.dataId, e))
+                compactExists = False
+            if compactExists:
+                try:
+                    background = dataRef.get(compactName, immediate=True)
+                except Exception, e:
+                    self.log.warn("Could not read %s %s: %s" % (compactName, dataRef.dataId, e))
+                    background = None
+                if background is not None and background.binSize == binSize \
+                    and background.signature == signature:
+                    return background
+
+        background = CompactBackground(dataRef.get("calexpBackground", immediate=True), binSize=binSize,
+            signature=signature)
+        if self.config.doWriteCompactBackground:
+            self.log.info("Persisting %s %s" % (compactName, dataRef.dataId))
+            try:
+                dataRef.put(background, compactName)
+            except Exception, e:
+                self.log.warn("Could not persist %s %s: %s" % (compactName, dataRef.dataId, e))
+        return background
+
+    @staticmethod
+    def _getFileSignature(dataRef, datasetType):
+        """Return a signature of the file of a dataset, based on its modification time and size,
+        or None if the file could not be found
+        """
+        try:
+            fileName = dataRef.get(datasetType + "_filename")[0]
+            fileStat = os.stat(fileName)
+        except Exception:
+            return None
+        return "%r %d" % (fileStat.st_mtime, fileStat.st_size)
+
+    def addBackground(self, exposure, background, srcWcs, srcBBox):
+        """Add a compact background model of a source exposure to a warped version of that exposure
+
+        The background is evaluated at the source position of each warped pixel, in blocks of rows
+        to limit memory use. This approximates adding the background before warping
+        (and PSF-matching with a normalized kernel) because the background is smooth.
+
+        @param[in,out] exposure: warped exposure
+        @param[in] background: compact background model of the source exposure (a CompactBackground)
+        @param[in] srcWcs: WCS of the source exposure
+        @param[in] srcBBox: parent bbox of the source exposure (an afwGeom.Box2I)
+        """
+        grid = self.getCoordMappingGrid(srcWcs=srcWcs, srcBBox=srcBBox, destWcs=exposure.getWcs())
+        if grid is None:
+            grid = CoordMappingGrid(srcWcs=srcWcs, srcBBox=srcBBox, destWcs=exposure.getWcs(),
+                spacing=self.config.coordGridSpacing)
+        imageArr = exposure.getMaskedImage().getImage().getArray()
+        height, width = imageArr.shape
+        x0, y0 = exposure.getX0(), exposure.getY0()
+        xArr = numpy.arange(x0, x0 + width, dtype=float)
+        rowsPerBlock = 256
+        for yStart in range(0, height, rowsPerBlock):
+            yEnd = min(yStart + rowsPerBlock, height)
+            destXArr, destYArr = numpy.meshgrid(xArr, numpy.arange(y0 + yStart, y0 + yEnd, dtype=float))
+            srcXArr, srcYArr = grid.mapToSource(destXArr, destYArr)
+            imageArr[yStart:yEnd, :] += background.evaluate(srcXArr, srcYArr)
+
+    def getPadding(self, doPsfMatch):
+        """Return the number of pixels by which a region of a calexp must be grown
+        so that the warped (and PSF-matched, if doPsfMatch) pixels in that region are unaffected
+
+        @param doPsfMatch: will the exposure be PSF-matched?
+        """
+        warpingKernel = self.warper.getWarpingKernel()
+        padding = max(warpingKernel.getWidth(), warpingKernel.getHeight()) // 2 + 1
+        if doPsfMatch:
+            padding += self.psfMatch.config.kernel.active.kernelSize // 2 + 1
+        return padding
+
+    def getCalExpSubBBox(self, dataRef, wcs, destBBox, doPsfMatch):
+        """Compute the region of a calexp needed to compute its warped pixels within destBBox
+
+        Only the calexp's header is read. The region is found by mapping the boundary of
+        destBBox onto the calexp and is then grown by getPadding(doPsfMatch).
+
+        @param dataRef: a sensor-level data reference
+        @param wcs: WCS of the warped exposure (e.g. of the tract)
+        @param destBBox: parent bbox of the warped exposure (e.g. outer bbox of the patch)
+        @param doPsfMatch: will the exposure be PSF-matched?
+        @return parent bbox of the needed region of the calexp (an afwGeom.Box2I),
+            or None if the whole calexp is needed
+
+        @raise RuntimeError if the calexp does not overlap destBBox
+        """
+        md = dataRef.get("calexp_md", immediate=True)
+        # the header WCS is relative to the image origin, which is assumed to be (0, 0) for a calexp
+        calExpBBox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(md.get("NAXIS1"), md.get("NAXIS2")))
+        calExpWcs = afwImage.makeWcs(md)
+
+        # sample the boundary of destBBox, since the mapping is not linear
+        destBox = afwGeom.Box2D(destBBox)
+        grid = self.getCoordMappingGrid(srcWcs=calExpWcs, srcBBox=calExpBBox, destWcs=wcs)
+        if grid is not None:
+            # the calexp only maps to the grid's bbox, so the rest of destBBox may be ignored
+            destBox.clip(afwGeom.Box2D(grid.getDestBBox()))
+            if destBox.isEmpty():
+                raise RuntimeError("calexp %s does not overlap the destination bbox" % (dataRef.dataId,))
+        numPerSide = 8
+        fracArr = numpy.arange(numPerSide + 1) / float(numPerSide)
+        xArr = destBox.getMinX() + fracArr * destBox.getWidth()
+        yArr = destBox.getMinY() + fracArr * destBox.getHeight()
+        minXArr, maxXArr = [numpy.repeat(x, len(yArr)) for x in (destBox.getMinX(), destBox.getMaxX())]
+        minYArr, maxYArr = [numpy.repeat(y, len(xArr)) for y in (destBox.getMinY(), destBox.getMaxY())]
+        destXArr = numpy.concatenate((xArr, xArr, minXArr, maxXArr))
+        destYArr = numpy.concatenate((minYArr, maxYArr, yArr, yArr))
+        subBox = afwGeom.Box2D()
+        if grid is not None:
+            srcXArr, srcYArr = grid.mapToSource(destXArr, destYArr)
+            for xPos, yPos in zip(srcXArr, srcYArr):
+                subBox.include(afwGeom.Point2D(xPos, yPos))
+        else:
+            for xPos, yPos in zip(destXArr, destYArr):
+                subBox.include(calExpWcs.skyToPixel(wcs.pixelToSky(afwGeom.Point2D(xPos, yPos))))
+
+        subBBox = afwGeom.Box2I(subBox)
+        subBBox.grow(self.getPadding(doPsfMatch))
+        subBBox.clip(calExpBBox)
+        if subBBox.isEmpty():
+            raise RuntimeError("calexp %s does not overlap the destination bbox" % (dataRef.dataId,))
+        if subBBox == calExpBBox:
+            return None
+        return subBBox
+    
+    def run(self, exposure, wcs, maxBBox=None, destBBox=None, dataId=None, background=None, expMetrics=None):
         """PSF-match exposure (if self.config.desiredFwhm is not None) and warp
         
         @param[in,out] exposure: exposure to preprocess; PSF matching is done in place
@@ -92,21 +515,40 @@ class WarpAndPsfMatchTask(pipeBase.Task):
             ignored if destBBox is not None
         @param destBBox: exact parent bbox of warped exposure (an afwGeom.Box2I or None);
             if None then maxBBox is used to determine the bbox, otherwise maxBBox is ignored
+        @param dataId: data ID of exposure, used to cache the PSF-matching kernel;
+            None if unknown, in which case the kernel is not cached
+        @param background: compact background model of exposure (a CompactBackground) to add
+            to the warped exposure, or None to add no background
+        @param[in,out] expMetrics: an ExposureMetrics (see makeExposureMetrics) to which to add
+            "PsfMatchTime", "WarpTime", "BgAddTime", "NumPixWarped" and "PixWarpedPerSec";
+            None if not wanted
         
         @return a pipe_base Struct containing:
         - exposure: processed exposure
         """
+        if expMetrics is None:
+            expMetrics = self.makeExposureMetrics(dataId if dataId is not None else {})
+        srcWcs = exposure.getWcs()
+        srcBBox = exposure.getMaskedImage().getBBox(afwImage.PARENT)
         if self.config.desiredFwhm is not None:
             self.log.info("PSF-match exposure")
-            fwhmPixels = self.config.desiredFwhm / wcs.pixelScale().asArcseconds()
-            kernelDim = exposure.getPsf().getKernel().getDimensions()
-            coreSigma = fwhmPixels / FwhmPerSigma
-            modelPsf = afwDetection.createPsf("DoubleGaussian", kernelDim[0], kernelDim[1],
-                coreSigma, coreSigma * 2.5, 0.1)
-            exposure = self.psfMatch.run(exposure, modelPsf).psfMatchedExposure
+            with expMetrics.timeStage("PsfMatchTime"):
+                fwhmPixels = self.config.desiredFwhm / wcs.pixelScale().asArcseconds()
+                kernelDim = exposure.getPsf().getKernel().getDimensions()
+                modelPsf = self.getModelPsf(fwhmPixels=fwhmPixels, kernelDim=kernelDim)
+                exposure = self.psfMatchExposure(exposure, modelPsf, dataId=dataId)
         self.log.info("Warp exposure")
-        with self.timer("warp"):
+        with self.timer("warp"), expMetrics.timeStage("WarpTime"):
             exposure = self.warper.warpExposure(wcs, exposure, maxBBox=maxBBox, destBBox=destBBox)
+        numPixWarped = exposure.getWidth() * exposure.getHeight()
+        expMetrics.set("NumPixWarped", numPixWarped)
+        warpTime = expMetrics.get("WarpTime")
+        if warpTime > 0:
+            expMetrics.set("PixWarpedPerSec", numPixWarped / warpTime)
+        if background is not None:
+            self.log.info("Add background to warped exposure")
+            with self.timer("addBackground"), expMetrics.timeStage("BgAddTime"):
+                self.addBackground(exposure, background, srcWcs=srcWcs, srcBBox=srcBBox)
         
         return pipeBase.Struct(
             exposure = exposure,
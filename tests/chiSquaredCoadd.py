@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import unittest
+import numpy
+import lsst.utils.tests as utilsTests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.pipe.base as pipeBase
+from lsst.pipe.tasks.chiSquaredCoadd import ChiSquaredCoaddTask
+
+class FakeButler(object):
+    """Butler that makes FakePatchRefs and records what is persisted"""
+    def __init__(self):
+        self.putDict = dict()
+
+    def dataRef(self, datasetType, dataId):
+        return FakePatchRef(self, dataId)
+
+    def getFilterList(self, datasetType):
+        """Return the filter of each persisted dataset of the given type (None if its data ID has none)"""
+        return sorted(filterName for (name, filterName) in self.putDict.iterkeys() if name == datasetType)
+
+class FakePatchRef(object):
+    """Patch data reference that records what is persisted in its butler"""
+    def __init__(self, butler, dataId):
+        self.butlerSubset = pipeBase.Struct(butler=butler)
+        self.dataId = dataId
+
+    def put(self, obj, datasetType):
+        self.butlerSubset.butler.putDict[(datasetType, self.dataId.get("filter"))] = obj
+
+class FakeChiSquaredCoaddTask(ChiSquaredCoaddTask):
+    """ChiSquaredCoaddTask that coadds in-memory exposures instead of warped calexps
+
+    selectExposures returns the exposures for the filter of the patch data reference
+    and accumulateCoadd adds them to the coadd as they are.
+    """
+    def __init__(self, bbox, wcs, exposureListDict, *args, **kwargs):
+        ChiSquaredCoaddTask.__init__(self, *args, **kwargs)
+        self.bbox = bbox
+        self.wcs = wcs
+        self.exposureListDict = exposureListDict
+
+    def getSkyInfo(self, patchRef):
+        return pipeBase.Struct(wcs=self.wcs, bbox=self.bbox)
+
+    def selectExposures(self, patchRef, wcs, bbox):
+        return self.exposureListDict.get(patchRef.dataId["filter"], [])
+
+    def accumulateCoadd(self, coadd, calExpRefList, tractWcs, patchBBox, doPsfMatch):
+        for exposure in calExpRefList:
+            coadd.addExposure(exposure)
+
+class ChiSquaredCoaddTestCase(unittest.TestCase):
+    """Test the multi-band chi squared coadd"""
+
+    def setUp(self):
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(100, 200), afwGeom.Extent2I(60, 40))
+        metadata = afwImage.ExposureF(self.bbox).getMetadata()
+        for key, value in (("CTYPE1", "RA---TAN"), ("CTYPE2", "DEC--TAN"), ("CRPIX1", 130.0),
+            ("CRPIX2", 220.0), ("CRVAL1", 10.0), ("CRVAL2", 20.0), ("CD1_1", -5.0e-5), ("CD1_2", 0.0),
+            ("CD2_1", 0.0), ("CD2_2", 5.0e-5)):
+            metadata.set(key, value)
+        self.wcs = afwImage.makeWcs(metadata)
+        numpy.random.seed(5)
+        self.exposureListDict = dict()
+        for i, filterName in enumerate(("g", "r", "r", "i", "i", "i")):
+            exposure = afwImage.ExposureF(self.bbox, self.wcs)
+            maskedImage = exposure.getMaskedImage()
+            maskedImage.getImage().getArray()[:] = numpy.random.normal(10.0 * (i + 1), 10.0, (40, 60))
+            maskedImage.getVariance().getArray()[:] = 100.0 * (i + 1)
+            maskedImage.getMask().getArray()[5 * i:5 * i + 3, 10:20] = afwImage.MaskU.getPlaneBitMask("SAT")
+            self.exposureListDict.setdefault(filterName, []).append(exposure)
+
+    def tearDown(self):
+        del self.wcs
+        del self.exposureListDict
+
+    def makeTask(self, filterList):
+        config = FakeChiSquaredCoaddTask.ConfigClass()
+        config.filterList = filterList
+        config.doInterp = False
+        config.badMaskPlanes = ["EDGE", "SAT"]
+        return FakeChiSquaredCoaddTask(bbox=self.bbox, wcs=self.wcs, exposureListDict=self.exposureListDict,
+            config=config)
+
+    def makeCoadd(self, task, exposureList):
+        coadd = task.makeCoadd(self.bbox, self.wcs)
+        for exposure in exposureList:
+            coadd.addExposure(exposure)
+        return coadd
+
+    def assertMaskedImagesEqual(self, maskedImage1, maskedImage2):
+        self.assertTrue(numpy.all(maskedImage1.getMask().getArray() == maskedImage2.getMask().getArray()))
+        for getPlane in (lambda mi: mi.getImage(), lambda mi: mi.getVariance()):
+            # pixels that are bad in every exposure of a band are NaN in that band's coadd
+            array1 = getPlane(maskedImage1).getArray()
+            array2 = getPlane(maskedImage2).getArray()
+            isGood = numpy.isfinite(array1)
+            self.assertTrue(numpy.all(isGood == numpy.isfinite(array2)))
+            self.assertTrue(numpy.allclose(array1[isGood], array2[isGood], rtol=1e-6))
+
+    def testMultiBand(self):
+        """Test that the combined coadd matches the per-band chi squared sums"""
+        filterList = ["g", "r", "i", "z"]
+        task = self.makeTask(filterList)
+        butler = FakeButler()
+        res = task.run(FakePatchRef(butler, dict(tract=0, patch="1,2", filter="r")))
+
+        # z has no exposures, so it is skipped
+        self.assertEqual(sorted(res.bandCoaddExposureDict.keys()), ["g", "i", "r"])
+        partialDataList = []
+        allExposureList = []
+        for filterName in ("g", "r", "i"):
+            exposureList = self.exposureListDict[filterName]
+            allExposureList += exposureList
+            bandCoadd = self.makeCoadd(task, exposureList)
+            partialDataList.append(bandCoadd.getPartialData())
+            bandMI = bandCoadd.getCoadd().getMaskedImage()
+            self.assertMaskedImagesEqual(res.bandCoaddExposureDict[filterName].getMaskedImage(), bandMI)
+            self.assertMaskedImagesEqual(butler.putDict[("chiSquaredCoadd", filterName)].getMaskedImage(),
+                bandMI)
+
+        # the combined chi squared sums are the sums of the per-band chi squared sums
+        partialData = res.coadd.getPartialData()
+        for name in ("image", "variance", "weight"):
+            self.assertTrue(numpy.allclose(partialData[name], sum(pd[name] for pd in partialDataList),
+                rtol=1e-6))
+
+        # and so the combined coadd matches a chi squared coadd of all exposures
+        fullMI = self.makeCoadd(task, allExposureList).getCoadd().getMaskedImage()
+        self.assertMaskedImagesEqual(res.coaddExposure.getMaskedImage(), fullMI)
+
+        # the combined coadd is persisted as <coaddName>Coadd_multiBand with no filter in its data ID
+        self.assertMaskedImagesEqual(butler.putDict[("chiSquaredCoadd_multiBand", None)].getMaskedImage(),
+            fullMI)
+        self.assertEqual(butler.getFilterList("chiSquaredCoadd_multiBand_depth"), [None])
+        self.assertEqual(butler.getFilterList("chiSquaredCoadd"), ["g", "i", "r"])
+        self.assertEqual(butler.getFilterList("chiSquaredCoadd_depth"), ["g", "i", "r"])
+
+    def testNoExposures(self):
+        """Test that a multi-band coadd with no exposures in any filter fails"""
+        task = self.makeTask(["u", "z"])
+        self.assertRaises(pipeBase.TaskError, task.run,
+            FakePatchRef(FakeButler(), dict(tract=0, patch="1,2", filter="r")))
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(ChiSquaredCoaddTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+import lsst.utils.tests as utilsTests
+import lsst.pex.config as pexConfig
+from lsst.pipe.tasks.coaddBase import makeConfigHash, getDatasetSignature, _makeSortedValue
+
+class SimpleConfig(pexConfig.Config):
+    intField = pexConfig.Field(doc="an int", dtype=int, default=3)
+    listField = pexConfig.ListField(doc="a list", dtype=str, default=["a", "b"])
+
+class FakeDataRef(object):
+    """A data reference whose datasets are files in a directory"""
+    def __init__(self, dirPath):
+        self.dirPath = dirPath
+
+    def get(self, datasetType):
+        return [os.path.join(self.dirPath, datasetType.replace("_filename", ".fits"))]
+
+class ConfigHashTestCase(unittest.TestCase):
+    """Test makeConfigHash and _makeSortedValue"""
+
+    def testSortedValue(self):
+        self.assertEqual(_makeSortedValue(dict(b=[1, dict(d=2, c=3)], a=(4,))),
+            (("a", (4,)), ("b", (1, (("c", 3), ("d", 2))))))
+        self.assertEqual(_makeSortedValue(5), 5)
+
+    def testConfigHash(self):
+        config = SimpleConfig()
+        configHash = makeConfigHash(config, [1, 2])
+        self.assertEqual(configHash, makeConfigHash(SimpleConfig(), [1, 2]))
+        self.assertEqual(makeConfigHash(dict(a=1, b=2)), makeConfigHash(dict(b=2, a=1)))
+        self.assertNotEqual(configHash, makeConfigHash(config, [2, 1]))
+        self.assertNotEqual(configHash, makeConfigHash(config))
+        config.listField = ["a"]
+        self.assertNotEqual(configHash, makeConfigHash(config, [1, 2]))
+
+class DatasetSignatureTestCase(unittest.TestCase):
+    """Test getDatasetSignature"""
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.dataRef = FakeDataRef(self.tempDir)
+        for name in ("calexp", "psf"):
+            self.writeFile(name, "data")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir, ignore_errors=True)
+
+    def writeFile(self, name, data, mtime=1000000000):
+        path = os.path.join(self.tempDir, name + ".fits")
+        with open(path, "w") as outFile:
+            outFile.write(data)
+        os.utime(path, (mtime, mtime))
+
+    def testSignature(self):
+        signature = getDatasetSignature(self.dataRef, ["calexp", "psf"])
+        self.assertEqual(signature, getDatasetSignature(self.dataRef, ["calexp", "psf"]))
+        self.assertNotEqual(signature, getDatasetSignature(self.dataRef, ["calexp"]))
+        self.writeFile("psf", "data", mtime=1000000001)
+        self.assertNotEqual(signature, getDatasetSignature(self.dataRef, ["calexp", "psf"]))
+        self.writeFile("psf", "more data")
+        self.assertNotEqual(signature, getDatasetSignature(self.dataRef, ["calexp", "psf"]))
+        self.writeFile("psf", "data")
+        self.assertEqual(signature, getDatasetSignature(self.dataRef, ["calexp", "psf"]))
+        self.assertEqual(getDatasetSignature(self.dataRef, ["calexp", "missing"]), "unknown")
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(ConfigHashTestCase)
+    suites += unittest.makeSuite(DatasetSignatureTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import unittest
+import numpy
+import lsst.utils.tests as utilsTests
+import lsst.afw.image as afwImage
+from lsst.pipe.tasks.compactBackground import CompactBackground
+
+class CompactBackgroundTestCase(unittest.TestCase):
+    """Test CompactBackground"""
+
+    def setUp(self):
+        # a linear ramp, which bilinear interpolation between bin means reproduces exactly
+        self.image = afwImage.ImageF(200, 150)
+        self.image.setXY0(10, 20)
+        yArr, xArr = numpy.mgrid[0:150, 0:200]
+        self.image.getArray()[:] = 5.0 + 0.01 * (xArr + 10) - 0.02 * (yArr + 20)
+
+    def tearDown(self):
+        del self.image
+
+    def testEvaluate(self):
+        """Test evaluating the background at pixel positions between the outer bin centers"""
+        background = CompactBackground(self.image, binSize=50)
+        self.assertEqual(background.binArr.shape, (3, 4))
+        xArr = numpy.array([35.0, 60.0, 100.5, 184.5])
+        yArr = numpy.array([45.0, 70.0, 95.5, 144.5])
+        predArr = 5.0 + 0.01 * xArr - 0.02 * yArr
+        self.assertTrue(numpy.allclose(background.evaluate(xArr, yArr), predArr, atol=1e-5))
+
+    def testExtrapolate(self):
+        """Test that the background is constant beyond the outer bin centers"""
+        background = CompactBackground(self.image, binSize=50)
+        edgeValue = background.evaluate(numpy.array([34.5]), numpy.array([44.5]))[0]
+        self.assertAlmostEqual(background.evaluate(numpy.array([0.0]), numpy.array([0.0]))[0], edgeValue,
+            places=5)
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(CompactBackgroundTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
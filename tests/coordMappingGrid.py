@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+import lsst.utils.tests as utilsTests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.daf.base as dafBase
+from lsst.pipe.tasks.coordMappingGrid import CoordMappingGrid, CoordMappingCache
+
+def makeWcs(crpix1, crpix2, crval1=10.0, crval2=20.0, rotDeg=0.0):
+    """Make a tangent-plane WCS with 0.18 arcsec pixels, rotated by rotDeg"""
+    metadata = dafBase.PropertyList()
+    scale = 5.0e-5
+    cosRot = numpy.cos(numpy.radians(rotDeg))
+    sinRot = numpy.sin(numpy.radians(rotDeg))
+    for key, value in (("CTYPE1", "RA---TAN"), ("CTYPE2", "DEC--TAN"), ("CRPIX1", crpix1),
+        ("CRPIX2", crpix2), ("CRVAL1", crval1), ("CRVAL2", crval2), ("CD1_1", -scale * cosRot),
+        ("CD1_2", scale * sinRot), ("CD2_1", scale * sinRot), ("CD2_2", scale * cosRot)):
+        metadata.set(key, value)
+    return afwImage.makeWcs(metadata)
+
+class CoordMappingGridTestCase(unittest.TestCase):
+    """Test CoordMappingGrid"""
+
+    def setUp(self):
+        self.destWcs = makeWcs(5000.0, 5000.0)
+        # a source image near the destination's reference pixel, rotated by 30 degrees
+        self.srcWcs = makeWcs(1000.0, 2000.0, crval1=10.02, crval2=20.03, rotDeg=30.0)
+        self.srcBBox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(2048, 4096))
+
+    def tearDown(self):
+        del self.destWcs
+        del self.srcWcs
+
+    def mapExactly(self, xArr, yArr):
+        """Map destination pixel positions to source pixel positions using the WCSs"""
+        srcPosList = [self.srcWcs.skyToPixel(self.destWcs.pixelToSky(afwGeom.Point2D(x, y)))
+            for x, y in zip(xArr, yArr)]
+        return numpy.array([pos[0] for pos in srcPosList]), numpy.array([pos[1] for pos in srcPosList])
+
+    def testMapToSource(self):
+        grid = CoordMappingGrid(srcWcs=self.srcWcs, srcBBox=self.srcBBox, destWcs=self.destWcs, spacing=50)
+        destBBox = grid.getDestBBox()
+        numpy.random.seed(1)
+        xArr = numpy.random.uniform(destBBox.getMinX(), destBBox.getMaxX(), 200)
+        yArr = numpy.random.uniform(destBBox.getMinY(), destBBox.getMaxY(), 200)
+        srcXArr, srcYArr = grid.mapToSource(xArr, yArr)
+        predSrcXArr, predSrcYArr = self.mapExactly(xArr, yArr)
+        self.assertTrue(numpy.max(numpy.abs(srcXArr - predSrcXArr)) < 0.01)
+        self.assertTrue(numpy.max(numpy.abs(srcYArr - predSrcYArr)) < 0.01)
+
+        # grid nodes are exact; the input shape is preserved
+        nodeXArr = numpy.array([[destBBox.getMinX(), destBBox.getMinX() + 50]], dtype=float)
+        nodeYArr = numpy.array([[destBBox.getMinY(), destBBox.getMinY() + 100]], dtype=float)
+        srcXArr, srcYArr = grid.mapToSource(nodeXArr, nodeYArr)
+        self.assertEqual(srcXArr.shape, (1, 2))
+        predSrcXArr, predSrcYArr = self.mapExactly(nodeXArr[0], nodeYArr[0])
+        self.assertTrue(numpy.allclose(srcXArr[0], predSrcXArr, rtol=0, atol=1.0e-8))
+        self.assertTrue(numpy.allclose(srcYArr[0], predSrcYArr, rtol=0, atol=1.0e-8))
+
+    def testDestBBox(self):
+        """The destination bbox contains the footprint of the source image"""
+        grid = CoordMappingGrid(srcWcs=self.srcWcs, srcBBox=self.srcBBox, destWcs=self.destWcs, spacing=100)
+        destBox = afwGeom.Box2D(grid.getDestBBox())
+        for srcPos in afwGeom.Box2D(self.srcBBox).getCorners():
+            destPos = self.destWcs.skyToPixel(self.srcWcs.pixelToSky(srcPos))
+            self.assertTrue(destBox.contains(destPos))
+        self.assertRaises(RuntimeError, CoordMappingGrid, self.srcWcs, self.srcBBox, self.destWcs, 0)
+
+class CoordMappingCacheTestCase(unittest.TestCase):
+    """Test CoordMappingCache"""
+
+    def setUp(self):
+        self.cacheDir = tempfile.mkdtemp()
+        self.destWcs = makeWcs(5000.0, 5000.0)
+        self.srcWcs = makeWcs(1000.0, 2000.0, crval1=10.02, crval2=20.03, rotDeg=30.0)
+        self.srcBBox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(2048, 4096))
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheDir)
+        del self.destWcs
+        del self.srcWcs
+
+    def testKey(self):
+        """Keys depend on both WCSs, the source bbox and the spacing, not on object identity"""
+        key = CoordMappingCache._makeKey(self.srcWcs, self.srcBBox, self.destWcs, 100)
+        sameSrcWcs = makeWcs(1000.0, 2000.0, crval1=10.02, crval2=20.03, rotDeg=30.0)
+        self.assertEqual(CoordMappingCache._makeKey(sameSrcWcs, self.srcBBox, self.destWcs, 100), key)
+        otherSrcWcs = makeWcs(1000.0, 2000.0, crval1=10.02, crval2=20.03, rotDeg=31.0)
+        otherBBox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(2048, 4095))
+        for otherKey in (
+            CoordMappingCache._makeKey(otherSrcWcs, self.srcBBox, self.destWcs, 100),
+            CoordMappingCache._makeKey(self.srcWcs, otherBBox, self.destWcs, 100),
+            CoordMappingCache._makeKey(self.srcWcs, self.srcBBox, makeWcs(5001.0, 5000.0), 100),
+            CoordMappingCache._makeKey(self.srcWcs, self.srcBBox, self.destWcs, 50),
+        ):
+            self.assertNotEqual(otherKey, key)
+
+    def testPersist(self):
+        """Grids are persisted and reloaded by a new cache; corrupt files are recomputed"""
+        cache = CoordMappingCache(maxSize=2, cacheDir=self.cacheDir)
+        grid = cache.getGrid(srcWcs=self.srcWcs, srcBBox=self.srcBBox, destWcs=self.destWcs, spacing=100)
+        self.assertTrue(cache.getGrid(srcWcs=self.srcWcs, srcBBox=self.srcBBox, destWcs=self.destWcs,
+            spacing=100) is grid)
+        key = CoordMappingCache._makeKey(self.srcWcs, self.srcBBox, self.destWcs, 100)
+        self.assertEqual(os.listdir(self.cacheDir), [os.path.basename(cache._getPath(key))])
+
+        newCache = CoordMappingCache(maxSize=2, cacheDir=self.cacheDir)
+        readGrid = newCache._readGrid(key)
+        self.assertTrue(readGrid is not None)
+        self.assertEqual(readGrid.getDestBBox(), grid.getDestBBox())
+        self.assertTrue(numpy.all(readGrid.srcXArr == grid.srcXArr))
+        self.assertTrue(numpy.all(readGrid.srcYArr == grid.srcYArr))
+
+        with open(cache._getPath(key), "wb") as outFile:
+            outFile.write("not a pickle")
+        self.assertTrue(newCache._readGrid(key) is None)
+        newGrid = newCache.getGrid(srcWcs=self.srcWcs, srcBBox=self.srcBBox, destWcs=self.destWcs,
+            spacing=100)
+        self.assertTrue(numpy.all(newGrid.srcXArr == grid.srcXArr))
+        self.assertTrue(newCache._readGrid(key) is not None)
+
+    def testNoPersist(self):
+        cache = CoordMappingCache(maxSize=2)
+        cache.getGrid(srcWcs=self.srcWcs, srcBBox=self.srcBBox, destWcs=self.destWcs, spacing=100)
+        self.assertEqual(os.listdir(self.cacheDir), [])
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(CoordMappingGridTestCase)
+    suites += unittest.makeSuite(CoordMappingCacheTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
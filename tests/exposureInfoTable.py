@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import unittest
+import numpy
+import lsst.utils.tests as utilsTests
+from lsst.pipe.tasks.exposureInfoTable import ExposureInfoTable
+from lsst.pipe.tasks.overlap import sphericalPolygonOverlapArea
+
+class ExposureInfoTableTestCase(unittest.TestCase):
+    """Test ExposureInfoTable"""
+
+    def setUp(self):
+        # corners of each exposure; the diamond's RA, Dec box overlaps the region, but it does not
+        self.raDecListList = [
+            [(0, 0), (1, 0), (1, 1), (0, 1)],
+            [(0.5, 0.5), (1.5, 0.5), (1.5, 1.5), (0.5, 1.5)],
+            [(2, 2), (3, 2), (3, 3), (2, 3)],
+            [(0.5, 0), (1, 0.5), (0.5, 1), (0, 0.5)],
+            [(359.5, 0), (0.5, 0), (0.5, 1), (359.5, 1)],
+            [(180, 0), (181, 0), (181, 1), (180, 1)],
+        ]
+        numExp = len(self.raDecListList)
+        self.table = ExposureInfoTable(
+            dict(visit=numpy.arange(numExp) + 100, ccd=[5] * numExp),
+            ra = [[ra for ra, dec in raDecList] for raDecList in self.raDecListList],
+            dec = [[dec for ra, dec in raDecList] for raDecList in self.raDecListList],
+            fwhm = numpy.linspace(0.5, 1.0, numExp),
+        )
+        self.region = [(0.8, 0.8), (2, 0.8), (2, 2), (0.8, 2)]
+
+    def tearDown(self):
+        del self.table
+
+    def testRows(self):
+        """Test that the table acts like a list of exposure information objects"""
+        self.assertEqual(len(self.table), 6)
+        expInfoList = list(self.table)
+        self.assertEqual(len(expInfoList), 6)
+        self.assertEqual(expInfoList[1].dataId, dict(visit=101, ccd=5))
+        self.assertTrue(isinstance(expInfoList[1].dataId["visit"], int))
+        self.assertAlmostEqual(expInfoList[-1].fwhm, 1.0)
+        self.assertEqual(self.table[-1], expInfoList[-1])
+        self.assertEqual(len(set(expInfoList + list(self.table))), 6)
+        coordList = self.table[4].coordList
+        self.assertEqual(len(coordList), 4)
+        self.assertAlmostEqual(coordList[0].getRa().asDegrees(), 359.5)
+        self.assertRaises(AttributeError, getattr, expInfoList[0], "seeing")
+        self.assertRaises(IndexError, self.table.__getitem__, 6)
+
+    def testSubset(self):
+        """Test indexing with slices and boolean masks"""
+        subTable = self.table[1:3]
+        self.assertTrue(isinstance(subTable, ExposureInfoTable))
+        self.assertEqual([expInfo.dataId["visit"] for expInfo in subTable], [101, 102])
+        subTable = self.table[self.table.getColumn("fwhm") > 0.75]
+        self.assertEqual(list(subTable.getDataIdColumn("visit")), [103, 104, 105])
+        self.assertEqual(subTable.getColumnNames(), ["fwhm"])
+        self.assertEqual(subTable.getDataIdKeys(), ["ccd", "visit"])
+
+    def testOverlapMask(self):
+        """Test the vectorized overlap test against the exact overlap area"""
+        for region in (self.region, self.raDecListList[0], self.raDecListList[5]):
+            predMask = [sphericalPolygonOverlapArea(raDecList, region) > 0
+                for raDecList in self.raDecListList]
+            self.assertEqual(list(self.table.getOverlapMask(region)), predMask)
+        self.assertEqual(list(self.table.getOverlapMask(self.region)),
+            [True, True, False, False, False, False])
+        self.assertEqual(len(self.table[0:0].getOverlapMask(self.region)), 0)
+
+    def testOverlapMaskIndices(self):
+        """Test the overlap test on a subset of exposures, reusing the footprint vertices and normals"""
+        vertexNormalArrays = self.table._getVertexNormalArrays()
+        fullMask = self.table.getOverlapMask(self.raDecListList[0])
+        for indices in ([0, 3, 5], [1], []):
+            mask = self.table.getOverlapMask(self.raDecListList[0], numpy.array(indices, dtype=int))
+            self.assertEqual(list(mask), list(fullMask[indices]))
+        self.assertTrue(self.table._getVertexNormalArrays() is vertexNormalArrays)
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(ExposureInfoTableTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import math
+import unittest
+import lsst.utils.tests as utilsTests
+import lsst.daf.base as dafBase
+from lsst.pipe.tasks.exposureMetrics import ExposureMetrics
+
+class FakeTask(object):
+    def __init__(self):
+        self.metadata = dafBase.PropertySet()
+
+class ExposureMetricsTestCase(unittest.TestCase):
+    """Test ExposureMetrics"""
+
+    def setUp(self):
+        self.task = FakeTask()
+        self.origGetMaxRss = ExposureMetrics.__dict__["_getMaxRss"]
+        # peak RSS when each exposure starts and ends: the second exposure needs less than the first
+        maxRssIter = iter([100, 500, 500, 500, 500, 700])
+        ExposureMetrics._getMaxRss = staticmethod(lambda: maxRssIter.next())
+
+    def tearDown(self):
+        ExposureMetrics._getMaxRss = self.origGetMaxRss
+        del self.task
+
+    def testRecord(self):
+        """Test that metadata arrays stay aligned per exposure, with NaN for metrics not measured"""
+        nameList = ("ReadTime", "FitTime")
+        expMetrics = ExposureMetrics(self.task, "match", dict(visit=1, ccd=2), nameList)
+        expMetrics.set("ReadTime", 1.5)
+        expMetrics.add("ReadTime", 0.5)
+        expMetrics.record()
+
+        expMetrics = ExposureMetrics(self.task, "match", dict(visit=2, ccd=2), nameList)
+        with expMetrics.timeStage("FitTime"):
+            pass
+        self.assertRaises(RuntimeError, expMetrics.set, "BadName", 1.0)
+        expMetrics.record()
+
+        expMetrics = ExposureMetrics(self.task, "match", dict(visit=3, ccd=2), nameList)
+        expMetrics.record()
+
+        metadata = self.task.metadata
+        self.assertEqual(list(metadata.getArray("matchExpId")),
+            ["ccd=2 visit=1", "ccd=2 visit=2", "ccd=2 visit=3"])
+        readTimeList = metadata.getArray("matchReadTime")
+        self.assertEqual(len(readTimeList), 3)
+        self.assertAlmostEqual(readTimeList[0], 2.0)
+        self.assertTrue(math.isnan(readTimeList[1]))
+        self.assertTrue(math.isnan(readTimeList[2]))
+        fitTimeList = metadata.getArray("matchFitTime")
+        self.assertTrue(math.isnan(fitTimeList[0]))
+        self.assertTrue(fitTimeList[1] >= 0)
+        self.assertTrue(math.isnan(fitTimeList[2]))
+        self.assertEqual(list(metadata.getArray("matchMaxResidentSetSize")), [500, 500, 700])
+        self.assertEqual(list(metadata.getArray("matchMaxRssDelta")), [400, 0, 200])
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(ExposureMetricsTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import unittest
+import numpy
+import lsst.utils.tests as utilsTests
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+from lsst.pipe.tasks.fftConvolve import ConvolveConfig, useFftConvolve, fftConvolveMaskedImage
+
+class FftConvolveTestCase(unittest.TestCase):
+    """Test FFT convolution against afwMath.convolve"""
+
+    def setUp(self):
+        width, height = 123, 97
+        self.maskedImage = afwImage.MaskedImageF(width, height)
+        numpy.random.seed(5)
+        self.maskedImage.getImage().getArray()[:] = numpy.random.normal(0.0, 10.0, (height, width))
+        self.maskedImage.getVariance().getArray()[:] = numpy.random.uniform(50.0, 150.0, (height, width))
+        self.maskedImage.getMask().getArray()[40, 50] = afwImage.MaskU.getPlaneBitMask("SAT")
+        self.maskedImage.getMask().getArray()[60, 20] = afwImage.MaskU.getPlaneBitMask("CR")
+        self.maskedImage.getImage().getArray()[70, 90] = numpy.nan
+        # an asymmetric kernel with an off-center center, to test orientation and centering
+        self.kernel = afwMath.AnalyticKernel(15, 11, afwMath.GaussianFunction2D(2.5, 1.5, 0.3))
+        self.kernel.setCtrX(6)
+        self.kernel.setCtrY(4)
+
+    def tearDown(self):
+        del self.maskedImage
+        del self.kernel
+
+    def assertMatchesDirect(self, tileSize):
+        directMI = self.maskedImage.Factory(self.maskedImage.getDimensions())
+        afwMath.convolve(directMI, self.maskedImage, self.kernel, True)
+        fftMI = self.maskedImage.Factory(self.maskedImage.getDimensions())
+        fftConvolveMaskedImage(fftMI, self.maskedImage, self.kernel, doNormalize=True, tileSize=tileSize)
+
+        self.assertTrue(numpy.all(fftMI.getMask().getArray() == directMI.getMask().getArray()))
+        for getPlane in (lambda mi: mi.getImage(), lambda mi: mi.getVariance()):
+            directArr = getPlane(directMI).getArray()
+            fftArr = getPlane(fftMI).getArray()
+            finiteArr = numpy.isfinite(directArr)
+            self.assertTrue(numpy.all(finiteArr == numpy.isfinite(fftArr)))
+            self.assertTrue(numpy.allclose(fftArr[finiteArr], directArr[finiteArr], rtol=1e-5, atol=1e-4))
+
+    def testOneTile(self):
+        """Test FFT convolution with a single tile"""
+        self.assertMatchesDirect(tileSize=512)
+
+    def testOverlapAdd(self):
+        """Test FFT convolution with many tiles, including partial tiles"""
+        self.assertMatchesDirect(tileSize=32)
+
+    def testUseFftConvolve(self):
+        """Test the choice of convolution algorithm"""
+        config = ConvolveConfig()
+        self.assertFalse(useFftConvolve(self.kernel, config))
+        config.fftMinKernelSize = 15
+        self.assertTrue(useFftConvolve(self.kernel, config))
+        config.fftMinKernelSize = 16
+        self.assertFalse(useFftConvolve(self.kernel, config))
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(FftConvolveTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
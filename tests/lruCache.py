@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import unittest
+import lsst.utils.tests as utilsTests
+from lsst.pipe.tasks.lruCache import LruCache
+
+class LruCacheTestCase(unittest.TestCase):
+    """Test LruCache"""
+
+    def testCount(self):
+        """Test that the least recently used items are discarded"""
+        cache = LruCache(maxSize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1) # "b" is now the least recently used
+        cache.put("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue("b" not in cache)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.numHits, 3)
+        self.assertEqual(cache.numMisses, 1)
+
+    def testSize(self):
+        """Test a size limit that is not a count of items"""
+        cache = LruCache(maxSize=10, sizeFunc=len)
+        cache.put("a", "x" * 4)
+        cache.put("b", "x" * 4)
+        self.assertEqual(cache.getTotalSize(), 8)
+        cache.put("a", "x" * 5) # replaces the old value
+        self.assertEqual(cache.getTotalSize(), 9)
+        cache.put("c", "x" * 3)
+        self.assertEqual(sorted(cache._itemDict.keys()), ["a", "c"])
+        self.assertEqual(cache.getTotalSize(), 8)
+        cache.put("d", "x" * 20) # too big, but the newest item is always kept
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.pop("d"), "x" * 20)
+        self.assertEqual(cache.getTotalSize(), 0)
+
+    def testDisabled(self):
+        """Test that nothing is cached if maxSize <= 0"""
+        cache = LruCache(maxSize=0)
+        cache.put("a", 1)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get("a", 5), 5)
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(LruCacheTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+import lsst.utils.tests as utilsTests
+import lsst.afw.coord as afwCoord
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.daf.base as dafBase
+import lsst.pipe.base as pipeBase
+from lsst.pipe.tasks.makeCoaddTempExp import MakeCoaddTempExpTask, _getPatchOrderKey, _mergeSelectionOrder
+
+class FakeButlerSubset(object):
+    def __init__(self, butler):
+        self.butler = butler
+
+class FakeDataRef(object):
+    def __init__(self, butler, dataId):
+        self.butlerSubset = FakeButlerSubset(butler)
+        self.dataId = dataId
+
+    def datasetExists(self, datasetType):
+        return datasetType == "calexp"
+
+    def get(self, datasetType, **kwargs):
+        raise RuntimeError("%s not found" % (datasetType,))
+
+class FakeButler(object):
+    def dataRef(self, datasetType, dataId):
+        return FakeDataRef(self, dataId)
+
+    def getKeys(self, datasetType, level):
+        return dict(visit=int, tract=int, patch=str)
+
+class FakeWarpTask(MakeCoaddTempExpTask):
+    """MakeCoaddTempExpTask whose "warped" calexps are computed from the data ID instead of read
+    """
+    def warpCalExp(self, calExpRef, tractWcs, patchBBox, doPsfMatch, expMetrics=None):
+        visit = calExpRef.dataId["visit"]
+        if visit < 0:
+            raise RuntimeError("bad visit %s" % (visit,))
+        bbox = afwGeom.Box2I(patchBBox.getMin(), afwGeom.Extent2I(patchBBox.getWidth() - visit, 5))
+        exposure = afwImage.ExposureF(bbox, tractWcs)
+        maskedImage = exposure.getMaskedImage()
+        maskedImage.getImage().getArray()[:,:] = numpy.arange(bbox.getWidth()) * visit
+        maskedImage.getMask().getArray()[:,:] = visit
+        maskedImage.getVariance().getArray()[:,:] = 0.5 * visit
+        exposure.getCalib().setFluxMag0(1.0e10 * visit, 1.0e8)
+        self.warpAndPsfMatch.metadata.add("warpedVisit", visit)
+        return exposure
+
+class FakeTractInfo(object):
+    def getId(self):
+        return 0
+
+class FakePatchInfo(object):
+    def __init__(self, index):
+        self.index = index
+
+    def getIndex(self):
+        return self.index
+
+def makeTractWcs():
+    """Make a simple tangent-plane WCS"""
+    crval = afwCoord.IcrsCoord(10.0*afwGeom.degrees, 20.0*afwGeom.degrees)
+    crpix = afwGeom.Point2D(0.0, 0.0)
+    return afwImage.makeWcs(crval, crpix, 5.0e-5, 0.0, 0.0, 5.0e-5)
+
+def makeBox(minX, maxX):
+    """Make a Box2I extending from minX to maxX (inclusive) in x, and 0 to 9 in y"""
+    return afwGeom.Box2I(afwGeom.Point2I(minX, 0), afwGeom.Point2I(maxX, 9))
+
+class FakeTractTask(MakeCoaddTempExpTask):
+    """MakeCoaddTempExpTask for a tract of two overlapping patches, and calexps with fixed footprints
+    """
+    # patch index: bbox of patch
+    PatchBBoxDict = {(0, 0): makeBox(0, 24), (1, 0): makeBox(16, 39)}
+    # calexp ID (visit, ccd): footprint on tract, in selection order
+    CalExpFootprintList = (((1, 2), makeBox(25, 39)), ((2, 1), makeBox(5, 35)), ((1, 1), makeBox(0, 29)))
+
+    def __init__(self, *args, **kwargs):
+        MakeCoaddTempExpTask.__init__(self, *args, **kwargs)
+        self.tractWcs = makeTractWcs()
+        self.warpedIdList = []
+        self.tempExpDict = dict()
+
+    def getSkyInfo(self, patchRef):
+        index = tuple(int(val) for val in patchRef.dataId["patch"].split(","))
+        return pipeBase.Struct(
+            tractInfo = FakeTractInfo(),
+            patchInfo = FakePatchInfo(index),
+            wcs = self.tractWcs,
+            bbox = self.PatchBBoxDict[index],
+        )
+
+    def selectExposures(self, patchRef, wcs, bbox):
+        butler = patchRef.butlerSubset.butler
+        return [butler.dataRef(datasetType="calexp", dataId=dict(visit=visit, ccd=ccd))
+            for (visit, ccd), footprint in self.CalExpFootprintList if footprint.overlaps(bbox)]
+
+    def selectTractExposures(self, patchRef, tractInfo, patchIndexList=None):
+        return dict((patchIndex, self.selectExposures(patchRef, None, self.PatchBBoxDict[patchIndex]))
+            for patchIndex in patchIndexList)
+
+    def warpCalExp(self, calExpRef, tractWcs, patchBBox, doPsfMatch, expMetrics=None):
+        calExpId = (calExpRef.dataId["visit"], calExpRef.dataId["ccd"])
+        self.warpedIdList.append(calExpId)
+        bbox = afwGeom.Box2I(dict(self.CalExpFootprintList)[calExpId])
+        bbox.clip(patchBBox)
+        exposure = afwImage.ExposureF(bbox)
+        exposure.getMaskedImage().getImage().getArray()[:,:] = 100 * calExpId[0] + calExpId[1]
+        exposure.getCalib().setFluxMag0(1.0e10, 1.0e8)
+        return exposure
+
+    def writeTempExp(self, patchRef, tempExpRef, coaddTempExp, provenance=None):
+        self.tempExpDict[(tempExpRef.dataId["visit"], tempExpRef.dataId["patch"])] = coaddTempExp
+
+class FakeCalExpRef(object):
+    def __init__(self, metadata):
+        self.dataId = dict(visit=1, ccd=1)
+        self.metadata = metadata
+
+    def get(self, datasetType, immediate=False):
+        if datasetType != "calexp_md" or self.metadata is None:
+            raise RuntimeError("%s not found" % (datasetType,))
+        return self.metadata
+
+def makeWcsMetadata(crpix1, crpix2):
+    """Make FITS WCS metadata for a tangent-plane WCS with 0.18 arcsec pixels"""
+    metadata = dafBase.PropertyList()
+    for key, value in (("CTYPE1", "RA---TAN"), ("CTYPE2", "DEC--TAN"), ("CRPIX1", crpix1),
+        ("CRPIX2", crpix2), ("CRVAL1", 10.0), ("CRVAL2", 20.0), ("CD1_1", -5.0e-5), ("CD1_2", 0.0),
+        ("CD2_1", 0.0), ("CD2_2", 5.0e-5)):
+        metadata.set(key, value)
+    return metadata
+
+class CalExpOverlapTestCase(unittest.TestCase):
+    """Test getCalExpFootprint and checkCalExpOverlap"""
+
+    def setUp(self):
+        self.task = MakeCoaddTempExpTask()
+        self.tractWcs = afwImage.makeWcs(makeWcsMetadata(200.0, 150.0))
+        # pixel (x, y) of the calexp is pixel (x + 100, y + 50) of the tract
+        calExpMetadata = makeWcsMetadata(100.0, 100.0)
+        calExpMetadata.set("NAXIS1", 40)
+        calExpMetadata.set("NAXIS2", 30)
+        self.calExpRef = FakeCalExpRef(calExpMetadata)
+
+    def tearDown(self):
+        del self.task
+        del self.tractWcs
+        del self.calExpRef
+
+    def testFootprint(self):
+        footprint = self.task.getCalExpFootprint(self.calExpRef, self.tractWcs)
+        self.assertEqual(len(footprint), 4)
+        predFootprint = [(99.5, 49.5), (139.5, 49.5), (139.5, 79.5), (99.5, 79.5)]
+        for (x, y) in footprint:
+            self.assertTrue(min(abs(x - predX) + abs(y - predY) for predX, predY in predFootprint) < 1.0e-5)
+
+        self.assertTrue(self.task.getCalExpFootprint(FakeCalExpRef(None), self.tractWcs) is None)
+        self.assertTrue(self.task.getCalExpFootprint(FakeCalExpRef(makeWcsMetadata(1.0, 1.0)),
+            self.tractWcs) is None)
+
+    def testCalExpOverlap(self):
+        """A calexp whose footprint only touches the patch edge does not overlap it"""
+        footprint = self.task.getCalExpFootprint(self.calExpRef, self.tractWcs)
+        touchBBox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Point2I(99, 99))
+        self.assertFalse(self.task.checkCalExpOverlap(self.calExpRef, footprint, touchBBox))
+        overlapBBox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Point2I(100, 99))
+        self.assertTrue(self.task.checkCalExpOverlap(self.calExpRef, footprint, overlapBBox))
+        cornerBBox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Point2I(99, 49))
+        self.assertFalse(self.task.checkCalExpOverlap(self.calExpRef, footprint, cornerBBox))
+        self.assertTrue(self.task.checkCalExpOverlap(self.calExpRef, None, touchBBox))
+
+    def testMinOverlapArea(self):
+        """Overlap must be more than minOverlapArea"""
+        # footprint overlaps the patch by 0.5 x 10 pixels
+        footprint = [(99.0, 10.0), (150.0, 10.0), (150.0, 20.0), (99.0, 20.0)]
+        patchBBox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Point2I(99, 99))
+        self.assertTrue(self.task.checkCalExpOverlap(self.calExpRef, footprint, patchBBox))
+        self.task.config.minOverlapArea = 4.9
+        self.assertTrue(self.task.checkCalExpOverlap(self.calExpRef, footprint, patchBBox))
+        self.task.config.minOverlapArea = 5.0
+        self.assertFalse(self.task.checkCalExpOverlap(self.calExpRef, footprint, patchBBox))
+
+class FakeFileDataRef(object):
+    """Data reference for datasets stored in files in one directory, named after the dataset type"""
+    def __init__(self, dirPath, dataId):
+        self.dirPath = dirPath
+        self.dataId = dataId
+        self.metadata = None
+
+    def datasetExists(self, datasetType):
+        return os.path.exists(os.path.join(self.dirPath, datasetType))
+
+    def get(self, datasetType, immediate=False):
+        if datasetType.endswith("_filename"):
+            return [os.path.join(self.dirPath, datasetType[:-len("_filename")])]
+        if datasetType.endswith("_md") and self.metadata is not None:
+            return self.metadata
+        raise RuntimeError("%s not found" % (datasetType,))
+
+class ProvenanceTestCase(unittest.TestCase):
+    """Test that makeProvenance and needTempExp skip up-to-date coaddTempExps and rebuild changed ones"""
+
+    def setUp(self):
+        self.dirPath = tempfile.mkdtemp()
+        for datasetType in ("calexp", "calexpBackground", "deepCoadd_tempExp"):
+            with open(os.path.join(self.dirPath, datasetType), "w") as outFile:
+                outFile.write("data")
+        self.calExpRefList = [FakeFileDataRef(self.dirPath, dict(visit=1, ccd=ccd)) for ccd in (1, 2)]
+        self.tempExpRef = FakeFileDataRef(self.dirPath, dict(visit=1, tract=0, patch="0,0"))
+        config = MakeCoaddTempExpTask.ConfigClass()
+        config.doIncremental = True
+        self.task = MakeCoaddTempExpTask(config=config)
+        self.setRecordedProvenance()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirPath)
+        del self.task
+
+    def setRecordedProvenance(self):
+        """Record the current provenance in the coaddTempExp metadata, as writeTempExp does"""
+        metadata = dafBase.PropertyList()
+        for name, value in self.task.makeProvenance(self.calExpRefList, doPsfMatch=False).iteritems():
+            metadata.set(name, value)
+        self.tempExpRef.metadata = metadata
+
+    def needTempExp(self):
+        provenance = self.task.makeProvenance(self.calExpRefList, doPsfMatch=False)
+        return self.task.needTempExp(self.tempExpRef, provenance)
+
+    def testSkip(self):
+        self.assertFalse(self.needTempExp())
+        self.task.config.doIncremental = False
+        self.task.config.doOverwrite = False
+        self.assertFalse(self.needTempExp())
+        self.task.config.doOverwrite = True
+        self.assertTrue(self.needTempExp())
+
+    def testInputChanged(self):
+        """Rebuild if the modification time or size of an input file changes"""
+        calExpPath = os.path.join(self.dirPath, "calexp")
+        fileStat = os.stat(calExpPath)
+        os.utime(calExpPath, (fileStat.st_atime, fileStat.st_mtime + 10))
+        self.assertTrue(self.needTempExp())
+        self.setRecordedProvenance()
+        self.assertFalse(self.needTempExp())
+
+        backgroundPath = os.path.join(self.dirPath, "calexpBackground")
+        fileStat = os.stat(backgroundPath)
+        with open(backgroundPath, "a") as outFile:
+            outFile.write("more data")
+        os.utime(backgroundPath, (fileStat.st_atime, fileStat.st_mtime))
+        self.assertTrue(self.needTempExp())
+
+    def testInputsChanged(self):
+        """Rebuild if the list of inputs changes or an input cannot be found"""
+        del self.calExpRefList[1]
+        self.assertTrue(self.needTempExp())
+        self.setRecordedProvenance()
+        self.assertFalse(self.needTempExp())
+        os.remove(os.path.join(self.dirPath, "calexpBackground"))
+        self.setRecordedProvenance()
+        self.assertTrue(self.needTempExp())
+
+    def testConfigChanged(self):
+        """Rebuild if a config item that affects the pixels changes"""
+        self.task.config.doCropTempExp = True
+        self.assertTrue(self.needTempExp())
+        self.task.config.doCropTempExp = False
+        self.assertFalse(self.needTempExp())
+        self.task.config.tempExpCompression.doCompress = True
+        self.assertTrue(self.needTempExp())
+
+    def testExecutionConfigChanged(self):
+        """Do not rebuild if only config items that control how coaddTempExps are made change"""
+        self.task.config.doIncremental = False
+        self.setRecordedProvenance()
+        self.task.config.doIncremental = True
+        self.assertFalse(self.needTempExp())
+        self.task.config.doOverwrite = False
+        self.task.config.numWarpProcesses = 4
+        self.task.config.maxPendingWarps = 3
+        self.task.config.doOrderPatches = True
+        self.assertFalse(self.needTempExp())
+
+class PatchOrderTestCase(unittest.TestCase):
+    """Test _getPatchOrderKey"""
+
+    def testSerpentine(self):
+        """Patches are grouped by tract and filter, and neighbors are adjacent"""
+        butler = FakeButler()
+        patchRefList = [butler.dataRef(datasetType="deepCoadd",
+            dataId=dict(tract=tract, patch=patch, filter="r"))
+            for tract in (1, 0) for patch in ("2,1", "0,0", "1,1", "2,0", "0,1", "1,0")]
+        patchRefList.append(butler.dataRef(datasetType="deepCoadd",
+            dataId=dict(tract=0, patch="0,0", filter="g")))
+        orderedIdList = [(ref.dataId["filter"], ref.dataId["tract"], ref.dataId["patch"])
+            for ref in sorted(patchRefList, key=_getPatchOrderKey)]
+        self.assertEqual(orderedIdList, [("g", 0, "0,0")] +
+            [("r", tract, patch) for tract in (0, 1) for patch in ("0,0", "1,0", "2,0", "2,1", "1,1", "0,1")])
+
+class MergeSelectionOrderTestCase(unittest.TestCase):
+    """Test _mergeSelectionOrder"""
+
+    def testConsistent(self):
+        self.assertEqual(_mergeSelectionOrder([["b", "d"], ["a", "b", "c"], ["c", "d", "e"]]),
+            ["a", "b", "c", "d", "e"])
+        self.assertEqual(_mergeSelectionOrder([]), [])
+
+    def testInconsistent(self):
+        """Keys in a cycle are placed in order of first appearance"""
+        self.assertEqual(_mergeSelectionOrder([["a", "b"], ["b", "a"]]), ["a", "b"])
+        self.assertEqual(_mergeSelectionOrder([["b", "c", "a"], ["a", "b"]]), ["b", "c", "a"])
+
+class RunTractTestCase(unittest.TestCase):
+    """Test that runTract warps each calexp once and gives the same coaddTempExps as run"""
+
+    def testRunTract(self):
+        butler = FakeButler()
+        patchRefList = [butler.dataRef(datasetType="deepCoadd", dataId=dict(tract=0, patch=patch))
+            for patch in ("0,0", "1,0")]
+        config = FakeTractTask.ConfigClass()
+        config.doPreFilterOverlap = False
+
+        tractTask = FakeTractTask(config=config)
+        tractResult = tractTask.runTract(patchRefList)
+        self.assertEqual(sorted(tractTask.warpedIdList), [(1, 1), (1, 2), (2, 1)])
+        self.assertEqual(len(tractResult.dataRefList), 4)
+
+        patchTask = FakeTractTask(config=config)
+        for patchRef in patchRefList:
+            patchTask.run(patchRef)
+        self.assertEqual(len(patchTask.warpedIdList), 5)
+
+        self.assertEqual(sorted(tractTask.tempExpDict.keys()), sorted(patchTask.tempExpDict.keys()))
+        for key, tractTempExp in tractTask.tempExpDict.iteritems():
+            patchTempExp = patchTask.tempExpDict[key]
+            tractMI = tractTempExp.getMaskedImage()
+            patchMI = patchTempExp.getMaskedImage()
+            self.assertEqual(tractMI.getBBox(afwImage.PARENT), patchMI.getBBox(afwImage.PARENT))
+            for getPlane in ("getImage", "getMask", "getVariance"):
+                tractArr = getattr(tractMI, getPlane)().getArray()
+                patchArr = getattr(patchMI, getPlane)().getArray()
+                bothNan = numpy.isnan(tractArr) & numpy.isnan(patchArr)
+                self.assertTrue(numpy.all((tractArr == patchArr) | bothNan))
+        # where calexps (1, 2) and (1, 1) overlap, (1, 1) is copied last, as it was selected last
+        tractArr = tractTask.tempExpDict[(1, "1,0")].getMaskedImage().getImage().getArray()
+        self.assertTrue(numpy.all(tractArr[:, 25 - 16:30 - 16] == 101))
+        self.assertTrue(numpy.all(tractArr[:, 30 - 16:] == 102))
+
+class ParallelWarpTestCase(unittest.TestCase):
+    """Test that warping calexps in worker processes gives the same results as warping them serially"""
+
+    def setUp(self):
+        butler = FakeButler()
+        self.calExpRefList = [butler.dataRef(datasetType="calexp", dataId=dict(visit=visit, ccd=1))
+            for visit in (1, 2, -1, 3, 4)]
+        self.tractWcs = makeTractWcs()
+        self.patchBBox = afwGeom.Box2I(afwGeom.Point2I(100, 200), afwGeom.Extent2I(20, 10))
+
+    def tearDown(self):
+        del self.calExpRefList
+        del self.tractWcs
+
+    def warpAll(self, numWarpProcesses):
+        """Warp all calexps twice (as for two coaddTempExps) and return (result list, task)"""
+        config = FakeWarpTask.ConfigClass()
+        config.numWarpProcesses = numWarpProcesses
+        config.maxPendingWarps = 2
+        task = FakeWarpTask(config=config)
+        resultList = []
+        try:
+            for i in range(2):
+                for calExpRef, exposure, expMetrics, warpError in task.iterWarpedCalExp(
+                    calExpRefList=self.calExpRefList, tractWcs=self.tractWcs, patchBBox=self.patchBBox,
+                    doPsfMatch=False):
+                    resultList.append((calExpRef, exposure, warpError))
+        finally:
+            task.closeWarpPool()
+        return resultList, task
+
+    def testParallel(self):
+        serialResultList, serialTask = self.warpAll(1)
+        parallelResultList, parallelTask = self.warpAll(2)
+        self.assertTrue(parallelTask._warpPool is None)
+        self.assertEqual(len(parallelResultList), 2 * len(self.calExpRefList))
+        for (serialRef, serialExp, serialError), (parallelRef, parallelExp, parallelError) \
+            in zip(serialResultList, parallelResultList):
+            self.assertTrue(serialRef is parallelRef)
+            if serialRef.dataId["visit"] < 0:
+                self.assertTrue(serialExp is None and parallelExp is None)
+                self.assertTrue(serialError is not None)
+                self.assertEqual(serialError, parallelError)
+                continue
+            self.assertTrue(parallelError is None)
+            serialMI = serialExp.getMaskedImage()
+            parallelMI = parallelExp.getMaskedImage()
+            self.assertEqual(serialMI.getBBox(afwImage.PARENT), parallelMI.getBBox(afwImage.PARENT))
+            self.assertTrue(numpy.all(serialMI.getImage().getArray() == parallelMI.getImage().getArray()))
+            self.assertTrue(numpy.all(serialMI.getMask().getArray() == parallelMI.getMask().getArray()))
+            self.assertTrue(numpy.all(
+                serialMI.getVariance().getArray() == parallelMI.getVariance().getArray()))
+            self.assertEqual(serialExp.getCalib().getFluxMag0(), parallelExp.getCalib().getFluxMag0())
+
+        # metadata added by the warpAndPsfMatch task in the workers is merged into this process
+        serialVisitList = list(serialTask.warpAndPsfMatch.metadata.getArray("warpedVisit"))
+        parallelVisitList = list(parallelTask.warpAndPsfMatch.metadata.getArray("warpedVisit"))
+        self.assertEqual(len(serialVisitList), 8)
+        self.assertEqual(sorted(parallelVisitList), sorted(serialVisitList))
+
+    def testDaemonic(self):
+        """A daemonic process (e.g. a TaskRunner worker) cannot start warp workers, so it warps serially"""
+        serialResultList = self.warpAll(1)[0]
+        process = multiprocessing.current_process()
+        process.daemon = True
+        try:
+            daemonResultList, daemonTask = self.warpAll(2)
+        finally:
+            process.daemon = False
+        self.assertTrue(daemonTask._warpPool is None)
+        self.assertEqual(len(daemonResultList), len(serialResultList))
+        for (serialRef, serialExp, serialError), (daemonRef, daemonExp, daemonError) \
+            in zip(serialResultList, daemonResultList):
+            self.assertTrue(serialRef is daemonRef)
+            self.assertEqual(serialError, daemonError)
+            if serialExp is not None:
+                self.assertTrue(numpy.all(serialExp.getMaskedImage().getImage().getArray() == \
+                    daemonExp.getMaskedImage().getImage().getArray()))
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(CalExpOverlapTestCase)
+    suites += unittest.makeSuite(ProvenanceTestCase)
+    suites += unittest.makeSuite(PatchOrderTestCase)
+    suites += unittest.makeSuite(MergeSelectionOrderTestCase)
+    suites += unittest.makeSuite(RunTractTestCase)
+    suites += unittest.makeSuite(ParallelWarpTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import os
+import tempfile
+import unittest
+
+import numpy
+
+import lsst.utils.tests as utilsTests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+from lsst.pipe.tasks.mappedExposure import MappedExposure, writeMappedExposure
+
+class MappedExposureTestCase(unittest.TestCase):
+    """Test writing and reading exposures in the memory-mappable layout"""
+
+    def setUp(self):
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(100, 200), afwGeom.Extent2I(60, 40))
+        self.exposure = afwImage.ExposureF(self.bbox)
+        maskedImage = self.exposure.getMaskedImage()
+        numpy.random.seed(1)
+        maskedImage.getImage().getArray()[:] = numpy.random.normal(size=(40, 60))
+        maskedImage.getMask().getArray()[:] = numpy.arange(60, dtype=numpy.uint16) % 4
+        maskedImage.getVariance().getArray()[:] = 2.5
+        self.exposure.getCalib().setFluxMag0(1.0e11, 1.0e9)
+        self.exposure.getMetadata().set("FOO", "bar")
+        self.exposure.getMetadata().set("NUM", 3)
+        fd, self.path = tempfile.mkstemp(suffix=".mmap")
+        os.close(fd)
+
+    def tearDown(self):
+        del self.exposure
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def testRoundTrip(self):
+        """Test that a whole exposure is read back unchanged"""
+        writeMappedExposure(self.exposure, self.path)
+        mappedExposure = MappedExposure(self.path)
+        self.assertEqual(mappedExposure.getBBox(), self.bbox)
+        exposure = mappedExposure.getExposure()
+        maskedImage = exposure.getMaskedImage()
+        origMI = self.exposure.getMaskedImage()
+        self.assertEqual(maskedImage.getBBox(afwImage.PARENT), self.bbox)
+        for plane, origPlane in ((maskedImage.getImage(), origMI.getImage()),
+            (maskedImage.getMask(), origMI.getMask()), (maskedImage.getVariance(), origMI.getVariance())):
+            self.assertTrue(numpy.all(plane.getArray() == origPlane.getArray()))
+        self.assertEqual(exposure.getCalib().getFluxMag0(), (1.0e11, 1.0e9))
+        self.assertEqual(exposure.getMetadata().get("FOO"), "bar")
+        self.assertEqual(exposure.getMetadata().get("NUM"), 3)
+
+    def testSubregion(self):
+        """Test that subregion arrays are views of the right pixels"""
+        writeMappedExposure(self.exposure, self.path)
+        mappedExposure = MappedExposure(self.path)
+        subBBox = afwGeom.Box2I(afwGeom.Point2I(110, 205), afwGeom.Extent2I(20, 10))
+        imageArr = mappedExposure.getArrays(subBBox)[0]
+        self.assertTrue(isinstance(imageArr, numpy.memmap))
+        origArr = self.exposure.getMaskedImage().getImage().getArray()[5:15, 10:30]
+        self.assertTrue(numpy.all(imageArr == origArr))
+        subExposure = mappedExposure.getExposure(subBBox)
+        self.assertEqual(subExposure.getMaskedImage().getBBox(afwImage.PARENT), subBBox)
+        self.assertTrue(numpy.all(subExposure.getMaskedImage().getImage().getArray() == origArr))
+
+        badBBox = afwGeom.Box2I(afwGeom.Point2I(90, 205), afwGeom.Extent2I(20, 10))
+        self.assertRaises(RuntimeError, mappedExposure.getArrays, badBBox)
+
+    def testNotMapped(self):
+        """Test that a file in another format is rejected"""
+        with open(self.path, "wb") as outFile:
+            outFile.write("SIMPLE  =                    T" + " " * 100)
+        self.assertRaises(RuntimeError, MappedExposure, self.path)
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(MappedExposureTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
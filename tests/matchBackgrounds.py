@@ -22,14 +22,17 @@
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
 
+import pickle
 import unittest
 import lsst.utils.tests as utilsTests
+import lsst.pipe.base as pipeBase
 import lsst.pipe.tasks as pipeTasks
 import lsst.afw.image as afwImage
 import lsst.afw.geom as afwGeom
 import lsst.afw.math as afwMath
 import numpy
-from lsst.pipe.tasks.matchBackgrounds import MatchBackgroundsTask
+from lsst.pipe.tasks.matchBackgrounds import MatchBackgroundsTask, BackgroundInfoCache, MatchedBackgroundModel
+from lsst.pipe.tasks.assembleCoadd import AssembleCoaddTask
 
 class MatchBackgroundsTestCase(unittest.TestCase):
     """Background Matching"""
@@ -308,6 +311,91 @@ class MatchBackgroundsTestCase(unittest.TestCase):
         self.assertRaises(RuntimeError, self.matcher.matchBackgrounds, self.vanilla, self.lowCover)
 
 
+class FakeBackground(object):
+    """A background model that renders a plane"""
+    def __init__(self, width, height):
+        self.image = afwImage.ImageF(width, height)
+        yArr, xArr = numpy.mgrid[0:height, 0:width]
+        self.image.getArray()[:,:] = 5.0 + 0.01 * xArr - 0.02 * yArr
+
+    def getImageF(self):
+        return self.image
+
+class FakeButler(object):
+    """A butler that holds one dataset, or that raises for an unknown dataset type"""
+    def __init__(self, dataset=None, isKnown=True):
+        self.dataset = dataset
+        self.isKnown = isKnown
+
+    def datasetExists(self, datasetType, dataId):
+        if not self.isKnown:
+            raise RuntimeError("Unknown dataset type %s" % (datasetType,))
+        return self.dataset is not None
+
+    def get(self, datasetType, dataId, immediate=False):
+        return self.dataset
+
+class BackgroundInfoCacheTestCase(unittest.TestCase):
+    """Test persistence and validation of background matching results"""
+
+    def setUp(self):
+        self.background = FakeBackground(300, 200)
+        self.expIdList = [dict(visit=1), dict(visit=2)]
+        self.expSignatureList = ["abc", "def"]
+        backgroundInfoList = [
+            pipeBase.Struct(isReference=True, backgroundModel=None, fitRMS=0.0, matchedMSE=None,
+                diffImVar=None),
+            pipeBase.Struct(isReference=False, backgroundModel=self.background, fitRMS=0.5,
+                matchedMSE=0.1, diffImVar=2.0),
+        ]
+        self.bgInfoCache = BackgroundInfoCache(self.expIdList, self.expSignatureList, "hash",
+            backgroundInfoList, binSize=32)
+
+    def tearDown(self):
+        del self.background
+        del self.bgInfoCache
+
+    def testModel(self):
+        """Test that the persisted model is compact and renders close to the original model"""
+        bgInfoCache = pickle.loads(pickle.dumps(self.bgInfoCache, pickle.HIGHEST_PROTOCOL))
+        backgroundInfoList = bgInfoCache.getBackgroundInfoList()
+        self.assertTrue(backgroundInfoList[0].isReference)
+        self.assertTrue(backgroundInfoList[0].backgroundModel is None)
+        self.assertEqual(backgroundInfoList[1].fitRMS, 0.5)
+        model = backgroundInfoList[1].backgroundModel
+        self.assertTrue(isinstance(model, MatchedBackgroundModel))
+        self.assertTrue(model.getNBytes() < self.background.getImageF().getArray().nbytes / 100)
+        modelArr = model.getImageF().getArray()
+        predArr = self.background.getImageF().getArray()
+        self.assertEqual(modelArr.shape, predArr.shape)
+        # bilinear interpolation of a plane is exact between the outermost bin centers
+        self.assertTrue(numpy.allclose(modelArr[16:-16, 16:-16], predArr[16:-16, 16:-16], atol=1e-4))
+        self.assertTrue(numpy.max(numpy.abs(modelArr - predArr)) < 0.02 * 16 + 0.01 * 16)
+
+    def testIsValid(self):
+        """Test that persisted results are only valid for the same, unchanged exposures and config"""
+        self.assertTrue(self.bgInfoCache.isValid([dict(visit=1), dict(visit=2)], ["abc", "def"], "hash"))
+        self.assertFalse(self.bgInfoCache.isValid([dict(visit=1), dict(visit=2)], ["abc", "def"], "other"))
+        self.assertFalse(self.bgInfoCache.isValid([dict(visit=2), dict(visit=1)], ["abc", "def"], "hash"))
+        self.assertFalse(self.bgInfoCache.isValid([dict(visit=1), dict(visit=2)], ["abc", "xyz"], "hash"))
+        bgInfoCache = BackgroundInfoCache(self.expIdList, ["abc", "unknown"], "hash",
+            self.bgInfoCache.getBackgroundInfoList(), binSize=32)
+        self.assertFalse(bgInfoCache.isValid(self.expIdList, ["abc", "unknown"], "hash"))
+        self.assertRaises(RuntimeError, BackgroundInfoCache, self.expIdList, ["abc"], "hash",
+            self.bgInfoCache.getBackgroundInfoList(), 32)
+
+    def testRead(self):
+        """Test AssembleCoaddTask.readBackgroundInfoList"""
+        task = AssembleCoaddTask()
+        patchId = dict(tract=0, patch="1,2", filter="r")
+        def read(butler, configHash="hash"):
+            return task.readBackgroundInfoList(butler, patchId, self.expIdList, self.expSignatureList,
+                configHash)
+        self.assertEqual(len(read(FakeButler(self.bgInfoCache))), 2)
+        self.assertTrue(read(FakeButler(self.bgInfoCache), configHash="other") is None)
+        self.assertTrue(read(FakeButler(None)) is None)
+        self.assertTrue(read(FakeButler(self.bgInfoCache, isKnown=False)) is None)
+
     
        
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
@@ -319,6 +407,7 @@ def suite():
 
     suites = []
     suites += unittest.makeSuite(MatchBackgroundsTestCase)
+    suites += unittest.makeSuite(BackgroundInfoCacheTestCase)
     suites += unittest.makeSuite(utilsTests.MemoryTestCase)
     return unittest.TestSuite(suites)
 
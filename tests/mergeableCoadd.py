@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import pickle
+import unittest
+import numpy
+import lsst.utils.tests as utilsTests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+from lsst.pipe.tasks.mergeableCoadd import MergeableCoadd
+
+class MergeableCoaddTestCase(unittest.TestCase):
+    """Test merging partial coadds"""
+
+    def setUp(self):
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(100, 200), afwGeom.Extent2I(60, 40))
+        metadata = afwImage.ExposureF(self.bbox).getMetadata()
+        for key, value in (("CTYPE1", "RA---TAN"), ("CTYPE2", "DEC--TAN"), ("CRPIX1", 130.0),
+            ("CRPIX2", 220.0), ("CRVAL1", 10.0), ("CRVAL2", 20.0), ("CD1_1", -5.0e-5), ("CD1_2", 0.0),
+            ("CD2_1", 0.0), ("CD2_2", 5.0e-5)):
+            metadata.set(key, value)
+        self.wcs = afwImage.makeWcs(metadata)
+        numpy.random.seed(3)
+        self.exposureList = []
+        for i in range(4):
+            exposure = afwImage.ExposureF(self.bbox, self.wcs)
+            maskedImage = exposure.getMaskedImage()
+            maskedImage.getImage().getArray()[:] = numpy.random.normal(100.0, 10.0, (40, 60))
+            maskedImage.getVariance().getArray()[:] = 100.0 * (i + 1)
+            maskedImage.getMask().getArray()[5 * i:5 * i + 3, 10:20] = afwImage.MaskU.getPlaneBitMask("SAT")
+            self.exposureList.append(exposure)
+
+    def tearDown(self):
+        del self.wcs
+        del self.exposureList
+
+    def makeCoadd(self, exposureList):
+        coadd = MergeableCoadd(bbox=self.bbox, wcs=self.wcs, badMaskPlanes=("EDGE", "SAT"))
+        for exposure in exposureList:
+            coadd.addExposure(exposure)
+        return coadd
+
+    def testMerge(self):
+        """Test that merging partial coadds matches a coadd of all exposures"""
+        # every pixel is good in at least three exposures, so the coadd has no NaNs
+        fullCoadd = self.makeCoadd(self.exposureList)
+        mergedCoadd = self.makeCoadd([])
+        partialCoaddList = [self.makeCoadd(self.exposureList[0::2]), self.makeCoadd(self.exposureList[1::2])]
+        for partialCoadd in partialCoaddList:
+            # partial data is returned from worker processes, so must survive pickling
+            mergedCoadd.mergePartialData(pickle.loads(pickle.dumps(partialCoadd.getPartialData())))
+
+        fullMI = fullCoadd.getCoadd().getMaskedImage()
+        mergedMI = mergedCoadd.getCoadd().getMaskedImage()
+        self.assertTrue(numpy.all(mergedMI.getMask().getArray() == fullMI.getMask().getArray()))
+        for getPlane in (lambda mi: mi.getImage(), lambda mi: mi.getVariance()):
+            self.assertTrue(numpy.allclose(getPlane(mergedMI).getArray(), getPlane(fullMI).getArray(),
+                rtol=1e-6))
+        self.assertTrue(numpy.allclose(mergedCoadd.getWeightMap().getArray(),
+            fullCoadd.getWeightMap().getArray(), rtol=1e-6))
+
+    def testBBoxMismatch(self):
+        """Test that merging a partial coadd with a different bbox fails"""
+        coadd = self.makeCoadd(self.exposureList[0:1])
+        partialData = coadd.getPartialData()
+        partialData["bbox"] = (0, 0, 60, 40)
+        self.assertRaises(RuntimeError, coadd.mergePartialData, partialData)
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(MergeableCoaddTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import unittest
+import lsst.utils.tests as utilsTests
+from lsst.pipe.tasks.overlap import clipPolygonToBox, polygonArea, polygonBoxOverlapArea, \
+    sphericalPolygonArea, sphericalPolygonOverlapArea
+
+class OverlapTestCase(unittest.TestCase):
+    """Test polygon overlap utilities"""
+
+    def setUp(self):
+        self.square = [(0, 0), (10, 0), (10, 10), (0, 10)]
+        self.diamond = [(5, 0), (10, 5), (5, 10), (0, 5)]
+
+    def testArea(self):
+        """Test polygonArea for both orientations"""
+        self.assertAlmostEqual(polygonArea(self.square), 100.0)
+        self.assertAlmostEqual(polygonArea(self.square[::-1]), 100.0)
+        self.assertAlmostEqual(polygonArea(self.diamond), 50.0)
+
+    def testContained(self):
+        """Test a polygon entirely inside the box"""
+        self.assertAlmostEqual(polygonBoxOverlapArea(self.square, (-1, -1, 11, 11)), 100.0)
+        self.assertAlmostEqual(polygonBoxOverlapArea(self.diamond, (0, 0, 10, 10)), 50.0)
+
+    def testPartial(self):
+        """Test a polygon that partly overlaps the box"""
+        self.assertAlmostEqual(polygonBoxOverlapArea(self.square, (5, 5, 20, 20)), 25.0)
+        self.assertAlmostEqual(polygonBoxOverlapArea(self.diamond, (0, 0, 5, 5)), 12.5)
+        self.assertAlmostEqual(polygonBoxOverlapArea(self.diamond[::-1], (5, 5, 100, 100)), 12.5)
+
+    def testDisjoint(self):
+        """Test a polygon that does not overlap the box"""
+        self.assertEqual(clipPolygonToBox(self.square, (20, 20, 30, 30)), [])
+        self.assertEqual(polygonBoxOverlapArea(self.square, (20, 20, 30, 30)), 0.0)
+        # bounding boxes overlap, but the diamond does not reach the corner
+        self.assertAlmostEqual(polygonBoxOverlapArea(self.diamond, (8, 8, 12, 12)), 0.0)
+
+class SphericalOverlapTestCase(unittest.TestCase):
+    """Test spherical polygon overlap utilities"""
+
+    def setUp(self):
+        self.square = [(0, 0), (1, 0), (1, 1), (0, 1)]
+        self.sqArcsecPerSqDeg = 3600.0**2
+
+    def testArea(self):
+        """Test sphericalPolygonArea, including vertices that are not in order"""
+        for square in (self.square, self.square[::-1], [(0, 0), (1, 1), (1, 0), (0, 1)]):
+            self.assertAlmostEqual(sphericalPolygonArea(square) / self.sqArcsecPerSqDeg, 1.0, places=3)
+        # a square around the north pole, 2 degrees on a side
+        polarSquare = [(45, 89), (135, 89), (225, 89), (315, 89)]
+        self.assertAlmostEqual(sphericalPolygonArea(polarSquare) / self.sqArcsecPerSqDeg, 2.0, places=3)
+
+    def testPartial(self):
+        """Test polygons that partly overlap, including across RA = 0"""
+        offsetSquare = [(0.5, 0.5), (1.5, 0.5), (1.5, 1.5), (0.5, 1.5)]
+        self.assertAlmostEqual(sphericalPolygonOverlapArea(self.square, offsetSquare) / self.sqArcsecPerSqDeg,
+            0.25, places=3)
+        wrapSquare = [(359.5, 0), (0.5, 0), (0.5, 1), (359.5, 1)]
+        self.assertAlmostEqual(sphericalPolygonOverlapArea(wrapSquare, self.square) / self.sqArcsecPerSqDeg,
+            0.5, places=3)
+
+    def testDisjoint(self):
+        """Test polygons that do not overlap, including ones whose RA, Dec boxes overlap"""
+        self.assertEqual(sphericalPolygonOverlapArea(self.square, [(2, 2), (3, 2), (3, 3), (2, 3)]), 0.0)
+        diamond = [(0.5, 0), (1, 0.5), (0.5, 1), (0, 0.5)]
+        self.assertEqual(sphericalPolygonOverlapArea(diamond, [(0.8, 0.8), (2, 0.8), (2, 2), (0.8, 2)]), 0.0)
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(OverlapTestCase)
+    suites += unittest.makeSuite(SphericalOverlapTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
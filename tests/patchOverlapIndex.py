@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+import lsst.utils.tests as utilsTests
+from lsst.pipe.tasks.patchOverlapIndex import PatchOverlapIndex, getCoaddId
+
+class PatchOverlapIndexTestCase(unittest.TestCase):
+    """Test PatchOverlapIndex"""
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.indexPath = os.path.join(self.tempDir, "patchOverlapIndex.sqlite3")
+        self.coaddId = getCoaddId(dict(tract=0, patch="1,2", filter="r"))
+        index = PatchOverlapIndex(self.indexPath, create=True)
+        index.addExposure(dict(visit=1, ccd=0), self.coaddId, [(0, (1, 2), 0.5, 1.0)])
+        index.addExposure(dict(visit=1, ccd=1), self.coaddId, [(0, (1, 2), 0.25, 0.6), (0, (2, 2), 0.2, 0.4)])
+        index.addExposure(dict(visit=2, ccd=0), dict(filter="i"), [(0, (1, 2), 0.5, 1.0)])
+        index.addExposure(dict(visit=3, ccd=0), self.coaddId, [])
+        index.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir, ignore_errors=True)
+
+    def testCoaddId(self):
+        self.assertEqual(self.coaddId, dict(filter="r"))
+
+    def testPatchExposures(self):
+        """Test looking up the calexps that overlap a patch"""
+        index = PatchOverlapIndex(self.indexPath)
+        try:
+            resultList = index.getPatchExposures(0, (1, 2), self.coaddId)
+            self.assertEqual([dataId for dataId, patchFraction, expFraction in resultList],
+                [dict(visit=1, ccd=0), dict(visit=1, ccd=1)])
+            self.assertTrue(isinstance(resultList[0][0].keys()[0], str))
+            self.assertEqual(len(index.getPatchExposures(0, (1, 2), self.coaddId, minPatchFraction=0.3)), 1)
+            self.assertEqual(len(index.getPatchExposures(0, (2, 2), self.coaddId)), 1)
+            self.assertEqual(len(index.getPatchExposures(0, (1, 2), dict(filter="i"))), 1)
+            self.assertEqual(len(index.getPatchExposures(1, (1, 2), self.coaddId)), 0)
+        finally:
+            index.close()
+
+    def testExposurePatches(self):
+        """Test looking up the patches that a calexp overlaps"""
+        index = PatchOverlapIndex(self.indexPath)
+        try:
+            self.assertEqual(index.getExposurePatches(dict(ccd=1, visit=1)),
+                [(0, (1, 2), 0.25, 0.6), (0, (2, 2), 0.2, 0.4)])
+            self.assertEqual(index.getExposurePatches(dict(visit=3, ccd=0)), [])
+            self.assertTrue(index.hasExposure(dict(visit=3, ccd=0)))
+            self.assertFalse(index.hasExposure(dict(visit=4, ccd=0)))
+        finally:
+            index.close()
+
+    def testReplace(self):
+        """Test that adding a calexp that is already indexed replaces its overlaps"""
+        index = PatchOverlapIndex(self.indexPath)
+        try:
+            index.addExposure(dict(visit=1, ccd=1), self.coaddId, [(0, (3, 3), 0.1, 1.0)])
+            self.assertEqual(index.getExposurePatches(dict(visit=1, ccd=1)), [(0, (3, 3), 0.1, 1.0)])
+            self.assertEqual(len(index.getPatchExposures(0, (1, 2), self.coaddId)), 1)
+        finally:
+            index.close()
+
+    def testNotAnIndex(self):
+        """Test that opening a missing index without create fails"""
+        self.assertRaises(RuntimeError, PatchOverlapIndex, os.path.join(self.tempDir, "missing.sqlite3"))
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(PatchOverlapIndexTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
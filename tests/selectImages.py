@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import unittest
+import lsst.utils.tests as utilsTests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.pipe.base as pipeBase
+import lsst.pipe.tasks.selectImages as selectImages
+from lsst.pipe.tasks.exposureInfoTable import ExposureInfoTable
+from lsst.pipe.tasks.selectImages import BaseSelectImagesConfig, BaseSelectImagesTask, BaseExposureInfo, \
+    BadSelectImagesTask
+
+class FakePatchInfo(object):
+    def __init__(self, index, outerBBox):
+        self._index = index
+        self._outerBBox = outerBBox
+
+    def getIndex(self):
+        return self._index
+
+    def getOuterBBox(self):
+        return self._outerBBox
+
+class FakeTractInfo(object):
+    """A tract of 4x3 patches, each with inner dimensions 100x100 and a border of 10 pixels"""
+    def __init__(self, wcs):
+        self._wcs = wcs
+
+    def getWcs(self):
+        return self._wcs
+
+    def getBBox(self):
+        return afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(400, 300))
+
+    def getNumPatches(self):
+        return afwGeom.Extent2I(4, 3)
+
+    def getPatchInnerDimensions(self):
+        return afwGeom.Extent2I(100, 100)
+
+    def getPatchBorder(self):
+        return 10
+
+    def getPatchInfo(self, index):
+        bbox = afwGeom.Box2I(afwGeom.Point2I(index[0] * 100 - 10, index[1] * 100 - 10),
+            afwGeom.Extent2I(120, 120))
+        return FakePatchInfo(index, bbox)
+
+class FakeExposureInfo(BaseExposureInfo):
+    def __init__(self, ccd, coordList, expectedWeight=None):
+        BaseExposureInfo.__init__(self)
+        self.dataId = dict(ccd=ccd)
+        self.coordList = coordList
+        self.expectedWeight = expectedWeight
+
+class FakeSelectImagesTask(BaseSelectImagesTask):
+    """Select exposures from a fixed list, ignoring the region"""
+    ConfigClass = BaseSelectImagesConfig
+
+    def __init__(self, exposureInfoList, config=None):
+        BaseSelectImagesTask.__init__(self, config=config)
+        self.exposureInfoList = exposureInfoList
+        self.numRuns = 0
+
+    def run(self, coordList):
+        self.numRuns += 1
+        return pipeBase.Struct(exposureInfoList = self.exposureInfoList)
+
+    def _runArgDictFromDataId(self, dataId):
+        return dict()
+
+class FakeDataRef(object):
+    def __init__(self):
+        self.dataId = dict(tract=0, patch="0,0")
+
+class TractTestCaseBase(unittest.TestCase):
+    """Base class for tests that select exposures for the patches of a FakeTractInfo"""
+
+    def setUp(self):
+        metadata = afwImage.ExposureF(10, 10).getMetadata()
+        for key, value in (("CTYPE1", "RA---TAN"), ("CTYPE2", "DEC--TAN"), ("CRPIX1", 200.0),
+            ("CRPIX2", 150.0), ("CRVAL1", 10.0), ("CRVAL2", 20.0), ("CD1_1", -5.0e-5), ("CD1_2", 0.0),
+            ("CD2_1", 0.0), ("CD2_2", 5.0e-5)):
+            metadata.set(key, value)
+        self.tractInfo = FakeTractInfo(afwImage.makeWcs(metadata))
+
+    def tearDown(self):
+        del self.tractInfo
+
+    def makeExposureInfo(self, ccd, minX, minY, maxX, maxY):
+        """Make exposure info for an exposure covering a box in tract pixels"""
+        box = afwGeom.Box2D(afwGeom.Point2D(minX, minY), afwGeom.Point2D(maxX, maxY))
+        return self.makePolygonExposureInfo(ccd, [(pos.getX(), pos.getY()) for pos in box.getCorners()])
+
+    def makePolygonExposureInfo(self, ccd, posList):
+        """Make exposure info for an exposure with corners at the specified tract pixel positions"""
+        coordList = [self.tractInfo.getWcs().pixelToSky(afwGeom.Point2D(*pos)) for pos in posList]
+        return FakeExposureInfo(ccd, coordList)
+
+class RunTractTestCase(TractTestCaseBase):
+    """Test BaseSelectImagesTask.runTractDataRef"""
+
+    def testPatchAssignment(self):
+        """Test that each exposure is assigned to the patches whose outer bbox it overlaps"""
+        exposureInfoList = [
+            self.makeExposureInfo(0, 20, 20, 80, 80), # inner region of patch (0, 0)
+            self.makeExposureInfo(1, 95, 20, 150, 80), # overlaps outer bboxes of (0, 0) and (1, 0)
+            self.makeExposureInfo(2, 250, 150, 380, 280), # overlaps (2..3, 1..2)
+        ]
+        task = FakeSelectImagesTask(exposureInfoList)
+        result = task.runTractDataRef(FakeDataRef(), self.tractInfo, makeDataRefList=False)
+        self.assertEqual(task.numRuns, 1)
+        self.assertEqual(len(result.patchExposureInfoListDict), 12)
+        self.assertTrue(result.patchDataRefListDict is None)
+        ccdListDict = dict((patchIndex, [expInfo.dataId["ccd"] for expInfo in expInfoList])
+            for patchIndex, expInfoList in result.patchExposureInfoListDict.iteritems())
+        self.assertEqual(ccdListDict[(0, 0)], [0, 1])
+        self.assertEqual(ccdListDict[(1, 0)], [1])
+        self.assertEqual(ccdListDict[(2, 0)], [])
+        self.assertEqual(ccdListDict[(2, 1)], [2])
+        self.assertEqual(ccdListDict[(3, 2)], [2])
+        self.assertEqual(ccdListDict[(1, 1)], [])
+
+        result = task.runTractDataRef(FakeDataRef(), self.tractInfo, patchIndexList=[(0, 0), (3, 2)],
+            makeDataRefList=False)
+        self.assertEqual(sorted(result.patchExposureInfoListDict.keys()), [(0, 0), (3, 2)])
+        self.assertEqual(len(result.patchExposureInfoListDict[(3, 2)]), 1)
+
+    def testExactOverlap(self):
+        """Test that an exposure whose bbox, but not footprint, overlaps a patch is rejected"""
+        # a diamond whose bbox overlaps the outer bbox of patch (0, 0) but whose edge misses its corner
+        exposureInfoList = [self.makePolygonExposureInfo(0, [(130, 100), (160, 130), (130, 160), (100, 130)])]
+        patchIndexList = [(0, 0), (1, 0), (1, 1)]
+        patchCoordList = [self.tractInfo.getWcs().pixelToSky(pos)
+            for pos in afwGeom.Box2D(self.tractInfo.getPatchInfo((0, 0)).getOuterBBox()).getCorners()]
+        self.assertFalse(BaseSelectImagesConfig().doExactOverlap)
+        for expInfoList in (exposureInfoList, ExposureInfoTable.fromExposureInfoList(exposureInfoList)):
+            for doExactOverlap in (False, True):
+                config = BaseSelectImagesConfig()
+                config.doExactOverlap = doExactOverlap
+                task = FakeSelectImagesTask(expInfoList, config=config)
+                result = task.runTractDataRef(FakeDataRef(), self.tractInfo, patchIndexList=patchIndexList,
+                    makeDataRefList=False)
+                numListDict = dict((patchIndex, len(patchExpInfoList))
+                    for patchIndex, patchExpInfoList in result.patchExposureInfoListDict.iteritems())
+                self.assertEqual(numListDict, {(0, 0): 0 if doExactOverlap else 1, (1, 0): 1, (1, 1): 1})
+                numSelected = len(task.runDataRef(FakeDataRef(), patchCoordList, makeDataRefList=False)
+                    .exposureInfoList)
+                self.assertEqual(numSelected, 0 if doExactOverlap else 1)
+
+    def testExactOverlapCandidates(self):
+        """Test that with doExactOverlap each patch is only tested against its candidate exposures"""
+        exposureInfoList = [
+            self.makeExposureInfo(0, 20, 20, 80, 80), # inner region of patch (0, 0)
+            self.makeExposureInfo(1, 95, 20, 150, 80), # overlaps outer bboxes of (0, 0) and (1, 0)
+            self.makeExposureInfo(2, 250, 150, 380, 280), # overlaps (2..3, 1..2)
+        ]
+        exposureInfoTable = ExposureInfoTable.fromExposureInfoList(exposureInfoList)
+        numTestedList = []
+        getOverlapMask = exposureInfoTable.getOverlapMask
+        def countingOverlapMask(raDecList, indices=None):
+            numTestedList.append(len(exposureInfoTable) if indices is None else len(indices))
+            return getOverlapMask(raDecList, indices)
+        exposureInfoTable.getOverlapMask = countingOverlapMask
+
+        config = BaseSelectImagesConfig()
+        config.doExactOverlap = True
+        task = FakeSelectImagesTask(exposureInfoTable, config=config)
+        result = task.runTractDataRef(FakeDataRef(), self.tractInfo, makeDataRefList=False)
+        ccdListDict = dict((patchIndex, [expInfo.dataId["ccd"] for expInfo in expInfoList])
+            for patchIndex, expInfoList in result.patchExposureInfoListDict.iteritems())
+        self.assertEqual(ccdListDict[(0, 0)], [0, 1])
+        self.assertEqual(ccdListDict[(1, 0)], [1])
+        self.assertEqual(ccdListDict[(2, 1)], [2])
+        self.assertEqual(ccdListDict[(1, 1)], [])
+        # 2 candidates for patch (0, 0), 1 for (1, 0) and 1 for each of the 4 patches that exposure 2 overlaps
+        self.assertEqual(sum(numTestedList), 7)
+
+    def testOverlapPreTest(self):
+        """Test that the area of overlap is only computed when needed, for lists and tables alike"""
+        exposureInfoList = [
+            self.makeExposureInfo(0, 20, 20, 80, 80), # inside the outer bbox of patch (0, 0)
+            self.makePolygonExposureInfo(1, [(130, 100), (160, 130), (130, 160), (100, 130)]), # misses it
+            self.makeExposureInfo(2, 100, 100, 150, 150), # overlaps its corner, which is at 109.5, 109.5
+            self.makeExposureInfo(3, 200, 200, 250, 250), # far away
+        ]
+        regionRaDecList = selectImages._getRaDecList([self.tractInfo.getWcs().pixelToSky(pos)
+            for pos in afwGeom.Box2D(self.tractInfo.getPatchInfo((0, 0)).getOuterBBox()).getCorners()])
+        areaArgList = []
+        sphericalPolygonOverlapArea = selectImages.sphericalPolygonOverlapArea
+        def countingOverlapArea(raDecList, clipRaDecList):
+            areaArgList.append(raDecList)
+            return sphericalPolygonOverlapArea(raDecList, clipRaDecList)
+        selectImages.sphericalPolygonOverlapArea = countingOverlapArea
+        try:
+            config = BaseSelectImagesConfig()
+            task = FakeSelectImagesTask(exposureInfoList, config=config)
+            exposureInfoTable = ExposureInfoTable.fromExposureInfoList(exposureInfoList)
+            for expInfoList in (exposureInfoList, exposureInfoTable):
+                self.assertEqual(task._getOverlapIndices(expInfoList, regionRaDecList), [0, 2])
+            self.assertEqual(len(areaArgList), 0)
+
+            # 9.5x9.5 pixels of 0.18 arcsec is 2.92 arcsec^2
+            config.minOverlapArea = 2.5
+            for expInfoList in (exposureInfoList, exposureInfoTable):
+                del areaArgList[:]
+                self.assertEqual(task._getOverlapIndices(expInfoList, regionRaDecList), [0, 2])
+                self.assertEqual(len(areaArgList), 2)
+            config.minOverlapArea = 3.5
+            self.assertEqual(task._getOverlapIndices(exposureInfoList, regionRaDecList), [0])
+        finally:
+            selectImages.sphericalPolygonOverlapArea = sphericalPolygonOverlapArea
+
+    def testMaxExposuresPerPatch(self):
+        """Test that only the exposures with the largest expected weight are kept for each patch"""
+        exposureInfoList = []
+        for ccd, weight in enumerate((1.0, None, 3.0, 2.0)):
+            exposureInfo = self.makeExposureInfo(ccd, 20, 20, 80, 80) # inner region of patch (0, 0)
+            exposureInfo.expectedWeight = weight
+            exposureInfoList.append(exposureInfo)
+        exposureInfoList.append(self.makeExposureInfo(4, 250, 150, 280, 180)) # patch (2, 1)
+        config = BaseSelectImagesConfig()
+        config.maxExposuresPerPatch = 2
+        task = FakeSelectImagesTask(exposureInfoList, config=config)
+        result = task.runTractDataRef(FakeDataRef(), self.tractInfo, makeDataRefList=False)
+        ccdListDict = dict((patchIndex, [expInfo.dataId["ccd"] for expInfo in expInfoList])
+            for patchIndex, expInfoList in result.patchExposureInfoListDict.iteritems())
+        self.assertEqual(ccdListDict[(0, 0)], [2, 3])
+        self.assertEqual(ccdListDict[(2, 1)], [4])
+
+        config.maxExposuresPerPatch = 4
+        result = task.runDataRef(FakeDataRef(), None, makeDataRefList=False)
+        # ccd 1 and 4 have unknown weight, so ccd 1 is kept by order
+        self.assertEqual([expInfo.dataId["ccd"] for expInfo in result.exposureInfoList], [0, 1, 2, 3])
+
+        del exposureInfoList[0].expectedWeight
+        self.assertRaises(RuntimeError, task.runDataRef, FakeDataRef(), None, makeDataRefList=False)
+
+class SelectIndexedTestCase(TractTestCaseBase):
+    """Test BaseSelectImagesTask.selectIndexed"""
+
+    def makeCandidateListDict(self):
+        """Make candidates as found in a patch overlap index
+
+        Pixels are 0.18 arcsec, so the outer bbox of a patch covers 466.56 arcsec^2
+        """
+        return {
+            (0, 0): [(dict(ccd=0), 0.5), (dict(ccd=1), 0.1), (dict(ccd=2), 0.5), (dict(ccd=3), 0.5)],
+            (1, 0): [(dict(ccd=1), 0.4)],
+            (2, 2): [],
+        }
+
+    def makeTask(self, config):
+        """Make a select task that returns ccds 0-2 (not 3) with expected weights"""
+        exposureInfoList = []
+        for ccd, weight in enumerate((1.0, 3.0, 2.0)):
+            exposureInfo = self.makeExposureInfo(ccd, 20, 20, 80, 80)
+            exposureInfo.expectedWeight = weight
+            exposureInfoList.append(exposureInfo)
+        return FakeSelectImagesTask(exposureInfoList, config=config)
+
+    def getCcdListDict(self, patchDataIdListDict):
+        return dict((patchIndex, [dataId["ccd"] for dataId in dataIdList])
+            for patchIndex, dataIdList in patchDataIdListDict.iteritems())
+
+    def testRunCuts(self):
+        """Test that candidates not returned by run are rejected, with a single call to run"""
+        task = self.makeTask(BaseSelectImagesConfig())
+        result = task.selectIndexed(FakeDataRef(), self.tractInfo, self.makeCandidateListDict())
+        self.assertEqual(task.numRuns, 1)
+        self.assertEqual(self.getCcdListDict(result), {(0, 0): [0, 1, 2], (1, 0): [1], (2, 2): []})
+
+    def testMinOverlapArea(self):
+        """Test that minOverlapArea is applied to the overlaps in the index if doExactOverlap is True"""
+        for doExactOverlap in (False, True):
+            config = BaseSelectImagesConfig()
+            config.doExactOverlap = doExactOverlap
+            config.minOverlapArea = 100.0
+            task = self.makeTask(config)
+            result = task.selectIndexed(FakeDataRef(), self.tractInfo, self.makeCandidateListDict())
+            self.assertEqual(self.getCcdListDict(result)[(0, 0)], [0, 2] if doExactOverlap else [0, 1, 2])
+
+    def testMaxExposuresPerPatch(self):
+        """Test that only the exposures with the largest expected weight are kept for each patch"""
+        config = BaseSelectImagesConfig()
+        config.maxExposuresPerPatch = 2
+        task = self.makeTask(config)
+        result = task.selectIndexed(FakeDataRef(), self.tractInfo, self.makeCandidateListDict())
+        self.assertEqual(self.getCcdListDict(result), {(0, 0): [1, 2], (1, 0): [1], (2, 2): []})
+
+    def testPlaceholder(self):
+        """Test that BadSelectImagesTask only applies the overlap cuts"""
+        config = BaseSelectImagesConfig()
+        config.doExactOverlap = True
+        config.minOverlapArea = 100.0
+        task = BadSelectImagesTask(config=config)
+        result = task.selectIndexed(FakeDataRef(), self.tractInfo, self.makeCandidateListDict())
+        self.assertEqual(self.getCcdListDict(result), {(0, 0): [0, 2, 3], (1, 0): [1], (2, 2): []})
+
+        config.maxExposuresPerPatch = 2
+        self.assertRaises(RuntimeError, task.selectIndexed, FakeDataRef(), self.tractInfo,
+            self.makeCandidateListDict())
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(RunTractTestCase)
+    suites += unittest.makeSuite(SelectIndexedTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
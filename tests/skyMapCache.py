@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import lsst.utils.tests as utilsTests
+from lsst.pipe.tasks.skyMapCache import getSkyMap, clearSkyMapCache
+
+class FakeDataRef(object):
+    """A minimal data reference that reads pickled "sky maps" from a directory and counts reads"""
+    def __init__(self, rootDir):
+        self.rootDir = rootDir
+        self.numReads = 0
+
+    def get(self, datasetType, immediate=False):
+        if datasetType.endswith("_filename"):
+            return [os.path.join(self.rootDir, datasetType[:-len("_filename")] + ".pickle")]
+        self.numReads += 1
+        with open(os.path.join(self.rootDir, datasetType + ".pickle"), "rb") as inFile:
+            return pickle.load(inFile)
+
+class SkyMapCacheTestCase(unittest.TestCase):
+    """Test getSkyMap"""
+
+    def setUp(self):
+        clearSkyMapCache()
+        self.rootDir = tempfile.mkdtemp()
+        self.dataRef = FakeDataRef(self.rootDir)
+        self.writeSkyMap("deepCoadd_skyMap", ["tract0", "tract1"])
+
+    def tearDown(self):
+        clearSkyMapCache()
+        shutil.rmtree(self.rootDir, ignore_errors=True)
+
+    def writeSkyMap(self, datasetType, skyMap):
+        with open(os.path.join(self.rootDir, datasetType + ".pickle"), "wb") as outFile:
+            pickle.dump(skyMap, outFile)
+
+    def testCache(self):
+        """Test that a sky map is read once"""
+        skyMap = getSkyMap(self.dataRef, "deepCoadd_skyMap")
+        self.assertEqual(skyMap, ["tract0", "tract1"])
+        self.assertTrue(getSkyMap(FakeDataRef(self.rootDir), "deepCoadd_skyMap") is skyMap)
+        self.assertEqual(self.dataRef.numReads, 1)
+
+    def testDatasetTypes(self):
+        """Test that different sky map datasets are cached separately"""
+        self.writeSkyMap("goodSeeingCoadd_skyMap", ["tract2"])
+        self.assertEqual(getSkyMap(self.dataRef, "deepCoadd_skyMap"), ["tract0", "tract1"])
+        self.assertEqual(getSkyMap(self.dataRef, "goodSeeingCoadd_skyMap"), ["tract2"])
+        self.assertEqual(getSkyMap(self.dataRef, "deepCoadd_skyMap"), ["tract0", "tract1"])
+        self.assertEqual(self.dataRef.numReads, 2)
+
+    def testStale(self):
+        """Test that a sky map is reread if its file changes"""
+        getSkyMap(self.dataRef, "deepCoadd_skyMap")
+        self.writeSkyMap("deepCoadd_skyMap", ["tract0", "tract1", "tract2"])
+        self.assertEqual(getSkyMap(self.dataRef, "deepCoadd_skyMap"), ["tract0", "tract1", "tract2"])
+        self.assertEqual(self.dataRef.numReads, 2)
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(SkyMapCacheTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import lsst.utils.tests as utilsTests
+import lsst.afw.coord as afwCoord
+import lsst.afw.geom as afwGeom
+from lsst.pipe.tasks.sqliteSelectImages import CalexpIndex, SqliteExposureInfo, getRaDecBox, \
+    makeSqliteExposureInfoTable
+
+def makeCoordList(raDecList):
+    """Make a list of IcrsCoord from a list of (RA, Dec) (deg)"""
+    return [afwCoord.IcrsCoord(afwGeom.Angle(ra, afwGeom.degrees), afwGeom.Angle(dec, afwGeom.degrees))
+        for ra, dec in raDecList]
+
+def makeBoxRaDecList(minRa, maxRa, minDec, maxDec):
+    """Return the corners of an RA, Dec box, in order"""
+    return [(minRa, minDec), (maxRa, minDec), (maxRa, maxDec), (minRa, maxDec)]
+
+class RaDecBoxTestCase(unittest.TestCase):
+    """Test getRaDecBox"""
+
+    def testSimple(self):
+        box = getRaDecBox(makeBoxRaDecList(10.0, 11.0, -5.0, -4.0))
+        for val, predVal in zip(box, (10.0, 11.0, -5.0, -4.0)):
+            self.assertAlmostEqual(val, predVal)
+
+    def testWrap(self):
+        """Test a polygon that straddles RA = 0"""
+        box = getRaDecBox(makeBoxRaDecList(359.5, 0.5, 10.0, 11.0))
+        for val, predVal in zip(box, (359.5, 360.5, 10.0, 11.0)):
+            self.assertAlmostEqual(val, predVal)
+
+    def testPole(self):
+        """Test a polygon that contains the north pole"""
+        box = getRaDecBox([(0.0, 89.0), (90.0, 89.0), (180.0, 89.0), (270.0, 89.0)])
+        self.assertEqual(box, (0.0, 360.0, 89.0, 90.0))
+
+
+class CalexpIndexTestCase(unittest.TestCase):
+    """Test CalexpIndex"""
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.indexPath = os.path.join(self.tempDir, "calexpIndex.sqlite3")
+        index = CalexpIndex(self.indexPath, create=True)
+        # visit 1 is near RA=0 in r, visit 2 is at RA=180 in i with unknown FWHM, zero point and sky
+        for ccd, (minRa, maxRa), fwhm, fluxMag0 in ((0, (359.6, 359.9), 0.7, 100.0),
+            (1, (359.9, 0.2), 0.9, 50.0)):
+            index.addExposure(dict(visit=1, ccd=ccd), "r", 1, fwhm,
+                makeCoordList(makeBoxRaDecList(minRa, maxRa, 0.0, 0.2)), fluxMag0=fluxMag0, skyLevel=10.0)
+        index.addExposure(dict(visit=2, ccd=0), "i", 2, None,
+            makeCoordList(makeBoxRaDecList(180.0, 180.3, 0.0, 0.2)))
+        index.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir, ignore_errors=True)
+
+    def query(self, raDecList=None, filterName=None, **cutDict):
+        index = CalexpIndex(self.indexPath)
+        try:
+            coordList = None if raDecList is None else makeCoordList(raDecList)
+            resultList = index.query(SqliteExposureInfo.getColumnNames(), coordList=coordList,
+                filterName=filterName, **cutDict)
+        finally:
+            index.close()
+        return [SqliteExposureInfo(result) for result in resultList]
+
+    def testQuery(self):
+        """Test selection by region and filter, including across RA = 0"""
+        self.assertEqual(len(self.query()), 3)
+        self.assertEqual(len(self.query(filterName="r")), 2)
+
+        expInfoList = self.query(makeBoxRaDecList(0.1, 0.5, 0.1, 0.3))
+        self.assertEqual([expInfo.dataId for expInfo in expInfoList], [dict(visit=1, ccd=1)])
+        self.assertEqual(expInfoList[0].filterName, "r")
+        self.assertAlmostEqual(expInfoList[0].fwhm, 0.9)
+        self.assertAlmostEqual(expInfoList[0].expectedWeight, 250.0)
+        self.assertAlmostEqual(expInfoList[0].coordList[0].getRa().asDegrees(), 359.9)
+
+        expInfoList = self.query(makeBoxRaDecList(359.0, 359.95, 0.1, 0.3))
+        self.assertEqual([expInfo.dataId["ccd"] for expInfo in expInfoList], [0, 1])
+
+        self.assertEqual(len(self.query(makeBoxRaDecList(180.1, 180.2, 0.1, 0.15), filterName="r")), 0)
+        expInfoList = self.query(makeBoxRaDecList(180.1, 180.2, 0.1, 0.15), filterName="i")
+        self.assertEqual(len(expInfoList), 1)
+        self.assertTrue(expInfoList[0].fwhm is None)
+        self.assertTrue(expInfoList[0].expectedWeight is None)
+
+    def testQualityCuts(self):
+        """Test that quality cuts are applied in the query and reject calexps with unknown values"""
+        def getDataIdList(**cutDict):
+            return [expInfo.dataId for expInfo in self.query(**cutDict)]
+        self.assertEqual(getDataIdList(maxFwhm=0.8), [dict(visit=1, ccd=0)])
+        self.assertEqual(getDataIdList(minFwhm=0.8), [dict(visit=1, ccd=1)])
+        self.assertEqual(getDataIdList(minFwhm=0.5, maxFwhm=1.0),
+            [dict(visit=1, ccd=0), dict(visit=1, ccd=1)])
+        self.assertEqual(getDataIdList(minFluxMag0=75.0), [dict(visit=1, ccd=0)])
+        self.assertEqual(len(getDataIdList(maxSkyLevel=10.0)), 2)
+        self.assertEqual(len(getDataIdList(maxSkyLevel=9.0)), 0)
+
+        index = CalexpIndex(self.indexPath)
+        try:
+            table = makeSqliteExposureInfoTable(index.query(SqliteExposureInfo.getColumnNames()))
+        finally:
+            index.close()
+        self.assertEqual([row.expectedWeight for row in table][0:2], [1000.0, 250.0])
+        self.assertTrue(table[2].expectedWeight != table[2].expectedWeight) # NaN
+        self.assertAlmostEqual(table[1].coordList[0].getRa().asDegrees(), 359.9)
+
+    def testMixedDataIdKeys(self):
+        """Test that a table is not made from calexps whose data IDs have different keys"""
+        index = CalexpIndex(self.indexPath)
+        try:
+            index.addExposure(dict(visit=3, ccd=0, raft="1,1"), "r", 3, 0.8,
+                makeCoordList(makeBoxRaDecList(10.0, 10.3, 0.0, 0.2)))
+            resultList = index.query(SqliteExposureInfo.getColumnNames())
+        finally:
+            index.close()
+        self.assertRaises(RuntimeError, makeSqliteExposureInfoTable, resultList)
+        self.assertEqual(len(makeSqliteExposureInfoTable(resultList[0:3])), 3)
+
+    def testUpgrade(self):
+        """Test that an index with schema version 1 is upgraded only if create is True"""
+        conn = sqlite3.connect(self.indexPath)
+        conn.executescript("""
+            CREATE TABLE calexp_old (
+                id INTEGER PRIMARY KEY,
+                dataId TEXT UNIQUE NOT NULL,
+                filter TEXT,
+                visit INTEGER,
+                fwhm REAL,
+                ra1 REAL, dec1 REAL, ra2 REAL, dec2 REAL, ra3 REAL, dec3 REAL, ra4 REAL, dec4 REAL
+            );
+            INSERT INTO calexp_old SELECT id, dataId, filter, visit, fwhm,
+                ra1, dec1, ra2, dec2, ra3, dec3, ra4, dec4 FROM calexp;
+            DROP TABLE calexp;
+            ALTER TABLE calexp_old RENAME TO calexp;
+            PRAGMA user_version = 1;
+        """)
+        conn.close()
+        self.assertRaises(RuntimeError, CalexpIndex, self.indexPath)
+        index = CalexpIndex(self.indexPath, create=True)
+        index.addExposure(dict(visit=3, ccd=0), "r", 3, 0.8,
+            makeCoordList(makeBoxRaDecList(10.0, 10.3, 0.0, 0.2)), fluxMag0=20.0, skyLevel=4.0)
+        index.close()
+        expInfoList = self.query()
+        self.assertEqual(len(expInfoList), 4)
+        self.assertTrue(expInfoList[0].fluxMag0 is None)
+        self.assertAlmostEqual(expInfoList[3].expectedWeight, 100.0)
+        self.assertAlmostEqual(expInfoList[3].coordList[2].getRa().asDegrees(), 10.3)
+
+    def testReplace(self):
+        """Test that adding a calexp that is already indexed replaces it"""
+        index = CalexpIndex(self.indexPath)
+        self.assertTrue(index.hasExposure(dict(ccd=0, visit=2)))
+        index.addExposure(dict(visit=2, ccd=0), "i", 2, 0.9,
+            makeCoordList(makeBoxRaDecList(90.0, 90.3, 0.0, 0.2)))
+        index.close()
+        self.assertEqual(len(self.query()), 3)
+        self.assertEqual(len(self.query(makeBoxRaDecList(180.1, 180.2, 0.1, 0.15))), 0)
+        self.assertEqual(len(self.query(makeBoxRaDecList(90.1, 90.2, 0.1, 0.15))), 1)
+
+    def testNotAnIndex(self):
+        """Test that opening a missing index without create fails"""
+        self.assertRaises(RuntimeError, CalexpIndex, os.path.join(self.tempDir, "missing.sqlite3"))
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(RaDecBoxTestCase)
+    suites += unittest.makeSuite(CalexpIndexTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
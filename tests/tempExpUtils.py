@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import unittest
+import numpy
+import lsst.utils.tests as utilsTests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+from lsst.pipe.tasks.tempExpUtils import cropTempExp, expandTempExp, getTempExpCropBBox, readTempExp
+
+class FakeTempExpRef(object):
+    """Data reference for an in-memory coaddTempExp that records the dataset types it reads"""
+    def __init__(self, exposure):
+        self.exposure = exposure
+        self.getNameList = []
+
+    def get(self, datasetType, bbox=None, imageOrigin="PARENT", immediate=True):
+        self.getNameList.append(datasetType)
+        if datasetType.endswith("_md"):
+            return self.exposure.getMetadata()
+        if datasetType.endswith("_sub"):
+            return self.exposure.Factory(self.exposure, bbox, afwImage.PARENT, True)
+        return self.exposure
+
+class TempExpTestCaseBase(unittest.TestCase):
+    """Base class for tests of a coaddTempExp with data in part of its patch"""
+
+    def setUp(self):
+        self.patchBBox = afwGeom.Box2I(afwGeom.Point2I(1000, 2000), afwGeom.Extent2I(100, 80))
+        self.exposure = afwImage.ExposureF(self.patchBBox)
+        maskedImage = self.exposure.getMaskedImage()
+        maskedImage.set(numpy.nan, afwImage.MaskU.getPlaneBitMask("EDGE"), numpy.inf)
+        self.dataBBox = afwGeom.Box2I(afwGeom.Point2I(1010, 2030), afwGeom.Extent2I(25, 40))
+        dataView = afwImage.MaskedImageF(maskedImage, self.dataBBox, afwImage.PARENT, False)
+        dataView.set(5.0, 0, 1.0)
+        del dataView
+
+    def tearDown(self):
+        del self.exposure
+
+    def assertMaskedImagesEqual(self, mi1, mi2):
+        self.assertEqual(mi1.getBBox(afwImage.PARENT), mi2.getBBox(afwImage.PARENT))
+        for getPlane in (lambda mi: mi.getImage(), lambda mi: mi.getMask(), lambda mi: mi.getVariance()):
+            arr1, arr2 = getPlane(mi1).getArray(), getPlane(mi2).getArray()
+            self.assertTrue(numpy.all((arr1 == arr2) | (numpy.isnan(arr1) & numpy.isnan(arr2))))
+
+class TempExpUtilsTestCase(TempExpTestCaseBase):
+    """Test cropping and expanding coaddTempExp"""
+
+    def testCropAndExpand(self):
+        """Test that expanding a cropped coaddTempExp restores the original"""
+        croppedExposure = cropTempExp(self.exposure)
+        self.assertEqual(croppedExposure.getMaskedImage().getBBox(afwImage.PARENT), self.dataBBox)
+        expandedExposure = expandTempExp(croppedExposure)
+        self.assertMaskedImagesEqual(expandedExposure.getMaskedImage(), self.exposure.getMaskedImage())
+
+    def testExpandRegion(self):
+        """Test expanding a cropped coaddTempExp to a region that partly lacks data"""
+        croppedExposure = cropTempExp(self.exposure)
+        bbox = afwGeom.Box2I(afwGeom.Point2I(1000, 2000), afwGeom.Extent2I(20, 50))
+        expandedExposure = expandTempExp(croppedExposure, bbox=bbox)
+        origView = afwImage.MaskedImageF(self.exposure.getMaskedImage(), bbox, afwImage.PARENT, False)
+        self.assertMaskedImagesEqual(expandedExposure.getMaskedImage(), origView)
+
+    def testNotCropped(self):
+        """Test that an uncropped coaddTempExp is returned unchanged"""
+        self.assertTrue(expandTempExp(self.exposure) is self.exposure)
+
+class ReadTempExpTestCase(TempExpTestCaseBase):
+    """Test reading regions of coaddTempExp"""
+
+    def getRegionView(self, bbox):
+        return afwImage.MaskedImageF(self.exposure.getMaskedImage(), bbox, afwImage.PARENT, False)
+
+    def testCropBBox(self):
+        """Test that a precomputed crop bbox saves reading the metadata for each region"""
+        tempExpRef = FakeTempExpRef(cropTempExp(self.exposure))
+        cropBBox = getTempExpCropBBox(tempExpRef, "deepCoadd_tempExp")
+        self.assertEqual(cropBBox, self.dataBBox)
+        self.assertEqual(tempExpRef.getNameList, ["deepCoadd_tempExp_md"])
+        del tempExpRef.getNameList[:]
+        for bbox in (
+            afwGeom.Box2I(afwGeom.Point2I(1000, 2000), afwGeom.Extent2I(20, 50)), # partly lacks data
+            afwGeom.Box2I(afwGeom.Point2I(1050, 2000), afwGeom.Extent2I(20, 20)), # has no data
+        ):
+            exposure = readTempExp(tempExpRef, "deepCoadd_tempExp", bbox=bbox, cropBBox=cropBBox,
+                checkCrop=False)
+            self.assertMaskedImagesEqual(exposure.getMaskedImage(), self.getRegionView(bbox))
+        self.assertEqual(tempExpRef.getNameList, ["deepCoadd_tempExp_sub"] * 2)
+
+        # without a crop bbox the metadata is read for each region
+        del tempExpRef.getNameList[:]
+        bbox = afwGeom.Box2I(afwGeom.Point2I(1000, 2000), afwGeom.Extent2I(20, 50))
+        exposure = readTempExp(tempExpRef, "deepCoadd_tempExp", bbox=bbox)
+        self.assertMaskedImagesEqual(exposure.getMaskedImage(), self.getRegionView(bbox))
+        self.assertEqual(tempExpRef.getNameList, ["deepCoadd_tempExp_md", "deepCoadd_tempExp_sub"])
+
+    def testNoCheckCrop(self):
+        """Test that an uncropped coaddTempExp is read without reading its metadata if checkCrop is False"""
+        tempExpRef = FakeTempExpRef(self.exposure)
+        self.assertTrue(getTempExpCropBBox(tempExpRef, "deepCoadd_tempExp") is None)
+        del tempExpRef.getNameList[:]
+        bbox = afwGeom.Box2I(afwGeom.Point2I(1005, 2025), afwGeom.Extent2I(30, 30))
+        exposure = readTempExp(tempExpRef, "deepCoadd_tempExp", bbox=bbox, checkCrop=False)
+        self.assertMaskedImagesEqual(exposure.getMaskedImage(), self.getRegionView(bbox))
+        self.assertEqual(tempExpRef.getNameList, ["deepCoadd_tempExp_sub"])
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(TempExpUtilsTestCase)
+    suites += unittest.makeSuite(ReadTempExpTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+import lsst.utils.tests as utilsTests
+import lsst.afw.detection as afwDetection
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+from lsst.pipe.tasks.warpAndPsfMatch import WarpAndPsfMatchTask
+
+class SpatialKernelPsf(object):
+    """A minimal PSF model whose kernel is a spatially varying sum of two Gaussians"""
+    def __init__(self, spatialParameters):
+        basisList = afwMath.KernelList()
+        for sigma in (1.5, 2.5):
+            basisList.append(afwMath.AnalyticKernel(21, 21, afwMath.GaussianFunction2D(sigma, sigma)))
+        self.kernel = afwMath.LinearCombinationKernel(basisList, afwMath.PolynomialFunction2D(1))
+        self.kernel.setSpatialParameters(spatialParameters)
+
+    def getKernel(self):
+        return self.kernel
+
+    def computeImage(self, pos):
+        image = afwImage.ImageD(self.kernel.getDimensions())
+        self.kernel.computeImage(image, True, pos[0], pos[1])
+        return image
+
+def makeExposure():
+    """Make an exposure containing a few stars and noise, with a double Gaussian PSF"""
+    exposure = afwImage.ExposureF(120, 100)
+    maskedImage = exposure.getMaskedImage()
+    imageArr = maskedImage.getImage().getArray()
+    numpy.random.seed(0)
+    imageArr[:,:] = numpy.random.normal(0.0, 1.0, imageArr.shape)
+    yArr, xArr = numpy.mgrid[0:imageArr.shape[0], 0:imageArr.shape[1]]
+    for xPos, yPos, flux in ((30.0, 40.0, 1000.0), (80.5, 60.2, 3000.0), (60.0, 20.0, 500.0)):
+        rSqArr = (xArr - xPos)**2 + (yArr - yPos)**2
+        imageArr += flux * numpy.exp(-rSqArr / (2.0 * 2.0**2)) / (2.0 * numpy.pi * 2.0**2)
+    maskedImage.getVariance().getArray()[:,:] = 1.0
+    exposure.setPsf(afwDetection.createPsf("DoubleGaussian", 21, 21, 2.0, 5.0, 0.1))
+    return exposure
+
+class KernelKeyTestCase(unittest.TestCase):
+    """Test the key of the PSF-matching kernel cache"""
+
+    def setUp(self):
+        self.task = WarpAndPsfMatchTask()
+        self.modelPsf = self.task.getModelPsf(fwhmPixels=8.0, kernelDim=(21, 21))
+        self.dataId = dict(visit=1, ccd=2)
+
+    def tearDown(self):
+        del self.task
+        del self.modelPsf
+
+    def makeKey(self, psf, width=101):
+        exposure = afwImage.ExposureF(width, 80)
+        exposure.setPsf(psf)
+        return self.task._makeKernelKey(exposure, self.modelPsf, self.dataId)
+
+    def testSpatialVariation(self):
+        """PSF models that are identical at the center but vary differently across the exposure differ"""
+        uniformParameters = [[1.0, 0.0, 0.0], [0.0, 0.0, 0.0]]
+        # the second basis kernel has coefficient 0 at the center (x = 50) but not elsewhere
+        varyingParameters = [[1.0, 0.0, 0.0], [-0.05, 0.001, 0.0]]
+        key = self.makeKey(SpatialKernelPsf(uniformParameters))
+        self.assertEqual(self.makeKey(SpatialKernelPsf(uniformParameters)), key)
+        self.assertNotEqual(self.makeKey(SpatialKernelPsf(varyingParameters)), key)
+        self.assertNotEqual(self.makeKey(SpatialKernelPsf(uniformParameters), width=103), key)
+
+class KernelCacheTestCase(unittest.TestCase):
+    """Test that PSF-matching with a cached kernel gives the same result as a fresh fit"""
+
+    def testCacheHit(self):
+        config = WarpAndPsfMatchTask.ConfigClass()
+        config.kernelCacheSize = 5
+        task = WarpAndPsfMatchTask(config=config)
+        exposure = makeExposure()
+        modelPsf = task.getModelPsf(fwhmPixels=8.0, kernelDim=exposure.getPsf().getKernel().getDimensions())
+        dataId = dict(visit=12345, ccd=1)
+
+        freshExposure = task.psfMatch.run(afwImage.ExposureF(exposure, True), modelPsf).psfMatchedExposure
+        task.psfMatchExposure(afwImage.ExposureF(exposure, True), modelPsf, dataId=dataId)
+        def failRun(*args, **kwargs):
+            self.fail("PSF-matching kernel was fit again instead of reused")
+        task.psfMatch.run = failRun
+        cachedExposure = task.psfMatchExposure(afwImage.ExposureF(exposure, True), modelPsf, dataId=dataId)
+        del task.psfMatch.run
+
+        # ignore a border that is affected by the edges of the image
+        border = 21
+        freshMI = freshExposure.getMaskedImage()
+        cachedMI = cachedExposure.getMaskedImage()
+        for getPlane in ("getImage", "getVariance"):
+            freshArr = getattr(freshMI, getPlane)().getArray()[border:-border, border:-border]
+            cachedArr = getattr(cachedMI, getPlane)().getArray()[border:-border, border:-border]
+            self.assertTrue(numpy.allclose(cachedArr, freshArr, rtol=1.0e-5, atol=1.0e-5))
+
+class FakeBackgroundDataRef(object):
+    """Data reference for calexpBackground, and for calexpBackgroundCompact if the mapper knows it"""
+    def __init__(self, dirPath, isKnown):
+        self.dataId = dict(visit=1, ccd=2)
+        self.dirPath = dirPath
+        self.isKnown = isKnown
+        self.background = afwImage.ImageF(100, 80)
+        self.background.set(3.5)
+        self.datasetDict = dict()
+
+    def _checkKnown(self, datasetType):
+        if datasetType == "calexpBackgroundCompact" and not self.isKnown:
+            raise RuntimeError("Unknown dataset type %s" % (datasetType,))
+
+    def datasetExists(self, datasetType):
+        self._checkKnown(datasetType)
+        return datasetType in self.datasetDict
+
+    def get(self, datasetType, immediate=False):
+        if datasetType == "calexpBackground_filename":
+            return [os.path.join(self.dirPath, "calexpBackground")]
+        if datasetType == "calexpBackground":
+            return self.background
+        self._checkKnown(datasetType)
+        return self.datasetDict[datasetType]
+
+    def put(self, dataset, datasetType):
+        self._checkKnown(datasetType)
+        self.datasetDict[datasetType] = dataset
+
+class CompactBackgroundTestCase(unittest.TestCase):
+    """Test WarpAndPsfMatchTask.getCompactBackground"""
+
+    def setUp(self):
+        self.dirPath = tempfile.mkdtemp()
+        with open(os.path.join(self.dirPath, "calexpBackground"), "w") as outFile:
+            outFile.write("data")
+        config = WarpAndPsfMatchTask.ConfigClass()
+        config.compactBackgroundBinSize = 32
+        config.doWriteCompactBackground = True
+        self.task = WarpAndPsfMatchTask(config=config)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirPath)
+        del self.task
+
+    def testPersist(self):
+        dataRef = FakeBackgroundDataRef(self.dirPath, isKnown=True)
+        background = self.task.getCompactBackground(dataRef)
+        self.assertTrue(dataRef.datasetDict["calexpBackgroundCompact"] is background)
+        self.assertTrue(self.task.getCompactBackground(dataRef) is background)
+
+    def testUnknownDatasetType(self):
+        """If the mapper does not know calexpBackgroundCompact then the model is computed each time"""
+        dataRef = FakeBackgroundDataRef(self.dirPath, isKnown=False)
+        background = self.task.getCompactBackground(dataRef)
+        self.assertEqual(background.binSize, 32)
+        valueArr = background.evaluate(numpy.array([10.0, 50.0]), numpy.array([20.0, 60.0]))
+        self.assertTrue(numpy.allclose(valueArr, 3.5))
+        self.assertEqual(dataRef.datasetDict, dict())
+
+class CountingDataRef(object):
+    """Data reference that makes a new 100x100 ImageF (40000 bytes) for each get, and counts the gets"""
+    def __init__(self, visit):
+        self.dataId = dict(visit=visit, ccd=1)
+        self.numGets = 0
+
+    def get(self, datasetType, immediate=False, **kwargs):
+        self.numGets += 1
+        return afwImage.ImageF(100, 100)
+
+class ReadCacheTestCase(unittest.TestCase):
+    """Test WarpAndPsfMatchTask.readDataset and the shared read cache"""
+
+    def makeTask(self, readCacheSizeMB):
+        config = WarpAndPsfMatchTask.ConfigClass()
+        config.readCacheSizeMB = readCacheSizeMB
+        return WarpAndPsfMatchTask(config=config)
+
+    def testCache(self):
+        task = self.makeTask(readCacheSizeMB=1)
+        dataRef = CountingDataRef(visit=1001)
+        expMetrics = task.makeExposureMetrics(dataRef.dataId)
+        image = task.readDataset(dataRef, "calexpBackground", expMetrics=expMetrics)
+        self.assertEqual(expMetrics.get("BytesRead"), 40000)
+        self.assertTrue(task.readDataset(dataRef, "calexpBackground", expMetrics=expMetrics) is image)
+        self.assertEqual(dataRef.numGets, 1)
+        self.assertEqual(expMetrics.get("BytesRead"), 40000)
+
+        # the key includes the dataset type and the arguments for get
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(10, 10))
+        task.readDataset(dataRef, "calexpBackground_sub", bbox=bbox, imageOrigin="PARENT")
+        task.readDataset(dataRef, "calexpBackground_sub", bbox=bbox, imageOrigin="PARENT")
+        self.assertEqual(dataRef.numGets, 2)
+
+        # the cache is shared by all tasks in this process with the same cache size
+        otherTask = self.makeTask(readCacheSizeMB=1)
+        self.assertTrue(otherTask.readDataset(dataRef, "calexpBackground") is image)
+        self.assertEqual(dataRef.numGets, 2)
+
+    def testEviction(self):
+        """The least recently used datasets are discarded to stay within readCacheSizeMB"""
+        task = self.makeTask(readCacheSizeMB=1)
+        dataRefList = [CountingDataRef(visit=2000 + i) for i in range(30)]
+        for dataRef in dataRefList:
+            task.readDataset(dataRef, "calexpBackground")
+        task.readDataset(dataRefList[0], "calexpBackground")
+        task.readDataset(dataRefList[-1], "calexpBackground")
+        self.assertEqual(dataRefList[0].numGets, 2)
+        self.assertEqual(dataRefList[-1].numGets, 1)
+
+    def testNoCache(self):
+        task = self.makeTask(readCacheSizeMB=0)
+        dataRef = CountingDataRef(visit=3001)
+        task.readDataset(dataRef, "calexpBackground")
+        task.readDataset(dataRef, "calexpBackground")
+        self.assertEqual(dataRef.numGets, 2)
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+
+    utilsTests.init()
+
+    suites = []
+    suites += unittest.makeSuite(KernelKeyTestCase)
+    suites += unittest.makeSuite(KernelCacheTestCase)
+    suites += unittest.makeSuite(CompactBackgroundTestCase)
+    suites += unittest.makeSuite(ReadCacheTestCase)
+    suites += unittest.makeSuite(utilsTests.MemoryTestCase)
+    return unittest.TestSuite(suites)
+
+def run(shouldExit = False):
+    """Run the tests"""
+
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)